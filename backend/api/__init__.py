@@ -1,11 +1,19 @@
-from .track import router as track_router
+from .track import router as track_router, PixelEndpoint
 from .stats import router as stats_router
 from .websocket import router as websocket_router, manager, broadcast_realtime_stats
+from .metrics import router as metrics_router, MetricsMiddleware
+from .admin import router as admin_router
+from .export import router as export_router
 
 __all__ = [
     "track_router",
+    "PixelEndpoint",
     "stats_router",
     "websocket_router",
     "manager",
-    "broadcast_realtime_stats"
+    "broadcast_realtime_stats",
+    "metrics_router",
+    "MetricsMiddleware",
+    "admin_router",
+    "export_router"
 ]
@@ -0,0 +1,42 @@
+import hmac
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from typing import Optional
+from config.settings import settings
+from backend.models import sql_profiler
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """要求请求头 X-Admin-Token 与 ADMIN_TOKEN 匹配；没有配置 ADMIN_TOKEN 时一律拒绝"""
+    if not settings.ADMIN_TOKEN or x_admin_token is None or not hmac.compare_digest(
+        x_admin_token.encode("utf-8"), settings.ADMIN_TOKEN.encode("utf-8")
+    ):
+        raise HTTPException(status_code=403, detail="forbidden")
+
+router = APIRouter(prefix="/api/admin", tags=["admin"], dependencies=[Depends(require_admin)])
+
+@router.get("/queries")
+async def get_query_profile(
+    limit: int = Query(20, ge=1, le=200, description="返回数量"),
+    order_by: str = Query("total", pattern="^(total|max|avg|calls)$", description="排序字段")
+):
+    """按语句指纹汇总的 SQL 耗时、最慢查询排行和慢查询日志"""
+    return sql_profiler.snapshot(limit=limit, order_by=order_by)
+
+@router.post("/queries/config")
+async def configure_query_profile(
+    enabled: Optional[bool] = Query(None, description="是否开启 SQL 分析"),
+    slow_threshold_ms: Optional[float] = Query(None, ge=0, description="慢查询阈值（毫秒）"),
+    explain_threshold_ms: Optional[float] = Query(None, ge=0, description="超过该耗时的查询采集 EXPLAIN"),
+    disable_explain: bool = Query(False, description="关闭 EXPLAIN 采集")
+):
+    sql_profiler.configure(
+        enabled=enabled,
+        slow_threshold_ms=slow_threshold_ms,
+        explain_threshold_ms=explain_threshold_ms,
+        disable_explain=disable_explain
+    )
+    return sql_profiler.snapshot(limit=0)
+
+@router.delete("/queries")
+async def reset_query_profile():
+    sql_profiler.reset()
+    return {"status": "success"}
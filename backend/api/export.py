@@ -0,0 +1,85 @@
+from datetime import datetime
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from typing import Optional
+from config.settings import settings, SITE_ID_PATTERN
+from backend.api.admin import require_admin
+from backend.services.export_service import (
+    export_service, ExportError, ExportUnsupported, EXPORT_FORMATS, EXPORT_TABLES
+)
+
+# 导出包含原始 IP 和 UA：与管理接口相同，没有配置 ADMIN_TOKEN 时拒绝所有请求
+router = APIRouter(prefix="/api/export", tags=["export"], dependencies=[Depends(require_admin)])
+
+# Accept 头中的媒体类型到导出格式
+ACCEPT_FORMATS = {
+    "text/csv": "csv",
+    "application/x-ndjson": "ndjson",
+    "application/ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+    "application/vnd.apache.parquet": "parquet",
+    "application/parquet": "parquet",
+    "*/*": "csv",
+    "text/*": "csv",
+    "application/*": "ndjson",
+}
+
+def negotiate_format(accept: Optional[str]) -> Optional[str]:
+    """按 q 值从高到低选第一个支持的格式；没有 Accept 头时默认 CSV"""
+    if not accept:
+        return "csv"
+    candidates = []
+    for position, part in enumerate(accept.split(",")):
+        media_type, *params = [p.strip() for p in part.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            candidates.append((-q, position, media_type.lower()))
+    for _, _, media_type in sorted(candidates):
+        fmt = ACCEPT_FORMATS.get(media_type)
+        if fmt == "parquet" and not export_service.parquet_available():
+            continue
+        if fmt:
+            return fmt
+    return None
+
+@router.get("/{table}")
+async def export_table(
+    request: Request,
+    table: str,
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson|parquet)$", description="导出格式，优先于 Accept 头"),
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID"),
+    start: Optional[datetime] = Query(None, description="开始时间（含）"),
+    end: Optional[datetime] = Query(None, description="结束时间（不含）"),
+    url: Optional[str] = Query(None, description="page_url 前缀"),
+    event_type: Optional[str] = Query(None, description="事件类型（仅 events）"),
+    stat_type: Optional[str] = Query(None, description="汇总类型（仅 aggregated_stats）"),
+    limit: Optional[int] = Query(None, ge=1, description="最多导出的行数")
+):
+    """流式导出原始数据或汇总表，支持 CSV、NDJSON 和 Parquet（需安装 pyarrow）"""
+    if table not in EXPORT_TABLES:
+        raise HTTPException(status_code=404, detail=f"unknown table: {table}")
+    fmt = format or negotiate_format(request.headers.get("accept"))
+    if fmt is None:
+        raise HTTPException(status_code=406, detail=f"supported formats: {', '.join(EXPORT_FORMATS)}")
+    if fmt == "parquet" and not export_service.parquet_available():
+        raise HTTPException(status_code=501, detail="Parquet 导出需要安装 pyarrow")
+    try:
+        query = export_service.build_query(table, site_id, start, end, url, event_type, stat_type, limit)
+        body = export_service.stream(fmt, query)
+    except ExportUnsupported as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    except ExportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    filename = f"{site_id}-{table}-{datetime.now().strftime('%Y%m%d%H%M%S')}.{fmt}"
+    return StreamingResponse(
+        body,
+        media_type=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
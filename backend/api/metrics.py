@@ -0,0 +1,50 @@
+import time
+from fastapi import APIRouter
+from fastapi.responses import Response
+from backend.utils.metrics import REGISTRY, CONTENT_TYPE, HTTP_REQUEST_SECONDS
+
+router = APIRouter(tags=["metrics"])
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
+
+class MetricsMiddleware:
+    """记录每个路由的请求耗时。纯 ASGI 实现，避免 BaseHTTPMiddleware 的额外开销"""
+
+    def __init__(self, app):
+        self.app = app
+        self._children = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self._observe(scope, status[0], time.perf_counter() - started)
+
+    def _observe(self, scope, status, elapsed):
+        # 使用路由模板而不是原始路径作为标签，避免标签基数随 URL 膨胀
+        route = scope.get("route")
+        if route is not None:
+            path = getattr(route, "path", "other")
+        elif scope["path"].startswith("/static/"):
+            path = "/static"
+        else:
+            path = "other"
+        key = (scope["method"], path, status)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = HTTP_REQUEST_SECONDS.labels(scope["method"], path, status)
+        child.observe(elapsed)
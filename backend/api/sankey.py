@@ -1,101 +1,19 @@
-from fastapi import APIRouter, Query
-from backend.services.tracking_service import tracking_service
-from backend.models import PageView
-from sqlalchemy.orm import Session as DBSession
-from collections import defaultdict
-import re
+from fastapi import APIRouter, Query, Response
+from config.settings import settings, SITE_ID_PATTERN
+from backend.services.flow_service import flow_service
+from backend.services.workload import workload_manager, WorkloadRejected
 
 router = APIRouter(prefix="/api/stats", tags=["sankey"])
 
 @router.get("/page-flow")
-async def get_page_flow(days: int = Query(7, description="查询天数")):
+async def get_page_flow(
+    response: Response,
+    days: int = Query(7, description="查询天数"),
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID")
+):
     try:
-        sessions = tracking_service.get_sessions_by_days(days)
-        
-        session_flows = defaultdict(list)
-        entry_pages = defaultdict(int)
-        
-        for session in sessions:
-            pageviews = tracking_service.get_session_pageviews(session['session_id'])
-            
-            pageviews = [pv for pv in pageviews if not should_exclude_url(pv.get('page_url', ''))]
-            
-            sorted_pvs = sorted(pageviews, key=lambda x: x.get('created_at', 0))
-            
-            max_hops = min(3, len(sorted_pvs) - 1)
-            for i in range(max_hops + 1):
-                sorted_pvs[i]['normalized_url'] = normalize_page_url(sorted_pvs[i].get('page_url', ''))
-            
-            if len(sorted_pvs) > 0:
-                first_page = sorted_pvs[0]['normalized_url']
-                entry_pages[first_page] += 1
-            
-            for i in range(max_hops):
-                current_page = sorted_pvs[i]['normalized_url']
-                next_page = sorted_pvs[i+1]['normalized_url']
-                
-                if current_page and next_page and current_page != next_page:
-                    session_flows[(current_page, next_page)].append(session['session_id'])
-        
-        nodes = set()
-        links = []
-        
-        for (source, target), session_ids in session_flows.items():
-            nodes.add(source)
-            nodes.add(target)
-            links.append({
-                'source': source,
-                'target': target,
-                'value': len(session_ids)
-            })
-        
-        nodes_list = [{'name': node} for node in sorted(nodes)]
-        
-        return {
-            'nodes': nodes_list,
-            'links': links,
-            'entry_pages': dict(entry_pages)
-        }
+        return await workload_manager.run("heavy", flow_service.get_page_flow, days, site_id, response=response)
+    except WorkloadRejected:
+        raise
     except Exception as e:
         return {'nodes': [], 'links': [], 'entry_pages': {}}
-
-def should_exclude_url(url):
-    if not url:
-        return False
-    return 'localhost:5500' in url or '/dashboard' in url
-
-def normalize_page_url(url):
-    if not url:
-        return '未知'
-    
-    try:
-        from urllib.parse import urlparse
-        parsed = urlparse(url)
-        path = parsed.path
-        
-        path = re.sub(r'/\d+$', '/:id', path)
-        path = re.sub(r'/\d+/', '/:id/', path)
-        
-        if path == '/' or not path:
-            return '首页'
-        
-        parts = path.strip('/').split('/')
-        
-        if len(parts) == 1:
-            if parts[0] == 'login':
-                return '登录页'
-            elif parts[0] == 'register':
-                return '注册页'
-            elif parts[0] == 'search':
-                return '搜索页'
-            elif parts[0] == 'wifi-model':
-                return 'WiFi模型详情'
-            elif parts[0] == 'submit':
-                return '提交页'
-            else:
-                return parts[0]
-        else:
-            return ' > '.join(parts[:3])
-            
-    except Exception:
-        return '未知'
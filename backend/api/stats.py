@@ -1,66 +1,197 @@
-from fastapi import APIRouter, Query
-from typing import Optional
+from fastapi import APIRouter, HTTPException, Query, Response
+from datetime import datetime
+from typing import List, Optional
+from config.settings import settings, SITE_ID_PATTERN
 from backend.services.stats_service import stats_service
+from backend.services.funnel_service import funnel_service
+from backend.services.retention_service import retention_service
+from backend.services.event_property_service import event_property_service
+from backend.services.geo_service import geo_service
+from backend.services.duration_service import duration_service
+from backend.services.path_service import path_service
+from backend.services.workload import workload_manager
 
 router = APIRouter(prefix="/api/stats", tags=["stats"])
 
+@router.get("/sites")
+async def get_site_overview(
+    response: Response,
+    days: int = Query(7, ge=1, le=90, description="天数范围")
+):
+    """各站点汇总，来自定时写入的每日汇总表"""
+    return await workload_manager.run("light", stats_service.get_site_overview, days, response=response)
+
+@router.get("/dashboard")
+async def get_dashboard_snapshot(
+    response: Response,
+    days: int = Query(7, ge=1, le=30, description="天数范围"),
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID")
+):
+    return await workload_manager.run("heavy", stats_service.get_dashboard_snapshot, days, site_id, response=response)
+
 @router.get("/realtime")
-async def get_realtime_stats():
-    return stats_service.get_realtime_stats()
+async def get_realtime_stats(
+    response: Response,
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID")
+):
+    return await workload_manager.run("light", stats_service.get_realtime_stats, site_id, response=response)
 
 @router.get("/page-views/trend")
 async def get_page_views_trend(
-    days: int = Query(7, ge=1, le=30, description="天数范围")
+    response: Response,
+    days: int = Query(7, ge=1, le=30, description="天数范围"),
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID")
 ):
-    return stats_service.get_page_views_trend(days)
+    return await workload_manager.run("heavy", stats_service.get_page_views_trend, days, site_id, response=response)
 
 @router.get("/visitors/trend")
 async def get_unique_visitors_trend(
-    days: int = Query(7, ge=1, le=30, description="天数范围")
+    response: Response,
+    days: int = Query(7, ge=1, le=30, description="天数范围"),
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID")
 ):
-    return stats_service.get_unique_visitors_trend(days)
+    return await workload_manager.run("heavy", stats_service.get_unique_visitors_trend, days, site_id, response=response)
 
 @router.get("/hourly")
 async def get_hourly_distribution(
-    days: int = Query(1, ge=1, le=30, description="天数范围")
+    response: Response,
+    days: int = Query(1, ge=1, le=30, description="天数范围"),
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID")
 ):
-    return stats_service.get_hourly_distribution(days)
+    return await workload_manager.run("heavy", stats_service.get_hourly_distribution, days, site_id, response=response)
 
 @router.get("/top-pages")
 async def get_top_pages(
-    limit: int = Query(10, ge=1, le=50, description="返回数量")
+    response: Response,
+    limit: int = Query(10, ge=1, le=50, description="返回数量"),
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID")
 ):
-    return stats_service.get_top_pages(limit)
+    return await workload_manager.run("heavy", stats_service.get_top_pages, limit, site_id, response=response)
 
 @router.get("/referrers")
 async def get_referrers(
-    limit: int = Query(10, ge=1, le=50, description="返回数量")
+    response: Response,
+    limit: int = Query(10, ge=1, le=50, description="返回数量"),
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID")
 ):
-    return stats_service.get_referrers(limit)
+    return await workload_manager.run("heavy", stats_service.get_referrers, limit, site_id, response=response)
 
 @router.get("/devices")
-async def get_device_stats():
-    return stats_service.get_device_stats()
+async def get_device_stats(
+    response: Response,
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID")
+):
+    return await workload_manager.run("heavy", stats_service.get_device_stats, site_id, response=response)
 
 @router.get("/browsers")
-async def get_browser_stats():
-    return stats_service.get_browser_stats()
+async def get_browser_stats(
+    response: Response,
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID")
+):
+    return await workload_manager.run("heavy", stats_service.get_browser_stats, site_id, response=response)
 
 @router.get("/events")
 async def get_event_stats(
+    response: Response,
     event_type: Optional[str] = Query(None, description="事件类型筛选"),
-    days: int = Query(7, ge=1, le=30, description="天数范围")
+    days: int = Query(7, ge=1, le=30, description="天数范围"),
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID")
 ):
-    return stats_service.get_event_stats(event_type, days)
+    return await workload_manager.run("heavy", stats_service.get_event_stats, event_type, days, site_id, response=response)
+
+@router.get("/events/breakdown")
+async def get_event_breakdown(
+    response: Response,
+    property: str = Query(..., min_length=1, max_length=64, description="属性键"),
+    event_name: Optional[str] = Query(None, description="事件名筛选"),
+    days: int = Query(7, ge=1, le=90, description="天数范围"),
+    limit: int = Query(20, ge=1, le=200, description="返回的属性值个数"),
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID")
+):
+    """按事件属性值分组的事件数，数值属性同时返回最小/最大/平均值"""
+    return await workload_manager.run("heavy", event_property_service.get_breakdown,
+                                      property, event_name, days, limit, site_id, response=response)
 
 @router.get("/user-type")
-async def get_user_type_stats():
+async def get_user_type_stats(
+    response: Response,
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID")
+):
     """获取新老用户统计数据"""
-    return stats_service.get_user_type_stats()
+    return await workload_manager.run("heavy", stats_service.get_user_type_stats, site_id, response=response)
 
 @router.get("/user-type/trend")
 async def get_user_type_trend(
-    days: int = Query(7, ge=1, le=30, description="天数范围")
+    response: Response,
+    days: int = Query(7, ge=1, le=30, description="天数范围"),
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID")
 ):
     """获取新老用户趋势数据"""
-    return stats_service.get_user_type_trend(days)
+    return await workload_manager.run("heavy", stats_service.get_user_type_trend, days, site_id, response=response)
+
+@router.get("/funnel")
+async def get_funnel(
+    response: Response,
+    steps: List[str] = Query(..., description="按顺序的步骤，如 page:/pricing* 或 event:signup_button"),
+    window_minutes: int = Query(30, ge=1, le=1440, description="从第一步起的转化窗口（分钟）"),
+    days: int = Query(7, ge=1, le=90, description="天数范围"),
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID")
+):
+    """漏斗分析：各步骤的会话数、转化率和流失数"""
+    try:
+        return await workload_manager.run("heavy", funnel_service.get_funnel,
+                                          steps, days, window_minutes, site_id, response=response)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/retention")
+async def get_retention(
+    response: Response,
+    period: str = Query("day", pattern="^(day|week)$", description="同群粒度：day 或 week"),
+    periods: int = Query(14, ge=1, le=90, description="同群数量（也是最大的间隔数）"),
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID")
+):
+    """同群留存矩阵：每个同群的人数及之后各天/各周仍有访问的用户数和比例"""
+    return await workload_manager.run("light", retention_service.get_retention, period, periods, site_id, response=response)
+
+@router.get("/geo")
+async def get_geo_stats(
+    response: Response,
+    days: int = Query(7, ge=1, le=90, description="天数范围"),
+    country: Optional[str] = Query(None, max_length=100, description="指定国家时返回城市分布"),
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID")
+):
+    """按国家/城市的会话分布，来自定时写入的地理汇总"""
+    return await workload_manager.run("light", geo_service.get_geo_stats, days, country, site_id, response=response)
+
+@router.get("/durations")
+async def get_durations(
+    response: Response,
+    kind: str = Query("session", pattern="^(session|page)$", description="session 为会话时长，page 为页面停留时长"),
+    days: int = Query(7, ge=1, le=90, description="天数范围（未指定 start 时）"),
+    start: Optional[datetime] = Query(None, description="起始时间（本地时间），按小时取整"),
+    end: Optional[datetime] = Query(None, description="结束时间（本地时间），默认为当前"),
+    url: Optional[str] = Query(None, max_length=500, description="只看某个页面（kind=page），按天取整"),
+    limit: int = Query(10, ge=1, le=100, description="kind=page 时返回的页面数"),
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID")
+):
+    """时长分位数（p50/p75/p90/p95/p99）和直方图，由按小时/天保存的分布草图合并得到"""
+    try:
+        return await workload_manager.run("light", duration_service.get_durations,
+                                          kind, days, url, start, end, limit, site_id, response=response)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/paths")
+async def get_paths(
+    response: Response,
+    prefix: List[str] = Query([], max_length=settings.PATH_MAX_DEPTH,
+                              description="路径前缀，按顺序的规范化页面名，如 prefix=首页&prefix=搜索页"),
+    depth: int = Query(3, ge=1, le=settings.PATH_MAX_DEPTH, description="从前缀往下展开的层数"),
+    days: int = Query(7, ge=1, le=90, description="天数范围"),
+    limit: int = Query(10, ge=1, le=100, description="每层返回的页面数和完整路径数"),
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN, description="站点 ID")
+):
+    """经过 prefix 的会话往下的页面路径树和最常见的完整路径，由每天保存的会话路径前缀树合并得到"""
+    return await workload_manager.run("light", path_service.get_paths,
+                                      prefix, depth, days, limit, site_id, response=response)
@@ -1,13 +1,44 @@
 from fastapi import APIRouter, Request, HTTPException, Query
 from fastapi.responses import Response
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from typing import Optional
+from urllib.parse import parse_qsl
+from config.settings import settings, SITE_ID_PATTERN
 from backend.services.tracking_service import tracking_service
+from backend.services.bot_detector import bot_detector
+from backend.services.spool import spool
+from backend.utils.metrics import INGEST_HITS, INGEST_QUEUE_DEPTH
+import json
+import re
+import time
 import uuid
 
 router = APIRouter(prefix="/api", tags=["tracking"])
 
+HIT_TYPES = ("pageview", "event", "duration")
+
+_SITE_ID_RE = re.compile(SITE_ID_PATTERN)
+
+def _spooled(hit_type: str, tracking_data: dict, json_api: bool = False) -> bool:
+    """
+    spool 已打开时把记录追加到 spool，由后台线程写库；返回 False 表示需要直接写库。
+    POST JSON 接口（json_api）的响应带有写库结果（新老用户、记录 ID），只有打开 SPOOL_JSON_ENDPOINTS 时才走 spool
+    """
+    if not (settings.SPOOL_ENABLED and spool.is_open) or (json_api and not settings.SPOOL_JSON_ENDPOINTS):
+        return False
+    spool.append({"type": hit_type, "received_at": time.time(), **tracking_data})
+    return True
+
+PIXEL_GIF = b'GIF89a\x01\x00\x01\x00\x80\x00\x00\xff\xff\xff\x00\x00\x00!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;'
+# 像素每次都要真正发出请求，不能被浏览器或代理缓存
+PIXEL_HEADERS = {
+    "cache-control": "no-store, no-cache, must-revalidate, max-age=0",
+    "pragma": "no-cache",
+    "expires": "0",
+}
+
 class PageViewData(BaseModel):
+    site_id: str = Field(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN)
     page_url: str
     page_title: Optional[str] = None
     referrer: Optional[str] = None
@@ -19,6 +50,7 @@ class PageViewData(BaseModel):
     duration: Optional[float] = None
 
 class EventData(BaseModel):
+    site_id: str = Field(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN)
     event_type: str
     event_name: str
     page_url: Optional[str] = None
@@ -26,65 +58,177 @@ class EventData(BaseModel):
     session_id: Optional[str] = None
     properties: Optional[dict] = None
 
-@router.get("/pixel")
-async def pixel_tracking(
-    request: Request,
-    type: str = Query(...),
-    page_url: Optional[str] = Query(None),
-    page_title: Optional[str] = Query(None),
-    referrer: Optional[str] = Query(None),
-    user_id: Optional[str] = Query(None),
-    session_id: Optional[str] = Query(None),
-    screen_width: Optional[int] = Query(None),
-    screen_height: Optional[int] = Query(None),
-    language: Optional[str] = Query(None),
-    event_type: Optional[str] = Query(None),
-    event_name: Optional[str] = Query(None),
-    element_id: Optional[str] = Query(None),
-    properties: Optional[str] = Query(None),
-    duration: Optional[float] = Query(None)
-):
+def _track_pixel(params: dict, client_host: str, user_agent: str, referer: Optional[str]):
+    """像素请求的处理逻辑，FastAPI 路由和 PixelEndpoint 共用；params 为校验过的查询参数，出错时吞掉，总是返回图片"""
+    type = params["type"]
+    hit_type = type if type in HIT_TYPES else "other"
+    INGEST_HITS.labels(hit_type).inc()
+    # 走 spool 时由 spool 维护队列深度
+    direct = not (settings.SPOOL_ENABLED and spool.is_open)
+    if direct:
+        INGEST_QUEUE_DEPTH.inc()
     try:
+        # 像素请求总是返回图片，site_id 不合法时直接丢弃，不写入任何站点
+        site_id = params.get("site_id") or settings.DEFAULT_SITE_ID
+        if not _SITE_ID_RE.match(site_id):
+            return
+        
+        # 爬虫识别放在所有数据库操作之前，命中后只计数
+        session_id = params.get("session_id")
+        verdict = bot_detector.check(user_agent, client_host, session_id)
+        if not bot_detector.should_store(verdict):
+            bot_detector.record(verdict, hit_type, site_id)
+            return
+        
         sid = session_id or str(uuid.uuid4())
-        client_host = request.client.host if request.client else "unknown"
-        user_agent = request.headers.get("user-agent", "")
         
         if type == "pageview":
             tracking_data = {
+                "site_id": site_id,
                 "session_id": sid,
-                "user_id": user_id,
-                "page_url": page_url or request.headers.get("referer", ""),
-                "page_title": page_title,
-                "referrer": referrer,
+                "user_id": params.get("user_id"),
+                "page_url": params.get("page_url") or referer or "",
+                "page_title": params.get("page_title"),
+                "referrer": params.get("referrer"),
                 "ip_address": client_host,
                 "user_agent": user_agent,
-                "screen_width": screen_width,
-                "screen_height": screen_height,
-                "language": language
+                "screen_width": params.get("screen_width"),
+                "screen_height": params.get("screen_height"),
+                "language": params.get("language")
             }
-            tracking_service.track_page_view(tracking_data)
+            if not _spooled("pageview", tracking_data):
+                tracking_service.track_page_view(tracking_data)
             
         elif type == "event":
-            import json
+            properties = params.get("properties")
             props = json.loads(properties) if properties else {}
             tracking_data = {
+                "site_id": site_id,
                 "session_id": sid,
-                "user_id": user_id,
-                "event_type": event_type or "custom",
-                "event_name": event_name or "",
-                "page_url": page_url or request.headers.get("referer", ""),
+                "user_id": params.get("user_id"),
+                "event_type": params.get("event_type") or "custom",
+                "event_name": params.get("event_name") or "",
+                "page_url": params.get("page_url") or referer or "",
                 "ip_address": client_host,
                 "user_agent": user_agent,
                 "properties": props
             }
-            tracking_service.track_event(tracking_data)
+            if not _spooled("event", tracking_data):
+                tracking_service.track_event(tracking_data)
             
         elif type == "duration":
-            tracking_service.update_session_duration(sid, duration or 0.0)
-        
-        return Response(content=b'GIF89a\x01\x00\x01\x00\x80\x00\x00\xff\xff\xff\x00\x00\x00!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;', media_type='image/gif')
-    except Exception as e:
-        return Response(content=b'GIF89a\x01\x00\x01\x00\x80\x00\x00\xff\xff\xff\x00\x00\x00!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;', media_type='image/gif')
+            duration = params.get("duration") or 0.0
+            tracking_data = {
+                "site_id": site_id,
+                "session_id": sid,
+                "user_id": params.get("user_id"),
+                "duration": duration,
+                "page_url": params.get("page_url") or referer or None
+            }
+            if not _spooled("duration", tracking_data):
+                tracking_service.update_session_duration(sid, duration, site_id, tracking_data["page_url"],
+                                                         tracking_data["user_id"])
+    except Exception:
+        pass
+    finally:
+        if direct:
+            INGEST_QUEUE_DEPTH.dec()
+
+@router.get("/pixel")
+async def pixel_tracking(
+    request: Request,
+    type: str = Query(...),
+    site_id: Optional[str] = Query(None),
+    page_url: Optional[str] = Query(None),
+    page_title: Optional[str] = Query(None),
+    referrer: Optional[str] = Query(None),
+    user_id: Optional[str] = Query(None),
+    session_id: Optional[str] = Query(None),
+    screen_width: Optional[int] = Query(None),
+    screen_height: Optional[int] = Query(None),
+    language: Optional[str] = Query(None),
+    event_type: Optional[str] = Query(None),
+    event_name: Optional[str] = Query(None),
+    element_id: Optional[str] = Query(None),
+    properties: Optional[str] = Query(None),
+    duration: Optional[float] = Query(None)
+):
+    # 正常情况下请求由 PixelEndpoint 处理，这里只处理它转交的参数不规范的请求和 422 错误
+    params = {
+        "type": type, "site_id": site_id, "page_url": page_url, "page_title": page_title,
+        "referrer": referrer, "user_id": user_id, "session_id": session_id,
+        "screen_width": screen_width, "screen_height": screen_height, "language": language,
+        "event_type": event_type, "event_name": event_name, "properties": properties, "duration": duration
+    }
+    client_host = request.client.host if request.client else "unknown"
+    _track_pixel(params, client_host, request.headers.get("user-agent", ""), request.headers.get("referer"))
+    return Response(content=PIXEL_GIF, media_type='image/gif', headers=PIXEL_HEADERS)
+
+# 快速通道只接受最简单的数字写法，其余（空格、前导零、科学计数法、inf 等）交给路由按 pydantic 的规则处理
+_NUMERIC_PARAMS = {
+    "screen_width": (re.compile(r"-?(?:0|[1-9][0-9]{0,17})\Z"), int),
+    "screen_height": (re.compile(r"-?(?:0|[1-9][0-9]{0,17})\Z"), int),
+    "duration": (re.compile(r"-?[0-9]{1,15}(?:\.[0-9]{1,15})?\Z"), float),
+}
+
+def parse_pixel_query(query_string: bytes) -> Optional[dict]:
+    """按 pixel_tracking 的参数定义解析查询串（同名参数取最后一个）；缺少 type 或数字格式不规范时返回 None"""
+    params = dict(parse_qsl(query_string.decode("latin-1"), keep_blank_values=True))
+    if "type" not in params:
+        return None
+    for name, (pattern, convert) in _NUMERIC_PARAMS.items():
+        value = params.get(name)
+        if value is not None:
+            if not pattern.match(value):
+                return None
+            params[name] = convert(value)
+    return params
+
+_PIXEL_RAW_HEADERS = [
+    (b"content-length", str(len(PIXEL_GIF)).encode()),
+    (b"content-type", b"image/gif"),
+    *((name.encode(), value.encode()) for name, value in PIXEL_HEADERS.items()),
+]
+_PIXEL_BODY = {"type": "http.response.body", "body": PIXEL_GIF}
+
+class PixelEndpoint:
+    """
+    GET /api/pixel 的纯 ASGI 快速通道，挂在路由之前：直接解析查询串和请求头，跳过 FastAPI 的依赖解析
+    和参数校验，返回预先构造好的 GIF 响应。parse_pixel_query 不能处理的请求原样交给 pixel_tracking，
+    两条路径共用 _track_pixel，行为（包括 422 错误）与原接口一致。
+    """
+
+    def __init__(self, app, path: str = "/api/pixel"):
+        self.app = app
+        self.path = path
+        # 让 MetricsMiddleware 仍按路由模板记录耗时
+        self.route = next(route for route in router.routes if getattr(route, "path", None) == path)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+        params = parse_pixel_query(scope["query_string"])
+        if params is None:
+            await self.app(scope, receive, send)
+            return
+
+        # 与 Starlette 的 Headers.get 一样取第一个同名头
+        user_agent = referer = None
+        for name, value in scope["headers"]:
+            if name == b"user-agent":
+                if user_agent is None:
+                    user_agent = value.decode("latin-1")
+            elif name == b"referer":
+                if referer is None:
+                    referer = value.decode("latin-1")
+        client = scope.get("client")
+        scope["route"] = self.route
+        _track_pixel(params, client[0] if client else "unknown", user_agent or "", referer)
+
+        # 外层的 CORS 中间件会往响应头列表里追加，每次复制一份；响应体消息不会被修改，可以共用
+        await send({"type": "http.response.start", "status": 200, "headers": list(_PIXEL_RAW_HEADERS)})
+        await send(_PIXEL_BODY)
 
 @router.post("/track/pageview")
 async def track_page_view(data: PageViewData, request: Request):
@@ -94,7 +238,14 @@ async def track_page_view(data: PageViewData, request: Request):
         client_host = request.client.host if request.client else "unknown"
         user_agent = request.headers.get("user-agent", "")
         
+        verdict = bot_detector.check(user_agent, client_host, data.session_id)
+        if not bot_detector.should_store(verdict):
+            bot_detector.record(verdict, "pageview", data.site_id)
+            return {"status": "filtered", "reason": verdict.reason, "session_id": session_id,
+                    "user_type": "unknown", "is_new_user": False}
+        
         tracking_data = {
+            "site_id": data.site_id,
             "session_id": session_id,
             "user_id": data.user_id,
             "page_url": data.page_url,
@@ -108,6 +259,10 @@ async def track_page_view(data: PageViewData, request: Request):
             "duration": data.duration
         }
         
+        # 走 spool 时还没写库，新老用户未知
+        if _spooled("pageview", tracking_data, json_api=True):
+            return {"status": "queued", "session_id": session_id, "user_type": "unknown", "is_new_user": False}
+        
         result = tracking_service.track_page_view(tracking_data)
         
         return {
@@ -127,7 +282,13 @@ async def track_event(data: EventData, request: Request):
         client_host = request.client.host if request.client else "unknown"
         user_agent = request.headers.get("user-agent", "")
         
+        verdict = bot_detector.check(user_agent, client_host, data.session_id)
+        if not bot_detector.should_store(verdict):
+            bot_detector.record(verdict, "event", data.site_id)
+            return {"status": "filtered", "reason": verdict.reason, "session_id": session_id}
+        
         tracking_data = {
+            "site_id": data.site_id,
             "session_id": session_id,
             "user_id": data.user_id,
             "event_type": data.event_type,
@@ -138,6 +299,9 @@ async def track_event(data: EventData, request: Request):
             "properties": data.properties
         }
         
+        if _spooled("event", tracking_data, json_api=True):
+            return {"status": "queued", "session_id": session_id}
+        
         result = tracking_service.track_event(tracking_data)
         
         return {
@@ -148,9 +312,20 @@ async def track_event(data: EventData, request: Request):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/track/session/duration")
-async def update_session_duration(session_id: str, duration: float):
+async def update_session_duration(
+    session_id: str,
+    duration: float,
+    site_id: str = Query(settings.DEFAULT_SITE_ID, pattern=SITE_ID_PATTERN),
+    page_url: Optional[str] = None,
+    user_id: Optional[str] = None
+):
     try:
-        tracking_service.update_session_duration(session_id, duration)
+        # user_id 可选，分片模式下用它直接找到会话所在的分片
+        record = {"site_id": site_id, "session_id": session_id, "user_id": user_id, "duration": duration,
+                  "page_url": page_url}
+        if _spooled("duration", record, json_api=True):
+            return {"status": "queued"}
+        tracking_service.update_session_duration(session_id, duration, site_id, page_url, user_id)
         return {"status": "success"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
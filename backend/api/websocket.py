@@ -1,50 +1,85 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-from typing import List
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query
+from typing import Dict, List
 import json
 import asyncio
+import re
+import time
+from config.settings import settings, SITE_ID_PATTERN
 from backend.services.stats_service import stats_service
+from backend.services.workload import workload_manager, WorkloadRejected
+from backend.utils.metrics import WEBSOCKET_CONNECTIONS, WEBSOCKET_SEND_SECONDS
 
 router = APIRouter(prefix="/api", tags=["websocket"])
 
+_SITE_ID_RE = re.compile(SITE_ID_PATTERN)
+
 class ConnectionManager:
+    """按站点分组管理连接，每个站点只收到自己的统计推送"""
+    
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Dict[str, List[WebSocket]] = {}
+    
+    def _update_gauge(self):
+        WEBSOCKET_CONNECTIONS.set(sum(len(c) for c in self.active_connections.values()))
+    
+    def sites(self) -> List[str]:
+        return [site_id for site_id, connections in self.active_connections.items() if connections]
     
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, site_id: str = settings.DEFAULT_SITE_ID):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections.setdefault(site_id, []).append(websocket)
+        self._update_gauge()
     
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+    def disconnect(self, websocket: WebSocket, site_id: str = settings.DEFAULT_SITE_ID):
+        connections = self.active_connections.get(site_id, [])
+        if websocket in connections:
+            connections.remove(websocket)
+        if not connections:
+            self.active_connections.pop(site_id, None)
+        self._update_gauge()
     
-    async def broadcast(self, message: dict):
+    async def broadcast(self, message: dict, site_id: str = settings.DEFAULT_SITE_ID):
         disconnected = []
-        for connection in self.active_connections:
+        for connection in list(self.active_connections.get(site_id, [])):
+            started = time.perf_counter()
             try:
                 await connection.send_json(message)
+                WEBSOCKET_SEND_SECONDS.observe(time.perf_counter() - started)
             except:
                 disconnected.append(connection)
         
         for connection in disconnected:
-            self.disconnect(connection)
+            self.disconnect(connection, site_id)
 
 manager = ConnectionManager()
 
 @router.websocket("/ws/realtime")
-async def websocket_realtime(websocket: WebSocket):
-    await manager.connect(websocket)
+async def websocket_realtime(websocket: WebSocket, site_id: str = Query(settings.DEFAULT_SITE_ID)):
+    if not _SITE_ID_RE.match(site_id):
+        await websocket.close(code=1008)
+        return
+    await manager.connect(websocket, site_id)
     try:
         while True:
             data = await websocket.receive_text()
             
             if data == "stats":
-                stats = stats_service.get_realtime_stats()
+                try:
+                    stats = await workload_manager.run("light", stats_service.get_realtime_stats, site_id)
+                except WorkloadRejected:
+                    continue
                 await websocket.send_json(stats)
     except WebSocketDisconnect:
-        manager.disconnect(websocket)
+        manager.disconnect(websocket, site_id)
     except Exception as e:
-        manager.disconnect(websocket)
+        manager.disconnect(websocket, site_id)
 
 async def broadcast_realtime_stats():
-    stats = stats_service.get_realtime_stats()
-    await manager.broadcast({"type": "stats_update", "data": stats})
+    # 只为有连接的站点计算统计
+    # 统计在负载管理的线程池中计算，不阻塞事件循环；繁忙时跳过这一轮
+    for site_id in manager.sites():
+        try:
+            stats = await workload_manager.run("light", stats_service.get_realtime_stats, site_id)
+        except WorkloadRejected:
+            continue
+        await manager.broadcast({"type": "stats_update", "data": stats}, site_id)
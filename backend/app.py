@@ -1,24 +1,47 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, Response
+from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
+import re
 import sys
+import threading
 from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from config import settings
+from config.settings import BASE_DIR, SITE_ID_PATTERN
 from backend.models import init_db
-from backend.api import track_router, stats_router, websocket_router
+from backend.api import track_router, stats_router, websocket_router, metrics_router, MetricsMiddleware, PixelEndpoint, admin_router, export_router
 from backend.api.sankey import router as sankey_router
-from backend.utils.scheduler import start_scheduler
+from backend.utils.scheduler import start_scheduler, stop_scheduler
+from backend.utils.assets import AssetPipeline, minify_js
+from backend.services.spool import spool, create_consumer
+from backend.services.retention_service import retention_service
+from backend.services.hot_window import hot_window
+from backend.services.duration_service import duration_service
+from backend.services.identity_cache import identity_cache
+from backend.services.workload import WorkloadRejected
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     init_db()
+    # 预热期间统计查询照常走 SQL，写入照常按 user_id 查库
+    threading.Thread(target=hot_window.warm, name="hot-window-warm", daemon=True).start()
+    threading.Thread(target=identity_cache.warm, name="identity-warm", daemon=True).start()
+    # spool 在这里而不是导入时打开，避免 --reload 的父进程占住目录锁
+    consumer = create_consumer() if settings.SPOOL_ENABLED else None
+    if consumer:
+        consumer.start()
     start_scheduler()
     yield
-    pass
+    stop_scheduler()
+    if consumer:
+        consumer.stop()
+        spool.close()
+    identity_cache.flush()
+    retention_service.flush()
+    duration_service.flush()
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
@@ -26,6 +49,8 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# 先添加的中间件在最内层：像素快速通道紧挨着路由，仍经过 CORS 和请求计时
+app.add_middleware(PixelEndpoint)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -33,55 +58,67 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+
+@app.exception_handler(WorkloadRejected)
+async def workload_rejected(request: Request, exc: WorkloadRejected):
+    return JSONResponse(status_code=503, content={"detail": str(exc)},
+                        headers={"Retry-After": str(exc.retry_after)})
 
 app.include_router(track_router)
 app.include_router(stats_router)
 app.include_router(websocket_router)
 app.include_router(sankey_router)
+app.include_router(metrics_router)
+app.include_router(admin_router)
+app.include_router(export_router)
 
 app.mount("/static", StaticFiles(directory="frontend/static"), name="static")
 
+TEMPLATES_DIR = BASE_DIR / "frontend" / "templates"
+TRACKING_DIR = BASE_DIR / "tracking"
+SITE_ID_RE = re.compile(SITE_ID_PATTERN)
+
+def render_tracker(content: str, site_id: str) -> str:
+    return content.replace(
+        "const SITE_ID = window.RA_TRACKER_ID || 'default';",
+        f"const SITE_ID = '{site_id}';"
+    )
+
+assets = AssetPipeline(hot_reload=settings.DEBUG, variant_cache_size=settings.ASSET_VARIANT_CACHE_SIZE)
+script_cache = f"public, max-age={settings.TRACKER_CACHE_MAX_AGE}"
+assets.register("tracker", TRACKING_DIR / "raymond-tracker.js", "application/javascript; charset=utf-8",
+                cache_control=script_cache, minify=minify_js, render=render_tracker)
+assets.register("ra", TRACKING_DIR / "ra-simple.js", "application/javascript; charset=utf-8",
+                cache_control=script_cache, minify=minify_js)
+for name in ("dashboard", "test", "tracker-test", "simple-demo"):
+    assets.register(name, TEMPLATES_DIR / f"{name}.html", "text/html")
+
 @app.get("/", response_class=HTMLResponse)
-async def root():
-    with open("frontend/templates/dashboard.html", "r", encoding="utf-8") as f:
-        return f.read()
+async def root(request: Request):
+    return assets.respond(request, "dashboard")
 
 @app.get("/tracker.js")
-async def tracker(site_id: str = None):
-    with open("tracking/raymond-tracker.js", "r", encoding="utf-8") as f:
-        content = f.read()
-        if site_id:
-            content = content.replace(
-                "pixelUrl: config.pixelUrl || 'http://localhost:8001/api/pixel'",
-                f"pixelUrl: config.pixelUrl || 'http://110.40.153.38:5500/api/pixel?site_id={site_id}'"
-            )
-        return Response(
-            content=content,
-            media_type="application/javascript; charset=utf-8"
-        )
+async def tracker(request: Request, site_id: str = None):
+    if site_id and not SITE_ID_RE.match(site_id):
+        raise HTTPException(status_code=400, detail="invalid site_id")
+    return assets.respond(request, "tracker", site_id or None)
 
 @app.get("/ra.js")
-async def ra_simple():
-    with open("tracking/ra-simple.js", "r", encoding="utf-8") as f:
-        return Response(
-            content=f.read(),
-            media_type="application/javascript; charset=utf-8"
-        )
+async def ra_simple(request: Request):
+    return assets.respond(request, "ra")
 
 @app.get("/test", response_class=HTMLResponse)
-async def test_page():
-    with open("frontend/templates/test.html", "r", encoding="utf-8") as f:
-        return f.read()
+async def test_page(request: Request):
+    return assets.respond(request, "test")
 
 @app.get("/tracker-test", response_class=HTMLResponse)
-async def tracker_test_page():
-    with open("frontend/templates/tracker-test.html", "r", encoding="utf-8") as f:
-        return f.read()
+async def tracker_test_page(request: Request):
+    return assets.respond(request, "tracker-test")
 
 @app.get("/simple-demo", response_class=HTMLResponse)
-async def simple_demo_page():
-    with open("frontend/templates/simple-demo.html", "r", encoding="utf-8") as f:
-        return f.read()
+async def simple_demo_page(request: Request):
+    return assets.respond(request, "simple-demo")
 
 if __name__ == "__main__":
     import uvicorn
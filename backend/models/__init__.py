@@ -1,11 +1,17 @@
 from .database import (
-    Base, engine, SessionLocal, get_db,
-    PageView, Event, Session, User, AggregatedStats,
+    Base, engine, read_engine, SessionLocal, ReadSessionLocal, get_db, get_read_db, open_db, sql_profiler, statement_guard,
+    day_bucket, bulk_insert, index_applies,
+    PageView, Event, EventProperty, Session, User, AggregatedStats, ActivityBitmap, DurationSketch, PathTrie,
+    UrlDimension, TitleDimension, UserAgentDimension, ReferrerDimension,
     init_db
 )
+from .shards import shards, sharded, shard_local, ShardSet
 
 __all__ = [
-    "Base", "engine", "SessionLocal", "get_db",
-    "PageView", "Event", "Session", "User", "AggregatedStats",
-    "init_db"
+    "Base", "engine", "read_engine", "SessionLocal", "ReadSessionLocal", "get_db", "get_read_db", "open_db", "sql_profiler", "statement_guard",
+    "day_bucket", "bulk_insert", "index_applies",
+    "PageView", "Event", "EventProperty", "Session", "User", "AggregatedStats", "ActivityBitmap", "DurationSketch", "PathTrie",
+    "UrlDimension", "TitleDimension", "UserAgentDimension", "ReferrerDimension",
+    "init_db",
+    "shards", "sharded", "shard_local", "ShardSet"
 ]
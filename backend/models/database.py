@@ -1,21 +1,166 @@
-from sqlalchemy import create_engine, Column, String, Integer, DateTime, Float, Text, Boolean, Index
+from sqlalchemy import create_engine, Column, String, Integer, SmallInteger, DateTime, Date, Float, Text, Boolean, Index, LargeBinary, insert
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine import make_url
+from sqlalchemy.sql.functions import GenericFunction
+from contextvars import ContextVar
 from datetime import datetime
+import io
 from config.settings import settings
+from backend.utils.sql_profiler import SQLProfiler
+from backend.utils.statement_guard import StatementGuard
 
-engine = create_engine(
-    settings.DATABASE_URL,
-    connect_args={"check_same_thread": False} if "sqlite" in settings.DATABASE_URL else {},
-    echo=False
+def _engine_options(url: str) -> dict:
+    """SQLite 关闭线程检查即可；PostgreSQL 等服务端数据库使用有界连接池并在取用前探活"""
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite":
+        return {"connect_args": {"check_same_thread": False}}
+    options = {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+        "insertmanyvalues_page_size": settings.DB_INSERT_PAGE_SIZE,
+    }
+    if url.drivername in ("postgresql", "postgresql+psycopg2"):
+        # 多行 INSERT 走 VALUES 批量，导入时的批量 UPDATE 走 execute_batch
+        options["executemany_mode"] = "values_plus_batch"
+    return options
+
+engine = create_engine(settings.DATABASE_URL, echo=False, **_engine_options(settings.DATABASE_URL))
+
+sql_profiler = SQLProfiler(
+    enabled=settings.SQL_PROFILING_ENABLED,
+    slow_threshold_ms=settings.SQL_SLOW_QUERY_MS,
+    top_n=settings.SQL_PROFILE_TOP_N,
+    explain_threshold_ms=settings.SQL_EXPLAIN_THRESHOLD_MS
 )
+sql_profiler.install(engine)
+
+# 统计接口的语句超时和取消，见 backend/services/workload.py
+statement_guard = StatementGuard()
+statement_guard.install(engine)
+
+def _create_read_engine():
+    """
+    只读查询使用的引擎：配置了 DATABASE_READ_URL 时连接该库（如只读副本）；
+    SQLite 文件库以 mode=ro 打开，其余情况复用主引擎
+    """
+    if settings.DATABASE_READ_URL:
+        read_engine = create_engine(settings.DATABASE_READ_URL, echo=False,
+                                    **_engine_options(settings.DATABASE_READ_URL))
+        sql_profiler.install(read_engine)
+        statement_guard.install(read_engine)
+        return read_engine
+    url = make_url(settings.DATABASE_URL)
+    if url.get_backend_name() != "sqlite" or not url.database or url.database == ":memory:":
+        return engine
+    read_engine = create_engine(
+        f"sqlite:///file:{url.database}?mode=ro&uri=true",
+        connect_args={"check_same_thread": False},
+        echo=False
+    )
+    sql_profiler.install(read_engine)
+    statement_guard.install(read_engine)
+    return read_engine
+
+read_engine = _create_read_engine()
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
 
 Base = declarative_base()
 
+class day_bucket(GenericFunction):
+    """按天分桶，结果为日期：SQLite 上是 date(x)，PostgreSQL 上是 date_trunc('day', x)"""
+    type = Date()
+    inherit_cache = True
+
+@compiles(day_bucket)
+def _compile_day_bucket(element, compiler, **kw):
+    return "date(%s)" % compiler.process(element.clauses, **kw)
+
+@compiles(day_bucket, "postgresql")
+def _compile_day_bucket_postgresql(element, compiler, **kw):
+    return "CAST(date_trunc('day', %s) AS DATE)" % compiler.process(element.clauses, **kw)
+
+def bulk_insert(conn, table, rows) -> None:
+    """
+    批量插入（所有行的键相同）：PostgreSQL + psycopg2 下用 COPY FROM STDIN，
+    其它情况用 executemany 的多行 INSERT。不返回自增 ID，需要 ID 时用 insert().returning()；
+    COPY 不会套用 Python 端的列默认值，行里要带齐需要的列。
+    """
+    if not rows:
+        return
+    if conn.dialect.name != "postgresql" or conn.dialect.driver != "psycopg2":
+        conn.execute(insert(table), rows)
+        return
+    columns = list(rows[0])
+    quote = conn.dialect.identifier_preparer.quote
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_value(row[c]) for c in columns))
+        buffer.write("\n")
+    buffer.seek(0)
+    cursor = conn.connection.driver_connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {quote(table.name)} ({', '.join(quote(c) for c in columns)}) FROM STDIN", buffer
+        )
+    finally:
+        cursor.close()
+
+def _copy_value(value) -> str:
+    # COPY 文本格式：\N 表示 NULL，反斜杠、制表符和换行需要转义
+    if value is None:
+        return "\\N"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        # bytea 的十六进制格式，开头的反斜杠同样要转义
+        return "\\\\x" + bytes(value).hex()
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def index_applies(index: Index, dialect_name: str) -> bool:
+    """索引是否在该数据库上创建，见 _dialect_index"""
+    only = index.info.get("only_dialect")
+    return (only is None or only == dialect_name) and index.info.get("skip_dialect") != dialect_name
+
+def _dialect_index(index: Index, only: str = None, skip: str = None) -> Index:
+    """只在某种数据库上创建（only）或在某种数据库上不建（skip）的索引"""
+    index.info.update(only_dialect=only, skip_dialect=skip)
+    return index.ddl_if(callable_=lambda ddl, target, bind, **kw: index_applies(target, kw["dialect"].name))
+
+def _timestamp_indexes(table: str):
+    """
+    只追加的明细表的时间列：PostgreSQL 上用 BRIN（按块记录最小/最大值，体积只有 B-tree 的零头，
+    时间范围扫描足够快），其它数据库用普通 B-tree
+    """
+    return (
+        _dialect_index(Index(f'ix_{table}_timestamp', 'timestamp'), skip="postgresql"),
+        _dialect_index(Index(f'brin_{table}_timestamp', 'timestamp', postgresql_using='brin'), only="postgresql"),
+    )
+
+# 分片模式下由 backend/models/shards.py 设置：其中的 get_db/get_read_db 打开该分片的连接
+active_shard: ContextVar = ContextVar("ra_active_shard", default=None)
+
 def get_db():
-    db = SessionLocal()
+    shard = active_shard.get()
+    db = shard.SessionLocal() if shard is not None else SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def open_db(engine=None):
+    """维护操作用的会话：engine 为空时与 next(get_db()) 相同，否则直接连接 engine（迁移、基准测试的数据库）"""
+    if engine is None:
+        return next(get_db())
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+
+def get_read_db():
+    shard = active_shard.get()
+    db = shard.ReadSessionLocal() if shard is not None else ReadSessionLocal()
     try:
         yield db
     finally:
@@ -25,67 +170,101 @@ class PageView(Base):
     __tablename__ = "page_views"
     
     id = Column(Integer, primary_key=True, index=True)
+    site_id = Column(String(64), default=settings.DEFAULT_SITE_ID, server_default=settings.DEFAULT_SITE_ID, nullable=False)
     session_id = Column(String(100), index=True)
     user_id = Column(String(100), index=True, nullable=True)
-    page_url = Column(String(500), index=True)
-    page_title = Column(String(200))
-    referrer = Column(String(500), nullable=True)
     ip_address = Column(String(45))
-    user_agent = Column(String(500))
     screen_width = Column(Integer, nullable=True)
     screen_height = Column(Integer, nullable=True)
     language = Column(String(10), nullable=True)
     duration = Column(Float, nullable=True)
-    timestamp = Column(DateTime, default=datetime.now, index=True)
+    traffic_class = Column(SmallInteger, default=0, server_default='0', nullable=False)
+    timestamp = Column(DateTime, default=datetime.now)
+    # URL、标题、来源和 UA 只保存在字典表中，明细行保存字典 ID；统计按这些整数分组，只给最终的前 N 项取回字符串
+    url_id = Column(Integer, nullable=True)
+    title_id = Column(Integer, nullable=True)
+    referrer_id = Column(Integer, nullable=True)
+    ua_id = Column(Integer, nullable=True)
     
+    # 所有复合索引都以 site_id 开头，每个站点的查询只扫描自己的索引区间
     __table_args__ = (
-        Index('idx_session_timestamp', 'session_id', 'timestamp'),
-        Index('idx_url_timestamp', 'page_url', 'timestamp'),
+        *_timestamp_indexes('page_views'),
+        Index('idx_site_session_timestamp', 'site_id', 'session_id', 'timestamp'),
+        Index('idx_site_url_id_timestamp', 'site_id', 'url_id', 'timestamp'),
+        Index('idx_site_traffic_timestamp', 'site_id', 'traffic_class', 'timestamp'),
+        Index('idx_site_traffic_url_id', 'site_id', 'traffic_class', 'url_id'),
+        Index('idx_site_referrer_id', 'site_id', 'referrer_id'),
+        Index('idx_site_ua_id', 'site_id', 'ua_id'),
     )
 
 class Event(Base):
     __tablename__ = "events"
     
     id = Column(Integer, primary_key=True, index=True)
+    site_id = Column(String(64), default=settings.DEFAULT_SITE_ID, server_default=settings.DEFAULT_SITE_ID, nullable=False)
     session_id = Column(String(100), index=True)
     user_id = Column(String(100), index=True, nullable=True)
     event_type = Column(String(50), index=True)
     event_name = Column(String(100))
     properties = Column(Text, nullable=True)
-    page_url = Column(String(500))
     ip_address = Column(String(45))
-    user_agent = Column(String(500))
-    timestamp = Column(DateTime, default=datetime.now, index=True)
+    timestamp = Column(DateTime, default=datetime.now)
+    url_id = Column(Integer, nullable=True)
+    ua_id = Column(Integer, nullable=True)
     
     __table_args__ = (
-        Index('idx_event_type_timestamp', 'event_type', 'timestamp'),
+        *_timestamp_indexes('events'),
+        Index('idx_site_event_timestamp', 'site_id', 'timestamp'),
+        Index('idx_site_event_type_timestamp', 'site_id', 'event_type', 'timestamp'),
+    )
+
+class EventProperty(Base):
+    """events.properties 顶层键值的索引副表，按属性分组/过滤时不必逐行解析 JSON"""
+    __tablename__ = "event_properties"
+    
+    id = Column(Integer, primary_key=True)
+    site_id = Column(String(64), default=settings.DEFAULT_SITE_ID, server_default=settings.DEFAULT_SITE_ID, nullable=False)
+    event_id = Column(Integer, nullable=False, index=True)
+    event_name = Column(String(100))
+    key = Column(String(64), nullable=False)
+    value = Column(String(200))
+    num_value = Column(Float, nullable=True)
+    timestamp = Column(DateTime, default=datetime.now)
+    
+    # 覆盖按属性分组的查询：站点 + 键 + 时间范围，事件名和值直接从索引读取
+    __table_args__ = (
+        Index('idx_site_key_timestamp', 'site_id', 'key', 'timestamp', 'event_name', 'value', 'num_value'),
     )
 
 class Session(Base):
     __tablename__ = "sessions"
     
     id = Column(Integer, primary_key=True, index=True)
-    session_id = Column(String(100), unique=True, index=True)
+    site_id = Column(String(64), default=settings.DEFAULT_SITE_ID, server_default=settings.DEFAULT_SITE_ID, nullable=False)
+    session_id = Column(String(100), index=True)
     user_id = Column(String(100), index=True, nullable=True)
     ip_address = Column(String(45))
-    user_agent = Column(String(500))
     start_time = Column(DateTime, default=datetime.now)
     end_time = Column(DateTime, nullable=True)
     page_views = Column(Integer, default=1)
     duration = Column(Float, default=0.0)
-    referrer = Column(String(500), nullable=True)
     country = Column(String(100), nullable=True)
     city = Column(String(100), nullable=True)
+    ua_id = Column(Integer, nullable=True)
+    referrer_id = Column(Integer, nullable=True)
     
     __table_args__ = (
-        Index('idx_start_time', 'start_time'),
+        Index('uq_site_session', 'site_id', 'session_id', unique=True),
+        Index('idx_site_start_time', 'site_id', 'start_time'),
+        Index('idx_site_end_time', 'site_id', 'end_time'),
     )
 
 class User(Base):
     __tablename__ = "users"
     
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(String(100), unique=True, index=True)
+    site_id = Column(String(64), default=settings.DEFAULT_SITE_ID, server_default=settings.DEFAULT_SITE_ID, nullable=False)
+    user_id = Column(String(100), index=True)
     first_visit = Column(DateTime, default=datetime.now)
     last_visit = Column(DateTime, default=datetime.now)
     visit_count = Column(Integer, default=1)
@@ -93,13 +272,15 @@ class User(Base):
     user_agent = Column(String(500), nullable=True)
     
     __table_args__ = (
-        Index('idx_user_id', 'user_id'),
+        Index('uq_site_user', 'site_id', 'user_id', unique=True),
+        Index('idx_site_first_visit', 'site_id', 'first_visit'),
     )
 
 class AggregatedStats(Base):
     __tablename__ = "aggregated_stats"
     
     id = Column(Integer, primary_key=True, index=True)
+    site_id = Column(String(64), default=settings.DEFAULT_SITE_ID, server_default=settings.DEFAULT_SITE_ID, nullable=False)
     stat_type = Column(String(50), index=True)
     stat_date = Column(DateTime, index=True)
     page_url = Column(String(500), nullable=True, index=True)
@@ -108,8 +289,92 @@ class AggregatedStats(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     
     __table_args__ = (
-        Index('idx_stat_date_type', 'stat_date', 'stat_type'),
+        Index('idx_site_stat_type_date', 'site_id', 'stat_type', 'stat_date'),
+    )
+
+class ActivityBitmap(Base):
+    """按天的用户位图：kind=active 为当天有访问的用户，kind=new 为当天首次出现的用户，位是 users.id"""
+    __tablename__ = "activity_bitmaps"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    site_id = Column(String(64), default=settings.DEFAULT_SITE_ID, server_default=settings.DEFAULT_SITE_ID, nullable=False)
+    kind = Column(String(16), nullable=False)
+    day = Column(DateTime, nullable=False)
+    encoding = Column(String(16), nullable=False)
+    cardinality = Column(Integer, default=0)
+    data = Column(LargeBinary, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('uq_site_kind_day', 'site_id', 'kind', 'day', unique=True),
+    )
+
+class DurationSketch(Base):
+    """
+    时长分布草图（DDSketch）：kind=session 为按会话开始时间每小时一行的会话时长，kind=page 为每小时所有页面的停留时长，
+    kind=page_url 为每个页面每天一行；url_id 为 0 表示不区分页面
+    """
+    __tablename__ = "duration_sketches"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    site_id = Column(String(64), default=settings.DEFAULT_SITE_ID, server_default=settings.DEFAULT_SITE_ID, nullable=False)
+    kind = Column(String(16), nullable=False)
+    url_id = Column(Integer, default=0, nullable=False)
+    bucket = Column(DateTime, nullable=False)
+    accuracy = Column(Float, nullable=False)
+    count = Column(Integer, default=0)
+    data = Column(LargeBinary, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('uq_site_kind_url_bucket', 'site_id', 'kind', 'url_id', 'bucket', unique=True),
     )
 
+class PathTrie(Base):
+    """每个站点每天一行：当天开始的会话的页面序列组成的前缀树（已剪枝、压缩序列化）"""
+    __tablename__ = "path_tries"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    site_id = Column(String(64), default=settings.DEFAULT_SITE_ID, server_default=settings.DEFAULT_SITE_ID, nullable=False)
+    day = Column(DateTime, nullable=False)
+    sessions = Column(Integer, default=0)
+    nodes = Column(Integer, default=0)
+    data = Column(LargeBinary, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('uq_path_tries_site_day', 'site_id', 'day', unique=True),
+    )
+
+class UrlDimension(Base):
+    """字典表：明细表里重复出现的长字符串只存一份，明细行保存整数 ID"""
+    __tablename__ = "dim_urls"
+    
+    id = Column(Integer, primary_key=True)
+    value = Column(String(500), nullable=False, unique=True)
+
+class TitleDimension(Base):
+    __tablename__ = "dim_titles"
+    
+    id = Column(Integer, primary_key=True)
+    value = Column(String(200), nullable=False, unique=True)
+
+class UserAgentDimension(Base):
+    __tablename__ = "dim_user_agents"
+    
+    id = Column(Integer, primary_key=True)
+    value = Column(String(500), nullable=False, unique=True)
+
+class ReferrerDimension(Base):
+    __tablename__ = "dim_referrers"
+    
+    id = Column(Integer, primary_key=True)
+    value = Column(String(500), nullable=False, unique=True)
+
 def init_db():
+    from .migrations import run_migrations
+    from .shards import shards
+    # 先准备好分片：主库的迁移中重建派生数据的步骤在分片模式下会访问所有分片
+    shards.init()
     Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
@@ -0,0 +1,355 @@
+"""
+数据库结构迁移
+
+create_all 只会建新表，不会修改已有表，所以给老库加列/加索引/回填数据的步骤放在这里。
+每个迁移只执行一次，已执行的记录在 schema_migrations 表中；迁移本身也要可重复执行，
+因为新建的库由 create_all 直接建出最新结构。
+
+用法:
+    python -m backend.models.migrations               # 执行未应用的迁移
+    python -m backend.models.migrations --reclassify  # 修改流量规则后重新回填 traffic_class
+    python -m backend.models.migrations --rebuild-retention  # 从明细重建留存位图
+    python -m backend.models.migrations --backfill-geo  # 安装 GeoIP 库后给已有会话补上地理信息
+    python -m backend.models.migrations --rebuild-durations  # 从 sessions 重建会话时长草图
+"""
+import argparse
+import sys
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from sqlalchemy import inspect, text
+
+BATCH_SIZE = 5000
+
+
+def _columns(conn, table):
+    return {c["name"] for c in inspect(conn).get_columns(table)}
+
+
+def _indexes(conn, table):
+    return {i["name"] for i in inspect(conn).get_indexes(table)}
+
+
+def reclassify_traffic(engine, progress: bool = False) -> int:
+    """按当前 TrafficFilter 规则重新计算 page_views.traffic_class，返回改动的行数"""
+    from backend.services.traffic_filter import traffic_filter
+
+    with engine.connect() as conn:
+        legacy = "page_url" in _columns(conn, "page_views")
+    if legacy:
+        # 0009 之前的库：明细行上还有字符串列
+        query = text(
+            "SELECT id, page_url, ip_address, user_agent, traffic_class FROM page_views "
+            "WHERE id > :last_id ORDER BY id LIMIT :limit"
+        )
+    else:
+        query = text(
+            "SELECT p.id, u.value AS page_url, p.ip_address, a.value AS user_agent, p.traffic_class "
+            "FROM page_views AS p LEFT JOIN dim_urls AS u ON u.id = p.url_id "
+            "LEFT JOIN dim_user_agents AS a ON a.id = p.ua_id "
+            "WHERE p.id > :last_id ORDER BY p.id LIMIT :limit"
+        )
+    changed = 0
+    last_id = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(query, {"last_id": last_id, "limit": BATCH_SIZE}).fetchall()
+            if not rows:
+                break
+            updates = []
+            for row in rows:
+                traffic_class = traffic_filter.classify(row.page_url, row.ip_address, row.user_agent)
+                if traffic_class != row.traffic_class:
+                    updates.append({"id": row.id, "traffic_class": traffic_class})
+            if updates:
+                conn.execute(text("UPDATE page_views SET traffic_class = :traffic_class WHERE id = :id"), updates)
+            changed += len(updates)
+            last_id = rows[-1].id
+        if progress:
+            print(f"  page_views id <= {last_id}: {changed} 行已更新", file=sys.stderr)
+    return changed
+
+
+def _0001_page_views_traffic_class(engine):
+    with engine.begin() as conn:
+        if "traffic_class" not in _columns(conn, "page_views"):
+            conn.execute(text("ALTER TABLE page_views ADD COLUMN traffic_class SMALLINT NOT NULL DEFAULT 0"))
+    reclassify_traffic(engine)
+    with engine.begin() as conn:
+        indexes = _indexes(conn, "page_views")
+        if "idx_traffic_timestamp" not in indexes:
+            conn.execute(text("CREATE INDEX idx_traffic_timestamp ON page_views (traffic_class, timestamp)"))
+        if "idx_traffic_url" not in indexes and "page_url" in _columns(conn, "page_views"):
+            conn.execute(text("CREATE INDEX idx_traffic_url ON page_views (traffic_class, page_url)"))
+
+
+# 0002 中各表新增/替换的索引：(表, 索引名, 列, 是否唯一)，以及被取代的旧索引
+SITE_INDEXES = [
+    ("page_views", "idx_site_session_timestamp", "site_id, session_id, timestamp", False),
+    ("page_views", "idx_site_url_timestamp", "site_id, page_url, timestamp", False),
+    ("page_views", "idx_site_traffic_timestamp", "site_id, traffic_class, timestamp", False),
+    ("page_views", "idx_site_traffic_url", "site_id, traffic_class, page_url", False),
+    ("events", "idx_site_event_timestamp", "site_id, timestamp", False),
+    ("events", "idx_site_event_type_timestamp", "site_id, event_type, timestamp", False),
+    ("sessions", "ix_sessions_session_id", "session_id", False),
+    ("sessions", "uq_site_session", "site_id, session_id", True),
+    ("sessions", "idx_site_start_time", "site_id, start_time", False),
+    ("sessions", "idx_site_end_time", "site_id, end_time", False),
+    ("users", "ix_users_user_id", "user_id", False),
+    ("users", "uq_site_user", "site_id, user_id", True),
+    ("users", "idx_site_first_visit", "site_id, first_visit", False),
+    ("aggregated_stats", "idx_site_stat_type_date", "site_id, stat_type, stat_date", False),
+]
+
+SUPERSEDED_INDEXES = [
+    ("page_views", "idx_session_timestamp"),
+    ("page_views", "idx_url_timestamp"),
+    ("page_views", "idx_traffic_timestamp"),
+    ("page_views", "idx_traffic_url"),
+    ("events", "idx_event_type_timestamp"),
+    # 原来 session_id / user_id 全局唯一，改为在站点内唯一
+    ("sessions", "ix_sessions_session_id"),
+    ("sessions", "idx_start_time"),
+    ("users", "ix_users_user_id"),
+    ("users", "idx_user_id"),
+    ("aggregated_stats", "idx_stat_date_type"),
+]
+
+
+def _0002_site_id(engine):
+    from config.settings import settings
+
+    default_site = settings.DEFAULT_SITE_ID.replace("'", "")
+    tables = ["page_views", "events", "sessions", "users", "aggregated_stats"]
+    with engine.begin() as conn:
+        for table in tables:
+            if "site_id" not in _columns(conn, table):
+                conn.execute(text(
+                    f"ALTER TABLE {table} ADD COLUMN site_id VARCHAR(64) NOT NULL DEFAULT '{default_site}'"
+                ))
+        for table, name in SUPERSEDED_INDEXES:
+            if name in _indexes(conn, table) and not _is_site_index(conn, table, name):
+                conn.execute(text(f"DROP INDEX {name}"))
+        for table, name, columns, unique in SITE_INDEXES:
+            # 新建的库没有 page_url 列（见 0009），基于它的索引随后也会被 0006 替换
+            if name not in _indexes(conn, table) and _has_columns(conn, table, columns):
+                conn.execute(text(
+                    f"CREATE {'UNIQUE ' if unique else ''}INDEX {name} ON {table} ({columns})"
+                ))
+
+
+def _has_columns(conn, table, columns):
+    return {c.strip() for c in columns.split(",")} <= _columns(conn, table)
+
+
+def _is_site_index(conn, table, name):
+    """ix_sessions_session_id 等名字在新结构里仍然存在（非唯一），已经是新索引时不要删除"""
+    for index in inspect(conn).get_indexes(table):
+        if index["name"] == name:
+            return not index["unique"] and any(name == n for _, n, _, _ in SITE_INDEXES)
+    return False
+
+
+def _0003_activity_bitmaps(engine):
+    # 表由 create_all 建出，这里用已有的明细回填留存位图
+    from backend.services.retention_service import retention_service
+
+    retention_service.rebuild(engine=engine)
+
+
+def _0004_event_properties(engine):
+    from backend.services.event_property_service import event_property_service
+
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM event_properties"))
+        event_property_service.index_events(conn)
+
+
+def _0005_brin_timestamps(engine):
+    # PostgreSQL 上明细表的时间列改用 BRIN，替换 create_all 早先建出的 B-tree；其它数据库不变
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as conn:
+        for table in ("page_views", "events"):
+            indexes = _indexes(conn, table)
+            if f"brin_{table}_timestamp" not in indexes:
+                conn.execute(text(f"CREATE INDEX brin_{table}_timestamp ON {table} USING brin (timestamp)"))
+            if f"ix_{table}_timestamp" in indexes:
+                conn.execute(text(f"DROP INDEX ix_{table}_timestamp"))
+
+
+# 0006：字典表 -> 引用它的 (表, ID 列, 字符串列)
+DIMENSION_SOURCES = {
+    "dim_urls": [("page_views", "url_id", "page_url"), ("events", "url_id", "page_url")],
+    "dim_titles": [("page_views", "title_id", "page_title")],
+    "dim_user_agents": [("page_views", "ua_id", "user_agent"), ("events", "ua_id", "user_agent"),
+                        ("sessions", "ua_id", "user_agent")],
+    "dim_referrers": [("page_views", "referrer_id", "referrer"), ("sessions", "referrer_id", "referrer")],
+}
+# 被整数 ID 索引取代的字符串索引
+DIMENSION_INDEXES = [
+    ("page_views", "idx_site_url_id_timestamp", "site_id, url_id, timestamp", ("idx_site_url_timestamp", "ix_page_views_page_url")),
+    ("page_views", "idx_site_traffic_url_id", "site_id, traffic_class, url_id", ("idx_site_traffic_url",)),
+    ("page_views", "idx_site_referrer_id", "site_id, referrer_id", ()),
+    ("page_views", "idx_site_ua_id", "site_id, ua_id", ()),
+]
+
+
+def _backfill_dimensions(engine):
+    """把明细表字符串列中的值写入字典表，并给还没有字典 ID 的行回填 ID；已经没有字符串列的表跳过"""
+    for dim_table, sources in DIMENSION_SOURCES.items():
+        with engine.connect() as conn:
+            sources = [(table, id_column, column) for table, id_column, column in sources
+                       if column in _columns(conn, table)]
+        if not sources:
+            continue
+        values = " UNION ".join(
+            f"SELECT {column} AS value FROM {table} WHERE {column} IS NOT NULL" for table, _, column in sources
+        )
+        with engine.begin() as conn:
+            conn.execute(text(
+                f"INSERT INTO {dim_table} (value) SELECT DISTINCT v.value FROM ({values}) AS v "
+                f"WHERE NOT EXISTS (SELECT 1 FROM {dim_table} AS d WHERE d.value = v.value)"
+            ))
+        for table, id_column, column in sources:
+            with engine.begin() as conn:
+                conn.execute(text(
+                    f"UPDATE {table} SET {id_column} = (SELECT d.id FROM {dim_table} AS d WHERE d.value = {table}.{column}) "
+                    f"WHERE {id_column} IS NULL AND {column} IS NOT NULL"
+                ))
+
+
+def _0006_dimensions(engine):
+    """明细表加上字典 ID 列，把已有的字符串写入字典表并回填 ID，再用整数索引替换 URL 字符串索引"""
+    with engine.begin() as conn:
+        for sources in DIMENSION_SOURCES.values():
+            for table, id_column, _ in sources:
+                if id_column not in _columns(conn, table):
+                    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {id_column} INTEGER"))
+
+    _backfill_dimensions(engine)
+
+    with engine.begin() as conn:
+        for table, name, columns, superseded in DIMENSION_INDEXES:
+            indexes = _indexes(conn, table)
+            for old in superseded:
+                if old in indexes:
+                    conn.execute(text(f"DROP INDEX {old}"))
+            if name not in indexes:
+                conn.execute(text(f"CREATE INDEX {name} ON {table} ({columns})"))
+        # 新索引要有统计信息，查询计划才会选用它们
+        conn.execute(text("ANALYZE"))
+
+
+def _0007_duration_sketches(engine):
+    # 表由 create_all 建出，这里用已有会话的时长回填会话草图；页面停留时长没有明细，从空开始
+    from backend.services.duration_service import duration_service
+
+    duration_service.rebuild_sessions(engine=engine)
+
+
+def _0008_path_tries(engine):
+    # 表由 create_all 建出，这里用已有的页面浏览建出每天的路径前缀树
+    from backend.services.path_service import path_service
+
+    path_service.rebuild(engine=engine)
+
+
+def _0009_drop_hit_strings(engine):
+    """
+    明细表只保留字典 ID：先补齐还没有 ID 的行，再删掉引用字符串列的索引和字符串列本身。
+    SQLite 删除列后文件不会自动变小，空出的页由之后的写入复用，或者手动执行 VACUUM。
+    """
+    _backfill_dimensions(engine)
+    strings = {}
+    for sources in DIMENSION_SOURCES.values():
+        for table, _, column in sources:
+            strings.setdefault(table, set()).add(column)
+    for table, columns in strings.items():
+        with engine.begin() as conn:
+            existing = columns & _columns(conn, table)
+            if not existing:
+                continue
+            for index in inspect(conn).get_indexes(table):
+                if existing & set(index["column_names"]):
+                    conn.execute(text(f"DROP INDEX {index['name']}"))
+            for column in sorted(existing):
+                conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {column}"))
+
+
+MIGRATIONS = [
+    ("0001_page_views_traffic_class", _0001_page_views_traffic_class),
+    ("0002_site_id", _0002_site_id),
+    ("0003_activity_bitmaps", _0003_activity_bitmaps),
+    ("0004_event_properties", _0004_event_properties),
+    ("0005_brin_timestamps", _0005_brin_timestamps),
+    ("0006_dimensions", _0006_dimensions),
+    ("0007_duration_sketches", _0007_duration_sketches),
+    ("0008_path_tries", _0008_path_tries),
+    ("0009_drop_hit_strings", _0009_drop_hit_strings),
+]
+
+
+def run_migrations(engine, progress: bool = False):
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations (name VARCHAR(100) PRIMARY KEY, applied_at TIMESTAMP)"
+        ))
+        applied = {row[0] for row in conn.execute(text("SELECT name FROM schema_migrations"))}
+
+    for name, migrate in MIGRATIONS:
+        if name in applied:
+            continue
+        if progress:
+            print(f"执行迁移 {name}", file=sys.stderr)
+        migrate(engine)
+        with engine.begin() as conn:
+            conn.execute(
+                text("INSERT INTO schema_migrations (name, applied_at) VALUES (:name, :applied_at)"),
+                {"name": name, "applied_at": datetime.utcnow()}
+            )
+
+
+def main(argv=None):
+    from backend.models.database import Base, engine
+
+    parser = argparse.ArgumentParser(description="数据库迁移")
+    parser.add_argument("--reclassify", action="store_true", help="按当前规则重新回填 page_views.traffic_class")
+    parser.add_argument("--rebuild-retention", action="store_true", help="从 users 和 page_views 重建留存位图")
+    parser.add_argument("--backfill-geo", action="store_true", help="按 GeoIP 库回填会话的 country/city 并重算地理汇总")
+    parser.add_argument("--rebuild-durations", action="store_true", help="从 sessions 重建会话时长草图")
+    parser.add_argument("--rebuild-paths", action="store_true", help="从 page_views 重建每天的会话路径前缀树")
+    args = parser.parse_args(argv)
+
+    Base.metadata.create_all(bind=engine)
+    run_migrations(engine, progress=True)
+    if args.reclassify:
+        changed = reclassify_traffic(engine, progress=True)
+        print(f"traffic_class 已更新 {changed} 行", file=sys.stderr)
+    if args.rebuild_retention:
+        from backend.services.retention_service import retention_service, ENCODING
+
+        written = retention_service.rebuild()
+        print(f"已写入 {written} 个留存位图（{ENCODING}）", file=sys.stderr)
+    if args.backfill_geo:
+        from backend.services.geo_service import geo_service
+
+        updated = geo_service.backfill()
+        geo_service.rollup()
+        print(f"country/city 已更新 {updated} 个会话", file=sys.stderr)
+    if args.rebuild_durations:
+        from backend.services.duration_service import duration_service
+
+        written = duration_service.rebuild_sessions()
+        print(f"已写入 {written} 个会话时长草图", file=sys.stderr)
+    if args.rebuild_paths:
+        from backend.services.path_service import path_service
+
+        written = path_service.rebuild()
+        print(f"已写入 {written} 棵路径前缀树", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
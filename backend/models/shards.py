@@ -0,0 +1,252 @@
+"""
+按用户分片的 SQLite 存储
+
+SQLite 同一时间只有一个写事务，单个文件的写入速度就是采集的上限。SHARD_COUNT 大于 1 时追踪数据按
+user_id 的 CRC32（没有 user_id 的匿名访问按 session_id）写入 SHARD_COUNT 个 SQLite 文件（WAL 模式），
+每个分片有自己的写线程。同一用户的用户行、会话、浏览和事件总在同一个分片里，所以每个用户只存在一次：
+按会话计算的统计（访客、漏斗、路径、会话时长）和按用户计算的统计（新老用户、留存）在各分片内都是完整的，
+合并时直接相加。时长记录可能不带 user_id（旧版 tracker），这时用 shards.locate 找到会话所在的分片。
+
+分片通过 ContextVar 选择：在 shards.use(i) 之内，get_db/get_read_db 打开第 i 个分片的连接，所以服务代码
+不需要知道分片的存在。另外提供三种接入方式：
+    - @sharded(merge)：分片模式下在所有分片上并行执行被装饰的函数，再用 merge(各分片结果, 调用参数) 合并；
+      已经在某个分片中（或未启用分片）时直接执行
+    - shard_local(factory)：带有进程内状态（待写回的计数、缓存）的单例每个分片各一份，属性访问转给当前分片的实例
+    - shards.routed(user_id, session_id)：在该用户所在的分片中执行（spool 关闭时的直接写入）
+匿名访问共用的 user_id 为空的用户行在每个分片各有一行，只有第 0 个分片的那一行参与用户计数
+（见 shards.counts_anonymous）。字典表各分片各有一份，字典 ID 只在分片内有效，合并结果时一律换回字符串。
+"""
+import functools
+import inspect
+import logging
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from contextvars import copy_context
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.orm import sessionmaker
+
+from config.settings import settings, BASE_DIR
+from .database import Base, Session as SessionModel, active_shard, sql_profiler, statement_guard
+
+logger = logging.getLogger("raymond.shards")
+
+# locate 记住的最近路由过的会话数
+SESSION_MEMO_SIZE = 100000
+
+def _wal_pragmas(dbapi_connection, connection_record):
+    # 读连接不阻塞写线程；每个事务提交时不必等待 fsync，检查点时才落盘
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+class Shard:
+    def __init__(self, index: int, path: str):
+        self.index = index
+        self.path = path
+        self.url = f"sqlite:///{path}"
+        self.engine = create_engine(self.url, echo=False, connect_args={"check_same_thread": False})
+        event.listen(self.engine, "connect", _wal_pragmas)
+        self.read_engine = create_engine(
+            f"sqlite:///file:{path}?mode=ro&uri=true",
+            connect_args={"check_same_thread": False},
+            echo=False
+        )
+        for target in (self.engine, self.read_engine):
+            sql_profiler.install(target)
+            statement_guard.install(target)
+        self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        self.ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.read_engine)
+
+    def __repr__(self):
+        return f"<Shard {self.index} {self.path}>"
+
+def shard_paths(count: int, paths: List[str]) -> List[str]:
+    """SHARD_PATHS 为空时使用 data/shards/shard_00.db 等"""
+    if not paths:
+        return [str(BASE_DIR / "data" / "shards" / f"shard_{i:02d}.db") for i in range(count)]
+    if len(paths) != count:
+        raise ValueError(f"SHARD_PATHS 有 {len(paths)} 项，与 SHARD_COUNT={count} 不一致")
+    return list(paths)
+
+def shard_of(key: Optional[str], count: int) -> int:
+    """路由键（user_id，匿名时为 session_id）所在的分片：CRC32 取模，跨进程、跨版本稳定；没有路由键的记录归第 0 个分片"""
+    if count <= 1 or not key:
+        return 0
+    return zlib.crc32(key.encode("utf-8")) % count
+
+class ShardSet:
+
+    def __init__(self, count: int = settings.SHARD_COUNT, paths: List[str] = settings.SHARD_PATHS,
+                 query_workers: int = settings.SHARD_QUERY_WORKERS, topk_slack: int = settings.SHARD_TOPK_SLACK):
+        self.shards = [Shard(i, path) for i, path in enumerate(shard_paths(count, paths))] if count > 1 else []
+        self.topk_slack = topk_slack
+        self._sessions: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, query_workers), thread_name_prefix="shard-query") \
+            if self.shards else None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.shards)
+
+    def __len__(self):
+        return len(self.shards)
+
+    def __iter__(self):
+        return iter(self.shards)
+
+    def __getitem__(self, index: int) -> Shard:
+        return self.shards[index]
+
+    def route(self, user_id: Optional[str], session_id: Optional[str]) -> int:
+        index = shard_of(user_id or session_id, len(self.shards))
+        if user_id and session_id:
+            # 同一批里随后的时长记录可能不带 user_id，记下会话的分片供 locate 使用
+            with self._lock:
+                self._sessions[session_id] = index
+                self._sessions.move_to_end(session_id)
+                if len(self._sessions) > SESSION_MEMO_SIZE:
+                    self._sessions.popitem(last=False)
+        return index
+
+    def locate(self, site_id: str, session_id: Optional[str]) -> int:
+        """
+        不带 user_id 的时长记录：先查本进程最近路由过的会话，再在各分片中查找该会话（sessions 的唯一索引），
+        都找不到时按 session_id 路由，与匿名会话的写入位置一致
+        """
+        if len(self.shards) > 1 and session_id:
+            with self._lock:
+                index = self._sessions.get(session_id)
+            if index is not None:
+                return index
+            query = select(SessionModel.id).where(
+                SessionModel.site_id == site_id, SessionModel.session_id == session_id
+            ).limit(1)
+            for shard in self.shards:
+                with shard.read_engine.connect() as conn:
+                    if conn.execute(query).first() is not None:
+                        return shard.index
+        return self.route(None, session_id)
+
+    @staticmethod
+    def current() -> Optional[Shard]:
+        return active_shard.get()
+
+    @contextmanager
+    def use(self, index: int):
+        """在上下文中 get_db/get_read_db 使用第 index 个分片"""
+        token = active_shard.set(self.shards[index])
+        try:
+            yield self.shards[index]
+        finally:
+            active_shard.reset(token)
+
+    def routed(self, user_id: Optional[str], session_id: Optional[str]):
+        """用户所在分片的上下文，未启用分片时什么也不做"""
+        return self.use(self.route(user_id, session_id)) if self.shards else nullcontext()
+
+    def located(self, site_id: str, session_id: Optional[str]):
+        """会话所在分片的上下文（见 locate），未启用分片时什么也不做"""
+        return self.use(self.locate(site_id, session_id)) if self.shards else nullcontext()
+
+    @staticmethod
+    def counts_anonymous() -> bool:
+        """user_id 为空的匿名用户行是否计入用户数：分片模式下只在第 0 个分片计入，每个分片都有这样一行"""
+        shard = active_shard.get()
+        return shard is None or shard.index == 0
+
+    def widen(self, limit: int) -> int:
+        """在分片中计算前 N 项时多取 SHARD_TOPK_SLACK 条，合并后的前 N 项才不会漏掉分布在各分片的大项"""
+        return limit + self.topk_slack if active_shard.get() is not None else limit
+
+    def map(self, fn: Callable, *args, **kwargs) -> List[Any]:
+        """在每个分片上并行执行 fn，按分片顺序返回结果；复制调用方的上下文（语句超时随之生效）"""
+        def run(index: int):
+            with self.use(index):
+                return fn(*args, **kwargs)
+        futures = [self._executor.submit(copy_context().run, run, shard.index) for shard in self.shards]
+        return [future.result() for future in futures]
+
+    def each(self, fn: Callable, *args, **kwargs) -> List[Any]:
+        """依次在每个分片上执行 fn（维护操作），未启用分片时只在主库上执行一次"""
+        if not self.shards:
+            return [fn(*args, **kwargs)]
+        results = []
+        for shard in self.shards:
+            with self.use(shard.index):
+                results.append(fn(*args, **kwargs))
+        return results
+
+    def init(self):
+        """建表并执行迁移，应用启动时在 init_db 之后调用"""
+        from .migrations import run_migrations
+
+        for shard in self.shards:
+            Path(shard.path).parent.mkdir(parents=True, exist_ok=True)
+            with self.use(shard.index):
+                Base.metadata.create_all(bind=shard.engine)
+                run_migrations(shard.engine)
+
+shards = ShardSet()
+
+def sharded(merge: Optional[Callable[[List[Any], Dict[str, Any]], Any]] = None):
+    """
+    分片模式下在所有分片上并行执行被装饰的函数，返回 merge(各分片结果, 绑定了默认值的调用参数)；
+    merge 为空时返回结果列表。装饰 shard_local 单例的方法时，每个分片调用的是该分片自己的实例。
+    调用时传入了 engine 参数（迁移指定的数据库）时只在该数据库上执行。
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not shards.enabled or active_shard.get() is not None or kwargs.get("engine") is not None:
+                return fn(*args, **kwargs)
+            owner = getattr(args[0], "_shard_local", None) if args else None
+            if owner is None:
+                partials = shards.map(fn, *args, **kwargs)
+            else:
+                partials = shards.map(lambda: fn(owner._instance(), *args[1:], **kwargs))
+            if merge is None:
+                return partials
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return merge(partials, bound.arguments)
+        return wrapper
+    return decorator
+
+class ShardLocal:
+    """每个分片各一份的单例：属性访问转给当前分片的实例，分片之外是主库的实例"""
+
+    def __init__(self, factory: Callable[[], Any]):
+        self._factory = factory
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def _instance(self):
+        shard = active_shard.get()
+        key = shard.index if shard is not None else None
+        instance = self._instances.get(key)
+        if instance is None:
+            with self._lock:
+                instance = self._instances.get(key)
+                if instance is None:
+                    instance = self._factory()
+                    instance._shard_local = self
+                    self._instances[key] = instance
+        return instance
+
+    def __getattr__(self, name):
+        return getattr(self._instance(), name)
+
+def shard_local(factory: Callable[[], Any]):
+    """未启用分片时直接返回 factory() 的实例"""
+    return ShardLocal(factory) if shards.enabled else factory()
@@ -1,9 +1,33 @@
-from .cache_service import redis_service, RedisService
+from .cache_service import redis_service, RedisService, LocalTTLCache, site_key
 from .stats_service import stats_service, StatsService
+from .flow_service import flow_service, FlowService
+from .path_service import path_service, PathService
+from .funnel_service import funnel_service, FunnelService
+from .retention_service import retention_service, RetentionService
+from .event_property_service import event_property_service, EventPropertyService
+from .geo_service import geo_service, GeoService
+from .dimension_service import dimension_service, DimensionService
+from .duration_service import duration_service, DurationService
+from .identity_cache import identity_cache, IdentityCache
+from .hot_window import hot_window, HotWindow
 from .tracking_service import tracking_service, TrackingService
+from .export_service import export_service, ExportService
+from .workload import workload_manager, WorkloadManager, WorkloadRejected
 
 __all__ = [
-    "redis_service", "RedisService",
+    "redis_service", "RedisService", "LocalTTLCache", "site_key",
     "stats_service", "StatsService",
-    "tracking_service", "TrackingService"
+    "flow_service", "FlowService",
+    "path_service", "PathService",
+    "funnel_service", "FunnelService",
+    "retention_service", "RetentionService",
+    "event_property_service", "EventPropertyService",
+    "geo_service", "GeoService",
+    "dimension_service", "DimensionService",
+    "duration_service", "DurationService",
+    "identity_cache", "IdentityCache",
+    "hot_window", "HotWindow",
+    "tracking_service", "TrackingService",
+    "export_service", "ExportService",
+    "workload_manager", "WorkloadManager", "WorkloadRejected"
 ]
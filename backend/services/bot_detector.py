@@ -0,0 +1,155 @@
+import re
+import threading
+import time
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from config.settings import settings
+from backend.services.cache_service import redis_service, site_key
+from backend.utils.metrics import Counter
+
+BOT_HITS = Counter("ra_bot_hits_total", "识别为爬虫的追踪请求数", ["reason", "type"])
+
+
+class BotVerdict(NamedTuple):
+    is_bot: bool
+    reason: Optional[str] = None
+
+
+HUMAN = BotVerdict(False)
+
+
+def load_signatures(path: str, extra: Iterable[str] = ()) -> List[str]:
+    signatures = []
+    file = Path(path)
+    if file.exists():
+        for line in file.read_text(encoding="utf-8").splitlines():
+            line = line.strip()
+            if line and not line.startswith("#"):
+                signatures.append(line.lower())
+    signatures.extend(s.lower() for s in extra if s)
+    # 去重并保持顺序
+    return list(dict.fromkeys(signatures))
+
+
+def compile_signatures(signatures: Iterable[str]) -> Optional["re.Pattern"]:
+    """
+    把特征串编译成按前缀树展开的正则，例如 bot/bingbot/baiduspider ->
+    (?:b(?:aiduspider|ingbot|ot))。每个位置最多沿一条分支匹配，避免普通多选一正则
+    在每个位置逐个尝试所有特征。调用方需要先把 UA 转成小写。
+    """
+    trie: Dict[str, dict] = {}
+    for signature in signatures:
+        node = trie
+        for ch in signature.lower():
+            node = node.setdefault(ch, {})
+        node[""] = {}
+    if not trie:
+        return None
+
+    def emit(node) -> str:
+        branches = [re.escape(ch) + emit(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        optional = "" in node
+        if len(branches) == 1 and not optional:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")" + ("?" if optional else "")
+
+    return re.compile(emit(trie))
+
+
+class RateTracker:
+    """
+    固定窗口计数器：统计每个 key 在当前窗口内的请求数，超过 max_hits 即判定为异常。
+    条目数超过 max_keys 时清理已过期的窗口，保证内存有界。
+    """
+
+    def __init__(self, window_seconds: int, max_per_second: float, max_keys: int = 100000):
+        self.window = max(1, window_seconds)
+        self.max_hits = max(1, int(max_per_second * self.window))
+        self.max_keys = max_keys
+        self._counts: Dict[str, Tuple[int, int]] = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key: str, now: Optional[float] = None) -> bool:
+        """记录一次请求，返回是否超过频率上限"""
+        window = int((now if now is not None else time.monotonic()) // self.window)
+        with self._lock:
+            start, count = self._counts.get(key, (window, 0))
+            if start != window:
+                start, count = window, 0
+            count += 1
+            self._counts[key] = (start, count)
+            if len(self._counts) > self.max_keys:
+                self._counts = {k: v for k, v in self._counts.items() if v[0] == window}
+        return count > self.max_hits
+
+
+class BotDetector:
+    """
+    在写库之前识别爬虫：UA 用所有特征编译成的前缀树正则一次扫描完成并按 UA 缓存结果，
+    再按 IP 和会话的请求频率做行为判断（上限为 0 的维度不判断，按 IP 默认关闭）。
+    """
+
+    def __init__(self, signatures: Iterable[str], empty_ua_is_bot: bool = True,
+                 rate_window_seconds: int = 10, max_hits_per_second_ip: float = 0,
+                 max_hits_per_second_session: float = 5.0, action: str = "count", cache_size: int = 4096):
+        self.signatures = list(signatures)
+        self.empty_ua_is_bot = empty_ua_is_bot
+        self.action = action
+        self._pattern = compile_signatures(self.signatures)
+        self.match_user_agent = lru_cache(maxsize=cache_size)(self._match_user_agent)
+        # 上限为 0 时不按该维度判断
+        self.ip_rate = RateTracker(rate_window_seconds, max_hits_per_second_ip) if max_hits_per_second_ip > 0 else None
+        self.session_rate = RateTracker(rate_window_seconds, max_hits_per_second_session) \
+            if max_hits_per_second_session > 0 else None
+
+    @classmethod
+    def from_settings(cls, config=settings):
+        return cls(
+            signatures=load_signatures(config.BOT_SIGNATURES_FILE, config.TRAFFIC_BOT_USER_AGENTS),
+            empty_ua_is_bot=config.BOT_EMPTY_UA_IS_BOT,
+            rate_window_seconds=config.BOT_RATE_WINDOW_SECONDS,
+            max_hits_per_second_ip=config.BOT_MAX_HITS_PER_SECOND_IP,
+            max_hits_per_second_session=config.BOT_MAX_HITS_PER_SECOND_SESSION,
+            action=config.BOT_ACTION,
+        )
+
+    def _match_user_agent(self, user_agent: Optional[str]) -> Optional[str]:
+        """返回命中的特征；没有命中时返回 None"""
+        if not user_agent:
+            return "empty_ua" if self.empty_ua_is_bot else None
+        if self._pattern is None:
+            return None
+        match = self._pattern.search(user_agent.lower())
+        return match.group(0) if match else None
+
+    def is_bot_user_agent(self, user_agent: Optional[str]) -> bool:
+        return self.match_user_agent(user_agent) is not None
+
+    def check(self, user_agent: Optional[str], ip_address: Optional[str] = None,
+              session_id: Optional[str] = None) -> BotVerdict:
+        signature = self.match_user_agent(user_agent)
+        if signature is not None:
+            return BotVerdict(True, "empty_ua" if signature == "empty_ua" else "user_agent")
+        if ip_address and self.ip_rate is not None and self.ip_rate.hit(ip_address):
+            return BotVerdict(True, "ip_rate")
+        if session_id and self.session_rate is not None and self.session_rate.hit(session_id):
+            return BotVerdict(True, "session_rate")
+        return HUMAN
+
+    def should_store(self, verdict: BotVerdict) -> bool:
+        """爬虫请求是否继续走正常的写库流程"""
+        return not verdict.is_bot or self.action == "store"
+
+    def record(self, verdict: BotVerdict, hit_type: str, site_id: Optional[str] = None):
+        """只计数的廉价路径：内存指标 + Redis 当日计数，不访问数据库"""
+        BOT_HITS.labels(verdict.reason, hit_type).inc()
+        if self.action == "count" and redis_service.is_available():
+            today = datetime.utcnow().date().isoformat()
+            redis_service.hincrby(site_key(site_id or settings.DEFAULT_SITE_ID, f"daily_bots:{today}"), verdict.reason)
+
+
+bot_detector = BotDetector.from_settings()
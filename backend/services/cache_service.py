@@ -1,8 +1,18 @@
 import json
+import threading
+import time
 import redis
 from typing import Optional, Dict, Any, List
 from config.settings import settings
 from datetime import datetime, timedelta
+from backend.utils.metrics import CACHE_REQUESTS, CACHE_ERRORS
+
+_cache_hit = CACHE_REQUESTS.labels("hit")
+_cache_miss = CACHE_REQUESTS.labels("miss")
+
+def site_key(site_id: str, key: str) -> str:
+    """按站点划分 Redis 键空间，例如 site:blog:stats:online_users"""
+    return f"site:{site_id}:{key}"
 
 class RedisService:
     def __init__(self):
@@ -11,6 +21,7 @@ class RedisService:
             self.available = True
             self.redis.ping()
         except:
+            CACHE_ERRORS.labels("connect").inc()
             self.available = False
             self.redis = None
     
@@ -21,6 +32,7 @@ class RedisService:
             self.redis.ping()
             return True
         except:
+            CACHE_ERRORS.labels("ping").inc()
             self.available = False
             return False
     
@@ -42,7 +54,9 @@ class RedisService:
         
         value = self.redis.get(key)
         if value is None:
+            _cache_miss.inc()
             return None
+        _cache_hit.inc()
         
         try:
             return json.loads(value)
@@ -76,7 +90,9 @@ class RedisService:
             return None
         value = self.redis.hget(name, key)
         if value is None:
+            _cache_miss.inc()
             return None
+        _cache_hit.inc()
         try:
             return json.loads(value)
         except:
@@ -114,4 +130,34 @@ class RedisService:
             return 0.0
         return self.redis.zincrby(name, amount, member)
 
+class LocalTTLCache:
+    """进程内的有界 TTL 缓存，Redis 不可用时作为兜底"""
+    
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self._data: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            return None
+        return value
+    
+    def set(self, key: str, value: Any, expire: int):
+        with self._lock:
+            if len(self._data) >= self.max_size and key not in self._data:
+                now = time.monotonic()
+                self._data = {k: v for k, v in self._data.items() if v[0] >= now}
+                if len(self._data) >= self.max_size:
+                    self._data.pop(next(iter(self._data)))
+            self._data[key] = (time.monotonic() + expire, value)
+    
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
 redis_service = RedisService()
@@ -0,0 +1,212 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+from sqlalchemy import insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from config.settings import settings
+from backend.models import (
+    UrlDimension, TitleDimension, UserAgentDimension, ReferrerDimension, engine as default_engine, get_db, shards
+)
+
+LOOKUP_CHUNK = 500
+
+DIMENSIONS = {
+    "url": UrlDimension,
+    "title": TitleDimension,
+    "user_agent": UserAgentDimension,
+    "referrer": ReferrerDimension,
+}
+
+# 明细表的 ID 列 -> (字典类别, 记录中对应的字符串字段)
+DIMENSION_COLUMNS = {
+    "url_id": ("url", "page_url"),
+    "title_id": ("title", "page_title"),
+    "referrer_id": ("referrer", "referrer"),
+    "ua_id": ("user_agent", "user_agent"),
+}
+PAGE_VIEW_DIMENSIONS = ("url_id", "title_id", "referrer_id", "ua_id")
+EVENT_DIMENSIONS = ("url_id", "ua_id")
+SESSION_DIMENSIONS = ("ua_id", "referrer_id")
+
+class Decoded(NamedTuple):
+    """DimensionService.decode 的结果：select 的列（ID 列换成字符串）、连接了字典表的 FROM，以及 字段名 -> 字符串列"""
+    columns: list
+    source: object
+    fields: Dict[str, object]
+
+class InternCache:
+    """字符串 -> ID 的有界 LRU：满了逐个淘汰最久没用到的值，热门值一直留在缓存里"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._items: "OrderedDict[str, int]" = OrderedDict()
+
+    def get(self, value: str) -> Optional[int]:
+        value_id = self._items.get(value)
+        if value_id is not None:
+            self._items.move_to_end(value)
+        return value_id
+
+    def update(self, resolved: Dict[str, int]):
+        for value, value_id in resolved.items():
+            self._items[value] = value_id
+            self._items.move_to_end(value)
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+def _insert_ignore(table, dialect_name: str):
+    """已存在的值跳过：并发写入同一个新值时只有一行生效，之后统一再查一次 ID"""
+    if dialect_name == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+    if dialect_name == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    return insert(table)
+
+class DimensionService:
+    """
+    URL、标题、UA、来源的字典编码：字符串第一次出现时写入对应的字典表，之后在进程内缓存 字符串 -> ID，
+    所有值都在缓存中时 encode 不打开数据库连接。有新值时在独立的短事务中写入并立即提交，所以要在打开明细的
+    写事务之前调用（SQLite 同一时间只有一个写事务）；明细事务回滚时字典里多出的行没有影响。
+    """
+
+    def __init__(self, cache_size: int = settings.DIMENSION_CACHE_SIZE):
+        self.cache_size = cache_size
+        # 按 (数据库 URL, 类别) 分开缓存，基准测试和分片模式会在同一进程里使用多个数据库
+        self._caches: Dict[Tuple[object, str], InternCache] = {}
+        self._lock = threading.Lock()
+
+    def encode(self, records: List[dict], columns: Iterable[str] = PAGE_VIEW_DIMENSIONS,
+               engine=None) -> List[Dict[str, Optional[int]]]:
+        """返回每条记录的 {ID 列: 字典 ID}，字符串为空的字段对应 None；engine 为空时使用 get_db 的数据库"""
+        if not records:
+            return []
+        columns = list(columns)
+        kinds = {}
+        for column in columns:
+            kind, field = DIMENSION_COLUMNS[column]
+            kinds.setdefault(kind, set()).update(
+                record.get(field) for record in records if record.get(field) is not None
+            )
+
+        # 先查缓存，只有缓存中缺少某些值时才连接数据库
+        url = self._engine(engine).url
+        ids, missing = {}, {}
+        with self._lock:
+            for kind, values in kinds.items():
+                cache = self._cache(url, kind)
+                found = ids[kind] = {}
+                for value in values:
+                    value_id = cache.get(value)
+                    if value_id is None:
+                        missing.setdefault(kind, []).append(value)
+                    else:
+                        found[value] = value_id
+
+        if missing and engine is not None:
+            with engine.begin() as conn:
+                for kind, values in missing.items():
+                    ids[kind].update(self._resolve(conn, kind, values))
+        elif missing:
+            db = next(get_db())
+            try:
+                conn = db.connection()
+                for kind, values in missing.items():
+                    ids[kind].update(self._resolve(conn, kind, values))
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+
+        encoded = []
+        for record in records:
+            row = {}
+            for column in columns:
+                kind, field = DIMENSION_COLUMNS[column]
+                value = record.get(field)
+                row[column] = ids[kind][value] if value is not None else None
+            encoded.append(row)
+        return encoded
+
+    def replace(self, rows: List[dict], columns: Iterable[str], engine=None):
+        """把 rows 中的字符串字段就地换成字典 ID 列，用于批量写入明细表（明细表只保存 ID）"""
+        columns = list(columns)
+        for row, ids in zip(rows, self.encode(rows, columns, engine=engine)):
+            for column in columns:
+                row.pop(DIMENSION_COLUMNS[column][1], None)
+            row.update(ids)
+
+    def decode(self, table, exclude: Iterable[str] = ()) -> Decoded:
+        """
+        读取明细表时把字典 ID 列换回字符串：每个 ID 列左连接对应的字典表，在原位置输出同名字符串字段
+        （url_id -> page_url），exclude 中的列不输出
+        """
+        exclude = set(exclude)
+        columns, fields, source = [], {}, table
+        for column in table.c:
+            if column.name in exclude:
+                continue
+            if column.name not in DIMENSION_COLUMNS:
+                columns.append(column)
+                continue
+            kind, field = DIMENSION_COLUMNS[column.name]
+            dim = DIMENSIONS[kind].__table__.alias(f"{table.name}_{field}")
+            source = source.outerjoin(dim, dim.c.id == column)
+            fields[field] = dim.c.value
+            columns.append(dim.c.value.label(field))
+        return Decoded(columns, source, fields)
+
+    def clear(self):
+        """丢弃缓存，数据库被重建后调用"""
+        with self._lock:
+            self._caches = {}
+
+    @staticmethod
+    def _engine(engine=None):
+        """encode 实际写入的数据库：指定的 engine，或 get_db 使用的（当前分片或主库）"""
+        if engine is not None:
+            return engine
+        shard = shards.current()
+        return shard.engine if shard is not None else default_engine
+
+    def _cache(self, url, kind: str) -> InternCache:
+        cache = self._caches.get((url, kind))
+        if cache is None:
+            cache = self._caches[(url, kind)] = InternCache(self.cache_size)
+        return cache
+
+    def _resolve(self, conn, kind: str, missing: List[str]) -> Dict[str, int]:
+        """缓存中没有的值：查字典表，仍然没有的插入后再查一次，结果放入缓存"""
+        table = DIMENSIONS[kind].__table__
+        resolved = self._lookup(conn, table, missing)
+        new = [value for value in missing if value not in resolved]
+        if new:
+            conn.execute(_insert_ignore(table, conn.dialect.name), [{"value": value} for value in new])
+            resolved.update(self._lookup(conn, table, new))
+
+        with self._lock:
+            self._cache(conn.engine.url, kind).update(resolved)
+        return resolved
+
+    def _lookup(self, conn, table, values: List[str]) -> Dict[str, int]:
+        found = {}
+        for i in range(0, len(values), LOOKUP_CHUNK):
+            rows = conn.execute(select(table.c.value, table.c.id).where(table.c.value.in_(values[i:i + LOOKUP_CHUNK])))
+            found.update({row.value: row.id for row in rows})
+        return found
+
+    def names(self, db, kind: str, ids: Iterable[int]) -> Dict[int, str]:
+        """按 ID 取回字符串，用于统计结果的前 N 项"""
+        table = DIMENSIONS[kind].__table__
+        ids = [value_id for value_id in set(ids) if value_id is not None]
+        names = {}
+        for i in range(0, len(ids), LOOKUP_CHUNK):
+            rows = db.execute(select(table.c.id, table.c.value).where(table.c.id.in_(ids[i:i + LOOKUP_CHUNK])))
+            names.update({row.id: row.value for row in rows})
+        return names
+
+dimension_service = DimensionService()
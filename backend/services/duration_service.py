@@ -0,0 +1,353 @@
+"""
+时长分布：会话时长和页面停留时长的分位数与直方图。
+
+每个 (站点, 类型, 页面, 时间桶) 保存一个 DDSketch：正数按 γ=(1+α)/(1-α) 的对数分桶，每个桶只存计数，
+任意分位数的相对误差不超过 α，两个草图的桶计数相加就是合并。时长像素写入后 TrackingService
+把增量记在内存里，由定时任务和关闭时的钩子并入已存的草图；范围查询只取出窗口内的草图相加（尚未写回的增量
+在内存中一并加上，查询不写库），不再排序原始行。
+
+会话草图与 sessions.duration 保持一致：同一会话再次上报时减去旧值、加上新值，草图里是每个会话当前的时长
+（只计大于 0 的），可用 python -m backend.models.migrations --rebuild-durations 从 sessions 重建。
+页面停留时长来自带 page_url 的时长像素，每次上报计一次，没有保存明细，无法重建。
+"""
+import math
+import struct
+import threading
+import zlib
+from bisect import bisect_right
+from datetime import datetime, time, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+from config.settings import settings
+from backend.models import DurationSketch, Session, UrlDimension, get_db, get_read_db, open_db, shards, sharded, shard_local
+from backend.services.dimension_service import dimension_service
+from backend.services.shard_merge import total as total_of
+from backend.utils.metrics import timed, STATS_QUERY_SECONDS
+
+KIND_SESSION = "session"
+KIND_PAGE = "page"
+KIND_PAGE_URL = "page_url"
+ALL_PAGES = 0
+PERCENTILES = (50, 75, 90, 95, 99)
+
+class DDSketch:
+    """只接受正数的 DDSketch；计数可以为负，用于表示待从已存草图中减去的值"""
+    __slots__ = ("accuracy", "gamma", "_log_gamma", "counts")
+
+    def __init__(self, accuracy: float = settings.DURATION_SKETCH_ACCURACY):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.counts = {}
+
+    def add(self, value: float, weight: int = 1):
+        index = math.ceil(math.log(value) / self._log_gamma)
+        self.counts[index] = self.counts.get(index, 0) + weight
+
+    def value(self, index: int) -> float:
+        """桶的代表值，与桶内任何值的相对误差不超过 accuracy"""
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def merge(self, other: "DDSketch") -> "DDSketch":
+        if other.accuracy != self.accuracy:
+            other = other.rebucket(self.accuracy)
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        return self
+
+    def rebucket(self, accuracy: float) -> "DDSketch":
+        """换成另一个精度：按代表值重新分桶，修改 DURATION_SKETCH_ACCURACY 后读取旧草图时使用"""
+        sketch = DDSketch(accuracy)
+        for index, count in self.counts.items():
+            sketch.add(self.value(index), count)
+        return sketch
+
+    def compact(self) -> "DDSketch":
+        """去掉计数不为正的桶（减去的值早于草图记录时会出现负数）"""
+        self.counts = {index: count for index, count in self.counts.items() if count > 0}
+        return self
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts.values())
+
+    def quantile(self, q: float) -> Optional[float]:
+        total = self.count
+        if total <= 0:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen > rank:
+                return self.value(index)
+        return self.value(max(self.counts))
+
+    def histogram(self, edges: List[float]) -> List[int]:
+        """按分界 edges 统计的个数，长度为 len(edges) + 1，最后一格是最大分界以上"""
+        bins = [0] * (len(edges) + 1)
+        for index, count in self.counts.items():
+            bins[bisect_right(edges, self.value(index))] += count
+        return bins
+
+    def serialize(self) -> bytes:
+        flat = [value for item in sorted(self.counts.items()) for value in item]
+        return zlib.compress(struct.pack(f"<{len(flat)}q", *flat))
+
+    @classmethod
+    def deserialize(cls, data: bytes, accuracy: float) -> "DDSketch":
+        raw = zlib.decompress(data)
+        flat = struct.unpack(f"<{len(raw) // 8}q", raw)
+        sketch = cls(accuracy)
+        sketch.counts = dict(zip(flat[::2], flat[1::2]))
+        return sketch
+
+def _local(utc_time: datetime) -> datetime:
+    """sessions 表的时间是 UTC，草图的时间桶统一按本地时间"""
+    return utc_time.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+
+def _hour(value: datetime) -> datetime:
+    return value.replace(minute=0, second=0, microsecond=0)
+
+def _day(value: datetime) -> datetime:
+    return datetime.combine(value.date(), time.min)
+
+def _seconds(value: Optional[float]) -> Optional[float]:
+    return round(value, 2) if value is not None else None
+
+def _merge_sketches(partials, arguments=None) -> Tuple["DDSketch", Optional[Dict[str, "DDSketch"]]]:
+    """各分片的草图相加；页面草图按 URL 字符串合并（url_id 只在分片内有效）"""
+    total, pages = partials[0]
+    for other_total, other_pages in partials[1:]:
+        total.merge(other_total)
+        for url, sketch in (other_pages or {}).items():
+            if url in pages:
+                pages[url].merge(sketch)
+            else:
+                pages[url] = sketch
+    return total, pages
+
+class DurationService:
+    """
+    时长分布草图的写入、合并和查询。会话时长和所有页面的停留时长按小时分桶，单个页面按天分桶，
+    查询窗口的起点相应地向下取整到小时或天。
+    """
+
+    def __init__(self, accuracy: float = settings.DURATION_SKETCH_ACCURACY):
+        self.accuracy = accuracy
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def _delta(self, key) -> DDSketch:
+        return self._pending.setdefault(key, DDSketch(self.accuracy))
+
+    def record_session(self, site_id: str, start_time: datetime, old: Optional[float], new: Optional[float]):
+        """写入事务提交后调用：会话时长从 old 改为 new，start_time 是 sessions 表中的 UTC 开始时间"""
+        if not start_time:
+            return
+        with self._lock:
+            delta = self._delta((site_id, KIND_SESSION, ALL_PAGES, _hour(_local(start_time))))
+            if old and old > 0:
+                delta.add(old, -1)
+            if new and new > 0:
+                delta.add(new)
+
+    def record_page(self, site_id: str, url_id: Optional[int], received_at: datetime, duration: Optional[float]):
+        """写入事务提交后调用：一次页面停留时长，received_at 是本地时间"""
+        if not duration or duration <= 0:
+            return
+        with self._lock:
+            self._delta((site_id, KIND_PAGE, ALL_PAGES, _hour(received_at))).add(duration)
+            if url_id:
+                self._delta((site_id, KIND_PAGE_URL, url_id, _day(received_at))).add(duration)
+
+    @sharded(total_of)
+    def flush(self) -> int:
+        """把待合并的增量并入已存的草图，返回写入的草图数；写库失败时放回待合并"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        pending = {key: delta for key, delta in pending.items() if any(delta.counts.values())}
+        if not pending:
+            return 0
+
+        db = next(get_db())
+        try:
+            for key, delta in pending.items():
+                self._merge(db, *key, delta)
+            db.commit()
+            return len(pending)
+        except Exception:
+            db.rollback()
+            with self._lock:
+                for key, delta in pending.items():
+                    self._delta(key).merge(delta)
+            raise
+        finally:
+            db.close()
+
+    def _merge(self, db, site_id: str, kind: str, url_id: int, bucket: datetime, delta: DDSketch):
+        row = db.query(DurationSketch).filter(
+            DurationSketch.site_id == site_id,
+            DurationSketch.kind == kind,
+            DurationSketch.url_id == url_id,
+            DurationSketch.bucket == bucket
+        ).first()
+        sketch = DDSketch(self.accuracy)
+        if row is not None:
+            sketch.merge(DDSketch.deserialize(row.data, row.accuracy))
+        sketch.merge(delta).compact()
+        if row is None:
+            db.add(self._row(site_id, kind, url_id, bucket, sketch))
+            return
+        row.accuracy = sketch.accuracy
+        row.count = sketch.count
+        row.data = sketch.serialize()
+        row.updated_at = datetime.utcnow()
+
+    def _row(self, site_id: str, kind: str, url_id: int, bucket: datetime, sketch: DDSketch) -> DurationSketch:
+        return DurationSketch(
+            site_id=site_id,
+            kind=kind,
+            url_id=url_id,
+            bucket=bucket,
+            accuracy=sketch.accuracy,
+            count=sketch.count,
+            data=sketch.serialize(),
+            updated_at=datetime.utcnow()
+        )
+
+    @sharded(total_of)
+    def rebuild_sessions(self, site_id: Optional[str] = None, engine=None) -> int:
+        """从 sessions.duration 重建会话时长草图，返回写入的草图数；engine 为空时使用 get_db 的数据库"""
+        if engine is None:
+            # 待写回的增量属于 get_db 的数据库，重建其它数据库时保留
+            with self._lock:
+                self._pending = {key: delta for key, delta in self._pending.items()
+                                 if key[1] != KIND_SESSION or (site_id and key[0] != site_id)}
+        db = open_db(engine)
+        try:
+            scope = [DurationSketch.kind == KIND_SESSION]
+            query = select(Session.site_id, Session.start_time, Session.duration).where(
+                Session.duration > 0, Session.start_time.isnot(None)
+            )
+            if site_id:
+                scope.append(DurationSketch.site_id == site_id)
+                query = query.where(Session.site_id == site_id)
+            db.query(DurationSketch).filter(*scope).delete(synchronize_session=False)
+
+            sketches = {}
+            for row in db.execute(query, execution_options={"yield_per": 10000}):
+                key = (row.site_id, _hour(_local(row.start_time)))
+                sketch = sketches.get(key)
+                if sketch is None:
+                    sketch = sketches[key] = DDSketch(self.accuracy)
+                sketch.add(row.duration)
+            db.add_all([
+                self._row(row_site, KIND_SESSION, ALL_PAGES, bucket, sketch)
+                for (row_site, bucket), sketch in sketches.items()
+            ])
+            db.commit()
+            return len(sketches)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    @timed(STATS_QUERY_SECONDS)
+    def get_durations(self, kind: str = KIND_SESSION, days: int = 7, url: Optional[str] = None,
+                      start: Optional[datetime] = None, end: Optional[datetime] = None, limit: int = 10,
+                      site_id: str = settings.DEFAULT_SITE_ID) -> Dict[str, Any]:
+        """
+        [start, end) 内的时长分位数和直方图，start 为空时取最近 days 天（含今天）。
+        kind=page 且不指定 url 时另外返回停留时长样本最多的 limit 个页面各自的分位数。
+        """
+        if kind not in (KIND_SESSION, KIND_PAGE):
+            raise ValueError(f"kind 只能是 {KIND_SESSION}、{KIND_PAGE}")
+        if url is not None and kind != KIND_PAGE:
+            raise ValueError("url 只能与 kind=page 一起使用")
+
+        end = end or datetime.now()
+        start = start or _day(end - timedelta(days=days - 1))
+        result = {"kind": kind, "start": start.isoformat(), "end": end.isoformat()}
+        if url is not None:
+            result["url"] = url
+        total, pages = self._sketches(kind, url, start, end, limit, site_id)
+        result.update(self._summary(total))
+        if pages is not None:
+            top = sorted(pages.items(), key=lambda item: item[1].count, reverse=True)[:limit]
+            result["pages"] = [{
+                "url": page_url,
+                "count": sketch.count,
+                "p50": _seconds(sketch.quantile(0.5)),
+                "p90": _seconds(sketch.quantile(0.9)),
+                "p99": _seconds(sketch.quantile(0.99))
+            } for page_url, sketch in top]
+        return result
+
+    @sharded(_merge_sketches)
+    def _sketches(self, kind: str, url: Optional[str], start: datetime, end: datetime, limit: int,
+                  site_id: str) -> Tuple[DDSketch, Optional[Dict[str, DDSketch]]]:
+        """窗口内合并后的草图；kind=page 且不指定 url 时另外返回样本最多的 limit 个页面各自的草图"""
+        db = next(get_read_db())
+        try:
+            pages = None
+            if url is not None:
+                url_id = db.execute(select(UrlDimension.id).where(UrlDimension.value == url)).scalar()
+                sketches = self._load(db, site_id, KIND_PAGE_URL, start, end, url_id) if url_id else {}
+                total = sketches.get(url_id) or DDSketch(self.accuracy)
+            else:
+                total = self._load(db, site_id, kind, start, end).get(ALL_PAGES) or DDSketch(self.accuracy)
+                if kind == KIND_PAGE:
+                    pages = self._pages(db, site_id, start, end, shards.widen(limit))
+        finally:
+            db.close()
+        return total, pages
+
+    def _load(self, db, site_id: str, kind: str, start: datetime, end: datetime,
+              url_id: Optional[int] = None) -> Dict[int, DDSketch]:
+        """窗口内的草图按 url_id 合并，加上尚未写回的增量"""
+        floor = _day if kind == KIND_PAGE_URL else _hour
+        query = db.query(DurationSketch.url_id, DurationSketch.accuracy, DurationSketch.data).filter(
+            DurationSketch.site_id == site_id,
+            DurationSketch.kind == kind,
+            DurationSketch.bucket >= floor(start),
+            DurationSketch.bucket < end
+        )
+        if url_id is not None:
+            query = query.filter(DurationSketch.url_id == url_id)
+        merged = {}
+        for row in query:
+            sketch = merged.get(row.url_id)
+            if sketch is None:
+                sketch = merged[row.url_id] = DDSketch(self.accuracy)
+            sketch.merge(DDSketch.deserialize(row.data, row.accuracy))
+        # 增量可能含有要减去的旧时长，合并后去掉不为正的桶
+        with self._lock:
+            for (delta_site, delta_kind, delta_url, bucket), delta in self._pending.items():
+                if (delta_site == site_id and delta_kind == kind and floor(start) <= bucket < end
+                        and (url_id is None or delta_url == url_id)):
+                    merged.setdefault(delta_url, DDSketch(self.accuracy)).merge(delta)
+        return {row_url: sketch.compact() for row_url, sketch in merged.items()}
+
+    def _summary(self, sketch: DDSketch) -> Dict[str, Any]:
+        edges = settings.DURATION_HISTOGRAM_EDGES
+        bounds = [0.0] + list(edges)
+        return {
+            "count": sketch.count,
+            "percentiles": {f"p{p}": _seconds(sketch.quantile(p / 100)) for p in PERCENTILES},
+            "histogram": [
+                {"min": low, "max": edges[i] if i < len(edges) else None, "count": count}
+                for i, (low, count) in enumerate(zip(bounds, sketch.histogram(edges)))
+            ]
+        }
+
+    def _pages(self, db, site_id: str, start: datetime, end: datetime, limit: int) -> Dict[str, DDSketch]:
+        """样本最多的 limit 个页面的草图，按 URL 字符串返回"""
+        sketches = self._load(db, site_id, KIND_PAGE_URL, start, end)
+        top = sorted(sketches.items(), key=lambda item: item[1].count, reverse=True)[:limit]
+        names = dimension_service.names(db, "url", (url_id for url_id, _ in top))
+        return {names.get(url_id): sketch for url_id, sketch in top}
+
+duration_service = shard_local(DurationService)
@@ -0,0 +1,190 @@
+import json
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import func, select, text
+from sqlalchemy.exc import OperationalError
+from config.settings import settings
+from backend.models import Event, EventProperty, get_read_db, bulk_insert, shards, sharded
+from backend.services.shard_merge import percentage, top_rows, weighted_average
+from backend.utils.metrics import timed, STATS_QUERY_SECONDS
+
+MAX_KEY_LENGTH = 64
+MAX_VALUE_LENGTH = 200
+
+# SQLite 有 JSON1 时直接在库里展开 properties；值的文本形式与 extract() 保持一致
+JSON1_INDEX_SQL = """
+INSERT INTO event_properties (site_id, event_id, event_name, key, value, num_value, timestamp)
+SELECT e.site_id, e.id, e.event_name, p.key,
+       CASE p.type WHEN 'true' THEN 'true' WHEN 'false' THEN 'false'
+            ELSE substr(CAST(p.value AS TEXT), 1, :max_value) END,
+       CASE WHEN p.type IN ('integer', 'real') THEN p.value END,
+       e.timestamp
+FROM events AS e, json_each(e.properties) AS p
+WHERE e.id > :after_id AND e.properties IS NOT NULL
+  AND json_valid(e.properties) AND json_type(e.properties) = 'object'
+  AND p.type NOT IN ('object', 'array', 'null')
+  AND length(p.key) <= :max_key
+"""
+
+def _keys_filter() -> str:
+    if not settings.EVENT_PROPERTY_KEYS:
+        return ""
+    keys = ", ".join("'" + key.replace("'", "''") + "'" for key in settings.EVENT_PROPERTY_KEYS)
+    return f"  AND p.key IN ({keys})\n"
+
+def _merge_breakdown(partials, arguments) -> Dict[str, Any]:
+    """各分片的事件数相加，取值按计数合并后取前 limit 个，数值统计按样本数加权"""
+    total = sum(p["total"] for p in partials)
+    values = top_rows((p["values"] for p in partials), "value", "count", arguments["limit"])
+    result = {
+        "property": arguments["property"],
+        "total": total,
+        "values": [dict(row, percentage=round(percentage(row["count"], total), 2)) for row in values]
+    }
+    numeric = [p["numeric"] for p in partials if "numeric" in p]
+    if numeric:
+        result["numeric"] = {
+            "count": sum(n["count"] for n in numeric),
+            "min": min(n["min"] for n in numeric),
+            "max": max(n["max"] for n in numeric),
+            "avg": round(weighted_average((n["avg"], n["count"]) for n in numeric), 4)
+        }
+    return result
+
+class EventPropertyService:
+    """
+    事件属性索引：events.properties 仍然保存完整 JSON，顶层的标量键值另外写入 event_properties，
+    数值同时存一份 num_value。EVENT_PROPERTY_KEYS 为空时索引所有键，否则只索引列出的常用键。
+    """
+
+    def extract(self, properties) -> List[Tuple[str, str, Optional[float]]]:
+        """返回需要索引的 (键, 文本值, 数值)，嵌套对象、数组和 null 不索引"""
+        if isinstance(properties, str):
+            try:
+                properties = json.loads(properties)
+            except ValueError:
+                return []
+        if not isinstance(properties, dict):
+            return []
+        allowed = settings.EVENT_PROPERTY_KEYS
+        items = []
+        for key, value in properties.items():
+            if len(key) > MAX_KEY_LENGTH or (allowed and key not in allowed):
+                continue
+            if isinstance(value, bool):
+                items.append((key, "true" if value else "false", None))
+            elif isinstance(value, (int, float)):
+                items.append((key, str(value)[:MAX_VALUE_LENGTH], float(value)))
+            elif isinstance(value, str):
+                items.append((key, value[:MAX_VALUE_LENGTH], None))
+        return items
+
+    def add_for_event(self, db, event: Event, properties):
+        """在写入事件的同一事务中补上属性行，需要先 flush 拿到事件 ID"""
+        items = self.extract(properties)
+        if not items:
+            return
+        db.flush()
+        db.add_all([
+            EventProperty(
+                site_id=event.site_id,
+                event_id=event.id,
+                event_name=event.event_name,
+                key=key,
+                value=value,
+                num_value=num_value,
+                timestamp=event.timestamp
+            )
+            for key, value, num_value in items
+        ])
+
+    def index_events(self, conn, after_id: int = 0) -> int:
+        """
+        为 id > after_id 的事件建立属性行（批量导入和迁移回填），返回写入的行数。
+        SQLite 支持 JSON1 时一条 INSERT ... SELECT 完成，否则逐批在 Python 中解析。
+        """
+        if conn.dialect.name == "sqlite" and self._has_json1(conn):
+            result = conn.execute(
+                text(JSON1_INDEX_SQL + _keys_filter()),
+                {"after_id": after_id, "max_key": MAX_KEY_LENGTH, "max_value": MAX_VALUE_LENGTH}
+            )
+            return result.rowcount
+
+        written = 0
+        query = select(Event.id, Event.site_id, Event.event_name, Event.properties, Event.timestamp).where(
+            Event.id > after_id, Event.properties.isnot(None)
+        ).order_by(Event.id)
+        for rows in conn.execution_options(yield_per=5000).execute(query).partitions():
+            values = [
+                {"site_id": r.site_id, "event_id": r.id, "event_name": r.event_name,
+                 "key": key, "value": value, "num_value": num_value, "timestamp": r.timestamp}
+                for r in rows
+                for key, value, num_value in self.extract(r.properties)
+            ]
+            bulk_insert(conn, EventProperty.__table__, values)
+            written += len(values)
+        return written
+
+    def index_rows(self, conn, events: List[Dict[str, Any]]) -> int:
+        """为已经写入、带 id 的事件行建立属性行（批量导入时 RETURNING 拿到 ID 之后），返回写入的行数"""
+        values = [
+            {"site_id": e["site_id"], "event_id": e["id"], "event_name": e["event_name"],
+             "key": key, "value": value, "num_value": num_value, "timestamp": e["timestamp"]}
+            for e in events
+            for key, value, num_value in self.extract(e.get("properties"))
+        ]
+        bulk_insert(conn, EventProperty.__table__, values)
+        return len(values)
+
+    def _has_json1(self, conn) -> bool:
+        try:
+            conn.execute(text("SELECT json_type('{}')"))
+            return True
+        except OperationalError:
+            return False
+
+    @timed(STATS_QUERY_SECONDS)
+    @sharded(_merge_breakdown)
+    def get_breakdown(self, property: str, event_name: Optional[str] = None, days: int = 7,
+                      limit: int = 20, site_id: str = settings.DEFAULT_SITE_ID) -> Dict[str, Any]:
+        """按属性值分组的事件数，只读 event_properties 的复合索引"""
+        start_date = datetime.now() - timedelta(days=days)
+        filters = [
+            EventProperty.site_id == site_id,
+            EventProperty.key == property,
+            EventProperty.timestamp >= start_date
+        ]
+        if event_name:
+            filters.append(EventProperty.event_name == event_name)
+
+        db = next(get_read_db())
+        try:
+            count = func.count().label("count")
+            rows = db.query(EventProperty.value, count).filter(*filters).group_by(
+                EventProperty.value
+            ).order_by(count.desc()).limit(shards.widen(limit)).all()
+            summary = db.query(
+                func.count(),
+                func.count(EventProperty.num_value),
+                func.min(EventProperty.num_value),
+                func.max(EventProperty.num_value),
+                func.avg(EventProperty.num_value)
+            ).filter(*filters).one()
+        finally:
+            db.close()
+
+        total, numeric, minimum, maximum, average = summary
+        result = {
+            "property": property,
+            "total": total,
+            "values": [{
+                "value": r.value,
+                "count": r.count,
+                "percentage": round(r.count / total * 100, 2) if total else 0
+            } for r in rows]
+        }
+        if numeric:
+            result["numeric"] = {"count": numeric, "min": minimum, "max": maximum, "avg": round(average, 4)}
+        return result
+
+event_property_service = EventPropertyService()
@@ -0,0 +1,203 @@
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Iterator, List, Optional
+from sqlalchemy import select, Integer, SmallInteger, Float, DateTime, Boolean
+from config.settings import settings
+from backend.models import PageView, Event, Session, AggregatedStats, read_engine, shards
+from backend.services.dimension_service import dimension_service
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# 可导出的表：(模型, 时间列)
+EXPORT_TABLES = {
+    "page_views": (PageView, PageView.timestamp),
+    "events": (Event, Event.timestamp),
+    "sessions": (Session, Session.start_time),
+    "aggregated_stats": (AggregatedStats, AggregatedStats.stat_date),
+}
+
+# 按用户分布到各分片的表，分片模式下依次导出每个分片；aggregated_stats 在各分片中只是部分汇总，不能直接拼接
+SHARDED_TABLES = ("page_views", "events", "sessions")
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+class ExportError(ValueError):
+    pass
+
+class ExportUnsupported(ExportError):
+    pass
+
+class _ChunkSink:
+    """给 ParquetWriter 用的只写文件对象，每写完一个 row group 就把缓冲的字节取走"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def _arrow_type(column):
+    if isinstance(column.type, (Integer, SmallInteger)):
+        return pa.int64()
+    if isinstance(column.type, Float):
+        return pa.float64()
+    if isinstance(column.type, DateTime):
+        return pa.timestamp("us")
+    if isinstance(column.type, Boolean):
+        return pa.bool_()
+    return pa.string()
+
+def _json_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+class ExportService:
+    """
+    原始数据和汇总表的流式导出：服务端游标按 batch_size 行分批取数，每批编码后立即输出，
+    内存占用与表大小无关。分片模式下明细依次从每个分片导出（按分片、分片内按 id 排序，id 在各分片分别编号）。
+    """
+
+    def __init__(self, engine=None, batch_size: int = settings.EXPORT_BATCH_ROWS):
+        if engine is not None:
+            self.engines = [engine]
+        elif shards.enabled:
+            self.engines = [shard.read_engine for shard in shards]
+        else:
+            self.engines = [read_engine]
+        self.batch_size = batch_size
+
+    @staticmethod
+    def parquet_available() -> bool:
+        return pa is not None
+
+    def build_query(self, table: str, site_id: str, start: Optional[datetime] = None,
+                    end: Optional[datetime] = None, url: Optional[str] = None,
+                    event_type: Optional[str] = None, stat_type: Optional[str] = None,
+                    limit: Optional[int] = None):
+        if table not in EXPORT_TABLES:
+            raise ExportError(f"unknown table: {table}")
+        if len(self.engines) > 1 and table not in SHARDED_TABLES:
+            raise ExportUnsupported(f"分片模式下不支持导出 {table}")
+        model, time_column = EXPORT_TABLES[table]
+        columns = model.__table__.c
+        # 字典 ID 只在本库内有意义，导出时换回原始字符串
+        decoded = dimension_service.decode(model.__table__)
+        query = select(*decoded.columns).select_from(decoded.source).where(columns.site_id == site_id)
+        if start:
+            query = query.where(time_column >= start)
+        if end:
+            query = query.where(time_column < end)
+        if url:
+            if "page_url" not in decoded.fields:
+                raise ExportError(f"{table} 没有 page_url 列")
+            query = query.where(decoded.fields["page_url"].startswith(url, autoescape=True))
+        if event_type:
+            if table != "events":
+                raise ExportError("event_type 只适用于 events")
+            query = query.where(columns.event_type == event_type)
+        if stat_type:
+            if table != "aggregated_stats":
+                raise ExportError("stat_type 只适用于 aggregated_stats")
+            query = query.where(columns.stat_type == stat_type)
+        query = query.order_by(columns.id)
+        if limit:
+            # 每个分片最多取 limit 行，合计的行数在 _partitions 中截断
+            query = query.limit(limit).execution_options(export_limit=limit)
+        return query
+
+    def _partitions(self, query) -> Iterator[List[tuple]]:
+        remaining = query.get_execution_options().get("export_limit")
+        for engine in self.engines:
+            with engine.connect() as conn:
+                result = conn.execution_options(yield_per=self.batch_size).execute(query)
+                for rows in result.partitions():
+                    if remaining is not None:
+                        rows = rows[:remaining]
+                        remaining -= len(rows)
+                    yield rows
+                    if remaining == 0:
+                        return
+
+    def stream(self, fmt: str, query) -> Iterator[bytes]:
+        columns = list(query.selected_columns)
+        if fmt == "csv":
+            return self._stream_csv(columns, query)
+        if fmt == "ndjson":
+            return self._stream_ndjson(columns, query)
+        if fmt == "parquet":
+            if pa is None:
+                raise ExportError("Parquet 导出需要安装 pyarrow")
+            return self._stream_parquet(columns, query)
+        raise ExportError(f"unknown format: {fmt}")
+
+    def _stream_csv(self, columns, query) -> Iterator[bytes]:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow([c.name for c in columns])
+        for rows in self._partitions(query):
+            writer.writerows(
+                [_json_value(v) for v in row] for row in rows
+            )
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode("utf-8")
+
+    def _stream_ndjson(self, columns, query) -> Iterator[bytes]:
+        names = [c.name for c in columns]
+        for rows in self._partitions(query):
+            yield "".join(
+                json.dumps({name: _json_value(v) for name, v in zip(names, row)}, ensure_ascii=False) + "\n"
+                for row in rows
+            ).encode("utf-8")
+
+    def _stream_parquet(self, columns, query) -> Iterator[bytes]:
+        schema = pa.schema([(c.name, _arrow_type(c)) for c in columns])
+        sink = _ChunkSink()
+        writer = pq.ParquetWriter(sink, schema, compression="zstd")
+        try:
+            for rows in self._partitions(query):
+                # 每批一个 row group，写完就把这部分字节发出去
+                batch = pa.RecordBatch.from_arrays(
+                    [pa.array([row[i] for row in rows], type=field.type) for i, field in enumerate(schema)],
+                    schema=schema
+                )
+                writer.write_batch(batch)
+                data = sink.drain()
+                if data:
+                    yield data
+        finally:
+            writer.close()
+        yield sink.drain()
+
+export_service = ExportService()
@@ -0,0 +1,141 @@
+import re
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from itertools import groupby
+from typing import Any, Dict
+from urllib.parse import urlparse
+from sqlalchemy import and_
+from config.settings import settings
+from backend.models import PageView, Session as SessionModel, get_read_db, sharded
+from backend.services.traffic_filter import TRAFFIC_NORMAL
+from backend.services.dimension_service import dimension_service
+from backend.utils.metrics import timed, STATS_QUERY_SECONDS
+
+def normalize_page_url(url):
+    if not url:
+        return '未知'
+    
+    try:
+        parsed = urlparse(url)
+        path = parsed.path
+        
+        path = re.sub(r'/\d+$', '/:id', path)
+        path = re.sub(r'/\d+/', '/:id/', path)
+        
+        if path == '/' or not path:
+            return '首页'
+        
+        parts = path.strip('/').split('/')
+        
+        if len(parts) == 1:
+            if parts[0] == 'login':
+                return '登录页'
+            elif parts[0] == 'register':
+                return '注册页'
+            elif parts[0] == 'search':
+                return '搜索页'
+            elif parts[0] == 'wifi-model':
+                return 'WiFi模型详情'
+            elif parts[0] == 'submit':
+                return '提交页'
+            else:
+                return parts[0]
+        else:
+            return ' > '.join(parts[:3])
+            
+    except Exception:
+        return '未知'
+
+def merge_page_flow(partials, arguments=None) -> Dict[str, Any]:
+    """各分片的桑基图合并：规范化后的页面名相同的跳转和入口计数相加"""
+    session_flows = defaultdict(int)
+    entry_pages = defaultdict(int)
+    for flow in partials:
+        for link in flow['links']:
+            session_flows[(link['source'], link['target'])] += link['value']
+        for page, sessions in flow['entry_pages'].items():
+            entry_pages[page] += sessions
+    nodes = {page for pair in session_flows for page in pair}
+    return {
+        'nodes': [{'name': node} for node in sorted(nodes)],
+        'links': [{'source': source, 'target': target, 'value': value} for (source, target), value in session_flows.items()],
+        'entry_pages': dict(entry_pages)
+    }
+
+class FlowService:
+    
+    MAX_HOPS = 3
+    
+    @timed(STATS_QUERY_SECONDS)
+    @sharded(merge_page_flow)
+    def get_page_flow(self, days: int = 7, site_id: str = settings.DEFAULT_SITE_ID, db=None) -> Dict[str, Any]:
+        """页面流转（桑基图）数据：每个会话前 3 跳的页面跳转计数"""
+        owns_session = db is None
+        if owns_session:
+            db = next(get_read_db())
+        try:
+            start_date = datetime.utcnow() - timedelta(days=days)
+            
+            # 一次查询取回窗口内所有会话的页面浏览，按会话、时间排序后逐个会话处理，
+            # 代替逐个会话查询页面浏览记录；只取整数 url_id，每个不同的 URL 只取回和规范化一次
+            rows = db.query(
+                PageView.session_id,
+                PageView.url_id
+            ).join(
+                SessionModel, and_(
+                    SessionModel.site_id == PageView.site_id,
+                    SessionModel.session_id == PageView.session_id
+                )
+            ).filter(
+                SessionModel.site_id == site_id,
+                SessionModel.start_time >= start_date,
+                PageView.site_id == site_id,
+                PageView.traffic_class == TRAFFIC_NORMAL
+            ).order_by(
+                SessionModel.id,
+                PageView.timestamp
+            ).yield_per(5000)
+            
+            # 先按 url_id 序列计数，不同的序列远少于会话数
+            paths = Counter(
+                tuple(r.url_id for _, r in zip(range(self.MAX_HOPS + 1), pageviews))
+                for _, pageviews in groupby(rows, key=lambda r: r.session_id)
+            )
+            names = dimension_service.names(db, "url", {url_id for path in paths for url_id in path})
+            pages = {url_id: normalize_page_url(url) for url_id, url in names.items()}
+            
+            session_flows = defaultdict(int)
+            entry_pages = defaultdict(int)
+            
+            for path, sessions in paths.items():
+                urls = [pages.get(url_id, normalize_page_url(None)) for url_id in path]
+                if not urls:
+                    continue
+                entry_pages[urls[0]] += sessions
+                
+                for current_page, next_page in zip(urls, urls[1:]):
+                    if current_page and next_page and current_page != next_page:
+                        session_flows[(current_page, next_page)] += sessions
+            
+            nodes = set()
+            links = []
+            
+            for (source, target), value in session_flows.items():
+                nodes.add(source)
+                nodes.add(target)
+                links.append({
+                    'source': source,
+                    'target': target,
+                    'value': value
+                })
+            
+            return {
+                'nodes': [{'name': node} for node in sorted(nodes)],
+                'links': links,
+                'entry_pages': dict(entry_pages)
+            }
+        finally:
+            if owns_session:
+                db.close()
+
+flow_service = FlowService()
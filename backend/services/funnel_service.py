@@ -0,0 +1,296 @@
+import fnmatch
+import hashlib
+import json
+import re
+from datetime import date, datetime, time, timedelta
+from itertools import groupby
+from typing import Any, Dict, List, NamedTuple, Tuple
+from urllib.parse import urlparse
+from sqlalchemy import select, union_all, literal
+from config.settings import settings
+from backend.models import PageView, Event, AggregatedStats, UrlDimension, get_db, get_read_db, sharded
+from backend.services.shard_merge import total
+from backend.services.traffic_filter import TRAFFIC_NORMAL
+from backend.utils.metrics import timed, STATS_QUERY_SECONDS
+
+MAX_STEPS = 10
+STEP_KINDS = ("page", "event")
+STAT_PREFIX = "funnel:"
+
+HIT_PAGE = 0
+HIT_EVENT = 1
+
+# 当天结束后再过转化窗口和这段余量（spool 写库延迟），该日的结果才不再变化、可以缓存
+SETTLE_MARGIN = timedelta(minutes=10)
+
+class FunnelStep(NamedTuple):
+    kind: str
+    pattern: str
+
+    @property
+    def label(self) -> str:
+        return f"{self.kind}:{self.pattern}"
+
+def parse_steps(specs: List[str]) -> List[FunnelStep]:
+    """解析 page:/pricing*、event:signup_button 形式的步骤定义，模式支持 * 和 ? 通配"""
+    if not 2 <= len(specs) <= MAX_STEPS:
+        raise ValueError(f"漏斗需要 2 到 {MAX_STEPS} 个步骤")
+    steps = []
+    for spec in specs:
+        kind, _, pattern = spec.partition(":")
+        if kind not in STEP_KINDS or not pattern:
+            raise ValueError(f"无效的步骤 {spec!r}，格式为 page:<URL 模式> 或 event:<事件名>")
+        steps.append(FunnelStep(kind, pattern))
+    return steps
+
+class FunnelMatcher:
+    """把页面 URL / 事件名映射为它命中的步骤位掩码，同一个值只匹配一次"""
+
+    CACHE_SIZE = 100000
+
+    def __init__(self, steps: List[FunnelStep]):
+        self.rules = [
+            (HIT_PAGE if step.kind == "page" else HIT_EVENT,
+             re.compile(fnmatch.translate(step.pattern)),
+             "://" in step.pattern)
+            for step in steps
+        ]
+        self.kinds = {kind for kind, _, _ in self.rules}
+        self._cache = {}
+
+    def mask(self, kind: int, value) -> int:
+        key = (kind, value)
+        mask = self._cache.get(key)
+        if mask is not None:
+            return mask
+        mask = 0
+        if value is not None:
+            path = None
+            for i, (rule_kind, regex, full_url) in enumerate(self.rules):
+                if rule_kind != kind:
+                    continue
+                target = value
+                # 页面模式不带协议时只匹配路径
+                if kind == HIT_PAGE and not full_url:
+                    if path is None:
+                        path = urlparse(value).path or "/"
+                    target = path
+                if regex.match(target):
+                    mask |= 1 << i
+        if len(self._cache) < self.CACHE_SIZE:
+            self._cache[key] = mask
+        return mask
+
+def walk_session(hits, matcher: FunnelMatcher, n_steps: int, window_seconds: float, entry_end: datetime) -> int:
+    """
+    按时间顺序扫描一个会话的访问，返回到达的步骤数（0 表示没有进入漏斗）。
+    starts[k] 是到达第 k 步的各条路径中最晚的开始时间：开始越晚，后续步骤剩余的窗口越宽。
+    第一步在 entry_end 之前命中才算进入漏斗，后续步骤可以越过 entry_end。
+    """
+    starts = [None] * n_steps
+    for kind, value, ts in hits:
+        mask = matcher.mask(kind, value)
+        if not mask:
+            continue
+        # 从后往前更新，同一次访问不会同时推进相邻两步
+        for k in range(n_steps - 1, 0, -1):
+            start = starts[k - 1]
+            if mask >> k & 1 and start is not None and (ts - start).total_seconds() <= window_seconds:
+                if starts[k] is None or start > starts[k]:
+                    starts[k] = start
+        if mask & 1 and ts < entry_end:
+            starts[0] = ts
+    reached = 0
+    while reached < n_steps and starts[reached] is not None:
+        reached += 1
+    return reached
+
+def _merge_daily_counts(partials, arguments) -> Tuple[Dict[date, List[int]], int]:
+    """会话只在一个分片中：每天各步的会话数相加，缓存天数取各分片中最少的"""
+    per_day = {
+        day: [sum(counts) for counts in zip(*(daily[day] for daily, _ in partials))]
+        for day in arguments["day_list"]
+    }
+    return per_day, min(cached_days for _, cached_days in partials)
+
+class FunnelService:
+    """
+    漏斗分析：每天一次按 (会话, 时间) 排序的扫描，同时合并页面浏览和事件，逐个会话推进步骤。
+    统计单位是会话-日（按第一步命中的日期归属），已经不会再变化的日期结果写入 aggregated_stats，
+    长时间范围只需计算新的日期。
+    """
+
+    def funnel_key(self, steps: List[FunnelStep], window_seconds: int) -> str:
+        definition = json.dumps([[s.label for s in steps], window_seconds], ensure_ascii=False)
+        return hashlib.sha1(definition.encode("utf-8")).hexdigest()[:16]
+
+    @timed(STATS_QUERY_SECONDS)
+    def get_funnel(self, steps: List[str], days: int = 7, window_minutes: int = 30,
+                   site_id: str = settings.DEFAULT_SITE_ID) -> Dict[str, Any]:
+        parsed = parse_steps(steps)
+        window_seconds = window_minutes * 60
+        today = datetime.now().date()
+        day_list = [today - timedelta(days=i) for i in range(days - 1, -1, -1)]
+        per_day, cached_days = self._daily_counts(parsed, window_seconds, day_list, site_id)
+
+        totals = [sum(per_day[day][k] for day in day_list) for k in range(len(parsed))]
+        result_steps = []
+        for k, step in enumerate(parsed):
+            previous = totals[k - 1] if k else totals[0]
+            result_steps.append({
+                "step": k + 1,
+                "name": step.label,
+                "sessions": totals[k],
+                "conversion_rate": round(totals[k] / totals[0] * 100, 2) if totals[0] else 0,
+                "step_conversion_rate": round(totals[k] / previous * 100, 2) if previous else 0,
+                "drop_off": previous - totals[k]
+            })
+        return {
+            "steps": result_steps,
+            "daily": [{
+                "date": day.isoformat(),
+                "entries": per_day[day][0],
+                "completed": per_day[day][-1]
+            } for day in day_list],
+            "window_minutes": window_minutes,
+            "cached_days": cached_days
+        }
+
+    @sharded(_merge_daily_counts)
+    def _daily_counts(self, parsed: List[FunnelStep], window_seconds: int, day_list: List[date],
+                      site_id: str) -> Tuple[Dict[date, List[int]], int]:
+        """day_list 中每天各步的会话数，以及其中直接取自缓存的天数"""
+        stat_type = STAT_PREFIX + self.funnel_key(parsed, window_seconds)
+        per_day = self._cached_days(stat_type, site_id, day_list)
+        cached_days = len(per_day)
+        matcher = FunnelMatcher(parsed)
+        settled = {}
+        for day in day_list:
+            if day in per_day:
+                continue
+            per_day[day] = self._compute_day(matcher, len(parsed), window_seconds, site_id, day)
+            if self._is_settled(day, window_seconds):
+                settled[day] = per_day[day]
+        if settled:
+            self._store(stat_type, site_id, parsed, window_seconds, settled)
+        return per_day, cached_days
+
+    def _compute_day(self, matcher: FunnelMatcher, n_steps: int, window_seconds: int,
+                     site_id: str, day: date) -> List[int]:
+        """计算第一步落在 day 当天的会话各步到达数，返回每一步的会话数"""
+        day_start = datetime.combine(day, time.min)
+        day_end = day_start + timedelta(days=1)
+        scan_end = day_end + timedelta(seconds=window_seconds)
+
+        selects = []
+        if HIT_PAGE in matcher.kinds:
+            selects.append(select(
+                PageView.session_id.label("session_id"),
+                PageView.timestamp.label("ts"),
+                literal(HIT_PAGE).label("kind"),
+                UrlDimension.value.label("value")
+            ).outerjoin(UrlDimension, UrlDimension.id == PageView.url_id).where(
+                PageView.site_id == site_id,
+                PageView.traffic_class == TRAFFIC_NORMAL,
+                PageView.timestamp >= day_start,
+                PageView.timestamp < scan_end
+            ))
+        if HIT_EVENT in matcher.kinds:
+            selects.append(select(
+                Event.session_id.label("session_id"),
+                Event.timestamp.label("ts"),
+                literal(HIT_EVENT).label("kind"),
+                Event.event_name.label("value")
+            ).where(
+                Event.site_id == site_id,
+                Event.timestamp >= day_start,
+                Event.timestamp < scan_end
+            ))
+        hits = union_all(*selects).subquery() if len(selects) > 1 else selects[0].subquery()
+        query = select(hits.c.session_id, hits.c.kind, hits.c.value, hits.c.ts).order_by(
+            hits.c.session_id, hits.c.ts
+        )
+
+        counts = [0] * n_steps
+        db = next(get_read_db())
+        try:
+            rows = db.execute(query, execution_options={"yield_per": 5000})
+            for _, session_hits in groupby(rows, key=lambda r: r.session_id):
+                reached = walk_session(
+                    ((r.kind, r.value, _as_datetime(r.ts)) for r in session_hits),
+                    matcher, n_steps, window_seconds, day_end
+                )
+                for k in range(reached):
+                    counts[k] += 1
+        finally:
+            db.close()
+        return counts
+
+    def _is_settled(self, day: date, window_seconds: int) -> bool:
+        day_end = datetime.combine(day, time.min) + timedelta(days=1)
+        return day_end + timedelta(seconds=window_seconds) + SETTLE_MARGIN <= datetime.now()
+
+    def _cached_days(self, stat_type: str, site_id: str, day_list: List[date]) -> Dict[date, List[int]]:
+        db = next(get_read_db())
+        try:
+            rows = db.query(AggregatedStats.stat_date, AggregatedStats.meta_data).filter(
+                AggregatedStats.site_id == site_id,
+                AggregatedStats.stat_type == stat_type,
+                AggregatedStats.stat_date >= datetime.combine(day_list[0], time.min),
+                AggregatedStats.stat_date <= datetime.combine(day_list[-1], time.min)
+            ).all()
+            return {r.stat_date.date(): json.loads(r.meta_data)["steps"] for r in rows}
+        finally:
+            db.close()
+
+    def _store(self, stat_type: str, site_id: str, steps: List[FunnelStep], window_seconds: int,
+               per_day: Dict[date, List[int]]):
+        db = next(get_db())
+        try:
+            stat_dates = [datetime.combine(day, time.min) for day in per_day]
+            db.query(AggregatedStats).filter(
+                AggregatedStats.site_id == site_id,
+                AggregatedStats.stat_type == stat_type,
+                AggregatedStats.stat_date.in_(stat_dates)
+            ).delete(synchronize_session=False)
+            db.add_all([
+                AggregatedStats(
+                    site_id=site_id,
+                    stat_type=stat_type,
+                    stat_date=datetime.combine(day, time.min),
+                    value=counts[0],
+                    meta_data=json.dumps({
+                        "steps": counts,
+                        "definition": [s.label for s in steps],
+                        "window_seconds": window_seconds
+                    }, ensure_ascii=False)
+                )
+                for day, counts in per_day.items()
+            ])
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    @sharded(total)
+    def invalidate(self, start: date, end: date) -> int:
+        """删除 [start, end) 内缓存的漏斗结果，历史数据变化（如批量导入）后调用"""
+        db = next(get_db())
+        try:
+            deleted = db.query(AggregatedStats).filter(
+                AggregatedStats.stat_type.like(STAT_PREFIX + "%"),
+                AggregatedStats.stat_date >= datetime.combine(start, time.min),
+                AggregatedStats.stat_date < datetime.combine(end, time.min)
+            ).delete(synchronize_session=False)
+            db.commit()
+            return deleted
+        finally:
+            db.close()
+
+def _as_datetime(value) -> datetime:
+    # UNION 子查询在 SQLite 上可能丢失列类型，时间以字符串返回
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+funnel_service = FunnelService()
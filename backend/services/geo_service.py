@@ -0,0 +1,159 @@
+import json
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy import func, update, bindparam
+from config.settings import settings
+from backend.models import Session, AggregatedStats, get_db, get_read_db, day_bucket, sharded
+from backend.services.shard_merge import concat, total as total_of
+from backend.utils.geoip import GeoIPResolver
+from backend.utils.metrics import timed, STATS_QUERY_SECONDS
+
+STAT_TYPE = "geo"
+UNKNOWN = ""
+
+class GeoService:
+    """
+    地理信息：新会话写入时按 IP 查本地 GeoIP 库填上 country/city，
+    定时把每个站点每天按国家、城市的会话数汇总成一行 aggregated_stats，/api/stats/geo 只读汇总。
+    """
+
+    def __init__(self, resolver: Optional[GeoIPResolver] = None):
+        self.resolver = resolver or GeoIPResolver(settings.GEOIP_DB_PATH, settings.GEOIP_CACHE_SIZE)
+
+    def locate(self, ip_address: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+        """返回 (国家, 城市)，没有 GeoIP 库或查不到时为 (None, None)"""
+        location = self.resolver.lookup(ip_address)
+        return location if location else (None, None)
+
+    @sharded(total_of)
+    def backfill(self, days: Optional[int] = None, batch_size: int = 5000) -> int:
+        """给 country 为空的会话补上地理信息（导入 GeoIP 库之前的数据），返回更新的行数"""
+        updated = 0
+        last_id = 0
+        while True:
+            db = next(get_db())
+            try:
+                query = db.query(Session.id, Session.ip_address).filter(
+                    Session.id > last_id,
+                    Session.country.is_(None),
+                    Session.ip_address.isnot(None)
+                )
+                if days:
+                    query = query.filter(Session.start_time >= datetime.utcnow() - timedelta(days=days))
+                rows = query.order_by(Session.id).limit(batch_size).all()
+                if not rows:
+                    return updated
+                values = []
+                for row in rows:
+                    country, city = self.locate(row.ip_address)
+                    if country:
+                        values.append({"_id": row.id, "_country": country, "_city": city})
+                if values:
+                    db.execute(
+                        update(Session.__table__).where(Session.__table__.c.id == bindparam("_id")).values(
+                            country=bindparam("_country"), city=bindparam("_city")
+                        ),
+                        values
+                    )
+                    db.commit()
+                updated += len(values)
+                last_id = rows[-1].id
+            finally:
+                db.close()
+
+    @sharded(total_of)
+    def rollup(self, days: int = None, start: date = None, end: date = None) -> int:
+        """与 rollup_site_stats 相同的日期范围，按会话开始日期写入每个站点每天的国家/城市分布"""
+        days = days or settings.SITE_ROLLUP_DAYS
+        db = next(get_db())
+        try:
+            start_day = datetime.combine(start or (datetime.now() - timedelta(days=days - 1)).date(), datetime.min.time())
+            end_day = datetime.combine(end, datetime.min.time()) if end else datetime.max
+
+            results = db.query(
+                Session.site_id,
+                day_bucket(Session.start_time).label('date'),
+                Session.country,
+                Session.city,
+                func.count(Session.id).label('sessions')
+            ).filter(
+                Session.start_time >= start_day,
+                Session.start_time < end_day
+            ).group_by(
+                Session.site_id,
+                day_bucket(Session.start_time),
+                Session.country,
+                Session.city
+            ).all()
+
+            daily = {}
+            for r in results:
+                countries = daily.setdefault((r.site_id, str(r.date)), {})
+                cities = countries.setdefault(r.country or UNKNOWN, {})
+                cities[r.city or UNKNOWN] = cities.get(r.city or UNKNOWN, 0) + r.sessions
+
+            db.query(AggregatedStats).filter(
+                AggregatedStats.stat_type == STAT_TYPE,
+                AggregatedStats.stat_date >= start_day,
+                AggregatedStats.stat_date < end_day
+            ).delete(synchronize_session=False)
+            db.add_all([
+                AggregatedStats(
+                    site_id=site_id,
+                    stat_type=STAT_TYPE,
+                    stat_date=datetime.strptime(day, "%Y-%m-%d"),
+                    value=sum(sum(cities.values()) for cities in countries.values()),
+                    meta_data=json.dumps(countries, ensure_ascii=False)
+                )
+                for (site_id, day), countries in daily.items()
+            ])
+            db.commit()
+            return len(daily)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    @timed(STATS_QUERY_SECONDS)
+    def get_geo_stats(self, days: int = 7, country: Optional[str] = None,
+                      site_id: str = settings.DEFAULT_SITE_ID) -> Dict[str, Any]:
+        """最近 days 天按国家的会话分布；指定 country 时返回该国家按城市的分布"""
+        totals = {}
+        for meta_data in self._daily(days, site_id):
+            for name, cities in json.loads(meta_data).items():
+                if country is not None:
+                    if name != country:
+                        continue
+                    for city, sessions in cities.items():
+                        totals[city] = totals.get(city, 0) + sessions
+                else:
+                    totals[name] = totals.get(name, 0) + sum(cities.values())
+
+        total = sum(totals.values())
+        key = "city" if country is not None else "country"
+        items = [{
+            key: name or None,
+            "sessions": sessions,
+            "percentage": round(sessions / total * 100, 2) if total else 0
+        } for name, sessions in sorted(totals.items(), key=lambda item: item[1], reverse=True)]
+        if country is None:
+            return {"total_sessions": total, "countries": items}
+        return {"total_sessions": total, "country": country, "cities": items}
+
+    @sharded(concat)
+    def _daily(self, days: int, site_id: str) -> List[str]:
+        """窗口内每天的国家/城市分布（meta_data 中的 JSON）"""
+        db = next(get_read_db())
+        try:
+            start_day = datetime.combine((datetime.now() - timedelta(days=days - 1)).date(), datetime.min.time())
+            rows = db.query(AggregatedStats.meta_data).filter(
+                AggregatedStats.site_id == site_id,
+                AggregatedStats.stat_type == STAT_TYPE,
+                AggregatedStats.stat_date >= start_day
+            ).all()
+        finally:
+            db.close()
+        return [row.meta_data for row in rows]
+
+geo_service = GeoService()
@@ -0,0 +1,245 @@
+"""
+最近 48 小时页面浏览的内存列存（热窗口）
+
+实时面板、days<=2 的趋势和小时分布只读最近一两天的数据。热窗口把这段时间的正常流量浏览
+保存为几列 NumPy 数组（时间戳、站点、url_id、会话），查询用布尔掩码加 bincount/unique 完成，不再访问数据库。
+
+数据按 page_views.id 从数据库增量读取：启动时从窗口起点预热，spool 每写入一批后立即追加，
+查询前如果距上次同步超过 HOT_WINDOW_SYNC_SECONDS 再补读一次（导入工具等其他进程写入的行）。
+数组是环形缓冲区，容量按需翻倍直到 HOT_WINDOW_MEMORY_MB；满了以后覆盖最旧的行，
+被覆盖的时间段不再由热窗口回答。没有安装 numpy、尚未预热完成或查询范围超出已覆盖的时间时，
+各方法返回 None，调用方回退到 SQL。
+"""
+import logging
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import List, NamedTuple, Optional
+
+from sqlalchemy import func, select
+from config.settings import settings
+from backend.models import PageView, get_db, shards, sharded, shard_local
+from backend.services.traffic_filter import TRAFFIC_NORMAL
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger("raymond.hot_window")
+
+EPOCH = datetime(1970, 1, 1)
+MICROS_PER_HOUR = 3600 * 10 ** 6
+INITIAL_ROWS = 1 << 16
+# 并发写入时 PostgreSQL 的自增 ID 不一定按提交顺序可见，同步时回看这么多个 ID
+SYNC_OVERLAP_IDS = 1000
+SYNC_CHUNK = 10000
+
+COLUMNS = (("id", "int64"), ("ts", "int64"), ("site", "int32"), ("url", "int64"), ("session", "int64"))
+
+class Bucket(NamedTuple):
+    date: date
+    hour: int
+    views: int
+    recent_views: int
+
+class UrlViews(NamedTuple):
+    url_id: int
+    views: int
+
+def _micros(value: datetime) -> int:
+    """page_views 的时间戳是不带时区的本地时间，直接换算成距 1970-01-01 的微秒数，日期和小时可整除得到"""
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+class HotWindow:
+
+    def __init__(self, hours: int = settings.HOT_WINDOW_HOURS, memory_mb: int = settings.HOT_WINDOW_MEMORY_MB,
+                 sync_seconds: float = settings.HOT_WINDOW_SYNC_SECONDS):
+        self.enabled = settings.HOT_WINDOW_ENABLED and np is not None
+        self.hours = hours
+        self.sync_seconds = sync_seconds
+        row_bytes = sum(np.dtype(dtype).itemsize for _, dtype in COLUMNS) if np is not None else 1
+        self.max_rows = max(INITIAL_ROWS, memory_mb * 1024 * 1024 // row_bytes)
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.ready = False
+        self._columns = None
+        self._size = 0
+        self._pos = 0
+        self._since = None
+        self._cursor = 0
+        self._recent_ids = set()
+        self._sites = {}
+        self._synced_at = 0.0
+
+    @sharded()
+    def warm(self):
+        """从数据库读入窗口内的浏览记录，应用启动时在后台线程调用"""
+        if not self.enabled:
+            return
+        started = time.perf_counter()
+        start = datetime.now() - timedelta(hours=self.hours)
+        db = next(get_db())
+        try:
+            first_id = db.execute(select(func.min(PageView.id)).where(PageView.timestamp >= start)).scalar()
+            if first_id is None:
+                first_id = (db.execute(select(func.max(PageView.id))).scalar() or 0) + 1
+        finally:
+            db.close()
+        with self._lock:
+            self._reset()
+            self._columns = {name: np.zeros(INITIAL_ROWS, dtype=dtype) for name, dtype in COLUMNS}
+            self._since = _micros(start)
+            self._cursor = first_id - 1
+        self.sync(wait=True)
+        with self._lock:
+            self.ready = True
+        logger.info("热窗口预热完成：%d 行，%.2fs", self._size, time.perf_counter() - started)
+
+    def clear(self):
+        """丢弃内存中的数据，之后的查询回退到 SQL，直到再次 warm"""
+        with self._lock:
+            self._reset()
+
+    def sync(self, wait: bool = False) -> int:
+        """读入 ID 大于上次同步位置的正常流量浏览，返回新增的行数；已有同步在进行且 wait 为假时直接返回"""
+        if not self.enabled or self._columns is None or not self._sync_lock.acquire(blocking=wait):
+            return 0
+        try:
+            added = 0
+            db = next(get_db())
+            try:
+                overlap = SYNC_OVERLAP_IDS if db.get_bind().dialect.name != "sqlite" else 0
+                top = db.execute(select(func.max(PageView.id))).scalar() or 0
+                cursor = self._cursor
+                while cursor < top:
+                    rows = db.execute(
+                        select(PageView.id, PageView.timestamp, PageView.site_id, PageView.url_id, PageView.session_id)
+                        .where(PageView.id > cursor - overlap, PageView.id <= min(top, cursor + SYNC_CHUNK),
+                               PageView.traffic_class == TRAFFIC_NORMAL,
+                               PageView.timestamp >= EPOCH + timedelta(microseconds=self._since))
+                        .order_by(PageView.id)
+                    ).all()
+                    rows = [r for r in rows if r.id not in self._recent_ids]
+                    if rows:
+                        self._append(rows)
+                        added += len(rows)
+                    if overlap:
+                        self._recent_ids.update(r.id for r in rows)
+                    cursor = min(top, cursor + SYNC_CHUNK)
+            finally:
+                db.close()
+            self._cursor = max(self._cursor, top)
+            if overlap:
+                self._recent_ids = {i for i in self._recent_ids if i > self._cursor - overlap}
+            self._synced_at = time.monotonic()
+            return added
+        finally:
+            self._sync_lock.release()
+
+    def after_ingest(self):
+        """spool 写入一批后调用：追加刚提交的行；失败只记日志，下次查询前会再补读"""
+        try:
+            self.sync()
+        except Exception:
+            logger.exception("热窗口同步失败")
+
+    def _append(self, rows):
+        values = {
+            "id": np.fromiter((r.id for r in rows), dtype=np.int64, count=len(rows)),
+            "ts": np.fromiter((_micros(r.timestamp) for r in rows), dtype=np.int64, count=len(rows)),
+            "site": np.fromiter((self._sites.setdefault(r.site_id, len(self._sites)) for r in rows),
+                                dtype=np.int32, count=len(rows)),
+            "url": np.fromiter((r.url_id if r.url_id is not None else -1 for r in rows), dtype=np.int64, count=len(rows)),
+            # 会话只用于去重计数，保存字符串的进程内哈希即可
+            "session": np.fromiter((hash(r.session_id) for r in rows), dtype=np.int64, count=len(rows)),
+        }
+        with self._lock:
+            offset = 0
+            while offset < len(rows):
+                self._make_room()
+                capacity = len(self._columns["id"])
+                n = min(len(rows) - offset, capacity - self._pos)
+                if self._size == capacity:
+                    # 环已写满：覆盖最旧的行，热窗口从此只覆盖剩下的时间段
+                    overwritten = self._columns["ts"][self._pos:self._pos + n].max()
+                    self._since = max(self._since, int(overwritten) + 1)
+                for name, column in self._columns.items():
+                    column[self._pos:self._pos + n] = values[name][offset:offset + n]
+                self._pos = (self._pos + n) % capacity
+                self._size = min(capacity, self._size + n)
+                offset += n
+
+    def _make_room(self):
+        """写满时如果最旧的行仍在窗口内且没到内存上限，把数组扩大一倍（按时间顺序重新排列）"""
+        capacity = len(self._columns["id"])
+        if self._size < capacity or capacity >= self.max_rows:
+            return
+        oldest = self._columns["ts"][self._pos]
+        if oldest < _micros(datetime.now() - timedelta(hours=self.hours)):
+            return
+        grown = min(capacity * 2, self.max_rows)
+        for name, column in self._columns.items():
+            resized = np.zeros(grown, dtype=column.dtype)
+            resized[:capacity] = np.concatenate((column[self._pos:], column[:self._pos]))
+            self._columns[name] = resized
+        self._pos = capacity
+
+    def _rows(self, site_id: str, start: datetime):
+        """站点 site_id 在 start 之后的行（按掩码取出的各列），不能由热窗口回答时返回 None；调用方持有锁"""
+        if not self.ready:
+            return None
+        if self.sync_seconds is not None and time.monotonic() - self._synced_at >= self.sync_seconds:
+            self.sync()
+        start_us = _micros(start)
+        if start_us < self._since:
+            return None
+        size = self._size
+        ts = self._columns["ts"][:size]
+        site = self._sites.get(site_id)
+        if site is None:
+            return {name: column[:0] for name, column in self._columns.items()}
+        mask = (ts >= start_us) & (self._columns["site"][:size] == site)
+        return {name: column[:size][mask] for name, column in self._columns.items()}
+
+    def summary(self, site_id: str, start: datetime) -> Optional[tuple]:
+        """start 之后的 (浏览量, 不同会话数)"""
+        with self._lock:
+            rows = self._rows(site_id, start)
+            if rows is None:
+                return None
+            return len(rows["ts"]), len(np.unique(rows["session"]))
+
+    def top_urls(self, site_id: str, start: datetime, limit: int) -> Optional[List[UrlViews]]:
+        """start 之后浏览量最高的 url_id"""
+        with self._lock:
+            rows = self._rows(site_id, start)
+            if rows is None:
+                return None
+            urls, counts = np.unique(rows["url"], return_counts=True)
+        order = np.argsort(-counts, kind="stable")[:limit]
+        return [UrlViews(int(urls[i]) if urls[i] >= 0 else None, int(counts[i])) for i in order]
+
+    def buckets(self, site_id: str, start: datetime, recent_start: datetime) -> Optional[List[Bucket]]:
+        """与 StatsService._page_view_buckets 相同的 (日期, 小时) 分桶"""
+        with self._lock:
+            rows = self._rows(site_id, start)
+            if rows is None:
+                return None
+            ts = rows["ts"]
+        if not len(ts):
+            return []
+        hours = ts // MICROS_PER_HOUR
+        first = int(hours.min())
+        views = np.bincount(hours - first)
+        recent = np.bincount(hours - first, weights=ts >= _micros(recent_start), minlength=len(views))
+        return [
+            Bucket((EPOCH + timedelta(hours=first + i)).date(), (first + i) % 24, int(views[i]), int(recent[i]))
+            for i in np.flatnonzero(views).tolist()
+        ]
+
+# 分片模式下每个分片各一份，内存上限按分片数均分
+hot_window = shard_local(lambda: HotWindow(memory_mb=settings.HOT_WINDOW_MEMORY_MB // max(1, len(shards))))
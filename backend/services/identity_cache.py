@@ -0,0 +1,321 @@
+"""
+写入时的用户/会话身份缓存
+
+同一个会话往往连续发来很多次命中，原来每次都要按 user_id 和 session_id 各 SELECT 一次再 UPDATE 计数。
+这里在进程内保存：
+    - 最近活跃用户的 LRU：(站点, user_id) -> (users.id, first_visit)
+    - 最近活跃会话的 LRU：(站点, session_id) -> sessions.id
+    - 所有已知用户的可扩展布隆过滤器：判断为“不存在”时一定是新用户，可以跳过 SELECT 直接插入
+已知用户/会话的 visit_count、last_visit、page_views、end_time 只在内存里累计，定时批量 UPDATE 写回
+（计数以增量写回，与导入工具等其他写入者互不覆盖）。进程崩溃时最近一个写回周期内的计数会少算，明细不受影响。
+
+布隆过滤器在启动时从 users 表预热，之后按 users.id 增量补读其他进程新建的用户；判断为新用户前如果
+距上次补读超过 IDENTITY_SYNC_SECONDS 会先补读一次。插入用户遇到唯一索引冲突时调用 invalidate，
+缓存清空并重新预热，期间一律查库。
+"""
+import hashlib
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+from contextvars import copy_context
+from datetime import datetime
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from sqlalchemy import bindparam, case, or_, select, update
+from config.settings import settings
+from backend.models import User, Session as SessionModel, get_db, sharded, shard_local
+from backend.services.shard_merge import total
+
+logger = logging.getLogger("raymond.identity")
+
+SYNC_CHUNK = 50000
+
+class KnownUser(NamedTuple):
+    id: int
+    first_visit: datetime
+
+def _user_key(site_id: str, user_id: Optional[str]) -> bytes:
+    # 没有 user_id 的匿名访问共用一个用户（与 user_id IS NULL 的查询一致），用 \x01 区分
+    return f"{site_id}\x00{user_id if user_id is not None else chr(1)}".encode()
+
+class BloomFilter:
+    """定长布隆过滤器，k 个位置由一次 blake2b 的两个 64 位哈希双重散列得到"""
+    __slots__ = ("capacity", "bits", "hashes", "size", "_array")
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.size = 0
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key: bytes):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, key: bytes):
+        for position in self._positions(key):
+            self._array[position >> 3] |= 1 << (position & 7)
+        self.size += 1
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(self._array[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+class ScalableBloomFilter:
+    """
+    可扩展布隆过滤器：当前过滤器装满后追加一个容量翻倍、误判率减半的新过滤器，
+    总误判率不超过 2 * error_rate，用户数超过预估时也不需要重建。
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.error_rate = error_rate
+        self.filters = [BloomFilter(capacity, error_rate / 2)]
+
+    def add(self, key: bytes):
+        current = self.filters[-1]
+        if current.size >= current.capacity:
+            current = BloomFilter(current.capacity * 2, self.error_rate / 2 ** (len(self.filters) + 1))
+            self.filters.append(current)
+        current.add(key)
+
+    def __contains__(self, key: bytes) -> bool:
+        return any(key in bloom for bloom in self.filters)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(bloom._array) for bloom in self.filters)
+
+class LRU:
+    def __init__(self, size: int):
+        self.size = size
+        self._items = OrderedDict()
+
+    def get(self, key):
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+class IdentityBatch:
+    """一个写事务中的身份变化，提交成功后由 IdentityCache.apply 并入缓存；回滚时直接丢弃"""
+
+    def __init__(self):
+        # 本事务新建、尚未提交的 ORM 对象，同一事务中的后续命中直接修改它们
+        self.new_users: Dict[Tuple[str, Optional[str]], User] = {}
+        self.new_sessions: Dict[Tuple[str, Optional[str]], SessionModel] = {}
+        # 提交后加入 LRU 的身份（新建的在 flush 后记录 ID）
+        self.users: Dict[Tuple[str, Optional[str]], KnownUser] = {}
+        self.sessions: Dict[Tuple[str, Optional[str]], int] = {}
+        # 已有行的计数增量：id -> [次数, 最新时间]
+        self.user_visits: Dict[int, list] = {}
+        self.session_views: Dict[int, list] = {}
+
+    def touch_user(self, user_pk: int, visits: int, at: datetime):
+        _accumulate(self.user_visits, user_pk, visits, at)
+
+    def touch_session(self, session_pk: int, at: datetime):
+        _accumulate(self.session_views, session_pk, 1, at)
+
+def _accumulate(target: Dict[int, list], pk: int, count: int, at: datetime):
+    entry = target.get(pk)
+    if entry is None:
+        target[pk] = [count, at]
+    else:
+        entry[0] += count
+        if at > entry[1]:
+            entry[1] = at
+
+def _latest(column, value):
+    """只让时间往后走：写回的时间早于库里已有的（例如时长像素刚更新过 end_time）时保留原值"""
+    return case((or_(column.is_(None), column < value), value), else_=column)
+
+class IdentityCache:
+
+    def __init__(self, user_cache_size: int = settings.IDENTITY_USER_CACHE_SIZE,
+                 session_cache_size: int = settings.IDENTITY_SESSION_CACHE_SIZE,
+                 bloom_capacity: int = settings.IDENTITY_BLOOM_CAPACITY,
+                 bloom_error_rate: float = settings.IDENTITY_BLOOM_ERROR_RATE,
+                 sync_seconds: float = settings.IDENTITY_SYNC_SECONDS):
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        self.sync_seconds = sync_seconds
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._users = LRU(user_cache_size)
+        self._sessions = LRU(session_cache_size)
+        self._bloom = None
+        self._cursor = 0
+        self._synced_at = 0.0
+        self._generation = 0
+        self._user_visits: Dict[int, list] = {}
+        self._session_views: Dict[int, list] = {}
+
+    @staticmethod
+    def batch(db) -> IdentityBatch:
+        return db.info.setdefault('identity', IdentityBatch())
+
+    # ---- 查找 ----
+
+    def user(self, site_id: str, user_id: Optional[str]) -> Optional[KnownUser]:
+        with self._lock:
+            return self._users.get((site_id, user_id))
+
+    def session(self, site_id: str, session_id: Optional[str]) -> Optional[int]:
+        with self._lock:
+            return self._sessions.get((site_id, session_id))
+
+    def may_exist(self, site_id: str, user_id: Optional[str]) -> bool:
+        """布隆过滤器判断用户可能已存在；返回 False 时一定不存在，过滤器尚未预热时总是返回 True"""
+        if self._bloom is None:
+            return True
+        key = _user_key(site_id, user_id)
+        if key in self._bloom:
+            return True
+        if time.monotonic() - self._synced_at >= self.sync_seconds:
+            self.sync()
+            bloom = self._bloom
+            return bloom is None or key in bloom
+        return False
+
+    # ---- 提交后 ----
+
+    def apply(self, batch: Optional[IdentityBatch]):
+        """写事务提交后调用：记住新出现的身份，累计已有行的计数"""
+        if batch is None:
+            return
+        with self._lock:
+            for key, known in batch.users.items():
+                self._users.put(key, known)
+                if self._bloom is not None:
+                    self._bloom.add(_user_key(*key))
+            for key, session_pk in batch.sessions.items():
+                self._sessions.put(key, session_pk)
+            for pk, (visits, at) in batch.user_visits.items():
+                _accumulate(self._user_visits, pk, visits, at)
+            for pk, (views, at) in batch.session_views.items():
+                _accumulate(self._session_views, pk, views, at)
+
+    @sharded(total)
+    def flush(self) -> int:
+        """把累计的计数批量写回 users/sessions，返回更新的行数；写库失败时放回待写"""
+        with self._lock:
+            users, self._user_visits = self._user_visits, {}
+            sessions, self._session_views = self._session_views, {}
+        if not users and not sessions:
+            return 0
+
+        db = next(get_db())
+        try:
+            table = User.__table__
+            if users:
+                db.execute(
+                    update(table).where(table.c.id == bindparam("_id")).values(
+                        visit_count=table.c.visit_count + bindparam("_visits"),
+                        last_visit=_latest(table.c.last_visit, bindparam("_at"))
+                    ),
+                    [{"_id": pk, "_visits": visits, "_at": at} for pk, (visits, at) in users.items()]
+                )
+            table = SessionModel.__table__
+            if sessions:
+                db.execute(
+                    update(table).where(table.c.id == bindparam("_id")).values(
+                        page_views=table.c.page_views + bindparam("_views"),
+                        end_time=_latest(table.c.end_time, bindparam("_at"))
+                    ),
+                    [{"_id": pk, "_views": views, "_at": at} for pk, (views, at) in sessions.items()]
+                )
+            db.commit()
+            return len(users) + len(sessions)
+        except Exception:
+            db.rollback()
+            with self._lock:
+                for pk, (visits, at) in users.items():
+                    _accumulate(self._user_visits, pk, visits, at)
+                for pk, (views, at) in sessions.items():
+                    _accumulate(self._session_views, pk, views, at)
+            raise
+        finally:
+            db.close()
+
+    # ---- 布隆过滤器 ----
+
+    @sharded()
+    def warm(self):
+        """从 users 表建立布隆过滤器，应用启动时在后台线程调用"""
+        started = time.perf_counter()
+        with self._lock:
+            generation = self._generation
+        bloom = ScalableBloomFilter(self.bloom_capacity, self.bloom_error_rate)
+        cursor = self._read_users(bloom, 0)
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._bloom = bloom
+            self._cursor = cursor
+            self._synced_at = time.monotonic()
+        logger.info("用户布隆过滤器预热完成：%d 个用户，%.1f KB，%.2fs",
+                    sum(b.size for b in bloom.filters), bloom.nbytes / 1024, time.perf_counter() - started)
+
+    def sync(self):
+        """补读 ID 大于上次位置的用户（其他进程新建的），已有补读在进行时直接返回"""
+        if not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            bloom = self._bloom
+            if bloom is None:
+                return
+            cursor = self._read_users(bloom, self._cursor, shared=True)
+            with self._lock:
+                if self._bloom is bloom:
+                    self._cursor = max(self._cursor, cursor)
+                self._synced_at = time.monotonic()
+        finally:
+            self._sync_lock.release()
+
+    def _read_users(self, bloom: ScalableBloomFilter, cursor: int, shared: bool = False) -> int:
+        db = next(get_db())
+        try:
+            while True:
+                rows = db.execute(
+                    select(User.id, User.site_id, User.user_id)
+                    .where(User.id > cursor).order_by(User.id).limit(SYNC_CHUNK)
+                ).all()
+                # 已投入使用的过滤器也会在 apply 中写入，按字节的置位要和它互斥
+                with self._lock if shared else nullcontext():
+                    for row in rows:
+                        bloom.add(_user_key(row.site_id, row.user_id))
+                if len(rows) < SYNC_CHUNK:
+                    return rows[-1].id if rows else cursor
+                cursor = rows[-1].id
+        finally:
+            db.close()
+
+    def invalidate(self):
+        """缓存可能与数据库不一致（插入用户时唯一索引冲突）：清空 LRU 和过滤器并在后台重新预热，待写的计数保留"""
+        with self._lock:
+            self._generation += 1
+            self._users.clear()
+            self._sessions.clear()
+            self._bloom = None
+        # 在当前上下文中预热，分片模式下只重建本分片的过滤器
+        threading.Thread(target=copy_context().run, args=(self.warm,), name="identity-warm", daemon=True).start()
+
+# 分片模式下每个分片各一份（用户表按分片各自独立）
+identity_cache = shard_local(IdentityCache)
@@ -0,0 +1,689 @@
+"""
+历史数据批量导入
+
+把部署追踪脚本之前的 nginx 访问日志（combined 格式）或导出的 NDJSON 记录导入数据库。
+文件按行流式读取（支持 .gz），按块交给进程池解析和分类，主进程负责切分会话、合并用户和会话，
+再以大事务批量写入。每个事务同时更新 import_checkpoints 中该文件的读取位置，中断后重新执行
+同一命令会从检查点继续，已写入的记录不会重复。导入结束后回补涉及日期的站点日汇总。
+
+NDJSON 每行一个对象，字段与追踪接口相同（type 默认为 pageview），时间取 timestamp
+（Unix 秒或 ISO 8601，不带时区时按本地时间）或 received_at，spool dump 的输出可以直接导入。
+访问日志没有会话和用户 ID，按 IP + UA 生成访客 ID，并按不活跃间隔切分会话。
+
+用法:
+    python -m backend.services.importer access.log access.log.1.gz --host https://www.example.com
+    python -m backend.services.importer hits.ndjson --site-id blog
+    python -m backend.services.importer logs/*.gz --host https://www.example.com --defer-indexes
+"""
+import argparse
+import calendar
+import gzip
+import hashlib
+import json
+import re
+import signal
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from sqlalchemy import bindparam, func, insert, inspect, select, text, update
+
+from config.settings import settings
+from backend.models import PageView, Event, EventProperty, Session as SessionModel, User, bulk_insert, index_applies
+from backend.services.event_property_service import event_property_service
+from backend.services.dimension_service import (
+    dimension_service, PAGE_VIEW_DIMENSIONS, EVENT_DIMENSIONS, SESSION_DIMENSIONS
+)
+from backend.services.geo_service import geo_service
+from backend.services.bot_detector import BotVerdict, bot_detector
+from backend.services.traffic_filter import TRAFFIC_BOT, traffic_filter
+
+CHUNK_LINES = 5000
+LOOKUP_CHUNK = 500
+
+# nginx 默认的 combined 格式：$remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent
+# "$http_referer" "$http_user_agent"
+LOG_LINE_RE = re.compile(
+    r'(?P<ip>\S+) \S+ \S+ \[(?P<time>[^\]]+)\] "(?P<request>[^"]*)" (?P<status>\d{3}) \S+'
+    r'(?: "(?P<referrer>[^"]*)" "(?P<user_agent>[^"]*)")?'
+)
+LOG_TIME_RE = re.compile(r"(\d{2})/(\w{3})/(\d{4}):(\d{2}):(\d{2}):(\d{2}) ([+-])(\d{2})(\d{2})")
+MONTHS = {name: i for i, name in enumerate(
+    ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"), start=1
+)}
+
+PAGE_VIEW_FIELDS = ("page_url", "page_title", "referrer", "ip_address", "user_agent",
+                    "screen_width", "screen_height", "language", "duration")
+EVENT_FIELDS = ("event_type", "event_name", "page_url", "ip_address", "user_agent")
+
+
+class ParseOptions(NamedTuple):
+    fmt: str
+    host: str
+    skip_extensions: Tuple[str, ...]
+    skip_path_prefixes: Tuple[str, ...]
+
+
+def detect_format(path: str) -> str:
+    name = path[:-3] if path.endswith(".gz") else path
+    return "ndjson" if name.endswith((".ndjson", ".jsonl", ".json")) else "nginx"
+
+
+def parse_log_time(value: str) -> Optional[float]:
+    """解析 10/Oct/2024:13:55:36 +0800，返回 Unix 秒；比 strptime 快且不受 locale 影响"""
+    m = LOG_TIME_RE.match(value)
+    if not m or m.group(2) not in MONTHS:
+        return None
+    day, month, year = int(m.group(1)), MONTHS[m.group(2)], int(m.group(3))
+    offset = (int(m.group(8)) * 3600 + int(m.group(9)) * 60) * (1 if m.group(7) == "+" else -1)
+    return calendar.timegm((year, month, day, int(m.group(4)), int(m.group(5)), int(m.group(6)))) - offset
+
+
+def parse_timestamp(value) -> Optional[float]:
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            return None
+    return None
+
+
+def visitor_key(ip_address: Optional[str], user_agent: Optional[str]) -> str:
+    return hashlib.sha1(f"{ip_address}\0{user_agent}".encode("utf-8")).hexdigest()[:16]
+
+
+def parse_log_line(line: str, options: ParseOptions):
+    """解析一行访问日志，返回记录或跳过原因"""
+    m = LOG_LINE_RE.match(line)
+    if not m:
+        return "malformed"
+    parts = m.group("request").split(" ")
+    if len(parts) < 2 or parts[0] != "GET":
+        return "method"
+    status = int(m.group("status"))
+    if not (200 <= status < 300 or status == 304):
+        return "status"
+    target = parts[1]
+    path = target.split("?", 1)[0]
+    if path.startswith(("http://", "https://")):
+        page_url = target
+        path = "/" + path.split("/", 3)[-1] if path.count("/") >= 3 else "/"
+    else:
+        page_url = options.host + target
+    if path.startswith(options.skip_path_prefixes) or path.lower().endswith(options.skip_extensions):
+        return "asset"
+    ts = parse_log_time(m.group("time"))
+    if ts is None:
+        return "malformed"
+    referrer = m.group("referrer")
+    user_agent = m.group("user_agent")
+    return {
+        "type": "pageview",
+        "ts": ts,
+        "page_url": page_url,
+        "referrer": referrer if referrer and referrer != "-" else None,
+        "ip_address": m.group("ip"),
+        "user_agent": user_agent if user_agent != "-" else "",
+    }
+
+
+def parse_ndjson_line(line: str, options: ParseOptions):
+    line = line.strip()
+    if not line:
+        return "empty"
+    try:
+        data = json.loads(line)
+    except ValueError:
+        return "malformed"
+    if not isinstance(data, dict):
+        return "malformed"
+    ts = parse_timestamp(data.get("timestamp", data.get("received_at")))
+    if ts is None:
+        return "no_timestamp"
+    data["ts"] = ts
+    data.setdefault("type", "pageview")
+    if data["type"] not in ("pageview", "event", "duration"):
+        return "type"
+    return data
+
+
+def parse_chunk(lines: List[bytes], options: ParseOptions) -> Tuple[List[dict], Dict[str, int]]:
+    """
+    在工作进程中解析一块行：解析、流量分类、过滤爬虫，并算好入库用的本地/UTC 时间和访客 ID。
+    返回 (记录, 各跳过原因的计数)。
+    """
+    parse = parse_ndjson_line if options.fmt == "ndjson" else parse_log_line
+    store_bots = bot_detector.should_store(BotVerdict(True, "user_agent"))
+    hits = []
+    skipped: Dict[str, int] = {}
+    for raw in lines:
+        hit = parse(raw.decode("utf-8", "replace"), options)
+        if isinstance(hit, str):
+            skipped[hit] = skipped.get(hit, 0) + 1
+            continue
+        if hit["type"] != "duration":
+            traffic_class = traffic_filter.classify(hit.get("page_url"), hit.get("ip_address"), hit.get("user_agent"))
+            if traffic_filter.should_drop(traffic_class) or (traffic_class == TRAFFIC_BOT and not store_bots):
+                skipped["filtered"] = skipped.get("filtered", 0) + 1
+                continue
+            hit["traffic_class"] = traffic_class
+        hit["timestamp"] = datetime.fromtimestamp(hit["ts"])
+        hit["utc"] = datetime.utcfromtimestamp(hit["ts"])
+        if not hit.get("session_id"):
+            hit["visitor"] = visitor_key(hit.get("ip_address"), hit.get("user_agent"))
+        hits.append(hit)
+    return hits, skipped
+
+
+def _init_worker():
+    # Ctrl-C 只由主进程处理，否则工作进程被中断后进程池会卡在关闭阶段
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class Sessionizer:
+    """给没有会话 ID 的记录分配会话：同一访客两次访问间隔超过 timeout 秒即开始新会话"""
+
+    def __init__(self, timeout_seconds: float):
+        self.timeout = timeout_seconds
+        self.active: Dict[str, list] = {}
+
+    def assign(self, key: str, ts: float) -> Tuple[str, bool]:
+        entry = self.active.get(key)
+        if entry is not None and ts - entry[1] <= self.timeout:
+            entry[1] = max(entry[1], ts)
+            return entry[0], False
+        # 会话 ID 由访客和开始时间决定，重新导入同一份日志得到相同的 ID
+        session_id = "imp-" + hashlib.sha1(f"{key}\0{ts}".encode("utf-8")).hexdigest()[:24]
+        self.active[key] = [session_id, ts]
+        return session_id, True
+
+    def prune(self, now: float):
+        cutoff = now - self.timeout
+        self.active = {k: v for k, v in self.active.items() if v[1] >= cutoff}
+
+    def state(self) -> dict:
+        return self.active
+
+    def load(self, state: dict):
+        self.active.update(state)
+
+
+class _Batch:
+    """一个事务要写入的记录，以及按 (站点, ID) 合并后的会话和用户变化"""
+
+    def __init__(self):
+        self.page_views: List[dict] = []
+        self.events: List[dict] = []
+        self.sessions: Dict[Tuple[str, str], dict] = {}
+        self.users: Dict[Tuple[str, str], dict] = {}
+        self.hits = 0
+
+    def __len__(self):
+        return self.hits
+
+
+class Importer:
+    def __init__(self, engine, fmt: str = "auto", site_id: str = settings.DEFAULT_SITE_ID, host: str = "",
+                 workers: int = settings.IMPORT_WORKERS, batch_size: int = settings.IMPORT_BATCH_SIZE,
+                 session_timeout_minutes: int = settings.IMPORT_SESSION_TIMEOUT_MINUTES,
+                 defer_indexes: bool = False, rollup: bool = True, progress: bool = True):
+        self.engine = engine
+        self.fmt = fmt
+        self.site_id = site_id
+        self.host = host.rstrip("/")
+        self.workers = workers
+        self.batch_size = batch_size
+        self.defer_indexes = defer_indexes
+        self.rollup = rollup
+        self.progress = progress
+        self.sessionizer = Sessionizer(session_timeout_minutes * 60)
+        self.stats = {"files": 0, "lines": 0, "page_views": 0, "events": 0, "durations": 0,
+                      "sessions": 0, "users": 0, "skipped": {}}
+        self._days = set()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._started = 0.0
+
+    # ---- 入口 ----
+
+    def run(self, paths: List[str]) -> dict:
+        self._started = time.perf_counter()
+        self._ensure_checkpoint_table()
+        if self.workers > 1:
+            self._pool = ProcessPoolExecutor(self.workers, initializer=_init_worker)
+        # 上次带 --defer-indexes 的导入中断时索引还没重建，这次结束时一并重建
+        rebuild = self.defer_indexes or bool(self._missing_indexes())
+        if self.defer_indexes:
+            self._drop_indexes()
+        try:
+            for path in paths:
+                self.import_file(path)
+        except BaseException:
+            if rebuild:
+                self._log("导入中断，明细表的二级索引尚未重建；重新执行导入命令会从检查点继续并在结束时重建")
+            raise
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown(cancel_futures=True)
+                self._pool = None
+        if rebuild:
+            self._create_indexes()
+        if self.rollup and self._days:
+            from backend.services.stats_service import stats_service
+            from backend.services.funnel_service import funnel_service
+            from backend.services.retention_service import retention_service
+            from backend.services.duration_service import duration_service
+            from backend.services.path_service import path_service
+
+            start, end = min(self._days), max(self._days) + timedelta(days=1)
+            rows = stats_service.rollup_site_stats(start=start, end=end)
+            geo_service.rollup(start=start, end=end)
+            path_service.rollup(start=start, end=end)
+            funnel_service.invalidate(start, end)
+            self._log(f"已回补 {start} ~ {end - timedelta(days=1)} 的站点日汇总（{rows} 行）")
+            # 导入会把用户的 first_visit 提前，新用户位图要一直重建到今天
+            bitmaps = retention_service.rebuild(start=start)
+            self._log(f"已重建 {start} 起的留存位图（{bitmaps} 个）")
+            sketches = duration_service.rebuild_sessions()
+            self._log(f"已重建会话时长草图（{sketches} 个）")
+        self.stats["seconds"] = round(time.perf_counter() - self._started, 2)
+        return self.stats
+
+    def import_file(self, path: str):
+        source = str(Path(path).resolve())
+        fmt = detect_format(path) if self.fmt == "auto" else self.fmt
+        options = ParseOptions(fmt, self.host, tuple(settings.IMPORT_SKIP_EXTENSIONS),
+                               tuple(settings.IMPORT_SKIP_PATH_PREFIXES))
+        position, lines, state = self._read_checkpoint(source)
+        compressed = path.endswith(".gz")
+        if not compressed and position > Path(path).stat().st_size:
+            self._log(f"{path} 比检查点记录的短，按新文件从头导入")
+            position, lines, state = 0, 0, {}
+        self.sessionizer.load(state)
+        if position:
+            self._log(f"{path}: 从检查点继续（已读取 {lines} 行）")
+
+        started = time.perf_counter()
+        start_position = position
+        batch = _Batch()
+        with (gzip.open(path, "rb") if compressed else open(path, "rb")) as f:
+            f.seek(position)
+            for (hits, skipped, n_lines), position in self._parsed_chunks(f, options, compressed):
+                lines += n_lines
+                self.stats["lines"] += n_lines
+                for reason, count in skipped.items():
+                    self.stats["skipped"][reason] = self.stats["skipped"].get(reason, 0) + count
+                for hit in hits:
+                    self._add(batch, hit)
+                if len(batch) >= self.batch_size:
+                    self._flush(batch, source, position, lines)
+                    self._report(path, lines, position - start_position, started)
+                    batch = _Batch()
+        if batch.hits or position != self._read_checkpoint(source)[0]:
+            self._flush(batch, source, position, lines)
+            self._report(path, lines, position - start_position, started)
+        self.stats["files"] += 1
+
+    # ---- 读取和解析 ----
+
+    def _chunks(self, f, compressed: bool) -> Iterator[Tuple[List[bytes], int]]:
+        """按块读取完整的行，返回 (行, 读完这些行之后的位置)；普通文件末尾没有换行的半行留到下次导入"""
+        while True:
+            lines = []
+            position = f.tell()
+            for _ in range(CHUNK_LINES):
+                line = f.readline()
+                if not line:
+                    break
+                if not line.endswith(b"\n") and not compressed:
+                    f.seek(position)
+                    break
+                lines.append(line)
+                position = f.tell()
+            if not lines:
+                return
+            yield lines, position
+
+    def _parsed_chunks(self, f, options: ParseOptions, compressed: bool):
+        """按原顺序返回每块的解析结果；使用进程池时最多有 2 * workers 块在解析中，内存有上界"""
+        if self._pool is None:
+            for lines, position in self._chunks(f, compressed):
+                yield (*parse_chunk(lines, options), len(lines)), position
+            return
+        pending = deque()
+        for lines, position in self._chunks(f, compressed):
+            pending.append((self._pool.submit(parse_chunk, lines, options), len(lines), position))
+            if len(pending) >= self.workers * 2:
+                future, n_lines, done_position = pending.popleft()
+                yield (*future.result(), n_lines), done_position
+        while pending:
+            future, n_lines, done_position = pending.popleft()
+            yield (*future.result(), n_lines), done_position
+
+    # ---- 合并 ----
+
+    def _add(self, batch: _Batch, hit: dict):
+        site_id = hit.get("site_id") or self.site_id
+        hit_type = hit["type"]
+        derived = False
+        if not hit.get("session_id"):
+            visitor = hit["visitor"]
+            hit["session_id"], _ = self.sessionizer.assign(f"{site_id}:{visitor}", hit["ts"])
+            hit["user_id"] = hit.get("user_id") or f"imp-{visitor}"
+            derived = True
+        session_id, user_id, utc = hit["session_id"], hit.get("user_id"), hit["utc"]
+        batch.hits += 1
+        self._days.add(hit["timestamp"].date())
+
+        if hit_type == "duration":
+            session = batch.sessions.setdefault((site_id, session_id), {"hits": 0, "start": utc, "end": utc})
+            session["duration"] = hit.get("duration") or 0.0
+            session["end"] = max(session["end"], utc)
+            session["touched"] = True
+            self.stats["durations"] += 1
+            return
+
+        if user_id:
+            user = batch.users.get((site_id, user_id))
+            if user is None:
+                user = batch.users[(site_id, user_id)] = {
+                    "first": utc, "last": utc, "visits": 0,
+                    "ip_address": hit.get("ip_address"), "user_agent": hit.get("user_agent"),
+                }
+            user["first"] = min(user["first"], utc)
+            user["last"] = max(user["last"], utc)
+
+        if hit_type == "event":
+            properties = hit.get("properties")
+            batch.events.append({
+                "site_id": site_id,
+                "session_id": session_id,
+                "user_id": user_id,
+                **{field: hit.get(field) for field in EVENT_FIELDS},
+                "properties": json.dumps(properties) if isinstance(properties, (dict, list)) else properties,
+                "timestamp": hit["timestamp"],
+            })
+            return
+
+        if user_id:
+            user["visits"] += 1
+        batch.page_views.append({
+            "site_id": site_id,
+            "session_id": session_id,
+            "user_id": user_id,
+            **{field: hit.get(field) for field in PAGE_VIEW_FIELDS},
+            "traffic_class": hit["traffic_class"],
+            "timestamp": hit["timestamp"],
+        })
+        session = batch.sessions.get((site_id, session_id))
+        if session is None:
+            session = batch.sessions[(site_id, session_id)] = {"hits": 0, "start": utc, "end": utc}
+        if not session.get("created"):
+            session.update(created=True, user_id=user_id, ip_address=hit.get("ip_address"),
+                           user_agent=hit.get("user_agent"), referrer=hit.get("referrer"), derived=derived)
+        session["hits"] += 1
+        session["start"] = min(session["start"], utc)
+        session["end"] = max(session["end"], utc)
+
+    # ---- 写入 ----
+
+    def _flush(self, batch: _Batch, source: str, position: int, lines: int):
+        """在一个事务中写入一批记录和检查点"""
+        if batch.hits and self.sessionizer.active:
+            self.sessionizer.prune(max(entry[1] for entry in self.sessionizer.active.values()))
+        self._encode_dimensions(batch)
+        with self.engine.begin() as conn:
+            self._write_users(conn, batch.users)
+            self._write_sessions(conn, batch.sessions)
+            bulk_insert(conn, PageView.__table__, batch.page_views)
+            if batch.events:
+                self._write_events(conn, batch.events)
+            self._write_checkpoint(conn, source, position, lines)
+        self.stats["page_views"] += len(batch.page_views)
+        self.stats["events"] += len(batch.events)
+
+    def _encode_dimensions(self, batch: _Batch):
+        """字典 ID 在写入明细的事务之前解析（新值在单独的事务中写入字典表），明细行只保留 ID"""
+        for rows, columns in ((batch.page_views, PAGE_VIEW_DIMENSIONS), (batch.events, EVENT_DIMENSIONS)):
+            dimension_service.replace(rows, columns, engine=self.engine)
+        sessions = [session for session in batch.sessions.values() if session.get("created")]
+        for session, ids in zip(sessions, dimension_service.encode(sessions, SESSION_DIMENSIONS, engine=self.engine)):
+            session.update(ids)
+
+    def _write_events(self, conn, events: List[dict]):
+        if conn.dialect.name == "sqlite":
+            # SQLite 同一时间只有一个写事务，新事件就是 id 大于原最大值的行，属性在库内用 JSON1 展开
+            last_id = conn.execute(select(func.max(Event.id))).scalar() or 0
+            conn.execute(insert(Event.__table__), events)
+            event_property_service.index_events(conn, last_id)
+            return
+        # 其它数据库可能有在线写入并发分配 ID，按 RETURNING 的顺序把 ID 对应回每一行
+        ids = conn.execute(
+            insert(Event.__table__).returning(Event.__table__.c.id, sort_by_parameter_order=True), events
+        ).scalars().all()
+        event_property_service.index_rows(conn, [dict(event, id=event_id) for event, event_id in zip(events, ids)])
+
+    def _existing(self, conn, model, id_column, keys) -> Dict[Tuple[str, str], dict]:
+        """按 (site_id, ID) 批量查出已存在的行，每次查询 LOOKUP_CHUNK 个 ID"""
+        by_site: Dict[str, List[str]] = {}
+        for site_id, key in keys:
+            by_site.setdefault(site_id, []).append(key)
+        found = {}
+        for site_id, ids in by_site.items():
+            for i in range(0, len(ids), LOOKUP_CHUNK):
+                rows = conn.execute(
+                    model.__table__.select().where(
+                        model.site_id == site_id, id_column.in_(ids[i:i + LOOKUP_CHUNK])
+                    )
+                ).mappings()
+                for row in rows:
+                    found[(site_id, row[id_column.key])] = dict(row)
+        return found
+
+    def _write_users(self, conn, users: Dict[Tuple[str, str], dict]):
+        if not users:
+            return
+        existing = self._existing(conn, User, User.user_id, users.keys())
+        new_rows, updates = [], []
+        for (site_id, user_id), user in users.items():
+            row = existing.get((site_id, user_id))
+            if row is None:
+                new_rows.append({
+                    "site_id": site_id, "user_id": user_id,
+                    "first_visit": user["first"], "last_visit": user["last"],
+                    "visit_count": max(user["visits"], 1),
+                    "ip_address": user["ip_address"], "user_agent": user["user_agent"],
+                })
+                continue
+            updates.append({
+                "_id": row["id"],
+                "_first_visit": min(row["first_visit"] or user["first"], user["first"]),
+                "_last_visit": max(row["last_visit"] or user["last"], user["last"]),
+                "_visit_count": (row["visit_count"] or 0) + user["visits"],
+            })
+        bulk_insert(conn, User.__table__, new_rows)
+        if updates:
+            conn.execute(
+                update(User.__table__).where(User.__table__.c.id == bindparam("_id")).values(
+                    first_visit=bindparam("_first_visit"), last_visit=bindparam("_last_visit"),
+                    visit_count=bindparam("_visit_count")
+                ),
+                updates
+            )
+        self.stats["users"] += len(new_rows)
+
+    def _write_sessions(self, conn, sessions: Dict[Tuple[str, str], dict]):
+        if not sessions:
+            return
+        existing = self._existing(conn, SessionModel, SessionModel.session_id, sessions.keys())
+        new_rows, updates = [], []
+        for (site_id, session_id), session in sessions.items():
+            row = existing.get((site_id, session_id))
+            if row is None:
+                # 和在线写入一致：时长记录只更新已有会话
+                if not session.get("created"):
+                    continue
+                country, city = geo_service.locate(session["ip_address"])
+                new_rows.append({
+                    "site_id": site_id, "session_id": session_id, "user_id": session["user_id"],
+                    "country": country, "city": city,
+                    "ip_address": session["ip_address"], "start_time": session["start"],
+                    "end_time": session["end"] if session["hits"] > 1 or session.get("touched") else None,
+                    "page_views": session["hits"],
+                    "duration": _session_duration(session, session["start"], session["end"]),
+                    "ua_id": session["ua_id"], "referrer_id": session["referrer_id"],
+                })
+                continue
+            start = min(row["start_time"] or session["start"], session["start"])
+            end = max(row["end_time"] or session["end"], session["end"])
+            updates.append({
+                "_id": row["id"],
+                "_start_time": start,
+                "_end_time": end,
+                "_page_views": (row["page_views"] or 0) + session["hits"],
+                "_duration": _session_duration(session, start, end, row["duration"]),
+            })
+        bulk_insert(conn, SessionModel.__table__, new_rows)
+        if updates:
+            conn.execute(
+                update(SessionModel.__table__).where(SessionModel.__table__.c.id == bindparam("_id")).values(
+                    start_time=bindparam("_start_time"), end_time=bindparam("_end_time"),
+                    page_views=bindparam("_page_views"), duration=bindparam("_duration")
+                ),
+                updates
+            )
+        self.stats["sessions"] += len(new_rows)
+
+    # ---- 检查点 ----
+
+    def _ensure_checkpoint_table(self):
+        with self.engine.begin() as conn:
+            conn.execute(text(
+                "CREATE TABLE IF NOT EXISTS import_checkpoints ("
+                "source VARCHAR(1000) PRIMARY KEY, position BIGINT, lines BIGINT, state TEXT, updated_at TIMESTAMP)"
+            ))
+
+    def _read_checkpoint(self, source: str) -> Tuple[int, int, dict]:
+        with self.engine.connect() as conn:
+            row = conn.execute(
+                text("SELECT position, lines, state FROM import_checkpoints WHERE source = :source"),
+                {"source": source}
+            ).first()
+        if row is None:
+            return 0, 0, {}
+        return row.position, row.lines, json.loads(row.state or "{}")
+
+    def _write_checkpoint(self, conn, source: str, position: int, lines: int):
+        params = {"source": source, "position": position, "lines": lines,
+                  "state": json.dumps(self.sessionizer.state()), "updated_at": datetime.utcnow()}
+        result = conn.execute(text(
+            "UPDATE import_checkpoints SET position = :position, lines = :lines, state = :state, "
+            "updated_at = :updated_at WHERE source = :source"
+        ), params)
+        if result.rowcount == 0:
+            conn.execute(text(
+                "INSERT INTO import_checkpoints (source, position, lines, state, updated_at) "
+                "VALUES (:source, :position, :lines, :state, :updated_at)"
+            ), params)
+
+    # ---- 索引 ----
+
+    def _deferred_indexes(self):
+        """导入期间可以先删掉的索引：明细表上的非唯一索引（会话和用户的唯一索引要保留）"""
+        dialect = self.engine.dialect.name
+        return [index for table in (PageView.__table__, Event.__table__, EventProperty.__table__)
+                for index in table.indexes if not index.unique and index_applies(index, dialect)]
+
+    def _missing_indexes(self):
+        with self.engine.connect() as conn:
+            inspector = inspect(conn)
+            existing = {i["name"] for table in ("page_views", "events", "event_properties")
+                        for i in inspector.get_indexes(table)}
+        return [index for index in self._deferred_indexes() if index.name not in existing]
+
+    def _drop_indexes(self):
+        self._log("删除明细表的二级索引，导入结束后重建")
+        for index in self._deferred_indexes():
+            index.drop(self.engine, checkfirst=True)
+
+    def _create_indexes(self):
+        started = time.perf_counter()
+        for index in self._deferred_indexes():
+            index.create(self.engine, checkfirst=True)
+        # 批量写入后刷新统计信息，查询计划才会用上新建的索引
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql("ANALYZE")
+        self._log(f"索引已重建，用时 {time.perf_counter() - started:.1f}s")
+
+    # ---- 输出 ----
+
+    def _report(self, path: str, lines: int, read_bytes: int, started: float):
+        elapsed = max(time.perf_counter() - started, 1e-9)
+        total = max(time.perf_counter() - self._started, 1e-9)
+        written = self.stats["page_views"] + self.stats["events"]
+        self._log(
+            f"  {Path(path).name}: {lines} 行, 累计写入 {written} 条 | "
+            f"{self.stats['lines'] / total:.0f} 行/秒, {written / total:.0f} 条/秒, "
+            f"{read_bytes / elapsed / 1024 / 1024:.1f} MB/秒"
+        )
+
+    def _log(self, message: str):
+        if self.progress:
+            print(message, file=sys.stderr)
+
+
+def _session_duration(session: dict, start: datetime, end: datetime, current: Optional[float] = None) -> float:
+    """有时长记录时以记录为准；从访问日志切分出的会话用首末两次访问的间隔；其余保持原值"""
+    if "duration" in session:
+        return session["duration"]
+    if session.get("derived"):
+        return round((end - start).total_seconds(), 2)
+    return current or 0.0
+
+
+def main(argv=None):
+    from backend.models import init_db, shards
+    from backend.models.database import engine
+
+    parser = argparse.ArgumentParser(description="导入历史访问日志或 NDJSON 记录")
+    parser.add_argument("paths", nargs="+", help="访问日志或 NDJSON 文件，可以是 .gz；按时间从旧到新排列")
+    parser.add_argument("--format", choices=("auto", "nginx", "ndjson"), default="auto")
+    parser.add_argument("--site-id", default=settings.DEFAULT_SITE_ID, help="记录中没有 site_id 时使用的站点")
+    parser.add_argument("--host", default="", help="访问日志中的路径前加上的站点地址，如 https://www.example.com")
+    parser.add_argument("--workers", type=int, default=settings.IMPORT_WORKERS, help="解析进程数，1 表示不用进程池")
+    parser.add_argument("--batch-size", type=int, default=settings.IMPORT_BATCH_SIZE, help="每个事务写入的记录数")
+    parser.add_argument("--session-timeout", type=int, default=settings.IMPORT_SESSION_TIMEOUT_MINUTES,
+                        help="访问日志切分会话的不活跃间隔（分钟）")
+    parser.add_argument("--defer-indexes", action="store_true",
+                        help="导入前删除明细表的二级索引、结束后重建，适合首次大批量导入（导入期间查询会变慢）")
+    parser.add_argument("--no-rollup", action="store_true", help="不回补站点日汇总")
+    args = parser.parse_args(argv)
+
+    if shards.enabled:
+        parser.error("分片模式下请先用 SHARD_COUNT=1 导入到单独的数据库，"
+                     "再用 python -m backend.services.sharding split 分布到各分片")
+    init_db()
+    importer = Importer(
+        engine,
+        fmt=args.format,
+        site_id=args.site_id,
+        host=args.host,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        session_timeout_minutes=args.session_timeout,
+        defer_indexes=args.defer_indexes,
+        rollup=not args.no_rollup,
+    )
+    stats = importer.run(args.paths)
+    print(json.dumps(stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
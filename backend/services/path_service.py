@@ -0,0 +1,303 @@
+"""
+会话路径分析：每个会话完整的页面序列，以及按前缀逐层下钻。
+
+桑基图只统计前 3 跳的两两跳转，看不出会话的先后顺序。这里把每个会话规范化后的页面序列
+（normalize_page_url，连续重复的页面只算一次，最多 PATH_MAX_DEPTH 步）插入一棵带计数的前缀树：
+    - 节点的 sessions 是经过这个前缀的会话数，exits 是恰好在这里结束的会话数
+    - 超过最大步数的会话截断后不计 exits，剪掉的子树也不单独记录，二者的差额在查询结果里是 other
+每个站点每天（按会话开始的本地日期）一棵树，剪掉会话数少于 PATH_PRUNE_MIN_SESSIONS 的节点、每个节点只留
+PATH_MAX_CHILDREN 个子节点，压缩后存入 path_tries。定时任务重算最近几天，历史数据可用
+python -m backend.models.migrations --rebuild-paths 重建；/api/stats/paths 只取出窗口内每天的树合并。
+"""
+import heapq
+import struct
+import zlib
+from collections import Counter, defaultdict
+from datetime import date, datetime, time, timedelta, timezone
+from itertools import groupby
+from typing import Any, Dict, List, Optional, Sequence
+
+from sqlalchemy import and_, func
+from config.settings import settings
+from backend.models import PageView, PathTrie, Session as SessionModel, get_read_db, open_db, sharded
+from backend.services.dimension_service import dimension_service
+from backend.services.flow_service import normalize_page_url
+from backend.services.shard_merge import concat, total as total_of
+from backend.services.traffic_filter import TRAFFIC_NORMAL
+from backend.utils.metrics import timed, STATS_QUERY_SECONDS
+
+# 重建历史数据时每次处理的天数，控制内存中的序列计数
+REBUILD_CHUNK_DAYS = 7
+
+class PathNode:
+    __slots__ = ("sessions", "exits", "children")
+
+    def __init__(self, sessions: int = 0, exits: int = 0):
+        self.sessions = sessions
+        self.exits = exits
+        self.children: Dict[str, "PathNode"] = {}
+
+class PrefixTrie:
+    """页面序列的前缀树，根节点的 sessions 是会话总数"""
+
+    def __init__(self):
+        self.root = PathNode()
+
+    def insert(self, path: Sequence[str], weight: int = 1, complete: bool = True):
+        """插入 weight 个相同的序列；complete 为 False 表示序列被截断，不计 exits"""
+        node = self.root
+        node.sessions += weight
+        for page in path:
+            child = node.children.get(page)
+            if child is None:
+                child = node.children[page] = PathNode()
+            child.sessions += weight
+            node = child
+        if complete and path:
+            node.exits += weight
+
+    def merge(self, other: "PrefixTrie") -> "PrefixTrie":
+        def merge_node(target: PathNode, source: PathNode):
+            target.sessions += source.sessions
+            target.exits += source.exits
+            for page, child in source.children.items():
+                existing = target.children.get(page)
+                if existing is None:
+                    target.children[page] = child
+                else:
+                    merge_node(existing, child)
+        merge_node(self.root, other.root)
+        return self
+
+    def prune(self, min_sessions: int = settings.PATH_PRUNE_MIN_SESSIONS,
+              max_children: int = settings.PATH_MAX_CHILDREN) -> "PrefixTrie":
+        """去掉会话数不足 min_sessions 的子树，每个节点只保留会话数最多的 max_children 个子节点"""
+        def prune_node(node: PathNode):
+            kept = [item for item in node.children.items() if item[1].sessions >= min_sessions]
+            if len(kept) > max_children:
+                kept = heapq.nlargest(max_children, kept, key=lambda item: item[1].sessions)
+            node.children = dict(kept)
+            for child in node.children.values():
+                prune_node(child)
+        prune_node(self.root)
+        return self
+
+    def find(self, prefix: Sequence[str]) -> Optional[PathNode]:
+        node = self.root
+        for page in prefix:
+            node = node.children.get(page)
+            if node is None:
+                return None
+        return node
+
+    @property
+    def sessions(self) -> int:
+        return self.root.sessions
+
+    def node_count(self) -> int:
+        stack, count = [self.root], 0
+        while stack:
+            node = stack.pop()
+            count += 1
+            stack.extend(node.children.values())
+        return count
+
+    def serialize(self) -> bytes:
+        """页面名表 + 先序遍历的 (页面下标, sessions, exits, 子节点数)，整体 zlib 压缩"""
+        labels, flat = {}, []
+
+        def visit(label: int, node: PathNode):
+            flat.extend((label, node.sessions, node.exits, len(node.children)))
+            for page, child in node.children.items():
+                visit(labels.setdefault(page, len(labels)), child)
+
+        visit(0, self.root)
+        names = "\x00".join(labels).encode()
+        return zlib.compress(struct.pack("<I", len(names)) + names + struct.pack(f"<{len(flat)}I", *flat))
+
+    @classmethod
+    def deserialize(cls, data: bytes) -> "PrefixTrie":
+        raw = zlib.decompress(data)
+        size, = struct.unpack_from("<I", raw)
+        names = raw[4:4 + size].decode().split("\x00") if size else []
+        flat = struct.unpack_from(f"<{(len(raw) - 4 - size) // 4}I", raw, 4 + size)
+        trie = cls()
+        _, trie.root.sessions, trie.root.exits, remaining = flat[:4]
+        # 栈中是 (节点, 尚未读取的子节点数)
+        stack = [(trie.root, remaining)]
+        for i in range(4, len(flat), 4):
+            while stack[-1][1] == 0:
+                stack.pop()
+            parent, remaining = stack[-1]
+            stack[-1] = (parent, remaining - 1)
+            child = parent.children[names[flat[i]]] = PathNode(flat[i + 1], flat[i + 2])
+            stack.append((child, flat[i + 3]))
+        return trie
+
+def _utc(local_time: datetime) -> datetime:
+    """本地日期边界换成 sessions 表使用的 UTC 时间"""
+    return local_time.astimezone(timezone.utc).replace(tzinfo=None)
+
+def _local_day(utc_time: datetime) -> datetime:
+    return datetime.combine(utc_time.replace(tzinfo=timezone.utc).astimezone().date(), time.min)
+
+def _collapse(pages: Sequence[str]) -> List[str]:
+    """连续重复的页面（刷新、站内锚点）只保留一次"""
+    return [page for i, page in enumerate(pages) if i == 0 or page != pages[i - 1]]
+
+class PathService:
+
+    def __init__(self, max_depth: int = settings.PATH_MAX_DEPTH):
+        self.max_depth = max_depth
+
+    @sharded(total_of)
+    def rollup(self, days: int = None, start: date = None, end: date = None, engine=None) -> int:
+        """
+        与 rollup_site_stats 相同的日期范围，重算每个站点每天的路径前缀树，返回写入的行数；
+        engine 为空时使用 get_db 的数据库
+        """
+        days = days or settings.SITE_ROLLUP_DAYS
+        start_day = datetime.combine(start or (datetime.now() - timedelta(days=days - 1)).date(), time.min)
+        end_day = datetime.combine(end, time.min) if end else None
+        db = open_db(engine)
+        try:
+            rows = db.query(
+                SessionModel.id,
+                SessionModel.site_id,
+                SessionModel.start_time,
+                PageView.url_id
+            ).join(
+                PageView, and_(
+                    PageView.site_id == SessionModel.site_id,
+                    PageView.session_id == SessionModel.session_id
+                )
+            ).filter(
+                SessionModel.start_time >= _utc(start_day),
+                PageView.traffic_class == TRAFFIC_NORMAL
+            )
+            if end_day:
+                rows = rows.filter(SessionModel.start_time < _utc(end_day))
+            rows = rows.order_by(SessionModel.id, PageView.timestamp).yield_per(5000)
+
+            # 与桑基图相同，先按 url_id 序列计数，每个不同的 URL 只取回和规范化一次
+            sequences = defaultdict(Counter)
+            for _, views in groupby(rows, key=lambda r: r.id):
+                first = next(views)
+                key = (first.site_id, _local_day(first.start_time))
+                sequences[key][(first.url_id,) + tuple(r.url_id for r in views)] += 1
+            url_ids = {url_id for counter in sequences.values() for path in counter for url_id in path}
+            names = dimension_service.names(db, "url", url_ids)
+            pages = {url_id: normalize_page_url(url) for url_id, url in names.items()}
+
+            tries = []
+            for (site_id, day), counter in sequences.items():
+                trie = PrefixTrie()
+                for path, sessions in counter.items():
+                    collapsed = _collapse([pages.get(url_id, normalize_page_url(None)) for url_id in path])
+                    trie.insert(collapsed[:self.max_depth], sessions, complete=len(collapsed) <= self.max_depth)
+                trie.prune()
+                tries.append(PathTrie(
+                    site_id=site_id,
+                    day=day,
+                    sessions=trie.sessions,
+                    nodes=trie.node_count(),
+                    data=trie.serialize(),
+                    updated_at=datetime.utcnow()
+                ))
+
+            scope = [PathTrie.day >= start_day]
+            if end_day:
+                scope.append(PathTrie.day < end_day)
+            db.query(PathTrie).filter(*scope).delete(synchronize_session=False)
+            db.add_all(tries)
+            db.commit()
+            return len(tries)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    @sharded(total_of)
+    def rebuild(self, engine=None) -> int:
+        """从最早的会话起按 REBUILD_CHUNK_DAYS 天一段重算所有路径前缀树，返回写入的行数；engine 同 rollup"""
+        db = open_db(engine)
+        try:
+            earliest = db.query(func.min(SessionModel.start_time)).scalar()
+        finally:
+            db.close()
+        if earliest is None:
+            return 0
+        day, today = _local_day(earliest).date(), date.today()
+        written = 0
+        while day <= today:
+            end = day + timedelta(days=REBUILD_CHUNK_DAYS)
+            written += self.rollup(start=day, end=end, engine=engine)
+            day = end
+        return written
+
+    @timed(STATS_QUERY_SECONDS)
+    def get_paths(self, prefix: Sequence[str] = (), depth: int = 3, days: int = 7, limit: int = 10,
+                  site_id: str = settings.DEFAULT_SITE_ID) -> Dict[str, Any]:
+        """
+        最近 days 天（含今天）经过 prefix 的会话：往下 depth 层的路径树（每层会话数最多的 limit 个页面），
+        以及在这 depth 层内结束的最常见的 limit 条完整路径。
+        """
+        prefix = list(prefix)
+        # 前缀树中是页面名而不是 url_id，各分片的树可以直接合并
+        trie = PrefixTrie()
+        for data in self._tries(days, site_id):
+            trie.merge(PrefixTrie.deserialize(data))
+        node = trie.find(prefix) or PathNode()
+        total = trie.sessions
+        return {
+            "prefix": prefix,
+            "total_sessions": total,
+            "sessions": node.sessions,
+            "percentage": round(node.sessions / total * 100, 2) if total else 0,
+            "exits": node.exits,
+            "other": node.sessions - node.exits - sum(child.sessions for child in node.children.values()),
+            "children": self._tree(node, depth, limit, node.sessions),
+            "paths": self._paths(node, prefix, depth, limit)
+        }
+
+    @sharded(concat)
+    def _tries(self, days: int, site_id: str) -> List[bytes]:
+        """窗口内每天序列化的前缀树"""
+        start_day = datetime.combine((datetime.now() - timedelta(days=days - 1)).date(), time.min)
+        db = next(get_read_db())
+        try:
+            rows = db.query(PathTrie.data).filter(
+                PathTrie.site_id == site_id,
+                PathTrie.day >= start_day
+            ).all()
+        finally:
+            db.close()
+        return [row.data for row in rows]
+
+    def _tree(self, node: PathNode, depth: int, limit: int, base: int) -> List[Dict[str, Any]]:
+        if depth <= 0:
+            return []
+        children = heapq.nlargest(limit, node.children.items(), key=lambda item: item[1].sessions)
+        return [{
+            "page": page,
+            "sessions": child.sessions,
+            "percentage": round(child.sessions / base * 100, 2) if base else 0,
+            "exits": child.exits,
+            "children": self._tree(child, depth - 1, limit, base)
+        } for page, child in children]
+
+    def _paths(self, node: PathNode, prefix: List[str], depth: int, limit: int) -> List[Dict[str, Any]]:
+        """前缀之下 depth 层以内结束的路径，按结束在该处的会话数排序"""
+        ended = []
+        stack = [(node, [])]
+        while stack:
+            current, suffix = stack.pop()
+            if current.exits:
+                ended.append((current.exits, suffix))
+            if len(suffix) < depth:
+                stack.extend((child, suffix + [page]) for page, child in current.children.items())
+        top = heapq.nlargest(limit, ended, key=lambda item: item[0])
+        return [{"path": prefix + suffix, "sessions": sessions} for sessions, suffix in top]
+
+path_service = PathService()
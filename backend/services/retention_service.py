@@ -0,0 +1,297 @@
+"""
+留存分析：按天保存用户位图，留存矩阵的每个格子是一次位图求交和计数。
+
+位图中的位是 users.id。kind=new 是首次出现（users.first_visit 的本地日期）在当天的用户，
+kind=active 是当天有正常页面浏览的用户。写入时 TrackingService 把用户记到内存里的待合并集合，
+定时任务和关闭时的钩子按 (站点, 类型, 日期) 与已存的位图做并集写回，查询时待合并的集合在内存中一并求并，不写库；导入历史数据、迁移或
+python -m backend.models.migrations --rebuild-retention 时用 rebuild 从明细重建。
+"""
+import threading
+import zlib
+from datetime import date, datetime, time, timedelta, timezone
+from itertools import groupby
+from typing import Any, Dict, Iterable, Optional
+
+from sqlalchemy import select, and_
+from config.settings import settings
+from backend.models import PageView, User, ActivityBitmap, get_db, get_read_db, open_db, day_bucket, sharded, shard_local
+from backend.services.shard_merge import total
+from backend.services.traffic_filter import TRAFFIC_NORMAL
+from backend.utils.metrics import timed, STATS_QUERY_SECONDS
+
+try:
+    from pyroaring import BitMap
+except ImportError:
+    BitMap = None
+
+KIND_ACTIVE = "active"
+KIND_NEW = "new"
+
+PERIOD_DAYS = {"day": 1, "week": 7}
+
+class IntBitMap:
+    """
+    没有 pyroaring 时使用的位图：一个 Python 大整数，按位与/或和 bit_count 都在 C 里逐机器字完成。
+    只实现留存计算用到的接口（|、&、len、迭代、序列化），序列化结果用 zlib 压缩掉连续的 0。
+    """
+    __slots__ = ("bits",)
+
+    def __init__(self, values: Iterable[int] = ()):
+        values = list(values)
+        if not values:
+            self.bits = 0
+            return
+        buffer = bytearray(max(values) // 8 + 1)
+        for value in values:
+            buffer[value >> 3] |= 1 << (value & 7)
+        self.bits = int.from_bytes(buffer, "little")
+
+    @classmethod
+    def _wrap(cls, bits: int) -> "IntBitMap":
+        bitmap = cls.__new__(cls)
+        bitmap.bits = bits
+        return bitmap
+
+    def __or__(self, other: "IntBitMap") -> "IntBitMap":
+        return self._wrap(self.bits | other.bits)
+
+    def __and__(self, other: "IntBitMap") -> "IntBitMap":
+        return self._wrap(self.bits & other.bits)
+
+    def __len__(self) -> int:
+        return self.bits.bit_count()
+
+    def __iter__(self):
+        for i, byte in enumerate(self.bits.to_bytes((self.bits.bit_length() + 7) // 8, "little")):
+            while byte:
+                low = byte & -byte
+                yield i * 8 + low.bit_length() - 1
+                byte ^= low
+
+    def serialize(self) -> bytes:
+        return zlib.compress(self.bits.to_bytes((self.bits.bit_length() + 7) // 8, "little"))
+
+    @classmethod
+    def deserialize(cls, data: bytes) -> "IntBitMap":
+        return cls._wrap(int.from_bytes(zlib.decompress(data), "little"))
+
+Bitmap = BitMap if BitMap is not None else IntBitMap
+ENCODING = "roaring" if BitMap is not None else "int"
+
+def load_bitmap(encoding: str, data: bytes):
+    """按存储时的格式读出位图，并转换成当前使用的实现"""
+    if encoding == ENCODING:
+        return Bitmap.deserialize(data)
+    if encoding == "roaring":
+        raise RuntimeError("位图以 roaring 格式存储，需要安装 pyroaring")
+    return Bitmap(IntBitMap.deserialize(data))
+
+def local_day(utc_time: datetime) -> date:
+    """users 表的时间是 UTC，page_views 是本地时间，位图统一按本地日期"""
+    return utc_time.replace(tzinfo=timezone.utc).astimezone().date()
+
+def _day_start(day: date) -> datetime:
+    return datetime.combine(day, time.min)
+
+def _merge_retention(partials, arguments=None) -> Dict[str, Any]:
+    """各分片的用户序号互不相干，位图不能求并；每个用户只在一个分片中，同群人数和各列人数相加后重算比例"""
+    merged = partials[0]
+    for partial in partials[1:]:
+        for cohort, other in zip(merged["cohorts"], partial["cohorts"]):
+            cohort["size"] += other["size"]
+            for cell, other_cell in zip(cohort["retention"], other["retention"]):
+                cell["users"] += other_cell["users"]
+    for cohort in merged["cohorts"]:
+        for cell in cohort["retention"]:
+            cell["rate"] = round(cell["users"] / cohort["size"] * 100, 2) if cohort["size"] else 0
+    return merged
+
+class RetentionService:
+    """
+    同群留存：第 D 天首次出现的用户中，第 D+k 天（或第 k 周）仍有访问的比例。
+    每天的新用户和活跃用户各一张位图，格子 = len(new[D] & active[D+k])，周粒度先对一周内的位图求并集。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def record(self, site_id: str, user_ordinal: int, cohort_day: date, active_day: Optional[date] = None):
+        """写入事务提交后调用：记录用户所属的首访日期，active_day 不为空时同时记为当天活跃"""
+        with self._lock:
+            self._pending.setdefault((site_id, KIND_NEW, cohort_day), set()).add(user_ordinal)
+            if active_day is not None:
+                self._pending.setdefault((site_id, KIND_ACTIVE, active_day), set()).add(user_ordinal)
+
+    @sharded(total)
+    def flush(self) -> int:
+        """把待合并的用户并入已存的位图，返回写入的位图数；写库失败时放回待合并集合"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        db = next(get_db())
+        try:
+            written = 0
+            for (site_id, kind, day), ordinals in pending.items():
+                if self._merge(db, site_id, kind, day, Bitmap(ordinals)):
+                    written += 1
+            db.commit()
+            return written
+        except Exception:
+            db.rollback()
+            with self._lock:
+                for key, ordinals in pending.items():
+                    self._pending.setdefault(key, set()).update(ordinals)
+            raise
+        finally:
+            db.close()
+
+    def _merge(self, db, site_id: str, kind: str, day: date, bitmap) -> bool:
+        row = db.query(ActivityBitmap).filter(
+            ActivityBitmap.site_id == site_id,
+            ActivityBitmap.kind == kind,
+            ActivityBitmap.day == _day_start(day)
+        ).first()
+        if row is None:
+            db.add(self._row(site_id, kind, day, bitmap))
+            return True
+        merged = load_bitmap(row.encoding, row.data) | bitmap
+        if len(merged) == row.cardinality and row.encoding == ENCODING:
+            return False
+        row.encoding = ENCODING
+        row.data = merged.serialize()
+        row.cardinality = len(merged)
+        row.updated_at = datetime.utcnow()
+        return True
+
+    def _row(self, site_id: str, kind: str, day: date, bitmap) -> ActivityBitmap:
+        return ActivityBitmap(
+            site_id=site_id,
+            kind=kind,
+            day=_day_start(day),
+            encoding=ENCODING,
+            cardinality=len(bitmap),
+            data=bitmap.serialize(),
+            updated_at=datetime.utcnow()
+        )
+
+    @timed(STATS_QUERY_SECONDS)
+    @sharded(_merge_retention)
+    def get_retention(self, period: str = "day", periods: int = 14,
+                      site_id: str = settings.DEFAULT_SITE_ID) -> Dict[str, Any]:
+        if period not in PERIOD_DAYS:
+            raise ValueError(f"period 只能是 {'、'.join(PERIOD_DAYS)}")
+
+        span = PERIOD_DAYS[period]
+        today = datetime.now().date()
+        current = today - timedelta(days=today.weekday()) if period == "week" else today
+        start = current - timedelta(days=span * (periods - 1))
+
+        new = [Bitmap() for _ in range(periods)]
+        active = [Bitmap() for _ in range(periods)]
+        for kind, day, bitmap in self._load(site_id, start, today):
+            index = (day - start).days // span
+            if kind == KIND_NEW:
+                new[index] = new[index] | bitmap
+            else:
+                active[index] = active[index] | bitmap
+
+        cohorts = []
+        for i in range(periods):
+            size = len(new[i])
+            retention = []
+            for k in range(periods - i):
+                users = len(new[i] & active[i + k])
+                retention.append({
+                    "offset": k,
+                    "users": users,
+                    "rate": round(users / size * 100, 2) if size else 0
+                })
+            cohorts.append({
+                "cohort": (start + timedelta(days=i * span)).isoformat(),
+                "size": size,
+                "retention": retention
+            })
+        return {"period": period, "cohorts": cohorts}
+
+    def _load(self, site_id: str, start: date, end: date):
+        """[start, end] 内已存的位图，加上尚未写回的待合并集合"""
+        db = next(get_read_db())
+        try:
+            rows = db.query(ActivityBitmap.kind, ActivityBitmap.day, ActivityBitmap.encoding, ActivityBitmap.data).filter(
+                ActivityBitmap.site_id == site_id,
+                ActivityBitmap.day >= _day_start(start),
+                ActivityBitmap.day <= _day_start(end)
+            ).all()
+        finally:
+            db.close()
+        bitmaps = [(r.kind, r.day.date(), load_bitmap(r.encoding, r.data)) for r in rows]
+        with self._lock:
+            bitmaps += [(kind, day, Bitmap(ordinals)) for (pending_site, kind, day), ordinals in self._pending.items()
+                        if pending_site == site_id and start <= day <= end]
+        return bitmaps
+
+    @sharded(total)
+    def rebuild(self, start: Optional[date] = None, end: Optional[date] = None,
+                site_id: Optional[str] = None, engine=None) -> int:
+        """
+        从 users 和 page_views 重建 [start, end) 的位图（为空表示不限），返回写入的位图数。
+        导入历史数据会把用户的 first_visit 提前，所以导入后要重建到今天为止。engine 为空时使用 get_db 的数据库。
+        """
+        db = open_db(engine)
+        try:
+            scope = [ActivityBitmap.site_id == site_id] if site_id else []
+            if start:
+                scope.append(ActivityBitmap.day >= _day_start(start))
+            if end:
+                scope.append(ActivityBitmap.day < _day_start(end))
+            db.query(ActivityBitmap).filter(*scope).delete(synchronize_session=False)
+
+            rows = [self._row(s, KIND_NEW, day, bitmap) for s, day, bitmap in self._new_users(db, start, end, site_id)]
+            rows += [self._row(s, KIND_ACTIVE, day, bitmap) for s, day, bitmap in self._active_users(db, start, end, site_id)]
+            db.add_all(rows)
+            db.commit()
+            return len(rows)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _new_users(self, db, start: Optional[date], end: Optional[date], site_id: Optional[str]):
+        query = select(User.site_id, User.id, User.first_visit).where(User.first_visit.isnot(None))
+        # first_visit 是 UTC，按本地日期筛选前先放宽一天
+        if start:
+            query = query.where(User.first_visit >= _day_start(start) - timedelta(days=1))
+        if end:
+            query = query.where(User.first_visit < _day_start(end) + timedelta(days=1))
+        if site_id:
+            query = query.where(User.site_id == site_id)
+        query = query.order_by(User.site_id, User.first_visit)
+
+        rows = db.execute(query, execution_options={"yield_per": 10000})
+        for (row_site, day), group in groupby(rows, key=lambda r: (r.site_id, local_day(r.first_visit))):
+            if (start and day < start) or (end and day >= end):
+                continue
+            yield row_site, day, Bitmap(r.id for r in group)
+
+    def _active_users(self, db, start: Optional[date], end: Optional[date], site_id: Optional[str]):
+        day = day_bucket(PageView.timestamp).label("day")
+        query = select(PageView.site_id, day, User.id).join(
+            User, and_(User.site_id == PageView.site_id, User.user_id == PageView.user_id)
+        ).where(PageView.traffic_class == TRAFFIC_NORMAL)
+        if start:
+            query = query.where(PageView.timestamp >= _day_start(start))
+        if end:
+            query = query.where(PageView.timestamp < _day_start(end))
+        if site_id:
+            query = query.where(PageView.site_id == site_id)
+        query = query.distinct().order_by(PageView.site_id, day)
+
+        rows = db.execute(query, execution_options={"yield_per": 10000})
+        for (row_site, row_day), group in groupby(rows, key=lambda r: (r.site_id, r.day)):
+            yield row_site, date.fromisoformat(str(row_day)), Bitmap(r.id for r in group)
+
+retention_service = shard_local(RetentionService)
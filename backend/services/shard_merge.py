@@ -0,0 +1,62 @@
+"""
+分片查询结果的合并（见 backend/models/shards.py 的 @sharded）
+
+用户和会话都只在一个分片中，计数直接相加；占比和平均值在相加之后重新计算。前 N 项由各分片多取
+SHARD_TOPK_SLACK 条（shards.widen），按名称相加后重新排序截断。合并函数的签名都是
+merge(各分片结果, 调用参数)，调用参数中带有默认值，可以取到 limit 等。
+"""
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+def total(partials: List[Any], arguments: Dict[str, Any] = None):
+    """数值结果（写入的行数、更新的条数）相加"""
+    return sum(partial or 0 for partial in partials)
+
+def concat(partials: List[List[Any]], arguments: Dict[str, Any] = None) -> List[Any]:
+    """各分片取出的行（汇总表中的 JSON、序列化的前缀树）拼在一起，由调用方照常合并"""
+    return [row for rows in partials for row in rows]
+
+def percentage(value: float, base: float) -> float:
+    return value / base * 100 if base > 0 else 0
+
+def sum_rows(partials: Iterable[List[Dict[str, Any]]], keys: Sequence[str]) -> List[Dict[str, Any]]:
+    """按 keys 相同的行合并，其余数值字段相加；保持各键第一次出现的顺序"""
+    merged = {}
+    for rows in partials:
+        for row in rows:
+            key = tuple(row.get(k) for k in keys)
+            target = merged.get(key)
+            if target is None:
+                merged[key] = dict(row)
+                continue
+            for field, value in row.items():
+                if field not in keys and isinstance(value, (int, float)) and not isinstance(value, bool):
+                    target[field] = (target.get(field) or 0) + value
+    return list(merged.values())
+
+def sorted_rows(partials: Iterable[List[Dict[str, Any]]], keys: Sequence[str]) -> List[Dict[str, Any]]:
+    """按键合并后按键排序（日期、小时）"""
+    return sorted(sum_rows(partials, keys), key=lambda row: tuple(row.get(k) for k in keys))
+
+def top_rows(partials: Iterable[List[Dict[str, Any]]], key: str, value: str,
+             limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """前 N 项：按名称合并后按 value 从大到小取前 limit 项"""
+    rows = sorted(sum_rows(partials, (key,)), key=lambda row: row.get(value) or 0, reverse=True)
+    return rows[:limit] if limit is not None else rows
+
+def merge_shares(partials: Iterable[Dict[str, Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    """{名称: {"count", "percentage"}} 的分布：计数相加后重算占比"""
+    counts = {}
+    for shares in partials:
+        for name, share in shares.items():
+            counts[name] = counts.get(name, 0) + share["count"]
+    base = sum(counts.values())
+    return {name: {"count": count, "percentage": percentage(count, base)} for name, count in counts.items()}
+
+def weighted_average(pairs: Iterable[tuple]) -> float:
+    """(平均值, 权重) 的加权平均"""
+    weight = 0
+    amount = 0.0
+    for average, count in pairs:
+        amount += (average or 0) * (count or 0)
+        weight += count or 0
+    return amount / weight if weight else 0
@@ -0,0 +1,297 @@
+"""
+分片存储的写入和数据分布（分片本身见 backend/models/shards.py）
+
+ShardWriter 是分片模式下 spool 消费者的 handler：一批记录按用户（见 ShardSet.route）拆给各分片，每个分片在自己的
+单线程执行器中调用 TrackingService.ingest_batch，各分片的写事务并行提交。某个分片失败时整批抛出、由
+spool 重试；已经提交的分片记下这一组记录的指纹，重试同一批时跳过，不会重复写入。
+
+split 把单库（或旧的各分片）中的会话、浏览、事件和用户按用户重新分布到 SHARD_PATHS，字典 ID 在目标分片中
+重新编码，之后在每个分片上重建汇总、留存位图、时长草图和路径前缀树。目标分片必须是空的。
+
+用法:
+    python -m backend.services.sharding split                          # 把 DATABASE_URL 中的数据分布到各分片
+    python -m backend.services.sharding split old/shard_00.db old/shard_01.db   # 修改分片数：从旧分片重新分布
+    python -m backend.services.sharding inspect                        # 各分片的行数
+"""
+import argparse
+import json
+import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from sqlalchemy import create_engine, func, select
+
+from config.settings import settings
+from backend.models import (
+    PageView, Event, Session as SessionModel, User, DurationSketch, UrlDimension, bulk_insert, shards
+)
+from backend.services.dimension_service import (
+    dimension_service, PAGE_VIEW_DIMENSIONS, EVENT_DIMENSIONS, SESSION_DIMENSIONS
+)
+
+COPY_BATCH_ROWS = 20000
+
+# 按用户分布的明细表及其字典 ID 列，用户行随后复制
+DETAIL_TABLES = (
+    (SessionModel, SESSION_DIMENSIONS),
+    (PageView, PAGE_VIEW_DIMENSIONS),
+    (Event, EVENT_DIMENSIONS),
+)
+
+def _route(record: dict) -> int:
+    """记录所在的分片；不带 user_id 的时长记录（旧版 tracker）要找到会话实际所在的分片"""
+    if record.get("type") == "duration" and not record.get("user_id"):
+        return shards.locate(record.get("site_id") or settings.DEFAULT_SITE_ID, record.get("session_id"))
+    return shards.route(record.get("user_id"), record.get("session_id"))
+
+def _fingerprint(records: List[dict]) -> int:
+    return zlib.crc32(json.dumps(records, sort_keys=True, default=str).encode("utf-8"))
+
+class ShardWriter:
+
+    def __init__(self, ingest: Optional[Callable[[List[dict]], dict]] = None):
+        if ingest is None:
+            from backend.services.tracking_service import tracking_service
+            ingest = tracking_service.ingest_batch
+        self.ingest = ingest
+        self._writers = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"shard-writer-{shard.index}") for shard in shards
+        ]
+        # 分片 -> 最近一次提交的记录组的指纹
+        self._committed: Dict[int, int] = {}
+
+    def ingest_batch(self, records: List[dict]) -> Dict[str, int]:
+        groups: Dict[int, List[dict]] = {}
+        for record in records:
+            groups.setdefault(_route(record), []).append(record)
+
+        result = {"written": 0, "skipped": 0}
+        futures = {}
+        for index, group in groups.items():
+            fingerprint = _fingerprint(group)
+            if self._committed.get(index) == fingerprint:
+                # 上次这一批在该分片已经提交，是其他分片失败导致整批重试
+                result["written"] += len(group)
+                continue
+            futures[index] = (fingerprint, self._writers[index].submit(self._write, index, group))
+
+        error = None
+        for index, (fingerprint, future) in futures.items():
+            try:
+                written = future.result() or {}
+            except Exception as e:
+                error = error or e
+                continue
+            self._committed[index] = fingerprint
+            result["written"] += written.get("written", 0)
+            result["skipped"] += written.get("skipped", 0)
+        if error is not None:
+            raise error
+        return result
+
+    def _write(self, index: int, records: List[dict]) -> dict:
+        with shards.use(index):
+            return self.ingest(records)
+
+# ---- 重新分布 ----
+
+def _source_url(source: str) -> str:
+    return source if "://" in source else f"sqlite:///{Path(source).resolve()}"
+
+def _sqlite_path(url: str) -> Optional[Path]:
+    return Path(url.split(":///", 1)[1]).resolve() if url.startswith("sqlite:///") else None
+
+def _detail_count(engine) -> int:
+    with engine.connect() as conn:
+        return sum(conn.execute(select(func.count()).select_from(model.__table__)).scalar()
+                   for model, _ in DETAIL_TABLES)
+
+class Splitter:
+    """把 sources 中的数据按用户分布到 shards，log 接收进度信息"""
+
+    def __init__(self, sources: List[str], batch_rows: int = COPY_BATCH_ROWS, log: Callable[[str], None] = print):
+        self.sources = [create_engine(_source_url(source)) for source in sources]
+        self.batch_rows = batch_rows
+        self.log = log
+        self._earliest: Optional[date] = None
+        self.counts = [dict.fromkeys(("sessions", "page_views", "events", "users"), 0) for _ in shards]
+
+    def check(self):
+        targets = {_sqlite_path(shard.url) for shard in shards}
+        for engine in self.sources:
+            if _sqlite_path(str(engine.url)) in targets:
+                raise ValueError(f"{engine.url} 同时是来源和目标分片，目标分片要使用新的路径（SHARD_PATHS）")
+        for shard in shards:
+            if _detail_count(shard.engine):
+                raise ValueError(f"分片 {shard.path} 已有数据，请指定空的分片路径")
+
+    def run(self):
+        self.check()
+        for engine in self.sources:
+            for model, dimensions in DETAIL_TABLES:
+                self._copy(engine, model, dimensions)
+        self._copy_users()
+        self._copy_page_sketches()
+        for shard in shards:
+            self._rebuild(shard.index)
+        return self.counts
+
+    def _rows(self, engine, table, order_by):
+        """按 order_by 流式读取整张表，每次返回 batch_rows 行（去掉自增 ID，字典 ID 换回字符串）"""
+        decoded = dimension_service.decode(table, exclude=("id",))
+        query = select(*decoded.columns).select_from(decoded.source).order_by(order_by)
+        with engine.connect() as conn:
+            result = conn.execution_options(yield_per=self.batch_rows).execute(query)
+            for partition in result.mappings().partitions():
+                yield [dict(row) for row in partition]
+
+    def _copy(self, engine, model, dimensions):
+        table = model.__table__
+        copied = 0
+        for rows in self._rows(engine, table, table.c.id):
+            groups: Dict[int, List[dict]] = {}
+            for row in rows:
+                index = shards.route(row.get("user_id"), row.get("session_id"))
+                groups.setdefault(index, []).append(row)
+                if model is SessionModel:
+                    if row.get("start_time") and (self._earliest is None or row["start_time"].date() < self._earliest):
+                        self._earliest = row["start_time"].date()
+            for index, group in groups.items():
+                self._insert(index, table, group, dimensions)
+                self.counts[index][table.name] += len(group)
+            copied += len(rows)
+            self.log(f"{engine.url.database}: {table.name} 已复制 {copied} 行")
+
+    def _insert(self, index: int, table, rows: List[dict], dimensions):
+        target = shards[index].engine
+        # 字典 ID 只在分片内有效，按字符串在目标分片中重新编码
+        dimension_service.replace(rows, dimensions, engine=target)
+        with target.begin() as conn:
+            bulk_insert(conn, table, rows)
+
+    def _copy_users(self):
+        """用户复制到 user_id 所在的分片，与其会话在一起；匿名用户行归第 0 个分片，多个来源中的同一用户合并"""
+        users: Dict[Tuple[str, str], dict] = {}
+        for engine in self.sources:
+            for rows in self._rows(engine, User.__table__, User.__table__.c.id):
+                for row in rows:
+                    key = (row["site_id"], row["user_id"])
+                    existing = users.get(key)
+                    if existing is None:
+                        users[key] = row
+                        continue
+                    existing["first_visit"] = min(filter(None, (existing["first_visit"], row["first_visit"])), default=None)
+                    existing["last_visit"] = max(filter(None, (existing["last_visit"], row["last_visit"])), default=None)
+                    existing["visit_count"] = (existing["visit_count"] or 0) + (row["visit_count"] or 0)
+        groups: Dict[int, List[dict]] = {}
+        for key, row in users.items():
+            groups.setdefault(shards.route(key[1], None), []).append(row)
+        for index, rows in groups.items():
+            for i in range(0, len(rows), self.batch_rows):
+                with shards[index].engine.begin() as conn:
+                    bulk_insert(conn, User.__table__, rows[i:i + self.batch_rows])
+            self.counts[index]["users"] += len(rows)
+        self.log(f"用户已复制 {len(users)} 个")
+
+    def _copy_page_sketches(self):
+        """
+        页面停留时长没有明细，无法在各分片重建：把来源中的页面草图合并后放到第 0 个分片，
+        url_id 换成目标分片中的字典 ID。会话时长草图在 _rebuild 中从各分片的会话重建。
+        """
+        from backend.services.duration_service import DDSketch, ALL_PAGES, KIND_PAGE, KIND_PAGE_URL, duration_service
+
+        sketches = {}
+        for engine in self.sources:
+            with engine.connect() as conn:
+                names = dict(conn.execute(select(UrlDimension.id, UrlDimension.value)).all())
+                rows = conn.execute(select(DurationSketch).where(DurationSketch.kind.in_((KIND_PAGE, KIND_PAGE_URL))))
+                for row in rows:
+                    url = names.get(row.url_id) if row.kind == KIND_PAGE_URL else None
+                    if row.kind == KIND_PAGE_URL and url is None:
+                        continue
+                    key = (row.site_id, row.kind, url, row.bucket)
+                    sketch = sketches.get(key)
+                    if sketch is None:
+                        sketch = sketches[key] = DDSketch(duration_service.accuracy)
+                    sketch.merge(DDSketch.deserialize(row.data, row.accuracy))
+        if not sketches:
+            return
+        target = shards[0].engine
+        url_ids = dimension_service.encode([{"page_url": url} for _, _, url, _ in sketches], ("url_id",), engine=target)
+        rows = []
+        for ((site_id, kind, _, bucket), sketch), ids in zip(sketches.items(), url_ids):
+            sketch.compact()
+            rows.append({
+                "site_id": site_id, "kind": kind, "url_id": ids["url_id"] or ALL_PAGES, "bucket": bucket,
+                "accuracy": sketch.accuracy, "count": sketch.count, "data": sketch.serialize(),
+                "updated_at": datetime.utcnow()
+            })
+        with target.begin() as conn:
+            bulk_insert(conn, DurationSketch.__table__, rows)
+        self.log(f"页面时长草图已合并 {len(rows)} 个")
+
+    def _rebuild(self, index: int):
+        """在分片上重建派生数据：事件属性索引、站点和地理日汇总、留存位图、会话时长草图、路径前缀树"""
+        from backend.services.event_property_service import event_property_service
+        from backend.services.stats_service import stats_service
+        from backend.services.geo_service import geo_service
+        from backend.services.retention_service import retention_service
+        from backend.services.duration_service import duration_service
+        from backend.services.path_service import path_service
+
+        with shards.use(index):
+            with shards[index].engine.begin() as conn:
+                event_property_service.index_events(conn)
+            if self._earliest is not None:
+                start, end = self._earliest - timedelta(days=1), date.today() + timedelta(days=1)
+                stats_service.rollup_site_stats(start=start, end=end)
+                geo_service.rollup(start=start, end=end)
+            retention_service.rebuild()
+            duration_service.rebuild_sessions()
+            path_service.rebuild()
+        self.log(f"分片 {index}: 派生数据已重建")
+
+def main(argv=None):
+    from backend.models import init_db
+
+    parser = argparse.ArgumentParser(description="分片存储的数据分布")
+    sub = parser.add_subparsers(dest="command", required=True)
+    split = sub.add_parser("split", help="把单库或旧分片中的数据按用户分布到 SHARD_PATHS")
+    split.add_argument("sources", nargs="*", help="来源数据库（URL 或 SQLite 文件路径），默认 DATABASE_URL")
+    split.add_argument("--batch-rows", type=int, default=COPY_BATCH_ROWS, help="每次读取和写入的行数")
+    sub.add_parser("inspect", help="查看各分片的行数")
+    args = parser.parse_args(argv)
+
+    if not shards.enabled:
+        parser.error("未启用分片：先设置 SHARD_COUNT（大于 1）和 SHARD_PATHS")
+    init_db()
+
+    if args.command == "split":
+        splitter = Splitter(args.sources or [settings.DATABASE_URL], args.batch_rows,
+                            log=lambda message: print(message, file=sys.stderr))
+        try:
+            counts = splitter.run()
+        except ValueError as e:
+            parser.error(str(e))
+        print(json.dumps(counts, ensure_ascii=False))
+
+    elif args.command == "inspect":
+        for shard in shards:
+            with shard.engine.connect() as conn:
+                counts = {
+                    model.__tablename__: conn.execute(select(func.count()).select_from(model.__table__)).scalar()
+                    for model in (SessionModel, PageView, Event, User)
+                }
+            # WAL 模式下最近的写入还在 -wal 文件中
+            size = sum(path.stat().st_size for path in (Path(shard.path), Path(shard.path + "-wal")) if path.exists())
+            print(f"{shard.index:>3}  {shard.path}  {size} 字节  " +
+                  "  ".join(f"{name} {count}" for name, count in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,591 @@
+"""
+追踪数据的本地落盘队列（spool）
+
+接收请求时先把记录追加到本地分段文件，再由后台消费线程按批写入数据库并记录检查点。
+数据库被锁、宕机或维护期间请求不会丢失，恢复后按原顺序补写，突发流量也由磁盘先吸收。
+
+每个进程独占 SPOOL_DIR 下的一个子目录（worker-00、worker-01…，用文件锁占用编号最小的空闲目录），
+多 worker 部署（uvicorn --workers、gunicorn）时各自追加、各自消费。worker 数减少后空出来的目录和旧版本
+直接写在 SPOOL_DIR 中的分段，由消费线程启动时接管并写入数据库。
+
+文件格式：目录下的 segment-0000000001.log 等分段文件，每条记录为
+    4 字节长度 + 4 字节 CRC32（小端）+ JSON 内容
+当前分段超过 segment_bytes 后切换到新分段。checkpoint.json 记录已写入数据库的 (分段, 偏移)，
+检查点之前的分段会被删除。投递语义为至少一次：写库成功但检查点未落盘时进程崩溃，
+重启后这一批会重放。
+
+用法:
+    python -m backend.services.spool inspect           # 查看各目录的分段、积压和检查点
+    python -m backend.services.spool dump --limit 20   # 打印检查点之后的记录
+    python -m backend.services.spool replay            # 把所有目录的积压写入数据库（需先停掉应用）
+"""
+import argparse
+import fcntl
+import itertools
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Callable, Iterator, List, NamedTuple, Optional, Tuple
+
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from config.settings import settings
+from backend.utils.metrics import INGEST_QUEUE_DEPTH, SPOOL_RECORDS, SPOOL_BACKLOG_BYTES
+
+logger = logging.getLogger("raymond.spool")
+
+HEADER = struct.Struct("<II")
+MAX_RECORD_BYTES = 1024 * 1024
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+CHECKPOINT_FILE = "checkpoint.json"
+LOCK_FILE = "LOCK"
+WORKER_PREFIX = "worker-"
+FSYNC_POLICIES = ("always", "interval", "never")
+
+
+class SpoolPosition(NamedTuple):
+    segment: int
+    offset: int
+
+
+class SpoolLocked(RuntimeError):
+    def __init__(self, directory: Path):
+        super().__init__(f"spool 目录 {directory} 正被其他进程使用")
+        self.directory = directory
+
+
+class CorruptRecord(Exception):
+    def __init__(self, path: Path, offset: int):
+        super().__init__(f"{path} 偏移 {offset} 处的记录校验失败")
+        self.path = path
+        self.offset = offset
+
+
+def segment_name(seq: int) -> str:
+    return f"{SEGMENT_PREFIX}{seq:010d}{SEGMENT_SUFFIX}"
+
+
+def segment_seq(path: Path) -> int:
+    return int(path.name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+
+def worker_directory(root: Path, slot: int) -> Path:
+    return root / f"{WORKER_PREFIX}{slot:02d}"
+
+
+def spool_directories(root: Path) -> List[Path]:
+    """root 下所有的 spool 目录：旧版本直接写在 root 中的分段（如果有）和各 worker 子目录"""
+    root = Path(root)
+    if not root.exists():
+        return []
+    directories = [root] if any(root.glob(f"{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}")) else []
+    return directories + sorted(p for p in root.glob(f"{WORKER_PREFIX}*") if p.is_dir())
+
+
+def encode_record(record: dict) -> bytes:
+    payload = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(path: Path, offset: int = 0, limit: Optional[int] = None) -> Iterator[Tuple[dict, int]]:
+    """
+    从 offset 开始读取完整记录，逐条返回 (记录, 下一条记录的偏移)。
+    文件尾部不完整的记录（正在写入或崩溃时写了一半）视为尚不存在；校验失败时抛出 CorruptRecord。
+    """
+    count = 0
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while limit is None or count < limit:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            length, crc = HEADER.unpack(header)
+            if length > MAX_RECORD_BYTES:
+                raise CorruptRecord(path, offset)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            if zlib.crc32(payload) != crc:
+                raise CorruptRecord(path, offset)
+            try:
+                record = json.loads(payload)
+            except ValueError:
+                raise CorruptRecord(path, offset)
+            offset += HEADER.size + length
+            count += 1
+            yield record, offset
+
+
+class Spool:
+    """
+    仅追加的分段日志。写入由 append 完成（应用内单写者，用文件锁防止多个进程同时写），
+    读取和检查点由消费者负责。fsync 策略：always 每条记录都落盘，interval 最多每
+    fsync_interval 秒落盘一次，never 交给操作系统。
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = 16 * 1024 * 1024, fsync: str = "interval",
+                 fsync_interval: float = 1.0):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync 策略必须是 {FSYNC_POLICIES} 之一")
+        self.directory = Path(directory)
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._lock_file = None
+        self._file = None
+        self._segment = 0
+        self._size = 0
+        self._dirty = False
+        self._last_sync = 0.0
+
+    @classmethod
+    def from_settings(cls, config=settings):
+        return cls(
+            directory=config.SPOOL_DIR,
+            segment_bytes=config.SPOOL_SEGMENT_BYTES,
+            fsync=config.SPOOL_FSYNC,
+            fsync_interval=config.SPOOL_FSYNC_INTERVAL_MS / 1000,
+        )
+
+    @property
+    def is_open(self) -> bool:
+        return self._file is not None
+
+    # ---- 写入 ----
+
+    def open_worker(self, root: Path):
+        """占用 root 下编号最小的空闲 worker 子目录并打开，多个进程各得一个"""
+        for slot in itertools.count():
+            self.directory = worker_directory(Path(root), slot)
+            try:
+                self.open()
+                return
+            except SpoolLocked:
+                continue
+
+    def open(self):
+        """创建目录、获取写锁、截掉最后一个分段中不完整的尾部并统计积压；目录被其他进程占用时抛出 SpoolLocked"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock_file = open(self.directory / LOCK_FILE, "a+")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            self._lock_file = None
+            raise SpoolLocked(self.directory)
+
+        segments = self.segments()
+        self._segment = segments[-1] if segments else max(self.read_checkpoint().segment, 1)
+        path = self._path(self._segment)
+        if path.exists() and not self._truncate_torn_tail(path):
+            # 中间有损坏记录的分段不再追加，由消费者跳过
+            self._segment += 1
+            path = self._path(self._segment)
+        self._file = open(path, "ab", buffering=0)
+        self._size = path.stat().st_size
+        self.pending = self.count_backlog()
+        self._update_gauges()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                if self.fsync != "never":
+                    os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+
+    def append(self, record: dict):
+        data = encode_record(record)
+        with self._lock:
+            if self._file is None:
+                raise RuntimeError("spool 尚未打开")
+            self._file.write(data)
+            self._size += len(data)
+            self.pending += 1
+            self._dirty = True
+            if self.fsync == "always" or (
+                self.fsync == "interval" and time.monotonic() - self._last_sync >= self.fsync_interval
+            ):
+                self._sync_locked()
+            if self._size >= self.segment_bytes:
+                self._rotate_locked()
+        SPOOL_RECORDS.labels("appended").inc()
+        INGEST_QUEUE_DEPTH.set(self.pending)
+
+    def sync(self):
+        with self._lock:
+            if self._file is not None and self._dirty and self.fsync != "never":
+                self._sync_locked()
+
+    def rotate(self):
+        """结束当前分段，之后的记录写入新分段"""
+        with self._lock:
+            if self._file is not None and self._size > 0:
+                self._rotate_locked()
+
+    def _sync_locked(self):
+        os.fsync(self._file.fileno())
+        self._dirty = False
+        self._last_sync = time.monotonic()
+
+    def _rotate_locked(self):
+        if self.fsync != "never":
+            self._sync_locked()
+        self._file.close()
+        self._segment += 1
+        self._file = open(self._path(self._segment), "ab", buffering=0)
+        self._size = 0
+
+    def _truncate_torn_tail(self, path: Path) -> bool:
+        """截掉分段末尾写了一半的记录；分段中间有校验失败的记录时不动文件，返回 False"""
+        end = 0
+        try:
+            for _, end in read_records(path):
+                pass
+        except CorruptRecord:
+            return False
+        if end < path.stat().st_size:
+            logger.warning("截断 %s 尾部不完整的记录：%d -> %d 字节", path.name, path.stat().st_size, end)
+            with open(path, "r+b") as f:
+                f.truncate(end)
+        return True
+
+    # ---- 读取和检查点 ----
+
+    def _path(self, seq: int) -> Path:
+        return self.directory / segment_name(seq)
+
+    def segments(self) -> List[int]:
+        if not self.directory.exists():
+            return []
+        return sorted(segment_seq(p) for p in self.directory.glob(f"{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}"))
+
+    def read_checkpoint(self) -> SpoolPosition:
+        path = self.directory / CHECKPOINT_FILE
+        if path.exists():
+            data = json.loads(path.read_text())
+            return SpoolPosition(data["segment"], data["offset"])
+        segments = self.segments()
+        return SpoolPosition(segments[0] if segments else 1, 0)
+
+    def write_checkpoint(self, position: SpoolPosition):
+        """原子地写入检查点（临时文件 + rename），然后删除已完全消费的分段"""
+        path = self.directory / CHECKPOINT_FILE
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"segment": position.segment, "offset": position.offset}, f)
+            f.flush()
+            if self.fsync != "never":
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+        for seq in self.segments():
+            if seq < position.segment:
+                self._path(seq).unlink()
+
+    def commit(self, position: SpoolPosition, count: int):
+        self.write_checkpoint(position)
+        self.pending = max(0, self.pending - count)
+        self._update_gauges()
+
+    def _start_position(self, position: SpoolPosition) -> SpoolPosition:
+        segments = self.segments()
+        if segments and position.segment < segments[0]:
+            return SpoolPosition(segments[0], 0)
+        return position
+
+    def read_batch(self, position: SpoolPosition, max_records: int) -> Tuple[List[dict], SpoolPosition]:
+        """
+        从 position 开始最多读取 max_records 条记录，返回 (记录, 读完后的位置)。
+        遇到损坏的记录时先返回之前读到的部分，下一次调用再抛出 CorruptRecord。
+        """
+        position = self._start_position(position)
+        records = []
+        while len(records) < max_records:
+            path = self._path(position.segment)
+            if path.exists():
+                try:
+                    for record, offset in read_records(path, position.offset, max_records - len(records)):
+                        records.append(record)
+                        position = SpoolPosition(position.segment, offset)
+                except CorruptRecord:
+                    if records:
+                        break
+                    raise
+                if len(records) >= max_records:
+                    break
+            # 后一个分段出现后当前分段不会再被写入；这时要再读一次，
+            # 避免漏掉读完之后、切换分段之前追加的记录
+            if not self._path(position.segment + 1).exists():
+                break
+            if path.exists() and any(True for _ in read_records(path, position.offset, 1)):
+                continue
+            position = SpoolPosition(position.segment + 1, 0)
+        return records, position
+
+    def skip_segment(self, position: SpoolPosition) -> SpoolPosition:
+        """跳过损坏的分段；如果损坏的是当前写入的分段，先切换到新分段"""
+        if position.segment >= self._segment and self.is_open:
+            self.rotate()
+        return SpoolPosition(position.segment + 1, 0)
+
+    def count_backlog(self) -> int:
+        position = self._start_position(self.read_checkpoint())
+        count = 0
+        for seq in self.segments():
+            if seq < position.segment:
+                continue
+            try:
+                for _ in read_records(self._path(seq), position.offset if seq == position.segment else 0):
+                    count += 1
+            except CorruptRecord:
+                continue
+        return count
+
+    def backlog_bytes(self) -> int:
+        position = self._start_position(self.read_checkpoint())
+        total = 0
+        for seq in self.segments():
+            if seq >= position.segment:
+                size = self._path(seq).stat().st_size
+                total += size - position.offset if seq == position.segment else size
+        return max(0, total)
+
+    def _update_gauges(self):
+        INGEST_QUEUE_DEPTH.set(self.pending)
+        SPOOL_BACKLOG_BYTES.set(self.backlog_bytes())
+
+
+class SpoolConsumer:
+    """
+    后台线程：从检查点开始按批读取 spool，交给 handler 写库，成功后推进检查点。
+    handler 抛出异常（例如数据库被锁或不可用）时不推进检查点，按指数退避后重试同一批。
+    """
+
+    def __init__(self, spool: Spool, handler: Callable[[List[dict]], dict], batch_size: int = 500,
+                 poll_interval: float = 0.2, max_backoff: float = 30.0, adopt_from: Optional[Path] = None):
+        self.spool = spool
+        # 启动时接管 adopt_from 下没有进程占用的其它 spool 目录
+        self.adopt_from = adopt_from
+        self.handler = handler
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="spool-consumer", daemon=True)
+        self._thread.start()
+
+    def stop(self, drain_seconds: float = 5.0):
+        """停止后台线程，并在 drain_seconds 内尽量把剩余积压写入数据库"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        deadline = time.monotonic() + drain_seconds
+        while time.monotonic() < deadline:
+            try:
+                if self.run_once() == 0:
+                    break
+            except Exception:
+                logger.exception("停止时写入 spool 积压失败，剩余记录将在下次启动时重放")
+                break
+
+    def drain(self) -> int:
+        """把积压全部写入数据库，返回写入的条数"""
+        total = 0
+        while not self._stop.is_set():
+            checkpoint = self.spool.read_checkpoint()
+            processed = self.run_once()
+            if processed == 0 and self.spool.read_checkpoint() == checkpoint:
+                break
+            total += processed
+        return total
+
+    def adopt(self, root: Path) -> int:
+        """
+        依次占用 root 下空闲且有积压的 spool 目录（退出的 worker 留下的、旧版本的），写入数据库后释放，
+        返回写入的条数；正被其他进程占用的目录跳过
+        """
+        total = 0
+        for directory in spool_directories(root):
+            if directory == self.spool.directory or self._stop.is_set():
+                continue
+            idle = Spool(directory, self.spool.segment_bytes, self.spool.fsync, self.spool.fsync_interval)
+            if not idle.count_backlog():
+                continue
+            try:
+                idle.open()
+            except SpoolLocked:
+                continue
+            try:
+                written = SpoolConsumer(idle, self.handler, self.batch_size).drain()
+            finally:
+                idle.close()
+            if written:
+                logger.info("接管 %s 中的积压，写入 %d 条", directory, written)
+            total += written
+        self.spool._update_gauges()
+        return total
+
+    def run_once(self) -> int:
+        """处理一批记录，返回处理的条数"""
+        position = self.spool.read_checkpoint()
+        try:
+            records, next_position = self.spool.read_batch(position, self.batch_size)
+        except CorruptRecord as e:
+            logger.error("%s，跳过该分段剩余内容", e)
+            SPOOL_RECORDS.labels("corrupt").inc()
+            self.spool.write_checkpoint(self.spool.skip_segment(SpoolPosition(segment_seq(e.path), e.offset)))
+            self.spool.pending = self.spool.count_backlog()
+            return 0
+        if not records:
+            if next_position != position:
+                self.spool.commit(next_position, 0)
+            return 0
+        result = self.handler(records) or {}
+        self.spool.commit(next_position, len(records))
+        SPOOL_RECORDS.labels("replayed").inc(result.get("written", len(records)))
+        if result.get("skipped"):
+            SPOOL_RECORDS.labels("skipped").inc(result["skipped"])
+        return len(records)
+
+    def _run(self):
+        if self.adopt_from is not None:
+            try:
+                self.adopt(self.adopt_from)
+            except Exception:
+                logger.exception("接管其它 spool 目录的积压失败，剩余记录在下次启动时处理")
+        backoff = self.poll_interval
+        while not self._stop.is_set():
+            try:
+                processed = self.run_once()
+                backoff = self.poll_interval
+            except Exception:
+                logger.exception("spool 写入数据库失败，%.1f 秒后重试", backoff)
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            self.spool.sync()
+            if processed < self.batch_size:
+                self._stop.wait(self.poll_interval)
+
+
+spool = Spool.from_settings()
+
+
+def _consumer(target: Spool, adopt_from: Optional[Path] = None) -> SpoolConsumer:
+    from backend.models import shards
+    from backend.services.tracking_service import tracking_service
+
+    if shards.enabled:
+        # 分片模式：一批按用户拆给各分片的写线程并行提交，每批相应加大
+        from backend.services.sharding import ShardWriter
+
+        handler, batch_size = ShardWriter().ingest_batch, settings.SPOOL_BATCH_SIZE * len(shards)
+    else:
+        handler, batch_size = tracking_service.ingest_batch, settings.SPOOL_BATCH_SIZE
+    return SpoolConsumer(
+        target,
+        handler,
+        batch_size=batch_size,
+        poll_interval=settings.SPOOL_POLL_INTERVAL_MS / 1000,
+        max_backoff=settings.SPOOL_MAX_BACKOFF_SECONDS,
+        adopt_from=adopt_from,
+    )
+
+
+def create_consumer() -> SpoolConsumer:
+    """应用启动时调用：占用 SPOOL_DIR 下的一个 worker 子目录，返回绑定到 TrackingService 的消费者"""
+    spool.open_worker(Path(settings.SPOOL_DIR))
+    return _consumer(spool, adopt_from=Path(settings.SPOOL_DIR))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="追踪数据 spool 管理")
+    parser.add_argument("--dir", default=settings.SPOOL_DIR, help="spool 根目录（也可以指定某个 worker 子目录）")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("inspect", help="查看各目录的分段、积压和检查点")
+    dump = sub.add_parser("dump", help="打印检查点之后的记录")
+    dump.add_argument("--limit", type=int, default=20)
+    dump.add_argument("--segment", type=int, help="只打印指定分段（从头开始）")
+    sub.add_parser("replay", help="把所有目录的积压记录写入数据库，需先停掉应用")
+    args = parser.parse_args(argv)
+
+    targets = [Spool(directory, settings.SPOOL_SEGMENT_BYTES, settings.SPOOL_FSYNC)
+               for directory in spool_directories(Path(args.dir))]
+
+    if args.command == "inspect":
+        for target in targets:
+            checkpoint = target.read_checkpoint()
+            print(f"目录: {target.directory}")
+            print(f"检查点: 分段 {checkpoint.segment} 偏移 {checkpoint.offset}")
+            for seq in target.segments():
+                path = target._path(seq)
+                count, status = 0, ""
+                try:
+                    for _ in read_records(path):
+                        count += 1
+                except CorruptRecord as e:
+                    status = f"  损坏: {e}"
+                print(f"  {path.name}  {path.stat().st_size} 字节  {count} 条{status}")
+            print(f"积压: {target.count_backlog()} 条, {target.backlog_bytes()} 字节")
+
+    elif args.command == "dump":
+        remaining = args.limit
+        for target in targets:
+            if args.segment is not None:
+                position = SpoolPosition(args.segment, 0)
+            else:
+                position = target.read_checkpoint()
+            records, _ = target.read_batch(position, remaining)
+            for record in records:
+                print(json.dumps(record, ensure_ascii=False))
+            remaining -= len(records)
+            if remaining <= 0:
+                break
+
+    elif args.command == "replay":
+        from backend.models import init_db
+
+        init_db()
+        total = 0
+        for target in targets:
+            try:
+                target.open()
+            except SpoolLocked as e:
+                print(f"{e}，跳过", file=sys.stderr)
+                continue
+            try:
+                written = _consumer(target).drain()
+            finally:
+                target.close()
+            total += written
+            print(f"{target.directory}: 已写入 {written} 条", file=sys.stderr)
+        # 计数、留存位图和时长草图平时由应用的定时任务写回
+        from backend.services.identity_cache import identity_cache
+        from backend.services.retention_service import retention_service
+        from backend.services.duration_service import duration_service
+
+        identity_cache.flush()
+        retention_service.flush()
+        duration_service.flush()
+        print(f"重放完成，共 {total} 条", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,431 @@
-from datetime import datetime, timedelta
-from typing import List, Dict, Any
-from sqlalchemy import func, and_
-from backend.models import PageView, Event, Session, User, get_db
-from backend.services.cache_service import redis_service
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from datetime import date, datetime, timedelta
+from typing import List, Dict, Any, NamedTuple, Optional
+from urllib.parse import urlparse
+from sqlalchemy import func, and_, case, literal_column
+from config.settings import settings
+from backend.models import PageView, Event, Session, User, AggregatedStats, get_db, get_read_db, day_bucket, shards, sharded
+from backend.services.cache_service import redis_service, site_key, LocalTTLCache
+from backend.services.traffic_filter import TRAFFIC_NORMAL
+from backend.services.dimension_service import dimension_service
+from backend.services.hot_window import hot_window
+from backend.services.shard_merge import total, percentage, sum_rows, sorted_rows, top_rows, merge_shares, weighted_average
+from backend.utils.metrics import timed, STATS_QUERY_SECONDS
+
+DEFAULT_SITE_ID = settings.DEFAULT_SITE_ID
+
+def parse_referrer(referrer):
+    if not referrer or referrer == "":
+        return "直接访问"
+
+    try:
+        parsed = urlparse(referrer)
+        domain = parsed.netloc.lower()
+
+        if domain in ["localhost", "127.0.0.1", "::1"]:
+            return "直接访问"
+
+        if "google" in domain:
+            return "Google"
+        elif "baidu" in domain:
+            return "百度"
+        elif "bing" in domain:
+            return "Bing"
+        elif "yahoo" in domain:
+            return "Yahoo"
+        elif "weibo" in domain:
+            return "微博"
+        elif "zhihu" in domain:
+            return "知乎"
+        elif "douyin" in domain or "tiktok" in domain:
+            return "抖音/TikTok"
+        elif "bilibili" in domain:
+            return "B站"
+        elif "github" in domain:
+            return "GitHub"
+        else:
+            return domain
+    except Exception:
+        return "直接访问"
+
+def parse_os(user_agent):
+    if not user_agent:
+        return '未知'
+    user_agent = user_agent.lower()
+    if 'mac os x' in user_agent or 'macintosh' in user_agent:
+        return 'Mac OS'
+    elif 'windows' in user_agent:
+        return 'Windows'
+    elif 'linux' in user_agent:
+        return 'Linux'
+    elif 'android' in user_agent:
+        return 'Android'
+    elif 'iphone' in user_agent or 'ipad' in user_agent or 'ios' in user_agent:
+        return 'iOS'
+    else:
+        return '其他'
+
+def parse_browser(user_agent):
+    if not user_agent:
+        return '未知'
+    user_agent = user_agent.lower()
+    if 'chrome' in user_agent and 'edg' not in user_agent:
+        return 'Chrome'
+    elif 'safari' in user_agent and 'chrome' not in user_agent:
+        return 'Safari'
+    elif 'firefox' in user_agent:
+        return 'Firefox'
+    elif 'edge' in user_agent or 'edg' in user_agent:
+        return 'Edge'
+    elif 'opera' in user_agent or 'opr' in user_agent:
+        return 'Opera'
+    else:
+        return '其他'
+
+class UserAgentCount(NamedTuple):
+    user_agent: Optional[str]
+    count: int
+
+def _share_by(rows, parse):
+    """把 (user_agent, count) 按 parse 的结果归类并计算占比"""
+    stats = {}
+    for r in rows:
+        name = parse(r.user_agent)
+        if name not in stats:
+            stats[name] = 0
+        stats[name] += r.count
+
+    total = sum(stats.values())
+
+    return {
+        name: {"count": count, "percentage": count / total * 100 if total > 0 else 0}
+        for name, count in stats.items()
+    }
+
+# ---- 分片模式下各方法结果的合并（见 backend/models/shards.py） ----
+
+def _merge_realtime(partials, arguments=None) -> Dict[str, Any]:
+    return {
+        "online_users": sum(p["online_users"] for p in partials),
+        "page_views_today": sum(p["page_views_today"] for p in partials),
+        "unique_visitors_today": sum(p["unique_visitors_today"] for p in partials),
+        # 各分片的会话互不重叠，平均时长按当天的访客数加权
+        "avg_duration_today": weighted_average((p["avg_duration_today"], p["unique_visitors_today"]) for p in partials),
+        "top_pages": top_rows((p["top_pages"] for p in partials), "url", "views", 10)
+    }
+
+def _merge_page_views_trend(partials, arguments) -> List[Dict[str, Any]]:
+    return sorted_rows(partials, ("date", "hour") if arguments["days"] <= 2 else ("date",))
+
+def _merge_by(*keys):
+    return lambda partials, arguments=None: sorted_rows(partials, keys)
+
+def _merge_top_pages(partials, arguments) -> List[Dict[str, Any]]:
+    return top_rows(partials, "url", "views", arguments["limit"])
+
+def _merge_referrers(partials, arguments) -> List[Dict[str, Any]]:
+    rows = top_rows(partials, "referrer", "views", arguments["limit"])
+    base = sum(row["views"] for row in rows)
+    return [dict(row, percentage=percentage(row["views"], base)) for row in rows]
+
+def _merge_shares(partials, arguments=None) -> Dict[str, Any]:
+    return merge_shares(partials)
+
+def _merge_event_stats(partials, arguments=None) -> List[Dict[str, Any]]:
+    return top_rows(partials, "event_name", "count")
+
+def _merge_user_type(partials, arguments=None) -> Dict[str, Any]:
+    total_users = sum(p["total_users"] for p in partials)
+    new_users = sum(p["new_users"] for p in partials)
+    returning_users = total_users - new_users
+    return {
+        "total_users": total_users,
+        "new_users": new_users,
+        "returning_users": returning_users,
+        "new_user_percentage": percentage(new_users, total_users),
+        "returning_user_percentage": percentage(returning_users, total_users)
+    }
+
+def _merge_site_overview(partials, arguments=None) -> List[Dict[str, Any]]:
+    durations = {}
+    for sites in partials:
+        for site in sites:
+            durations.setdefault(site["site_id"], []).append((site["avg_duration"], site["sessions"]))
+    sites = sum_rows(partials, ("site_id",))
+    for site in sites:
+        site["avg_duration"] = weighted_average(durations[site["site_id"]])
+    return sorted(sites, key=lambda site: site["page_views"], reverse=True)
+
+def _merge_dashboard(partials, arguments) -> Dict[str, Any]:
+    from backend.services.flow_service import merge_page_flow
+    
+    part = lambda name: [p[name] for p in partials]
+    return {
+        "realtime": _merge_realtime(part("realtime")),
+        "page_views_trend": _merge_page_views_trend(part("page_views_trend"), arguments),
+        "visitors_trend": sorted_rows(part("visitors_trend"), ("date",)),
+        "hourly": sorted_rows(part("hourly"), ("hour",)),
+        "devices": merge_shares(part("devices")),
+        "browsers": merge_shares(part("browsers")),
+        "user_type": _merge_user_type(part("user_type")),
+        "user_type_trend": sorted_rows(part("user_type_trend"), ("date",)),
+        "top_pages": top_rows(part("top_pages"), "url", "views", 10),
+        "referrers": _merge_referrers(part("referrers"), {"limit": 10}),
+        "page_flow": merge_page_flow(part("page_flow")),
+        "generated_at": max(part("generated_at"))
+    }
 
 class StatsService:
     
-    def _exclude_dashboard(self, query):
-        return query.filter(~PageView.page_url.like('%localhost:5500%')).filter(~PageView.page_url.like('%/dashboard%'))
+    ROLLUP_STAT_TYPES = ("page_views", "unique_visitors", "sessions", "avg_duration")
+    
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(
+            max_workers=settings.DASHBOARD_QUERY_WORKERS,
+            thread_name_prefix="stats-query"
+        )
+        self._local_cache = LocalTTLCache()
+    
+    def _scoped(self, query, site_id: str):
+        # 内部/爬虫流量在写入时已由 TrafficFilter 标记，这里只需走 (site_id, traffic_class, timestamp) 索引
+        return query.filter(PageView.site_id == site_id, PageView.traffic_class == TRAFFIC_NORMAL)
+    
+    # ---- 多个面板共用的中间结果 ----
+    
+    def _page_view_buckets(self, db, site_id: str, start_date: datetime, recent_start: datetime):
+        """按 (日期, 小时) 统计浏览量；recent_views 只统计 recent_start 之后的部分"""
+        buckets = hot_window.buckets(site_id, start_date, recent_start)
+        if buckets is not None:
+            return buckets
+        return self._scoped(db.query(
+            day_bucket(PageView.timestamp).label('date'),
+            func.extract('hour', PageView.timestamp).label('hour'),
+            func.count(PageView.id).label('views'),
+            func.sum(case((PageView.timestamp >= recent_start, 1), else_=0)).label('recent_views')
+        ), site_id).filter(
+            PageView.timestamp >= start_date
+        ).group_by(
+            day_bucket(PageView.timestamp),
+            func.extract('hour', PageView.timestamp)
+        ).order_by(
+            day_bucket(PageView.timestamp),
+            func.extract('hour', PageView.timestamp)
+        ).all()
+    
+    def _daily_distinct(self, db, site_id: str, start_date: datetime, with_users: bool = False):
+        """按日期统计不同会话数（访客数），with_users 时同时统计不同用户数（活跃用户）"""
+        columns = [
+            day_bucket(PageView.timestamp).label('date'),
+            func.count(func.distinct(PageView.session_id)).label('visitors')
+        ]
+        if with_users:
+            columns.append(func.count(func.distinct(PageView.user_id)).label('active_users'))
+        return self._scoped(db.query(*columns), site_id).filter(
+            PageView.timestamp >= start_date
+        ).group_by(
+            day_bucket(PageView.timestamp)
+        ).order_by(
+            day_bucket(PageView.timestamp)
+        ).all()
+    
+    def _user_agent_counts(self, db, site_id: str):
+        """每个 UA 的浏览量：按 ua_id 分组（只读 (site_id, ua_id) 索引），再取回 UA 字符串"""
+        rows = db.query(
+            PageView.ua_id,
+            func.count(PageView.id).label('count')
+        ).filter(
+            PageView.site_id == site_id,
+            PageView.ua_id.isnot(None)
+        ).group_by(
+            PageView.ua_id
+        ).all()
+        names = dimension_service.names(db, "user_agent", (r.ua_id for r in rows))
+        return [UserAgentCount(names.get(r.ua_id), r.count) for r in rows]
+    
+    @staticmethod
+    def _trend_from_buckets(buckets, days: int) -> List[Dict[str, Any]]:
+        if days <= 2:
+            return [
+                {"date": str(r.date), "hour": int(r.hour), "views": r.views}
+                for r in buckets
+            ]
+        daily = {}
+        for r in buckets:
+            daily[str(r.date)] = daily.get(str(r.date), 0) + r.views
+        return [{"date": date, "views": views} for date, views in daily.items()]
+    
+    @staticmethod
+    def _hourly_from_buckets(buckets) -> List[Dict[str, Any]]:
+        hourly_data = {i: 0 for i in range(24)}
+        for r in buckets:
+            hourly_data[int(r.hour)] += r.recent_views or 0
+        
+        return [
+            {"hour": hour, "views": views}
+            for hour, views in hourly_data.items()
+        ]
+    
+    @staticmethod
+    def _user_type_trend_from(daily_new_users, daily_active_users, start_date, end_date) -> List[Dict[str, Any]]:
+        # 生成日期范围
+        date_range = []
+        current_date = start_date
+        while current_date <= end_date:
+            date_range.append(current_date)
+            current_date += timedelta(days=1)
+        
+        new_users_map = {str(r.date): r.new_users for r in daily_new_users}
+        active_users_map = {str(r.date): r.active_users for r in daily_active_users}
+        
+        trend_data = []
+        for date in date_range:
+            date_str = str(date.date())
+            new_users = new_users_map.get(date_str, 0)
+            active_users = active_users_map.get(date_str, 0)
+            returning_users = max(0, active_users - new_users)
+            
+            trend_data.append({
+                "date": date_str,
+                "new_users": new_users,
+                "returning_users": returning_users,
+                "total_active": active_users
+            })
+        
+        return trend_data
+    
+    # ---- 各个面板 ----
+    
+    def _realtime_extra(self, db, site_id: str, today_start: datetime) -> Dict[str, Any]:
+        """实时面板中不依赖浏览量分桶的部分：平均时长、今日热门页面、在线用户"""
+        yesterday_start = today_start - timedelta(days=1)
+        stats = {}
+        
+        result = db.query(func.avg(Session.duration)).filter(
+            Session.site_id == site_id,
+            Session.start_time >= today_start,
+            Session.duration.isnot(None),
+            Session.duration > 0
+        ).scalar()
+        stats["avg_duration_today"] = float(result) if result else 0
+        
+        limit = shards.widen(10)
+        top_pages = hot_window.top_urls(site_id, today_start, limit)
+        if top_pages is None:
+            # 按 url_id + 0 分组，让 SQLite 走 (site_id, traffic_class, timestamp) 索引只读今天的数据，
+            # 而不是为了省掉排序沿 (site_id, traffic_class, url_id) 索引扫描整个站点；
+            # 查询列和分组用同一个不带参数的表达式，PostgreSQL 才认为两者相同
+            url_id = PageView.url_id.op('+')(literal_column("0"))
+            top_pages = self._scoped(db.query(
+                url_id.label('url_id'),
+                func.count(PageView.id).label('views')
+            ), site_id).filter(
+                PageView.timestamp >= today_start
+            ).group_by(
+                url_id
+            ).order_by(
+                func.count(PageView.id).desc()
+            ).limit(limit).all()
+        
+        stats["top_pages"] = self._with_urls(db, top_pages)
+        
+        result = db.query(func.count(func.distinct(Session.session_id))).filter(
+            Session.site_id == site_id,
+            Session.end_time >= yesterday_start
+        ).scalar()
+        stats["online_users"] = result or 0
+        return stats
+    
+    def _top_pages(self, db, site_id: str, limit: int) -> List[Dict[str, Any]]:
+        results = self._scoped(db.query(
+            PageView.url_id,
+            func.count(PageView.id).label('views')
+        ), site_id).group_by(
+            PageView.url_id
+        ).order_by(
+            func.count(PageView.id).desc()
+        ).limit(limit).all()
+        
+        return self._with_urls(db, results)
+    
+    def _with_urls(self, db, rows) -> List[Dict[str, Any]]:
+        """(url_id, views) 的前 N 项换回 URL"""
+        names = dimension_service.names(db, "url", (r.url_id for r in rows))
+        return [{"url": names.get(r.url_id), "views": r.views} for r in rows]
+    
+    def _referrers(self, db, site_id: str, limit: int) -> List[Dict[str, Any]]:
+        results = db.query(
+            PageView.referrer_id,
+            func.count(PageView.id).label('views')
+        ).filter(
+            PageView.site_id == site_id
+        ).group_by(
+            PageView.referrer_id
+        ).all()
+        names = dimension_service.names(db, "referrer", (r.referrer_id for r in results))
+        
+        referrer_counts = {}
+        for r in results:
+            ref_name = parse_referrer(names.get(r.referrer_id))
+            if ref_name not in referrer_counts:
+                referrer_counts[ref_name] = 0
+            referrer_counts[ref_name] += r.views
+        
+        sorted_referrers = sorted(referrer_counts.items(), key=lambda x: x[1], reverse=True)[:limit]
+        
+        total = sum(count for _, count in sorted_referrers)
+        
+        return [
+            {"referrer": name, "views": count, "percentage": count / total * 100 if total > 0 else 0}
+            for name, count in sorted_referrers
+        ]
     
-    def get_realtime_stats(self) -> Dict[str, Any]:
+    def _users(self, query, site_id: str):
+        # 分片模式下每个分片都有一行匿名用户（user_id 为空），只在第 0 个分片计入
+        query = query.filter(User.site_id == site_id)
+        return query if shards.counts_anonymous() else query.filter(User.user_id.isnot(None))
+    
+    def _user_type_stats(self, db, site_id: str) -> Dict[str, Any]:
+        today = datetime.now().date()
+        today_start = datetime.combine(today, datetime.min.time())
+        
+        # 获取总用户数
+        total_users = self._users(db.query(func.count(User.id)), site_id).scalar() or 0
+        
+        # 获取新用户数（今天首次访问的用户）
+        new_users = self._users(db.query(func.count(User.id)), site_id).filter(
+            User.first_visit >= today_start,
+            User.first_visit < today_start + timedelta(days=1)
+        ).scalar() or 0
+        
+        # 获取老用户数
+        returning_users = total_users - new_users
+        
+        # 计算比例
+        new_user_percentage = (new_users / total_users * 100) if total_users > 0 else 0
+        returning_user_percentage = (returning_users / total_users * 100) if total_users > 0 else 0
+        
+        return {
+            "total_users": total_users,
+            "new_users": new_users,
+            "returning_users": returning_users,
+            "new_user_percentage": new_user_percentage,
+            "returning_user_percentage": returning_user_percentage
+        }
+    
+    def _daily_new_users(self, db, site_id: str, start_date: datetime):
+        return self._users(db.query(
+            day_bucket(User.first_visit).label('date'),
+            func.count(User.id).label('new_users')
+        ), site_id).filter(
+            User.first_visit >= start_date
+        ).group_by(
+            day_bucket(User.first_visit)
+        ).all()
+    
+    @timed(STATS_QUERY_SECONDS)
+    @sharded(_merge_realtime)
+    def get_realtime_stats(self, site_id: str = DEFAULT_SITE_ID) -> Dict[str, Any]:
         stats = {
             "online_users": 0,
             "page_views_today": 0,
@@ -23,270 +439,108 @@ class StatsService:
             now = datetime.now()
             today = now.date()
             today_start = datetime.combine(today, datetime.min.time())
-            yesterday_start = today_start - timedelta(days=1)
-            
-            stats["page_views_today"] = self._exclude_dashboard(db.query(func.count(PageView.id))).filter(
-                PageView.timestamp >= today_start
-            ).scalar() or 0
-            
-            stats["unique_visitors_today"] = self._exclude_dashboard(db.query(func.count(func.distinct(PageView.session_id)))).filter(
-                PageView.timestamp >= today_start
-            ).scalar() or 0
-            
-            result = db.query(func.avg(Session.duration)).filter(
-                Session.start_time >= today_start,
-                Session.duration.isnot(None),
-                Session.duration > 0
-            ).scalar()
-            stats["avg_duration_today"] = float(result) if result else 0
-            
-            top_pages = self._exclude_dashboard(db.query(
-                PageView.page_url,
-                func.count(PageView.id).label('views')
-            )).filter(
-                PageView.timestamp >= today_start
-            ).group_by(
-                PageView.page_url
-            ).order_by(
-                func.count(PageView.id).desc()
-            ).limit(10).all()
             
-            stats["top_pages"] = [{"url": r.page_url, "views": r.views} for r in top_pages]
+            summary = hot_window.summary(site_id, today_start)
+            if summary is not None:
+                stats["page_views_today"], stats["unique_visitors_today"] = summary
+            else:
+                stats["page_views_today"] = self._scoped(db.query(func.count(PageView.id)), site_id).filter(
+                    PageView.timestamp >= today_start
+                ).scalar() or 0
+                
+                stats["unique_visitors_today"] = self._scoped(db.query(func.count(func.distinct(PageView.session_id))), site_id).filter(
+                    PageView.timestamp >= today_start
+                ).scalar() or 0
             
-            result = db.query(func.count(func.distinct(Session.session_id))).filter(
-                Session.end_time >= yesterday_start
-            ).scalar()
-            stats["online_users"] = result or 0
+            stats.update(self._realtime_extra(db, site_id, today_start))
         finally:
             db.close()
         
         return stats
     
-    def get_page_views_trend(self, days: int = 7) -> List[Dict[str, Any]]:
+    @timed(STATS_QUERY_SECONDS)
+    @sharded(_merge_page_views_trend)
+    def get_page_views_trend(self, days: int = 7, site_id: str = DEFAULT_SITE_ID) -> List[Dict[str, Any]]:
         db = next(get_db())
         try:
-            end_date = datetime.now()
-            start_date = end_date - timedelta(days=days)
+            start_date = datetime.now() - timedelta(days=days)
             
             if days <= 2:
-                results = self._exclude_dashboard(db.query(
-                    func.date(PageView.timestamp).label('date'),
-                    func.extract('hour', PageView.timestamp).label('hour'),
-                    func.count(PageView.id).label('views')
-                )).filter(
-                    PageView.timestamp >= start_date
-                ).group_by(
-                    func.date(PageView.timestamp),
-                    func.extract('hour', PageView.timestamp)
-                ).order_by(
-                    func.date(PageView.timestamp),
-                    func.extract('hour', PageView.timestamp)
-                ).all()
-                
-                return [
-                    {"date": str(r.date), "hour": int(r.hour), "views": r.views}
-                    for r in results
-                ]
-            else:
-                results = self._exclude_dashboard(db.query(
-                    func.date(PageView.timestamp).label('date'),
-                    func.count(PageView.id).label('views')
-                )).filter(
-                    PageView.timestamp >= start_date
-                ).group_by(
-                    func.date(PageView.timestamp)
-                ).order_by(
-                    func.date(PageView.timestamp)
-                ).all()
-                
-                return [
-                    {"date": str(r.date), "views": r.views}
-                    for r in results
-                ]
-        finally:
-            db.close()
-    
-    def get_unique_visitors_trend(self, days: int = 7) -> List[Dict[str, Any]]:
-        db = next(get_db())
-        try:
-            end_date = datetime.now()
-            start_date = end_date - timedelta(days=days)
+                return self._trend_from_buckets(self._page_view_buckets(db, site_id, start_date, start_date), days)
             
-            results = self._exclude_dashboard(db.query(
-                func.date(PageView.timestamp).label('date'),
-                func.count(func.distinct(PageView.session_id)).label('visitors')
-            )).filter(
+            # 单独请求按天趋势时不需要小时分桶，按日期分组即可
+            results = self._scoped(db.query(
+                day_bucket(PageView.timestamp).label('date'),
+                func.count(PageView.id).label('views')
+            ), site_id).filter(
                 PageView.timestamp >= start_date
             ).group_by(
-                func.date(PageView.timestamp)
+                day_bucket(PageView.timestamp)
             ).order_by(
-                func.date(PageView.timestamp)
+                day_bucket(PageView.timestamp)
             ).all()
             
             return [
-                {"date": str(r.date), "visitors": r.visitors}
+                {"date": str(r.date), "views": r.views}
                 for r in results
             ]
         finally:
             db.close()
     
-    def get_top_pages(self, limit: int = 10) -> List[Dict[str, Any]]:
+    @timed(STATS_QUERY_SECONDS)
+    @sharded(_merge_by("date"))
+    def get_unique_visitors_trend(self, days: int = 7, site_id: str = DEFAULT_SITE_ID) -> List[Dict[str, Any]]:
         db = next(get_db())
         try:
-            results = self._exclude_dashboard(db.query(
-                PageView.page_url,
-                func.count(PageView.id).label('views')
-            )).group_by(
-                PageView.page_url
-            ).order_by(
-                func.count(PageView.id).desc()
-            ).limit(limit).all()
+            start_date = datetime.now() - timedelta(days=days)
             
             return [
-                {"url": r.page_url, "views": r.views}
-                for r in results
+                {"date": str(r.date), "visitors": r.visitors}
+                for r in self._daily_distinct(db, site_id, start_date)
             ]
         finally:
             db.close()
     
-    def get_hourly_distribution(self, days: int = 1) -> List[Dict[str, Any]]:
+    @timed(STATS_QUERY_SECONDS)
+    @sharded(_merge_top_pages)
+    def get_top_pages(self, limit: int = 10, site_id: str = DEFAULT_SITE_ID) -> List[Dict[str, Any]]:
         db = next(get_db())
         try:
-            end_date = datetime.now()
-            start_date = end_date - timedelta(days=days)
-            
-            results = self._exclude_dashboard(db.query(
-                func.extract('hour', PageView.timestamp).label('hour'),
-                func.count(PageView.id).label('views')
-            )).filter(
-                PageView.timestamp >= start_date
-            ).group_by(
-                func.extract('hour', PageView.timestamp)
-            ).order_by(
-                func.extract('hour', PageView.timestamp)
-            ).all()
-            
-            hourly_data = {i: 0 for i in range(24)}
-            for r in results:
-                hourly_data[int(r.hour)] = r.views
-            
-            return [
-                {"hour": hour, "views": views}
-                for hour, views in hourly_data.items()
-            ]
+            return self._top_pages(db, site_id, shards.widen(limit))
         finally:
             db.close()
     
-    def get_referrers(self, limit: int = 10) -> List[Dict[str, Any]]:
-        from urllib.parse import urlparse
-        
-        def parse_referrer(referrer):
-            if not referrer or referrer == "":
-                return "直接访问"
-            
-            try:
-                parsed = urlparse(referrer)
-                domain = parsed.netloc.lower()
-                
-                if domain in ["localhost", "127.0.0.1", "::1"]:
-                    return "直接访问"
-                
-                if "google" in domain:
-                    return "Google"
-                elif "baidu" in domain:
-                    return "百度"
-                elif "bing" in domain:
-                    return "Bing"
-                elif "yahoo" in domain:
-                    return "Yahoo"
-                elif "weibo" in domain:
-                    return "微博"
-                elif "zhihu" in domain:
-                    return "知乎"
-                elif "douyin" in domain or "tiktok" in domain:
-                    return "抖音/TikTok"
-                elif "bilibili" in domain:
-                    return "B站"
-                elif "github" in domain:
-                    return "GitHub"
-                else:
-                    return domain
-            except Exception:
-                return "直接访问"
-        
+    @timed(STATS_QUERY_SECONDS)
+    @sharded(_merge_by("hour"))
+    def get_hourly_distribution(self, days: int = 1, site_id: str = DEFAULT_SITE_ID) -> List[Dict[str, Any]]:
         db = next(get_db())
         try:
-            results = db.query(
-                PageView.referrer,
-                func.count(PageView.id).label('views')
-            ).all()
-            
-            referrer_counts = {}
-            for r in results:
-                ref_name = parse_referrer(r.referrer)
-                if ref_name not in referrer_counts:
-                    referrer_counts[ref_name] = 0
-                referrer_counts[ref_name] += r.views
-            
-            sorted_referrers = sorted(referrer_counts.items(), key=lambda x: x[1], reverse=True)[:limit]
-            
-            total = sum(count for _, count in sorted_referrers)
-            
-            return [
-                {"referrer": name, "views": count, "percentage": count / total * 100 if total > 0 else 0}
-                for name, count in sorted_referrers
-            ]
+            start_date = datetime.now() - timedelta(days=days)
+            return self._hourly_from_buckets(self._page_view_buckets(db, site_id, start_date, start_date))
         finally:
             db.close()
     
-    def get_device_stats(self) -> Dict[str, Any]:
-        import re
-        
-        def parse_os(user_agent):
-            if not user_agent:
-                return '未知'
-            user_agent = user_agent.lower()
-            if 'mac os x' in user_agent or 'macintosh' in user_agent:
-                return 'Mac OS'
-            elif 'windows' in user_agent:
-                return 'Windows'
-            elif 'linux' in user_agent:
-                return 'Linux'
-            elif 'android' in user_agent:
-                return 'Android'
-            elif 'iphone' in user_agent or 'ipad' in user_agent or 'ios' in user_agent:
-                return 'iOS'
-            else:
-                return '其他'
-        
+    @timed(STATS_QUERY_SECONDS)
+    @sharded(_merge_referrers)
+    def get_referrers(self, limit: int = 10, site_id: str = DEFAULT_SITE_ID) -> List[Dict[str, Any]]:
         db = next(get_db())
         try:
-            results = db.query(
-                PageView.user_agent,
-                func.count(PageView.id).label('count')
-            ).filter(
-                PageView.user_agent.isnot(None)
-            ).group_by(
-                PageView.user_agent
-            ).all()
-            
-            os_stats = {}
-            for r in results:
-                os_name = parse_os(r.user_agent)
-                if os_name not in os_stats:
-                    os_stats[os_name] = 0
-                os_stats[os_name] += r.count
-            
-            total = sum(os_stats.values())
-            
-            return {
-                os_name: {"count": count, "percentage": count / total * 100 if total > 0 else 0}
-                for os_name, count in os_stats.items()
-            }
+            return self._referrers(db, site_id, shards.widen(limit))
         finally:
             db.close()
     
-    def get_event_stats(self, event_type: str = None, days: int = 7) -> List[Dict[str, Any]]:
+    @timed(STATS_QUERY_SECONDS)
+    @sharded(_merge_shares)
+    def get_device_stats(self, site_id: str = DEFAULT_SITE_ID) -> Dict[str, Any]:
+        db = next(get_db())
+        try:
+            return _share_by(self._user_agent_counts(db, site_id), parse_os)
+        finally:
+            db.close()
+    
+    @timed(STATS_QUERY_SECONDS)
+    @sharded(_merge_event_stats)
+    def get_event_stats(self, event_type: str = None, days: int = 7, site_id: str = DEFAULT_SITE_ID) -> List[Dict[str, Any]]:
         db = next(get_db())
         try:
             end_date = datetime.utcnow()
@@ -296,6 +550,7 @@ class StatsService:
                 Event.event_name,
                 func.count(Event.id).label('count')
             ).filter(
+                Event.site_id == site_id,
                 Event.timestamp >= start_date
             )
             
@@ -314,140 +569,245 @@ class StatsService:
             ]
         finally:
             db.close()
-
-    def get_browser_stats(self) -> Dict[str, Any]:
-        def parse_browser(user_agent):
-            if not user_agent:
-                return '未知'
-            user_agent = user_agent.lower()
-            if 'chrome' in user_agent and 'edg' not in user_agent:
-                return 'Chrome'
-            elif 'safari' in user_agent and 'chrome' not in user_agent:
-                return 'Safari'
-            elif 'firefox' in user_agent:
-                return 'Firefox'
-            elif 'edge' in user_agent or 'edg' in user_agent:
-                return 'Edge'
-            elif 'opera' in user_agent or 'opr' in user_agent:
-                return 'Opera'
-            else:
-                return '其他'
-        
+    
+    @timed(STATS_QUERY_SECONDS)
+    @sharded(_merge_shares)
+    def get_browser_stats(self, site_id: str = DEFAULT_SITE_ID) -> Dict[str, Any]:
         db = next(get_db())
         try:
-            results = db.query(
-                PageView.user_agent,
-                func.count(PageView.id).label('count')
-            ).filter(
-                PageView.user_agent.isnot(None)
-            ).group_by(
-                PageView.user_agent
-            ).all()
-            
-            browser_stats = {}
-            for r in results:
-                browser_name = parse_browser(r.user_agent)
-                if browser_name not in browser_stats:
-                    browser_stats[browser_name] = 0
-                browser_stats[browser_name] += r.count
-            
-            total = sum(browser_stats.values())
-            
-            return {
-                browser_name: {"count": count, "percentage": count / total * 100 if total > 0 else 0}
-                for browser_name, count in browser_stats.items()
-            }
+            return _share_by(self._user_agent_counts(db, site_id), parse_browser)
         finally:
             db.close()
     
-    def get_user_type_stats(self) -> Dict[str, Any]:
+    @timed(STATS_QUERY_SECONDS)
+    @sharded(_merge_user_type)
+    def get_user_type_stats(self, site_id: str = DEFAULT_SITE_ID) -> Dict[str, Any]:
         """获取新老用户统计数据"""
         db = next(get_db())
         try:
-            now = datetime.now()
-            today = now.date()
-            today_start = datetime.combine(today, datetime.min.time())
-            
-            # 获取总用户数
-            total_users = db.query(func.count(User.id)).scalar() or 0
-            
-            # 获取新用户数（今天首次访问的用户）
-            new_users = db.query(func.count(User.id)).filter(
-                func.date(User.first_visit) == today
-            ).scalar() or 0
-            
-            # 获取老用户数
-            returning_users = total_users - new_users
-            
-            # 计算比例
-            new_user_percentage = (new_users / total_users * 100) if total_users > 0 else 0
-            returning_user_percentage = (returning_users / total_users * 100) if total_users > 0 else 0
-            
-            return {
-                "total_users": total_users,
-                "new_users": new_users,
-                "returning_users": returning_users,
-                "new_user_percentage": new_user_percentage,
-                "returning_user_percentage": returning_user_percentage
-            }
+            return self._user_type_stats(db, site_id)
         finally:
             db.close()
     
-    def get_user_type_trend(self, days: int = 7) -> List[Dict[str, Any]]:
+    @timed(STATS_QUERY_SECONDS)
+    @sharded(_merge_by("date"))
+    def get_user_type_trend(self, days: int = 7, site_id: str = DEFAULT_SITE_ID) -> List[Dict[str, Any]]:
         """获取新老用户趋势数据"""
         db = next(get_db())
         try:
             end_date = datetime.now()
             start_date = end_date - timedelta(days=days)
             
-            # 生成日期范围
-            date_range = []
-            current_date = start_date
-            while current_date <= end_date:
-                date_range.append(current_date)
-                current_date += timedelta(days=1)
-            
-            # 获取每天的新用户数
-            daily_new_users = db.query(
-                func.date(User.first_visit).label('date'),
-                func.count(User.id).label('new_users')
-            ).filter(
-                User.first_visit >= start_date
-            ).group_by(
-                func.date(User.first_visit)
-            ).all()
-            
             # 获取每天的活跃用户数（包含新老用户）
-            daily_active_users = self._exclude_dashboard(db.query(
-                func.date(PageView.timestamp).label('date'),
+            daily_active_users = self._scoped(db.query(
+                day_bucket(PageView.timestamp).label('date'),
                 func.count(func.distinct(PageView.user_id)).label('active_users')
-            )).filter(
+            ), site_id).filter(
                 PageView.timestamp >= start_date,
                 PageView.user_id.isnot(None)
             ).group_by(
-                func.date(PageView.timestamp)
+                day_bucket(PageView.timestamp)
+            ).all()
+            
+            return self._user_type_trend_from(
+                self._daily_new_users(db, site_id, start_date), daily_active_users, start_date, end_date
+            )
+        finally:
+            db.close()
+    
+    @sharded(total)
+    def rollup_site_stats(self, days: int = None, start: date = None, end: date = None) -> int:
+        """
+        把最近 days 天（或 [start, end) 日期区间，用于导入历史数据后回补）每个站点的日汇总
+        （浏览量、访客、会话、平均时长）重新写入 aggregated_stats，返回写入的行数。
+        站点列表等跨站点的页面只读汇总表，不再扫描明细。
+        """
+        days = days or settings.SITE_ROLLUP_DAYS
+        db = next(get_db())
+        try:
+            start_day = datetime.combine(start or (datetime.now() - timedelta(days=days - 1)).date(), datetime.min.time())
+            end_day = datetime.combine(end, datetime.min.time()) if end else datetime.max
+            
+            rows = {}
+            page_views = db.query(
+                PageView.site_id,
+                day_bucket(PageView.timestamp).label('date'),
+                func.count(PageView.id).label('page_views'),
+                func.count(func.distinct(PageView.session_id)).label('unique_visitors')
+            ).filter(
+                PageView.timestamp >= start_day,
+                PageView.timestamp < end_day,
+                PageView.traffic_class == TRAFFIC_NORMAL
+            ).group_by(
+                PageView.site_id,
+                day_bucket(PageView.timestamp)
+            ).all()
+            for r in page_views:
+                rows[(r.site_id, str(r.date), "page_views")] = r.page_views
+                rows[(r.site_id, str(r.date), "unique_visitors")] = r.unique_visitors
+            
+            sessions = db.query(
+                Session.site_id,
+                day_bucket(Session.start_time).label('date'),
+                func.count(Session.id).label('sessions'),
+                func.avg(case((Session.duration > 0, Session.duration))).label('avg_duration')
+            ).filter(
+                Session.start_time >= start_day,
+                Session.start_time < end_day
+            ).group_by(
+                Session.site_id,
+                day_bucket(Session.start_time)
+            ).all()
+            for r in sessions:
+                rows[(r.site_id, str(r.date), "sessions")] = r.sessions
+                rows[(r.site_id, str(r.date), "avg_duration")] = float(r.avg_duration or 0)
+            
+            db.query(AggregatedStats).filter(
+                AggregatedStats.stat_type.in_(self.ROLLUP_STAT_TYPES),
+                AggregatedStats.stat_date >= start_day,
+                AggregatedStats.stat_date < end_day
+            ).delete(synchronize_session=False)
+            db.add_all([
+                AggregatedStats(
+                    site_id=site_id,
+                    stat_type=stat_type,
+                    stat_date=datetime.strptime(date, "%Y-%m-%d"),
+                    value=value
+                )
+                for (site_id, date, stat_type), value in rows.items()
+            ])
+            db.commit()
+            return len(rows)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+    
+    @timed(STATS_QUERY_SECONDS)
+    @sharded(_merge_site_overview)
+    def get_site_overview(self, days: int = 7) -> List[Dict[str, Any]]:
+        """各站点最近 days 天的汇总，数据来自 rollup_site_stats 写入的日汇总"""
+        db = next(get_read_db())
+        try:
+            start_day = datetime.combine((datetime.now() - timedelta(days=days - 1)).date(), datetime.min.time())
+            results = db.query(
+                AggregatedStats.site_id,
+                AggregatedStats.stat_date,
+                AggregatedStats.stat_type,
+                AggregatedStats.value
+            ).filter(
+                AggregatedStats.stat_type.in_(self.ROLLUP_STAT_TYPES),
+                AggregatedStats.stat_date >= start_day
             ).all()
             
-            # 构建结果
-            new_users_map = {str(r.date): r.new_users for r in daily_new_users}
-            active_users_map = {str(r.date): r.active_users for r in daily_active_users}
+            daily = {}
+            for r in results:
+                daily.setdefault((r.site_id, r.stat_date), {})[r.stat_type] = r.value
             
-            trend_data = []
-            for date in date_range:
-                date_str = str(date.date())
-                new_users = new_users_map.get(date_str, 0)
-                active_users = active_users_map.get(date_str, 0)
-                returning_users = max(0, active_users - new_users)
-                
-                trend_data.append({
-                    "date": date_str,
-                    "new_users": new_users,
-                    "returning_users": returning_users,
-                    "total_active": active_users
+            sites = {}
+            for (site_id, _), values in daily.items():
+                site = sites.setdefault(site_id, {
+                    "site_id": site_id, "page_views": 0, "unique_visitors": 0, "sessions": 0, "total_duration": 0.0
                 })
+                site["page_views"] += int(values.get("page_views", 0))
+                site["unique_visitors"] += int(values.get("unique_visitors", 0))
+                site["sessions"] += int(values.get("sessions", 0))
+                # 平均时长按会话数加权
+                site["total_duration"] += values.get("avg_duration", 0) * values.get("sessions", 0)
             
-            return trend_data
+            for site in sites.values():
+                total_duration = site.pop("total_duration")
+                site["avg_duration"] = total_duration / site["sessions"] if site["sessions"] else 0
+            
+            return sorted(sites.values(), key=lambda site: site["page_views"], reverse=True)
         finally:
             db.close()
+    
+    def _run_read(self, fn, *args):
+        """在只读会话中执行 fn(db, *args)，供线程池调用"""
+        db = next(get_read_db())
+        try:
+            return fn(db, *args)
+        finally:
+            db.close()
+    
+    @timed(STATS_QUERY_SECONDS)
+    @sharded(_merge_dashboard)
+    def get_dashboard_snapshot(self, days: int = 7, site_id: str = DEFAULT_SITE_ID) -> Dict[str, Any]:
+        """
+        仪表盘所有面板的数据。趋势、访客、小时分布和今日概况共用同一次分桶扫描和按日去重结果，
+        其余互不依赖的查询在线程池中用只读连接并行执行，整体作为一个单元缓存。
+        """
+        # 分片模式下每个分片缓存自己的部分结果，合并在 @sharded 中完成
+        shard = shards.current()
+        cache_key = site_key(site_id, f"stats:dashboard:{days}" + (f":shard{shard.index}" if shard else ""))
+        cached = redis_service.get(cache_key) or self._local_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        from backend.services.flow_service import flow_service
+        
+        now = datetime.now()
+        today_start = datetime.combine(now.date(), datetime.min.time())
+        day_ago = now - timedelta(days=1)
+        start_date = now - timedelta(days=days)
+        # 分桶扫描要同时覆盖趋势窗口、最近 24 小时和今天
+        scan_start = min(start_date, day_ago, today_start)
+        
+        # 复制上下文，让子查询同样受负载管理的语句超时约束
+        run = lambda fn, *args: self._executor.submit(contextvars.copy_context().run, self._run_read, fn, *args)
+        # 耗时长的查询先提交，避免排在短查询后面
+        futures = {
+            "page_flow": run(lambda db: flow_service.get_page_flow(days, site_id, db=db)),
+            "referrers": run(self._referrers, site_id, shards.widen(10)),
+            "user_agents": run(self._user_agent_counts, site_id),
+            "daily": run(self._daily_distinct, site_id, scan_start, True),
+            "buckets": run(self._page_view_buckets, site_id, scan_start, day_ago),
+            "top_pages": run(self._top_pages, site_id, shards.widen(10)),
+            "realtime_extra": run(self._realtime_extra, site_id, today_start),
+            "user_type": run(self._user_type_stats, site_id),
+            "new_users": run(self._daily_new_users, site_id, start_date),
+        }
+        results = {name: future.result() for name, future in futures.items()}
+        
+        buckets = results["buckets"]
+        trend_buckets = [r for r in buckets if (str(r.date), int(r.hour)) >= self._bucket_key(start_date)]
+        daily = results["daily"]
+        today_str = str(now.date())
+        daily_in_range = [r for r in daily if str(r.date) >= str(start_date.date())]
+        today_row = next((r for r in daily if str(r.date) == today_str), None)
+        
+        realtime = {
+            "online_users": 0,
+            "page_views_today": sum(r.views for r in buckets if str(r.date) == today_str),
+            "unique_visitors_today": today_row.visitors if today_row else 0,
+            "avg_duration_today": 0,
+            "top_pages": []
+        }
+        realtime.update(results["realtime_extra"])
+        
+        snapshot = {
+            "realtime": realtime,
+            "page_views_trend": self._trend_from_buckets(trend_buckets, days),
+            "visitors_trend": [{"date": str(r.date), "visitors": r.visitors} for r in daily_in_range],
+            "hourly": self._hourly_from_buckets(buckets),
+            "devices": _share_by(results["user_agents"], parse_os),
+            "browsers": _share_by(results["user_agents"], parse_browser),
+            "user_type": results["user_type"],
+            "user_type_trend": self._user_type_trend_from(results["new_users"], daily_in_range, start_date, now),
+            "top_pages": results["top_pages"],
+            "referrers": results["referrers"],
+            "page_flow": results["page_flow"],
+            "generated_at": now.isoformat()
+        }
+        
+        redis_service.set(cache_key, snapshot, expire=settings.DASHBOARD_CACHE_SECONDS)
+        self._local_cache.set(cache_key, snapshot, expire=settings.DASHBOARD_CACHE_SECONDS)
+        return snapshot
+    
+    @staticmethod
+    def _bucket_key(moment: datetime):
+        return (moment.date().isoformat(), moment.hour)
 
 stats_service = StatsService()
@@ -1,186 +1,413 @@
 from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import Session
-from backend.models import PageView, Event, Session as SessionModel, User, get_db
-from backend.services.cache_service import redis_service
+from config.settings import settings
+from backend.models import PageView, Event, Session as SessionModel, User, get_db, shards
+from backend.services.cache_service import redis_service, site_key
+from backend.services.traffic_filter import traffic_filter, TRAFFIC_NORMAL
+from backend.services.retention_service import retention_service, local_day
+from backend.services.event_property_service import event_property_service
+from backend.services.geo_service import geo_service
+from backend.services.dimension_service import dimension_service, EVENT_DIMENSIONS
+from backend.services.hot_window import hot_window
+from backend.services.duration_service import duration_service
+from backend.services.identity_cache import identity_cache, KnownUser
+from backend.utils.metrics import timed, INGEST_COMMIT_SECONDS, INGEST_ERRORS
 import json
 
+def _received_at(data: dict) -> Tuple[datetime, datetime]:
+    """
+    请求的接收时间，返回 (本地时间, UTC 时间)。经 spool 延迟写入的记录带有 received_at（Unix 秒），
+    要按接收时间而不是写库时间入库；page_views/events 的时间戳用本地时间，用户和会话用 UTC。
+    """
+    received_at = data.get('received_at')
+    if received_at is None:
+        return datetime.now(), datetime.utcnow()
+    return datetime.fromtimestamp(received_at), datetime.utcfromtimestamp(received_at)
+
 class TrackingService:
     
+    @timed(INGEST_COMMIT_SECONDS, "pageview")
     def track_page_view(self, data: dict):
-        db = next(get_db())
-        try:
-            user_id = data.get('user_id')
-            ip_address = data.get('ip_address')
-            user_agent = data.get('user_agent')
-            
-            # 检查用户是否存在
-            user = db.query(User).filter(
-                User.user_id == user_id
-            ).first()
-            
-            # 确定用户类型
-            is_new_user = False
-            if not user:
-                # 创建新用户
-                user = User(
-                    user_id=user_id,
-                    first_visit=datetime.utcnow(),
-                    last_visit=datetime.utcnow(),
-                    visit_count=1,
-                    ip_address=ip_address,
-                    user_agent=user_agent
-                )
-                db.add(user)
-                is_new_user = True
-            else:
-                # 更新老用户信息
-                user.last_visit = datetime.utcnow()
-                user.visit_count += 1
-                if not user.ip_address:
-                    user.ip_address = ip_address
-                if not user.user_agent:
-                    user.user_agent = user_agent
-            
-            session = db.query(SessionModel).filter(
-                SessionModel.session_id == data.get('session_id')
-            ).first()
-            
-            if not session:
-                session = SessionModel(
-                    session_id=data.get('session_id'),
-                    user_id=user_id,
-                    ip_address=ip_address,
-                    user_agent=user_agent,
-                    referrer=data.get('referrer'),
-                    start_time=datetime.utcnow()
-                )
-                db.add(session)
-            else:
-                session.page_views += 1
-                session.end_time = datetime.utcnow()
-            
-            db.flush()
+        # 分片模式下写入该用户所在的分片
+        with shards.routed(data.get('user_id'), data.get('session_id')):
+            traffic_class = traffic_filter.classify(data.get('page_url'), data.get('ip_address'), data.get('user_agent'))
+            if traffic_filter.should_drop(traffic_class):
+                return {"status": "filtered", "traffic_class": traffic_class}
             
-            page_view = PageView(
-                session_id=data.get('session_id'),
-                user_id=user_id,
-                page_url=data.get('page_url'),
-                page_title=data.get('page_title'),
-                referrer=data.get('referrer'),
-                ip_address=ip_address,
-                user_agent=user_agent,
-                screen_width=data.get('screen_width'),
-                screen_height=data.get('screen_height'),
-                language=data.get('language'),
-                duration=data.get('duration')
-            )
-            db.add(page_view)
-            db.commit()
-            
-            self._update_realtime_stats(data.get('page_url'))
-            
-            return {
-                "status": "success", 
-                "page_view_id": page_view.id,
-                "is_new_user": is_new_user,
-                "user_type": "new" if is_new_user else "returning"
-            }
-        except Exception as e:
-            db.rollback()
-            raise e
-        finally:
-            db.close()
+            # 字典 ID 要在打开写事务之前解析，见 DimensionService
+            dims = dimension_service.encode([data])[0]
+            db = next(get_db())
+            try:
+                page_view, is_new_user = self._write_page_view(db, data, traffic_class, dims)
+                db.commit()
+                
+                self._record_activity(db)
+                self._update_realtime_stats(page_view.site_id, data.get('page_url'))
+                
+                return {
+                    "status": "success", 
+                    "page_view_id": page_view.id,
+                    "is_new_user": is_new_user,
+                    "user_type": "new" if is_new_user else "returning"
+                }
+            except Exception as e:
+                db.rollback()
+                self._check_identities(e)
+                INGEST_ERRORS.labels("pageview").inc()
+                raise e
+            finally:
+                db.close()
+    
+    def _write_page_view(self, db, data: dict, traffic_class: int, dims: dict):
+        """在当前事务中写入一次页面浏览（含用户和会话），不提交；dims 是 DimensionService.encode 的结果"""
+        site_id = data.get('site_id') or settings.DEFAULT_SITE_ID
+        user_id = data.get('user_id')
+        ip_address = data.get('ip_address')
+        user_agent = data.get('user_agent')
+        local_time, utc_time = _received_at(data)
+        
+        user, is_new_user = self._visit_user(db, site_id, user_id, ip_address, user_agent, utc_time, count_visit=True)
+        self._visit_session(db, site_id, data, dims, utc_time)
+        
+        user = self._flush_identities(db, site_id, user)
+        if user_id and traffic_class == TRAFFIC_NORMAL:
+            self._note_activity(db, site_id, user, local_time.date())
+        
+        page_view = PageView(
+            site_id=site_id,
+            session_id=data.get('session_id'),
+            user_id=user_id,
+            ip_address=ip_address,
+            screen_width=data.get('screen_width'),
+            screen_height=data.get('screen_height'),
+            language=data.get('language'),
+            duration=data.get('duration'),
+            traffic_class=traffic_class,
+            timestamp=local_time,
+            url_id=dims.get('url_id'),
+            title_id=dims.get('title_id'),
+            referrer_id=dims.get('referrer_id'),
+            ua_id=dims.get('ua_id')
+        )
+        db.add(page_view)
+        return page_view, is_new_user
     
+    @timed(INGEST_COMMIT_SECONDS, "event")
     def track_event(self, data: dict):
-        db = next(get_db())
-        try:
-            user_id = data.get('user_id')
-            ip_address = data.get('ip_address')
-            user_agent = data.get('user_agent')
+        # 分片模式下写入该用户所在的分片
+        with shards.routed(data.get('user_id'), data.get('session_id')):
+            traffic_class = traffic_filter.classify(data.get('page_url'), data.get('ip_address'), data.get('user_agent'))
+            if traffic_filter.should_drop(traffic_class):
+                return {"status": "filtered", "traffic_class": traffic_class}
             
-            # 确保用户存在
-            user = db.query(User).filter(
+            dims = dimension_service.encode([data], EVENT_DIMENSIONS)[0]
+            db = next(get_db())
+            try:
+                event = self._write_event(db, data, dims)
+                db.commit()
+                
+                self._record_activity(db)
+                self._update_event_stats(event.site_id, data.get('event_type'))
+                
+                return {"status": "success", "event_id": event.id}
+            except Exception as e:
+                db.rollback()
+                self._check_identities(e)
+                INGEST_ERRORS.labels("event").inc()
+                raise e
+            finally:
+                db.close()
+    
+    def _write_event(self, db, data: dict, dims: dict):
+        """在当前事务中写入一个事件，不提交"""
+        site_id = data.get('site_id') or settings.DEFAULT_SITE_ID
+        user_id = data.get('user_id')
+        ip_address = data.get('ip_address')
+        user_agent = data.get('user_agent')
+        local_time, utc_time = _received_at(data)
+        
+        user, is_new_user = self._visit_user(db, site_id, user_id, ip_address, user_agent, utc_time,
+                                             count_visit=False, create=bool(user_id))
+        if is_new_user:
+            user = self._flush_identities(db, site_id, user)
+            self._note_activity(db, site_id, user)
+        
+        properties_json = json.dumps(data.get('properties', {})) if data.get('properties') else None
+        
+        event = Event(
+            site_id=site_id,
+            session_id=data.get('session_id'),
+            user_id=user_id,
+            event_type=data.get('event_type'),
+            event_name=data.get('event_name'),
+            properties=properties_json,
+            ip_address=ip_address,
+            timestamp=local_time,
+            url_id=dims.get('url_id'),
+            ua_id=dims.get('ua_id')
+        )
+        db.add(event)
+        event_property_service.add_for_event(db, event, data.get('properties'))
+        return event
+    
+    def _visit_user(self, db, site_id: str, user_id, ip_address, user_agent, utc_time: datetime,
+                    count_visit: bool, create: bool = True):
+        """
+        找到或新建用户并记一次访问，返回 (用户, 是否新用户)，用户为 User 或 KnownUser（都有 id、first_visit）。
+        已知用户不 SELECT 也不 UPDATE：visit_count/last_visit 记在 IdentityCache 中批量写回；
+        布隆过滤器判断为新用户时直接插入。
+        """
+        batch = identity_cache.batch(db)
+        key = (site_id, user_id)
+        user = batch.new_users.get(key)
+        if user is not None:
+            # 同一事务中刚建的用户
+            if count_visit:
+                user.visit_count += 1
+            user.last_visit = utc_time
+            return user, False
+        
+        known = batch.users.get(key) or identity_cache.user(site_id, user_id)
+        if known is None and identity_cache.may_exist(site_id, user_id):
+            row = db.query(User).filter(
+                User.site_id == site_id,
                 User.user_id == user_id
             ).first()
-            
-            if not user and user_id:
-                # 创建新用户（如果不存在）
-                user = User(
-                    user_id=user_id,
-                    first_visit=datetime.utcnow(),
-                    last_visit=datetime.utcnow(),
-                    visit_count=1,
-                    ip_address=ip_address,
-                    user_agent=user_agent
-                )
-                db.add(user)
-            elif user:
-                # 更新用户最后访问时间
-                user.last_visit = datetime.utcnow()
-            
-            properties_json = json.dumps(data.get('properties', {})) if data.get('properties') else None
-            
-            event = Event(
-                session_id=data.get('session_id'),
-                user_id=user_id,
-                event_type=data.get('event_type'),
-                event_name=data.get('event_name'),
-                properties=properties_json,
-                page_url=data.get('page_url'),
-                ip_address=ip_address,
-                user_agent=user_agent
-            )
-            db.add(event)
-            db.commit()
-            
-            self._update_event_stats(data.get('event_type'))
-            
-            return {"status": "success", "event_id": event.id}
-        except Exception as e:
-            db.rollback()
-            raise e
-        finally:
-            db.close()
+            if row is not None:
+                if not row.ip_address:
+                    row.ip_address = ip_address
+                if not row.user_agent:
+                    row.user_agent = user_agent
+                known = batch.users[key] = KnownUser(row.id, row.first_visit)
+        if known is not None:
+            batch.touch_user(known.id, 1 if count_visit else 0, utc_time)
+            return known, False
+        if not create:
+            return None, False
+        
+        user = User(
+            site_id=site_id,
+            user_id=user_id,
+            first_visit=utc_time,
+            last_visit=utc_time,
+            visit_count=1,
+            ip_address=ip_address,
+            user_agent=user_agent
+        )
+        db.add(user)
+        batch.new_users[key] = user
+        return user, True
+    
+    def _visit_session(self, db, site_id: str, data: dict, dims: dict, utc_time: datetime):
+        """找到或新建会话并记一次浏览；已知会话的 page_views/end_time 同样由 IdentityCache 批量写回"""
+        batch = identity_cache.batch(db)
+        session_id = data.get('session_id')
+        key = (site_id, session_id)
+        session = batch.new_sessions.get(key)
+        if session is not None:
+            session.page_views += 1
+            session.end_time = utc_time
+            return
+        
+        session_pk = batch.sessions.get(key) or identity_cache.session(site_id, session_id)
+        if session_pk is None:
+            session_pk = db.query(SessionModel.id).filter(
+                SessionModel.site_id == site_id,
+                SessionModel.session_id == session_id
+            ).scalar()
+            if session_pk is not None:
+                batch.sessions[key] = session_pk
+        if session_pk is not None:
+            batch.touch_session(session_pk, utc_time)
+            return
+        
+        ip_address = data.get('ip_address')
+        country, city = geo_service.locate(ip_address)
+        session = SessionModel(
+            site_id=site_id,
+            session_id=session_id,
+            user_id=data.get('user_id'),
+            ip_address=ip_address,
+            country=country,
+            city=city,
+            start_time=utc_time,
+            ua_id=dims.get('ua_id'),
+            referrer_id=dims.get('referrer_id')
+        )
+        db.add(session)
+        batch.new_sessions[key] = session
+    
+    def _flush_identities(self, db, site_id: str, user):
+        """写入本事务新建的用户和会话以取得 ID，记下提交后要缓存的身份；返回用户对应的 KnownUser"""
+        batch = identity_cache.batch(db)
+        if db.new:
+            db.flush()
+        for key, session in batch.new_sessions.items():
+            batch.sessions.setdefault(key, session.id)
+        for key, new_user in batch.new_users.items():
+            batch.users.setdefault(key, KnownUser(new_user.id, new_user.first_visit))
+        if user is None or isinstance(user, KnownUser):
+            return user
+        return batch.users[(site_id, user.user_id)]
+    
+    def _check_identities(self, error: Exception):
+        """唯一索引冲突可能是布隆过滤器漏掉了其他进程新建的用户，清空身份缓存，之后先查库"""
+        if isinstance(error, IntegrityError):
+            identity_cache.invalidate()
+    
+    def _note_activity(self, db, site_id: str, user: User, active_day=None):
+        """记下需要并入留存位图的用户，提交成功后由 _record_activity 交给 RetentionService"""
+        db.info.setdefault('activity', []).append((site_id, user.id, local_day(user.first_visit), active_day))
     
-    def _update_realtime_stats(self, page_url: str):
+    def _record_activity(self, db):
+        identity_cache.apply(db.info.pop('identity', None))
+        for activity in db.info.pop('activity', []):
+            retention_service.record(*activity)
+        for site_id, start_time, old, new, url_id, received_at in db.info.pop('durations', []):
+            duration_service.record_session(site_id, start_time, old, new)
+            duration_service.record_page(site_id, url_id, received_at, new)
+    
+    def _update_realtime_stats(self, site_id: str, page_url: str):
         if not redis_service.is_available():
             return
         
         today = datetime.utcnow().date().isoformat()
         
-        redis_service.hincrby(f"daily_stats:{today}", "page_views")
-        redis_service.incr("stats:page_views_today")
-        redis_service.zincrby("stats:top_pages", 1, page_url)
+        redis_service.hincrby(site_key(site_id, f"daily_stats:{today}"), "page_views")
+        redis_service.increment(site_key(site_id, "stats:page_views_today"))
+        redis_service.zincrby(site_key(site_id, "stats:top_pages"), 1, page_url)
     
-    def _update_event_stats(self, event_type: str):
+    def _update_event_stats(self, site_id: str, event_type: str):
         if not redis_service.is_available():
             return
         
         today = datetime.utcnow().date().isoformat()
-        redis_service.hincrby(f"daily_events:{today}", event_type)
+        redis_service.hincrby(site_key(site_id, f"daily_events:{today}"), event_type)
+    
+    @timed(INGEST_COMMIT_SECONDS, "duration")
+    def update_session_duration(self, session_id: str, duration: float, site_id: str = None, page_url: str = None,
+                                user_id: str = None):
+        # 分片模式下写入该会话所在的分片：带 user_id 时直接路由，否则在各分片中查找会话
+        site_id = site_id or settings.DEFAULT_SITE_ID
+        with shards.routed(user_id, session_id) if user_id else shards.located(site_id, session_id):
+            data = {"session_id": session_id, "duration": duration, "site_id": site_id, "page_url": page_url}
+            dims = dimension_service.encode([data], ("url_id",))[0]
+            db = next(get_db())
+            try:
+                self._write_duration(db, data, dims)
+                db.commit()
+                self._record_activity(db)
+            except Exception as e:
+                db.rollback()
+                INGEST_ERRORS.labels("duration").inc()
+                raise e
+            finally:
+                db.close()
+    
+    def _write_duration(self, db, data: dict, dims: dict):
+        site_id = data.get('site_id') or settings.DEFAULT_SITE_ID
+        session = db.query(SessionModel).filter(
+            SessionModel.site_id == site_id,
+            SessionModel.session_id == data.get('session_id')
+        ).first()
+        
+        if session:
+            local_now, utc_now = _received_at(data)
+            duration = data.get('duration') or 0.0
+            # 时长分布草图在提交后由 _record_activity 更新
+            db.info.setdefault('durations', []).append(
+                (site_id, session.start_time, session.duration, duration, dims.get('url_id'), local_now)
+            )
+            session.duration = duration
+            session.end_time = utc_now
     
-    def update_session_duration(self, session_id: str, duration: float):
+    @timed(INGEST_COMMIT_SECONDS, "batch")
+    def ingest_batch(self, records: List[dict]) -> Dict[str, int]:
+        """
+        在一个事务中写入一批追踪记录（来自 spool），记录的 type 为 pageview/event/duration。
+        数据库不可用（OperationalError）时整体回滚并抛出，由调用方稍后重试；
+        单条记录本身有问题时逐条重放并跳过坏记录，避免一条坏数据卡住整个队列。
+        """
         db = next(get_db())
         try:
-            session = db.query(SessionModel).filter(
-                SessionModel.session_id == session_id
-            ).first()
-            
-            if session:
-                session.duration = duration
-                session.end_time = datetime.utcnow()
-                db.commit()
+            dims = dimension_service.encode(records)
+            written = [self._write_record(db, record, record_dims) for record, record_dims in zip(records, dims)]
+            db.commit()
+            self._record_activity(db)
+        except OperationalError:
+            db.rollback()
+            db.close()
+            raise
         except Exception as e:
             db.rollback()
-            raise e
-        finally:
             db.close()
+            self._check_identities(e)
+            return self._ingest_one_by_one(records)
+        db.close()
+        self._after_commit(written)
+        hot_window.after_ingest()
+        return {"written": len(records), "skipped": 0}
+    
+    def _ingest_one_by_one(self, records: List[dict]) -> Dict[str, int]:
+        skipped = 0
+        for record in records:
+            db = next(get_db())
+            try:
+                result = self._write_record(db, record, dimension_service.encode([record])[0])
+                db.commit()
+                self._record_activity(db)
+            except OperationalError:
+                db.rollback()
+                raise
+            except Exception as e:
+                db.rollback()
+                self._check_identities(e)
+                INGEST_ERRORS.labels("batch").inc()
+                skipped += 1
+                continue
+            finally:
+                db.close()
+            self._after_commit([result])
+        hot_window.after_ingest()
+        return {"written": len(records) - skipped, "skipped": skipped}
+    
+    def _write_record(self, db, record: dict, dims: dict):
+        """写入一条 spool 记录，返回需要在提交后更新 Redis 的记录，被过滤时返回 None"""
+        hit_type = record.get("type")
+        if hit_type == "duration":
+            self._write_duration(db, record, dims)
+            return None
+        
+        traffic_class = traffic_filter.classify(record.get('page_url'), record.get('ip_address'), record.get('user_agent'))
+        if traffic_filter.should_drop(traffic_class):
+            return None
+        if hit_type == "pageview":
+            self._write_page_view(db, record, traffic_class, dims)
+        elif hit_type == "event":
+            self._write_event(db, record, dims)
+        else:
+            raise ValueError(f"unknown record type: {hit_type}")
+        return record
+    
+    def _after_commit(self, written):
+        for record in written:
+            if record is None:
+                continue
+            site_id = record.get('site_id') or settings.DEFAULT_SITE_ID
+            if record["type"] == "pageview":
+                self._update_realtime_stats(site_id, record.get('page_url'))
+            else:
+                self._update_event_stats(site_id, record.get('event_type'))
     
-    def get_sessions_by_days(self, days: int):
+    def get_sessions_by_days(self, days: int, site_id: str = None):
         db = next(get_db())
         try:
             start_date = datetime.utcnow() - timedelta(days=days)
             sessions = db.query(SessionModel).filter(
+                SessionModel.site_id == (site_id or settings.DEFAULT_SITE_ID),
                 SessionModel.start_time >= start_date
             ).all()
             
@@ -195,17 +422,20 @@ class TrackingService:
         finally:
             db.close()
     
-    def get_session_pageviews(self, session_id: str):
+    def get_session_pageviews(self, session_id: str, site_id: str = None):
+        decoded = dimension_service.decode(PageView.__table__)
         db = next(get_db())
         try:
-            pageviews = db.query(PageView).filter(
+            pageviews = db.execute(select(*decoded.columns).select_from(decoded.source).where(
+                PageView.site_id == (site_id or settings.DEFAULT_SITE_ID),
                 PageView.session_id == session_id
-            ).order_by(PageView.timestamp).all()
+            ).order_by(PageView.timestamp)).all()
             
             return [{
                 'id': pv.id,
                 'page_url': pv.page_url,
                 'page_title': pv.page_title,
+                'traffic_class': pv.traffic_class,
                 'created_at': pv.timestamp.timestamp() if pv.timestamp else 0
             } for pv in pageviews]
         finally:
@@ -0,0 +1,81 @@
+import ipaddress
+from typing import Iterable, Optional
+from urllib.parse import urlparse
+from config.settings import settings
+from backend.services.bot_detector import BotDetector, bot_detector
+
+# page_views.traffic_class 的取值
+TRAFFIC_NORMAL = 0
+TRAFFIC_INTERNAL = 1
+TRAFFIC_BOT = 2
+
+TRAFFIC_CLASS_NAMES = {
+    TRAFFIC_NORMAL: "normal",
+    TRAFFIC_INTERNAL: "internal",
+    TRAFFIC_BOT: "bot",
+}
+
+
+class TrafficFilter:
+    """
+    在写入时对每条访问做一次分类：内部流量（指定主机、路径前缀、IP 段）和爬虫流量
+    会被打上 traffic_class 标记，或按配置直接丢弃，统计查询只需按索引过滤 traffic_class。
+    """
+
+    def __init__(self, internal_hosts: Iterable[str] = (), internal_path_prefixes: Iterable[str] = (),
+                 internal_ip_ranges: Iterable[str] = (), bot_detector: Optional[BotDetector] = None,
+                 drop_classes: Iterable[str] = ()):
+        self.internal_hosts = {h.lower() for h in internal_hosts}
+        self.internal_path_prefixes = tuple(internal_path_prefixes)
+        self.internal_networks = [ipaddress.ip_network(r, strict=False) for r in internal_ip_ranges]
+        self.bot_detector = bot_detector
+        names = {name: value for value, name in TRAFFIC_CLASS_NAMES.items()}
+        self.drop_classes = {names[c] for c in drop_classes if c in names}
+
+    @classmethod
+    def from_settings(cls, config=settings):
+        return cls(
+            internal_hosts=config.TRAFFIC_INTERNAL_HOSTS,
+            internal_path_prefixes=config.TRAFFIC_INTERNAL_PATH_PREFIXES,
+            internal_ip_ranges=config.TRAFFIC_INTERNAL_IP_RANGES,
+            bot_detector=bot_detector,
+            drop_classes=config.TRAFFIC_DROP_CLASSES,
+        )
+
+    def _is_internal_url(self, url: str) -> bool:
+        if not url:
+            return False
+        try:
+            parsed = urlparse(url)
+        except ValueError:
+            return False
+        netloc = parsed.netloc.lower()
+        if netloc and (netloc in self.internal_hosts or (parsed.hostname or "") in self.internal_hosts):
+            return True
+        return bool(self.internal_path_prefixes) and parsed.path.startswith(self.internal_path_prefixes)
+
+    def _is_internal_ip(self, ip_address: Optional[str]) -> bool:
+        if not self.internal_networks or not ip_address:
+            return False
+        try:
+            address = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return False
+        return any(address in network for network in self.internal_networks)
+
+    def is_bot(self, user_agent: Optional[str]) -> bool:
+        return self.bot_detector is not None and self.bot_detector.is_bot_user_agent(user_agent)
+
+    def classify(self, page_url: Optional[str], ip_address: Optional[str] = None,
+                 user_agent: Optional[str] = None) -> int:
+        if self._is_internal_url(page_url) or self._is_internal_ip(ip_address):
+            return TRAFFIC_INTERNAL
+        if self.is_bot(user_agent):
+            return TRAFFIC_BOT
+        return TRAFFIC_NORMAL
+
+    def should_drop(self, traffic_class: int) -> bool:
+        return traffic_class in self.drop_classes
+
+
+traffic_filter = TrafficFilter.from_settings()
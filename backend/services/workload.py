@@ -0,0 +1,154 @@
+"""
+统计查询的负载管理
+
+统计接口原来直接在事件循环里同步查库，一次 days=30 的页面流转或大范围的 top-pages 就会同时占住事件循环和数据库，
+追踪像素只能排在后面。这里把接口分成 light/heavy 两类，每类用自己的有界线程池执行：
+    - 每类有并发上限。没有空位时不排队：最近一次的结果还在就直接返回它（带 Age/Warning 响应头），
+      没有才等待空位，超过 WORKLOAD_QUEUE_TIMEOUT_SECONDS 仍没有空位时返回 503
+    - 每次执行有语句超时（见 backend/utils/statement_guard.py），到时中断正在执行的语句，同样优先返回旧结果
+    - 写入优先：spool 积压超过 WORKLOAD_INGEST_BACKLOG 条时 heavy 类只允许一个查询在执行
+占用的空位在线程真正结束时才释放，所以并发上限约束的是数据库上的实际负载，而不只是等待中的请求。
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from starlette.responses import Response
+
+from config.settings import settings
+from backend.models import statement_guard
+from backend.services.cache_service import LocalTTLCache
+from backend.services.spool import spool
+from backend.utils.metrics import WORKLOAD_ACTIVE, WORKLOAD_REQUESTS
+from backend.utils.statement_guard import QueryBudget
+
+logger = logging.getLogger("raymond.workload")
+
+# 等待空位时的轮询间隔（秒）；只有没有旧结果可返回时才会等待
+QUEUE_POLL_SECONDS = 0.02
+
+class WorkloadRejected(Exception):
+    """没有空位或查询超时，且没有可用的旧结果；由应用转换为 503"""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class WorkloadClass:
+    def __init__(self, name: str, concurrency: int, timeout: float, yields_to_ingest: bool = False):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.yields_to_ingest = yields_to_ingest
+        self.active = 0
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix=f"workload-{name}")
+        self.gauge = WORKLOAD_ACTIVE.labels(name)
+        self.outcomes = {
+            outcome: WORKLOAD_REQUESTS.labels(name, outcome)
+            for outcome in ("ok", "stale", "timeout", "rejected", "error")
+        }
+
+class WorkloadManager:
+
+    def __init__(self, queue_timeout: float = settings.WORKLOAD_QUEUE_TIMEOUT_SECONDS,
+                 stale_max_age: int = settings.WORKLOAD_STALE_MAX_AGE_SECONDS,
+                 stale_cache_size: int = settings.WORKLOAD_STALE_CACHE_SIZE,
+                 ingest_backlog: Optional[int] = settings.WORKLOAD_INGEST_BACKLOG):
+        self.classes: Dict[str, WorkloadClass] = {
+            "light": WorkloadClass("light", settings.WORKLOAD_LIGHT_CONCURRENCY, settings.WORKLOAD_LIGHT_TIMEOUT_SECONDS),
+            "heavy": WorkloadClass("heavy", settings.WORKLOAD_HEAVY_CONCURRENCY, settings.WORKLOAD_HEAVY_TIMEOUT_SECONDS,
+                                   yields_to_ingest=True),
+        }
+        self.queue_timeout = queue_timeout
+        self.stale_max_age = stale_max_age
+        self.ingest_backlog = ingest_backlog
+        self._lock = threading.Lock()
+        self._results = LocalTTLCache(max_size=stale_cache_size)
+
+    def limit(self, workload: WorkloadClass) -> int:
+        """当前允许的并发数：写入积压时让路的类别只留一个"""
+        if workload.yields_to_ingest and self.ingest_backlog and spool.pending >= self.ingest_backlog:
+            return 1
+        return workload.concurrency
+
+    async def run(self, kind: str, fn: Callable, *args, response: Optional[Response] = None):
+        """在 kind 类别的线程池中执行 fn(*args)；超载或超时时返回旧结果并在 response 上标注"""
+        workload = self.classes[kind]
+        key = f"{fn.__module__}.{fn.__qualname__}{args!r}"
+
+        if not self._acquire(workload):
+            stale = self._stale(workload, key, response)
+            if stale is not None:
+                return stale
+            deadline = time.monotonic() + self.queue_timeout
+            while not self._acquire(workload):
+                if time.monotonic() >= deadline:
+                    workload.outcomes["rejected"].inc()
+                    raise WorkloadRejected("统计查询繁忙，请稍后重试")
+                await asyncio.sleep(QUEUE_POLL_SECONDS)
+
+        budget = QueryBudget(workload.timeout)
+        try:
+            future = workload.executor.submit(self._execute, budget, fn, args)
+        except Exception:
+            self._release(workload)
+            raise
+        future.add_done_callback(lambda _: self._release(workload))
+
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), workload.timeout)
+        except asyncio.TimeoutError:
+            # 语句之外的 Python 计算不受语句超时约束，这里中断正在执行的语句，空位等线程结束后释放
+            budget.cancel()
+            return self._timed_out(workload, key, response)
+        except Exception:
+            if budget.expired():
+                return self._timed_out(workload, key, response)
+            workload.outcomes["error"].inc()
+            raise
+
+        self._results.set(key, (time.monotonic(), result), expire=self.stale_max_age)
+        workload.outcomes["ok"].inc()
+        return result
+
+    @staticmethod
+    def _execute(budget: QueryBudget, fn: Callable, args: tuple):
+        with statement_guard.budget(budget):
+            return fn(*args)
+
+    def _acquire(self, workload: WorkloadClass) -> bool:
+        with self._lock:
+            if workload.active >= self.limit(workload):
+                return False
+            workload.active += 1
+        workload.gauge.inc()
+        return True
+
+    def _release(self, workload: WorkloadClass):
+        with self._lock:
+            workload.active -= 1
+        workload.gauge.dec()
+
+    def _stale(self, workload: WorkloadClass, key: str, response: Optional[Response]):
+        entry = self._results.get(key)
+        if entry is None:
+            return None
+        stored_at, result = entry
+        workload.outcomes["stale"].inc()
+        if response is not None:
+            response.headers["Age"] = str(int(time.monotonic() - stored_at))
+            response.headers["Warning"] = '110 - "Response is Stale"'
+        return result
+
+    def _timed_out(self, workload: WorkloadClass, key: str, response: Optional[Response]):
+        workload.outcomes["timeout"].inc()
+        logger.warning("%s 类统计查询超过 %gs：%s", workload.name, workload.timeout, key[:200])
+        stale = self._stale(workload, key, response)
+        if stale is None:
+            raise WorkloadRejected("统计查询超时，请缩小查询范围或稍后重试")
+        return stale
+
+workload_manager = WorkloadManager()
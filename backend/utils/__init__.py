@@ -1,3 +1,9 @@
-from .scheduler import scheduler, start_scheduler
+__all__ = ["scheduler", "start_scheduler", "stop_scheduler"]
 
-__all__ = ["scheduler", "start_scheduler"]
+
+def __getattr__(name):
+    # 延迟导入：scheduler 依赖 backend.api，而 api/services 又会用到 utils 下的其他模块
+    if name in __all__:
+        from . import scheduler as module
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,202 @@
+"""
+静态资源管线
+
+启动时读取并压缩追踪脚本和页面模板，按 site_id 渲染出的脚本变体保存在有界 LRU 缓存中。
+每个变体预先计算 gzip（以及安装了 brotli 时的 br）版本和强 ETag，请求时只做协商，
+不再读文件。只有开发模式下才会在请求时检查文件修改时间并热加载。
+"""
+import gzip
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+from fastapi import Request
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_LINE_COMMENT = re.compile(r"^\s*//.*$")
+
+
+def minify_js(source: str) -> str:
+    """
+    保守的 JS 压缩：去掉整行注释、行首行尾空白和空行。
+    不处理行内注释和语句内部的空白，避免误伤字符串和正则字面量。
+    """
+    lines = []
+    for line in source.splitlines():
+        if _LINE_COMMENT.match(line):
+            continue
+        line = line.strip()
+        if line:
+            lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+def parse_accept_encoding(header: str) -> Dict[str, float]:
+    """Accept-Encoding 解析为 {编码: q 值}，没有 q 参数时为 1，q 值不合法的项忽略"""
+    weights = {}
+    for part in header.split(","):
+        coding, *params = [item.strip() for item in part.split(";")]
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = -1.0
+        if 0 <= q <= 1:
+            weights[coding.lower()] = q
+    return weights
+
+
+def _coding_weight(weights: Dict[str, float], coding: str) -> float:
+    """
+    某个编码的 q 值：明确列出的取其值，否则取 "*" 的值；都没有时其余编码不接受，identity 仍可接受，
+    但排在任何明确接受的编码之后（取最小的 q 值 0.001）。请求头为空时只接受 identity
+    """
+    if coding in weights:
+        return weights[coding]
+    if "*" in weights:
+        return weights["*"]
+    return 0.001 if coding == "identity" else 0.0
+
+
+class Asset:
+    __slots__ = ("body", "gzip", "br", "etag", "media_type", "cache_control")
+
+    def __init__(self, body: bytes, media_type: str, cache_control: str):
+        self.body = body
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.etag = hashlib.sha1(body).hexdigest()[:20]
+        self.gzip = gzip.compress(body, compresslevel=9, mtime=0)
+        self.br = brotli.compress(body) if brotli is not None else None
+
+    def select(self, accept_encoding: str) -> Optional[Tuple[bytes, Optional[str], str]]:
+        """
+        按 Accept-Encoding 选择表示，返回 (内容, Content-Encoding, ETag)；q 值最高的编码中取最小的表示，
+        q=0 表示不接受。没有可接受的表示（identity 也被排除）时返回 None
+        """
+        weights = parse_accept_encoding(accept_encoding)
+        candidates = [(self.body, None, f'"{self.etag}"')]
+        if self.br is not None:
+            candidates.append((self.br, "br", f'"{self.etag}-br"'))
+        candidates.append((self.gzip, "gzip", f'"{self.etag}-gz"'))
+        best, best_key = None, None
+        for candidate in candidates:
+            q = _coding_weight(weights, candidate[1] or "identity")
+            if q <= 0:
+                continue
+            key = (q, -len(candidate[0]))
+            if best_key is None or key > best_key:
+                best, best_key = candidate, key
+        return best
+
+
+class _Source:
+    __slots__ = ("path", "media_type", "cache_control", "minify", "render", "text", "mtime")
+
+    def __init__(self, path: Path, media_type: str, cache_control: str,
+                 minify: Optional[Callable[[str], str]], render: Optional[Callable[[str, str], str]]):
+        self.path = path
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.minify = minify
+        self.render = render
+        self.text = ""
+        self.mtime = 0.0
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag == etag or tag == f"W/{etag}" for tag in candidates)
+
+
+class AssetPipeline:
+    def __init__(self, hot_reload: bool = False, variant_cache_size: int = 256):
+        self.hot_reload = hot_reload
+        self.variant_cache_size = variant_cache_size
+        self._sources: Dict[str, _Source] = {}
+        self._assets: "OrderedDict[Tuple[str, Optional[str]], Asset]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, name: str, path: Path, media_type: str, cache_control: str = "no-cache",
+                 minify: Optional[Callable[[str], str]] = None,
+                 render: Optional[Callable[[str, str], str]] = None):
+        """
+        注册一个资源并立即加载。render(text, variant) 用于生成变体（如按 site_id 改写脚本），
+        返回值会再经过 minify。
+        """
+        source = _Source(Path(path), media_type, cache_control, minify, render)
+        self._sources[name] = source
+        self._load(name, source)
+
+    def _load(self, name: str, source: _Source):
+        source.text = source.path.read_text(encoding="utf-8")
+        source.mtime = source.path.stat().st_mtime
+        with self._lock:
+            for key in [key for key in self._assets if key[0] == name]:
+                del self._assets[key]
+            self._assets[(name, None)] = self._build(source, None)
+
+    def _build(self, source: _Source, variant: Optional[str]) -> Asset:
+        text = source.text
+        if variant is not None and source.render is not None:
+            text = source.render(text, variant)
+        if source.minify is not None:
+            text = source.minify(text)
+        return Asset(text.encode("utf-8"), source.media_type, source.cache_control)
+
+    def get(self, name: str, variant: Optional[str] = None) -> Asset:
+        source = self._sources[name]
+        if self.hot_reload and source.path.stat().st_mtime != source.mtime:
+            self._load(name, source)
+        key = (name, variant if source.render is not None else None)
+        with self._lock:
+            asset = self._assets.get(key)
+            if asset is not None:
+                self._assets.move_to_end(key)
+                return asset
+        asset = self._build(source, key[1])
+        with self._lock:
+            self._assets[key] = asset
+            # 默认变体不参与淘汰，只淘汰最久未使用的 site_id 变体
+            while len(self._assets) > self.variant_cache_size + len(self._sources):
+                for old_key in self._assets:
+                    if old_key[1] is not None:
+                        del self._assets[old_key]
+                        break
+                else:
+                    break
+        return asset
+
+    def respond(self, request: Request, name: str, variant: Optional[str] = None) -> Response:
+        asset = self.get(name, variant)
+        selected = asset.select(request.headers.get("accept-encoding", ""))
+        if selected is None:
+            # 客户端连 identity 也排除了（identity;q=0 或 *;q=0），没有可以发送的表示
+            return Response(status_code=406, headers={"Vary": "Accept-Encoding"})
+        body, encoding, etag = selected
+        headers = {
+            "ETag": etag,
+            "Cache-Control": asset.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if _etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return Response(content=body, media_type=asset.media_type, headers=headers)
@@ -0,0 +1,308 @@
+"""
+离线 GeoIP 查询
+
+IP 段数据库是一个只读的紧凑文件，运行时整体 mmap，按起始地址有序的数组直接在映射内存上二分查找：
+不解析、不复制，多个 worker 进程共享同一份页缓存。查询结果按 IPv4 /24（IPv6 /48）前缀缓存。
+
+文件格式（小端）：
+    头部   8 字节魔数 + IPv4 段数 + IPv6 段数 + 位置数 + 字符串区字节数（各 uint32）
+    IPv6   起始、结束地址的高 64 位（uint64 数组），IPv6 按 /64 粒度存储
+    IPv4   起始、结束地址（uint32 数组）
+    位置   每个 IPv4/IPv6 段对应的位置编号（uint32），位置字符串的偏移表（uint32，位置数 + 1 个）
+    字符串 UTF-8 的 "国家\\x1f城市"
+
+用法:
+    python -m backend.utils.geoip build ranges.csv -o data/geoip.radb            # start,end,country,city
+    python -m backend.utils.geoip build dbip-city-lite.csv -o data/geoip.radb --dbip-city
+    python -m backend.utils.geoip lookup 8.8.8.8 --db data/geoip.radb
+"""
+import argparse
+import bisect
+import csv
+import gzip
+import ipaddress
+import logging
+import mmap
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+from array import array
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+MAGIC = b"RAGEOIP1"
+HEADER = struct.Struct("<8sIIII")
+SEPARATOR = "\x1f"
+
+logger = logging.getLogger("raymond.geoip")
+
+Location = Tuple[str, Optional[str]]
+
+
+class GeoIPError(Exception):
+    pass
+
+
+class GeoIPDatabase:
+    """只读的 mmap IP 段数据库，lookup 接受打包后的地址（inet_pton 的结果）"""
+
+    def __init__(self, path: str):
+        if sys.byteorder != "little":
+            raise GeoIPError("GeoIP 数据库按小端存储，当前平台不支持直接映射")
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._map()
+        except Exception:
+            self._mmap.close()
+            raise
+
+    def _map(self):
+        if len(self._mmap) < HEADER.size:
+            raise GeoIPError(f"{self.path} 不是 GeoIP 数据库")
+        magic, v4, v6, locations, blob = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise GeoIPError(f"{self.path} 不是 GeoIP 数据库")
+        expected = HEADER.size + v6 * 16 + v4 * 8 + (v4 + v6) * 4 + (locations + 1) * 4 + blob
+        if len(self._mmap) != expected:
+            raise GeoIPError(f"{self.path} 大小不符（{len(self._mmap)} != {expected}），文件可能不完整")
+
+        view = memoryview(self._mmap)
+        offset = HEADER.size
+
+        def section(count, fmt):
+            nonlocal offset
+            size = count * struct.calcsize(fmt)
+            part = view[offset:offset + size].cast(fmt)
+            offset += size
+            return part
+
+        self._v6_starts = section(v6, "Q")
+        self._v6_ends = section(v6, "Q")
+        self._v4_starts = section(v4, "I")
+        self._v4_ends = section(v4, "I")
+        self._v4_locations = section(v4, "I")
+        self._v6_locations = section(v6, "I")
+        self._offsets = section(locations + 1, "I")
+        self._blob = view[offset:offset + blob]
+        self._views = [self._v6_starts, self._v6_ends, self._v4_starts, self._v4_ends,
+                       self._v4_locations, self._v6_locations, self._offsets, self._blob, view]
+        self.counts = {"ipv4": v4, "ipv6": v6, "locations": locations}
+        self._decoded: Dict[int, Location] = {}
+
+    def lookup(self, packed: bytes) -> Optional[Location]:
+        if len(packed) == 4:
+            ip = int.from_bytes(packed, "big")
+            starts, ends, locations = self._v4_starts, self._v4_ends, self._v4_locations
+        else:
+            ip = int.from_bytes(packed[:8], "big")
+            starts, ends, locations = self._v6_starts, self._v6_ends, self._v6_locations
+        i = bisect.bisect_right(starts, ip) - 1
+        if i < 0 or ip > ends[i]:
+            return None
+        return self._location(locations[i])
+
+    def _location(self, index: int) -> Location:
+        location = self._decoded.get(index)
+        if location is None:
+            raw = bytes(self._blob[self._offsets[index]:self._offsets[index + 1]]).decode("utf-8")
+            country, _, city = raw.partition(SEPARATOR)
+            location = self._decoded[index] = (country, city or None)
+        return location
+
+    def close(self):
+        # 先释放 cast 出来的子视图，最后是整个映射的视图
+        for view in self._views:
+            view.release()
+        self._mmap.close()
+
+
+def pack_ip(ip: Optional[str]) -> Optional[bytes]:
+    """把地址字符串转成 4/16 字节，IPv4 映射的 IPv6 地址按 IPv4 处理，无法解析时返回 None"""
+    if not ip:
+        return None
+    try:
+        return socket.inet_pton(socket.AF_INET, ip)
+    except OSError:
+        pass
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, ip)
+    except OSError:
+        return None
+    if packed[:12] == b"\x00" * 10 + b"\xff\xff":
+        return packed[12:]
+    return packed
+
+
+class GeoIPResolver:
+    """
+    进程内的查询入口：首次查询时打开数据库，之后每隔 check_interval 秒检查文件是否被替换；
+    文件不存在时所有查询返回 None。结果按 IPv4 /24、IPv6 /48 前缀缓存。
+    """
+
+    def __init__(self, path: str, cache_size: int = 65536, check_interval: float = 60.0):
+        self.path = path
+        self.cache_size = cache_size
+        self.check_interval = check_interval
+        self._db: Optional[GeoIPDatabase] = None
+        self._mtime = None
+        self._checked_at = None
+        self._cache: Dict[bytes, Optional[Location]] = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, ip: Optional[str]) -> Optional[Location]:
+        packed = pack_ip(ip)
+        if packed is None:
+            return None
+        prefix = packed[:3] if len(packed) == 4 else packed[:6]
+        cache = self._cache
+        if prefix in cache:
+            return cache[prefix]
+
+        db = self._database()
+        location = db.lookup(packed) if db is not None else None
+        if len(cache) >= self.cache_size:
+            cache.clear()
+        cache[prefix] = location
+        return location
+
+    def _database(self) -> Optional[GeoIPDatabase]:
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return self._db
+        with self._lock:
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime != self._mtime:
+                self._mtime = mtime
+                # 旧的映射不主动关闭，可能还有线程在上面查找；没有引用后随对象回收
+                self._db = self._open() if mtime is not None else None
+                self._cache = {}
+        return self._db
+
+    def _open(self) -> Optional[GeoIPDatabase]:
+        try:
+            return GeoIPDatabase(self.path)
+        except (GeoIPError, OSError, ValueError) as e:
+            # 数据库损坏不能影响写入，跳过地理信息
+            logger.error("无法打开 GeoIP 数据库 %s：%s", self.path, e)
+            return None
+
+
+def _parse_rows(path: str, dbip_city: bool):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", newline="") as f:
+        for row in csv.reader(f):
+            if not row or row[0].startswith("#"):
+                continue
+            try:
+                if dbip_city:
+                    # DB-IP city lite：ip_start,ip_end,continent,country,stateprov,city,...
+                    start, end = ipaddress.ip_address(row[0]), ipaddress.ip_address(row[1])
+                    country, city = row[3], row[5]
+                elif "/" in row[0]:
+                    network = ipaddress.ip_network(row[0], strict=False)
+                    start, end = network.network_address, network.broadcast_address
+                    country, city = row[1], row[2] if len(row) > 2 else ""
+                else:
+                    start, end = ipaddress.ip_address(row[0]), ipaddress.ip_address(row[1])
+                    country, city = row[2], row[3] if len(row) > 3 else ""
+            except (ValueError, IndexError):
+                # 表头或格式不对的行
+                continue
+            if start.version != end.version or not country:
+                continue
+            yield start, end, country.strip(), city.strip()
+
+
+def _compact(ranges: List[Tuple[int, int, int]]) -> List[Tuple[int, int, int]]:
+    """按起始地址排序，丢弃与前一段重叠的段，合并相邻且位置相同的段"""
+    ranges.sort()
+    result = []
+    for start, end, location in ranges:
+        if result:
+            last_start, last_end, last_location = result[-1]
+            if start <= last_end:
+                continue
+            if start == last_end + 1 and location == last_location:
+                result[-1] = (last_start, end, location)
+                continue
+        result.append((start, end, location))
+    return result
+
+
+def build(sources: List[str], output: str, dbip_city: bool = False) -> Dict[str, int]:
+    locations: Dict[Location, int] = {}
+    v4, v6 = [], []
+    for source in sources:
+        for start, end, country, city in _parse_rows(source, dbip_city):
+            location = locations.setdefault((country, city), len(locations))
+            if start.version == 4:
+                v4.append((int(start), int(end), location))
+            else:
+                v6.append((int(start) >> 64, int(end) >> 64, location))
+    v4, v6 = _compact(v4), _compact(v6)
+
+    blob = bytearray()
+    offsets = array("I", [0])
+    for country, city in locations:
+        blob += f"{country}{SEPARATOR}{city}".encode("utf-8")
+        offsets.append(len(blob))
+
+    tmp = output + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(v4), len(v6), len(locations), len(blob)))
+        f.write(array("Q", [r[0] for r in v6]).tobytes())
+        f.write(array("Q", [r[1] for r in v6]).tobytes())
+        f.write(array("I", [r[0] for r in v4]).tobytes())
+        f.write(array("I", [r[1] for r in v4]).tobytes())
+        f.write(array("I", [r[2] for r in v4]).tobytes())
+        f.write(array("I", [r[2] for r in v6]).tobytes())
+        f.write(offsets.tobytes())
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    # 原子替换，运行中的进程在下次检查时切换到新文件
+    os.replace(tmp, output)
+    return {"ipv4": len(v4), "ipv6": len(v6), "locations": len(locations)}
+
+
+def main(argv=None):
+    sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+    from config.settings import settings
+
+    parser = argparse.ArgumentParser(description="GeoIP 数据库")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build_parser = sub.add_parser("build", help="从 CSV 生成 mmap 格式的数据库")
+    build_parser.add_argument("sources", nargs="+", help="CSV 文件（可为 .gz）：start,end,country,city 或 cidr,country,city")
+    build_parser.add_argument("-o", "--output", default=settings.GEOIP_DB_PATH, help="输出文件")
+    build_parser.add_argument("--dbip-city", action="store_true", help="输入为 DB-IP city lite CSV")
+    lookup_parser = sub.add_parser("lookup", help="查询地址")
+    lookup_parser.add_argument("ips", nargs="+")
+    lookup_parser.add_argument("--db", default=settings.GEOIP_DB_PATH, help="数据库文件")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        started = time.perf_counter()
+        counts = build(args.sources, args.output, args.dbip_city)
+        print(f"已写入 {args.output}：IPv4 {counts['ipv4']} 段，IPv6 {counts['ipv6']} 段，"
+              f"{counts['locations']} 个位置，用时 {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    else:
+        db = GeoIPDatabase(args.db)
+        try:
+            for ip in args.ips:
+                packed = pack_ip(ip)
+                print(ip, db.lookup(packed) if packed else "无效地址")
+        finally:
+            db.close()
+
+
+if __name__ == "__main__":
+    main()
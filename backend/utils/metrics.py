@@ -0,0 +1,269 @@
+"""
+轻量级 Prometheus 风格指标
+
+只依赖标准库。计数器/直方图的更新是普通的属性加法，在 GIL 下足够准确，
+不加锁以保证追踪像素这类热点路径上的开销可以忽略。
+"""
+import asyncio
+import functools
+import time
+from bisect import bisect_left
+from typing import Dict, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs.extend(f'{n}="{_escape(v)}"' for n, v in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ("child", "started")
+
+    def __init__(self, child: _HistogramChild):
+        self.child = child
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.started)
+        return False
+
+
+class Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if not self.labelnames:
+            self._default = self._new_child()
+            self._children[()] = self._default
+        (registry or REGISTRY).register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} 需要标签 {self.labelnames}")
+            child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for key, child in list(self._children.items()):
+            lines.extend(self._collect_child(key, child))
+        return lines
+
+    def _collect_child(self, key, child) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}"]
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self._default.inc(amount)
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self._default.set(value)
+
+    def inc(self, amount: float = 1.0):
+        self._default.inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self._default.dec(amount)
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+    def _collect_child(self, key, child) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, (("le", _format_value(bound)),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"指标 {metric.name} 已注册")
+        self._metrics[metric.name] = metric
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def timed(histogram: Histogram, label: Optional[str] = None):
+    """以函数名（或给定标签）为标签，记录同步/异步函数的执行耗时"""
+    def decorator(fn):
+        child = histogram.labels(label or fn.__name__)
+
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    child.observe(time.perf_counter() - started)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+# ---- 应用指标 ----
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "ra_http_request_duration_seconds", "HTTP 请求耗时（按路由）", ["method", "route", "status"]
+)
+STATS_QUERY_SECONDS = Histogram(
+    "ra_stats_query_duration_seconds", "StatsService 方法的数据库查询耗时", ["method"]
+)
+INGEST_HITS = Counter("ra_ingest_hits_total", "接收到的追踪请求数", ["type"])
+INGEST_ERRORS = Counter("ra_ingest_errors_total", "写入失败的追踪请求数", ["type"])
+INGEST_COMMIT_SECONDS = Histogram(
+    "ra_ingest_commit_duration_seconds", "追踪数据写库（含提交）耗时", ["type"]
+)
+INGEST_QUEUE_DEPTH = Gauge("ra_ingest_queue_depth", "已接收但尚未写入数据库的追踪请求数")
+SPOOL_RECORDS = Counter("ra_spool_records_total", "spool 记录数", ["op"])
+SPOOL_BACKLOG_BYTES = Gauge("ra_spool_backlog_bytes", "spool 中尚未写入数据库的字节数")
+CACHE_REQUESTS = Counter("ra_cache_requests_total", "Redis 缓存读取次数", ["result"])
+CACHE_ERRORS = Counter("ra_cache_errors_total", "Redis 操作失败次数", ["op"])
+WORKLOAD_REQUESTS = Counter(
+    "ra_workload_requests_total", "统计查询的准入结果（ok/stale/timeout/rejected/error）", ["class", "outcome"]
+)
+WORKLOAD_ACTIVE = Gauge("ra_workload_active_queries", "正在执行的统计查询数", ["class"])
+WEBSOCKET_CONNECTIONS = Gauge("ra_websocket_connections", "当前 WebSocket 连接数")
+WEBSOCKET_SEND_SECONDS = Histogram("ra_websocket_send_duration_seconds", "WebSocket 单次发送耗时")
+SCHEDULER_JOB_SECONDS = Histogram(
+    "ra_scheduler_job_duration_seconds", "定时任务执行耗时", ["job"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+)
+SCHEDULER_JOB_LAG_SECONDS = Histogram(
+    "ra_scheduler_job_lag_seconds", "定时任务从计划时间到提交执行的延迟", ["job"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0)
+)
+SCHEDULER_JOB_SKIPPED = Counter(
+    "ra_scheduler_job_skipped_total", "跳过的定时任务执行次数（overlap/coalesced/missed）", ["job", "reason"]
+)
+SCHEDULER_JOB_ERRORS = Counter("ra_scheduler_job_errors_total", "执行失败的定时任务次数", ["job"])
@@ -1,96 +1,194 @@
+"""
+定时任务
+
+查库的任务是普通函数，在 SCHEDULER_WORKERS 个线程的 "db" 执行器中运行，不再阻塞事件循环；
+只有 WebSocket 推送在事件循环上运行，统计本身交给负载管理的线程池。每个任务同一时间只运行一个实例，
+上一次还没结束时到期的执行直接跳过，积压的多次执行合并为一次，触发时间带随机偏移，避免所有任务挤在同一刻。
+执行耗时、计划时间到提交的延迟、跳过次数和失败次数记录在 ra_scheduler_* 指标中。
+"""
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
+from apscheduler.executors.asyncio import AsyncIOExecutor
+from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from backend.api import broadcast_realtime_stats
-from backend.services.cache_service import redis_service
-from backend.models import get_db, Session as SessionModel, PageView
+from backend.services.cache_service import redis_service, site_key
+from backend.services.stats_service import stats_service
+from backend.services.retention_service import retention_service
+from backend.services.geo_service import geo_service
+from backend.services.duration_service import duration_service
+from backend.services.path_service import path_service
+from backend.services.identity_cache import identity_cache
+from config.settings import settings
+from backend.models import get_db, shards, Session as SessionModel, PageView
+from backend.services.shard_merge import weighted_average
 from sqlalchemy import func, and_
-import json
+from backend.utils.metrics import (
+    timed, SCHEDULER_JOB_SECONDS, SCHEDULER_JOB_LAG_SECONDS, SCHEDULER_JOB_SKIPPED, SCHEDULER_JOB_ERRORS
+)
 
-scheduler = AsyncIOScheduler()
+scheduler = AsyncIOScheduler(
+    executors={
+        "default": AsyncIOExecutor(),
+        "db": ThreadPoolExecutor(settings.SCHEDULER_WORKERS),
+    },
+    job_defaults={
+        "max_instances": 1,
+        "coalesce": True,
+        "misfire_grace_time": settings.SCHEDULER_MISFIRE_GRACE_SECONDS,
+    },
+)
 
-async def update_online_users():
-    if not redis_service.is_available():
-        return
-    
+def _per_site(rows_by_shard):
+    """各分片按站点的计数相加（会话只在一个分片中）"""
+    totals = {}
+    for rows in rows_by_shard:
+        for site_id, count in rows:
+            totals[site_id] = totals.get(site_id, 0) + count
+    return totals
+
+def _online_users():
     db = next(get_db())
     try:
         five_minutes_ago = datetime.utcnow() - timedelta(minutes=5)
-        active_sessions = db.query(func.count(func.distinct(SessionModel.session_id))).filter(
+        return db.query(
+            SessionModel.site_id,
+            func.count(func.distinct(SessionModel.session_id))
+        ).filter(
             SessionModel.start_time >= five_minutes_ago
-        ).scalar()
-        
-        redis_service.set("stats:online_users", active_sessions, expire=300)
+        ).group_by(SessionModel.site_id).all()
     finally:
         db.close()
 
-async def update_daily_unique_visitors():
+@timed(SCHEDULER_JOB_SECONDS)
+def update_online_users():
     if not redis_service.is_available():
         return
     
+    for site_id, count in _per_site(shards.each(_online_users)).items():
+        redis_service.set(site_key(site_id, "stats:online_users"), count, expire=300)
+
+def _unique_visitors():
     db = next(get_db())
     try:
         today = datetime.utcnow().date()
         tomorrow = today + timedelta(days=1)
         
-        unique_visitors = db.query(func.count(func.distinct(PageView.session_id))).filter(
+        return db.query(
+            PageView.site_id,
+            func.count(func.distinct(PageView.session_id))
+        ).filter(
             and_(
                 PageView.timestamp >= datetime.combine(today, datetime.min.time()),
                 PageView.timestamp < datetime.combine(tomorrow, datetime.min.time())
             )
-        ).scalar()
-        
-        redis_service.set("stats:unique_visitors_today", unique_visitors, expire=86400)
+        ).group_by(PageView.site_id).all()
     finally:
         db.close()
 
-async def calculate_avg_duration():
+@timed(SCHEDULER_JOB_SECONDS)
+def update_daily_unique_visitors():
     if not redis_service.is_available():
         return
     
+    for site_id, count in _per_site(shards.each(_unique_visitors)).items():
+        redis_service.set(site_key(site_id, "stats:unique_visitors_today"), count, expire=86400)
+
+def _avg_durations():
     db = next(get_db())
     try:
         today = datetime.utcnow().date()
-        tomorrow = today + timedelta(days=1)
         
-        avg_duration = db.query(func.avg(SessionModel.duration)).filter(
+        return db.query(
+            SessionModel.site_id,
+            func.avg(SessionModel.duration),
+            func.count(SessionModel.duration)
+        ).filter(
             SessionModel.start_time >= datetime.combine(today, datetime.min.time())
-        ).scalar()
-        
-        redis_service.set("stats:avg_duration_today", avg_duration or 0, expire=86400)
+        ).group_by(SessionModel.site_id).all()
     finally:
         db.close()
 
+@timed(SCHEDULER_JOB_SECONDS)
+def calculate_avg_duration():
+    if not redis_service.is_available():
+        return
+    
+    averages = {}
+    for rows in shards.each(_avg_durations):
+        for site_id, avg_duration, count in rows:
+            averages.setdefault(site_id, []).append((avg_duration, count))
+    for site_id, pairs in averages.items():
+        redis_service.set(site_key(site_id, "stats:avg_duration_today"), weighted_average(pairs), expire=86400)
+
+@timed(SCHEDULER_JOB_SECONDS)
+def rollup_site_stats():
+    stats_service.rollup_site_stats()
+    geo_service.rollup()
+
+@timed(SCHEDULER_JOB_SECONDS)
+def rollup_paths():
+    path_service.rollup()
+
+@timed(SCHEDULER_JOB_SECONDS)
+def flush_retention_bitmaps():
+    retention_service.flush()
+
+@timed(SCHEDULER_JOB_SECONDS)
+def flush_duration_sketches():
+    duration_service.flush()
+
+@timed(SCHEDULER_JOB_SECONDS)
+def flush_identity_counters():
+    identity_cache.flush()
+
+@timed(SCHEDULER_JOB_SECONDS)
 async def broadcast_stats_update():
     await broadcast_realtime_stats()
 
-def start_scheduler():
-    scheduler.add_job(
-        update_online_users,
-        trigger=IntervalTrigger(minutes=1),
-        id='update_online_users',
-        replace_existing=True
-    )
-    
-    scheduler.add_job(
-        update_daily_unique_visitors,
-        trigger=IntervalTrigger(minutes=5),
-        id='update_daily_unique_visitors',
-        replace_existing=True
-    )
-    
-    scheduler.add_job(
-        calculate_avg_duration,
-        trigger=IntervalTrigger(minutes=10),
-        id='calculate_avg_duration',
-        replace_existing=True
-    )
-    
+def _on_submitted(event):
+    now = datetime.now(timezone.utc)
+    SCHEDULER_JOB_LAG_SECONDS.labels(event.job_id).observe(max(0.0, (now - event.scheduled_run_times[-1]).total_seconds()))
+    if len(event.scheduled_run_times) > 1:
+        SCHEDULER_JOB_SKIPPED.labels(event.job_id, "coalesced").inc(len(event.scheduled_run_times) - 1)
+
+def _on_max_instances(event):
+    SCHEDULER_JOB_SKIPPED.labels(event.job_id, "overlap").inc(len(event.scheduled_run_times))
+
+def _on_missed(event):
+    SCHEDULER_JOB_SKIPPED.labels(event.job_id, "missed").inc()
+
+def _on_error(event):
+    SCHEDULER_JOB_ERRORS.labels(event.job_id).inc()
+
+def _add_job(func, seconds: float, executor: str = "db"):
     scheduler.add_job(
-        broadcast_stats_update,
-        trigger=IntervalTrigger(seconds=5),
-        id='broadcast_stats_update',
+        func,
+        trigger=IntervalTrigger(seconds=seconds, jitter=seconds * settings.SCHEDULER_JITTER_RATIO or None),
+        id=func.__name__,
+        executor=executor,
         replace_existing=True
     )
+
+def start_scheduler():
+    _add_job(update_online_users, 60)
+    _add_job(update_daily_unique_visitors, 5 * 60)
+    _add_job(calculate_avg_duration, 10 * 60)
+    _add_job(rollup_site_stats, 10 * 60)
+    _add_job(rollup_paths, settings.PATH_ROLLUP_INTERVAL_SECONDS)
+    _add_job(flush_retention_bitmaps, settings.RETENTION_FLUSH_INTERVAL_SECONDS)
+    _add_job(flush_duration_sketches, settings.DURATION_FLUSH_INTERVAL_SECONDS)
+    _add_job(flush_identity_counters, settings.IDENTITY_FLUSH_INTERVAL_SECONDS)
+    _add_job(broadcast_stats_update, 5, executor="default")
     
+    scheduler.add_listener(_on_submitted, EVENT_JOB_SUBMITTED)
+    scheduler.add_listener(_on_max_instances, EVENT_JOB_MAX_INSTANCES)
+    scheduler.add_listener(_on_missed, EVENT_JOB_MISSED)
+    scheduler.add_listener(_on_error, EVENT_JOB_ERROR)
     scheduler.start()
+
+def stop_scheduler():
+    """停止触发新的执行，并等待正在运行的任务结束"""
+    if scheduler.running:
+        scheduler.shutdown(wait=True)
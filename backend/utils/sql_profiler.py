@@ -0,0 +1,221 @@
+"""
+SQL 性能分析
+
+挂在 SQLAlchemy 引擎的 before_cursor_execute/after_cursor_execute 事件上，记录每条语句的耗时、
+归一化指纹、行数（取驱动报告的 rowcount，SQLite 的 SELECT 不提供）和调用它的服务方法；保留最慢查询的排行和慢查询环形日志，
+并可以对超过阈值的查询按需采集 EXPLAIN。
+"""
+import hashlib
+import heapq
+import itertools
+import logging
+import re
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import event
+
+logger = logging.getLogger("raymond.sql")
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\bIN\s*\((?:\s*[?%][^,)]*,?)+\)", re.IGNORECASE)
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|:\w+|\$\d+|%s")
+_WHITESPACE = re.compile(r"\s+")
+
+# 调用方定位时只认这些目录下的代码
+_CALLER_MARKERS = ("/backend/services/", "/backend/api/", "/backend/utils/scheduler")
+
+
+def fingerprint(statement: str) -> str:
+    """把语句中的字面量、占位符和 IN 列表统一替换，得到可用于聚合的指纹"""
+    sql = _STRING_LITERAL.sub("?", statement)
+    sql = _PLACEHOLDER.sub("?", sql)
+    sql = _NUMBER_LITERAL.sub("?", sql)
+    sql = _IN_LIST.sub("IN (...)", sql)
+    return _WHITESPACE.sub(" ", sql).strip()
+
+
+def _fingerprint_id(sql: str) -> str:
+    return hashlib.md5(sql.encode("utf-8")).hexdigest()[:12]
+
+
+def _find_caller() -> Optional[str]:
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename.replace("\\", "/")
+        if any(marker in filename for marker in _CALLER_MARKERS) and "sql_profiler" not in filename:
+            name = getattr(frame.f_code, "co_qualname", None)
+            if name is None:
+                owner = frame.f_locals.get("self")
+                name = f"{type(owner).__name__}.{frame.f_code.co_name}" if owner is not None else frame.f_code.co_name
+            return name
+        frame = frame.f_back
+    return None
+
+
+def _is_scan(plan: List[str]) -> bool:
+    return any(line.lstrip().upper().startswith(("SCAN", "SEQ SCAN")) or "Seq Scan" in line for line in plan)
+
+
+class QueryStats:
+    __slots__ = ("fingerprint", "sql", "calls", "total_time", "max_time", "rows", "callers", "plan")
+
+    def __init__(self, fingerprint_id: str, sql: str):
+        self.fingerprint = fingerprint_id
+        self.sql = sql
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rows: Optional[int] = None
+        self.callers: Dict[str, int] = {}
+        self.plan: Optional[List[str]] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "fingerprint": self.fingerprint,
+            "sql": self.sql,
+            "calls": self.calls,
+            "total_ms": round(self.total_time * 1000, 3),
+            "avg_ms": round(self.total_time * 1000 / self.calls, 3) if self.calls else 0,
+            "max_ms": round(self.max_time * 1000, 3),
+            "rows": self.rows,
+            "callers": self.callers,
+            "plan": self.plan,
+            "full_scan": _is_scan(self.plan) if self.plan else None,
+        }
+
+
+class SQLProfiler:
+    def __init__(self, enabled: bool = False, slow_threshold_ms: float = 100.0, top_n: int = 50,
+                 slow_log_size: int = 200, explain_threshold_ms: Optional[float] = None):
+        self.enabled = enabled
+        self.slow_threshold = slow_threshold_ms / 1000
+        self.top_n = top_n
+        self.explain_threshold = explain_threshold_ms / 1000 if explain_threshold_ms is not None else None
+        self._lock = threading.Lock()
+        self._stats: Dict[str, QueryStats] = {}
+        self._slowest: List[tuple] = []
+        self._slow_log = deque(maxlen=slow_log_size)
+        self._seq = itertools.count()
+        self._fingerprints: Dict[str, tuple] = {}
+        self._engines = []
+
+    def install(self, engine):
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+        self._engines.append(engine)
+
+    def configure(self, enabled: Optional[bool] = None, slow_threshold_ms: Optional[float] = None,
+                  explain_threshold_ms: Optional[float] = None, disable_explain: bool = False):
+        if enabled is not None:
+            self.enabled = enabled
+        if slow_threshold_ms is not None:
+            self.slow_threshold = slow_threshold_ms / 1000
+        if disable_explain:
+            self.explain_threshold = None
+        elif explain_threshold_ms is not None:
+            self.explain_threshold = explain_threshold_ms / 1000
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._slowest.clear()
+            self._slow_log.clear()
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        if self.enabled:
+            conn.info["ra_query_start"] = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop("ra_query_start", None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+
+        cached = self._fingerprints.get(statement)
+        if cached is None:
+            sql = fingerprint(statement)
+            cached = (_fingerprint_id(sql), sql)
+            if len(self._fingerprints) < 10000:
+                self._fingerprints[statement] = cached
+        fp_id, sql = cached
+
+        rowcount = cursor.rowcount if cursor.rowcount is not None and cursor.rowcount >= 0 else None
+        caller = _find_caller()
+
+        with self._lock:
+            stats = self._stats.get(fp_id)
+            if stats is None:
+                stats = self._stats[fp_id] = QueryStats(fp_id, sql)
+            stats.calls += 1
+            stats.total_time += elapsed
+            stats.max_time = max(stats.max_time, elapsed)
+            if rowcount is not None:
+                stats.rows = (stats.rows or 0) + rowcount
+            if caller:
+                stats.callers[caller] = stats.callers.get(caller, 0) + 1
+
+            entry = {
+                "fingerprint": fp_id,
+                "statement": statement,
+                "parameters": repr(parameters)[:500],
+                "duration_ms": round(elapsed * 1000, 3),
+                "rows": rowcount,
+                "caller": caller,
+                "at": datetime.utcnow().isoformat(),
+            }
+            item = (elapsed, next(self._seq), entry)
+            if len(self._slowest) < self.top_n:
+                heapq.heappush(self._slowest, item)
+            elif elapsed > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, item)
+            needs_plan = (
+                self.explain_threshold is not None
+                and elapsed >= self.explain_threshold
+                and stats.plan is None
+                and not executemany
+            )
+
+        if elapsed >= self.slow_threshold:
+            self._slow_log.append(entry)
+            logger.warning("slow query %.1fms [%s] %s", elapsed * 1000, caller or "-", sql)
+
+        if needs_plan and statement.lstrip().upper().startswith("SELECT"):
+            stats.plan = self._explain(conn, statement, parameters)
+            entry["plan"] = stats.plan
+
+    def _explain(self, conn, statement, parameters) -> List[str]:
+        prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+        # 直接使用 DBAPI 游标，不会再次触发本分析器的事件
+        cursor = conn.connection.cursor()
+        try:
+            cursor.execute(prefix + statement, parameters)
+            return [str(row[-1]) for row in cursor.fetchall()]
+        except Exception as e:
+            return [f"EXPLAIN failed: {e}"]
+        finally:
+            cursor.close()
+
+    def snapshot(self, limit: int = 20, order_by: str = "total") -> Dict[str, Any]:
+        key = {
+            "total": lambda s: s.total_time,
+            "max": lambda s: s.max_time,
+            "calls": lambda s: s.calls,
+            "avg": lambda s: s.total_time / s.calls if s.calls else 0,
+        }.get(order_by, lambda s: s.total_time)
+        with self._lock:
+            fingerprints = sorted(self._stats.values(), key=key, reverse=True)[:limit]
+            slowest = sorted(self._slowest, key=lambda item: item[0], reverse=True)[:limit]
+            return {
+                "enabled": self.enabled,
+                "slow_threshold_ms": self.slow_threshold * 1000,
+                "explain_threshold_ms": self.explain_threshold * 1000 if self.explain_threshold is not None else None,
+                "fingerprints": [s.to_dict() for s in fingerprints],
+                "slowest": [entry for _, _, entry in slowest],
+                "slow_log": list(self._slow_log)[-limit:],
+            }
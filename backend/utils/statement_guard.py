@@ -0,0 +1,112 @@
+"""
+统计查询的语句超时与取消
+
+在 StatementGuard.budget() 的上下文中执行的语句带有截止时间：
+    - SQLite：连接上装一个 progress_handler，每执行若干条虚拟机指令检查一次，超时或被取消时中断当前语句；
+      连接归还连接池时卸下，不影响之后借到这个连接的写入
+    - PostgreSQL：每条语句前执行 SET LOCAL statement_timeout（剩余时间），只在当前事务内有效
+QueryBudget.cancel() 还会直接中断正在执行的语句（sqlite3 的 interrupt、psycopg2 的 cancel）。
+上下文之外的语句（追踪写入、定时任务）不受影响。
+"""
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event
+
+_current: ContextVar[Optional["QueryBudget"]] = ContextVar("ra_query_budget", default=None)
+
+_BUDGET_KEY = "ra_query_budget"
+
+
+class QueryTimeout(Exception):
+    """语句在截止时间之后才开始执行"""
+
+
+class QueryBudget:
+    __slots__ = ("deadline", "cancelled", "_connections", "_lock")
+
+    def __init__(self, timeout: float):
+        self.deadline = time.monotonic() + timeout
+        self.cancelled = False
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def remaining(self) -> float:
+        return self.deadline - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.cancelled or time.monotonic() >= self.deadline
+
+    def cancel(self):
+        """标记为已取消，并中断所有正在使用的连接上的语句"""
+        self.cancelled = True
+        with self._lock:
+            connections = list(self._connections.values())
+        for dialect_name, driver_connection in connections:
+            try:
+                if dialect_name == "sqlite":
+                    driver_connection.interrupt()
+                elif dialect_name == "postgresql":
+                    driver_connection.cancel()
+            except Exception:
+                pass
+
+    def _attach(self, dialect_name: str, driver_connection):
+        with self._lock:
+            self._connections[id(driver_connection)] = (dialect_name, driver_connection)
+
+    def _detach(self, driver_connection):
+        with self._lock:
+            self._connections.pop(id(driver_connection), None)
+
+
+class StatementGuard:
+    def __init__(self, progress_steps: int = 10000):
+        self.progress_steps = progress_steps
+
+    def install(self, engine):
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "checkin", self._checkin)
+
+    @contextmanager
+    def budget(self, budget: QueryBudget):
+        """上下文中执行的语句受 budget 的截止时间约束，其他线程可以通过 budget.cancel() 中断它们"""
+        token = _current.set(budget)
+        try:
+            yield budget
+        finally:
+            _current.reset(token)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        budget = _current.get()
+        if budget is None:
+            return
+        if budget.expired():
+            raise QueryTimeout("查询超时或已取消")
+        dialect_name = conn.dialect.name
+        record_info = conn.connection.info
+        driver_connection = conn.connection.driver_connection
+        if dialect_name == "sqlite":
+            # 结果在 fetch 时才逐行计算，处理函数要一直保留到连接归还
+            if record_info.get(_BUDGET_KEY) is not budget:
+                driver_connection.set_progress_handler(lambda: 1 if budget.expired() else 0, self.progress_steps)
+        elif dialect_name == "postgresql":
+            # 用另一个普通游标执行：流式读取时 cursor 是服务端游标，只能执行查询
+            setter = driver_connection.cursor()
+            try:
+                setter.execute(f"SET LOCAL statement_timeout = {max(1, int(budget.remaining() * 1000))}")
+            finally:
+                setter.close()
+        record_info[_BUDGET_KEY] = budget
+        budget._attach(dialect_name, driver_connection)
+
+    def _checkin(self, dbapi_connection, connection_record):
+        budget = connection_record.info.pop(_BUDGET_KEY, None)
+        if budget is None or dbapi_connection is None:
+            return
+        budget._detach(dbapi_connection)
+        if hasattr(dbapi_connection, "set_progress_handler"):
+            dbapi_connection.set_progress_handler(None, 0)
@@ -0,0 +1,112 @@
+"""
+分片写入吞吐量的基准测试
+
+把同一批与 spool 中相同格式的追踪记录分别写入单个 SQLite 文件和 N 个分片，比较每秒写入的记录数。
+分片数和路径在导入配置时确定，所以每种配置在单独的子进程中运行，数据库放在临时目录下。
+单库按 SPOOL_BATCH_SIZE 一批调用 TrackingService.ingest_batch，分片模式与 spool 消费者相同，
+每批 SPOOL_BATCH_SIZE × 分片数条交给 ShardWriter。
+
+用法:
+    python -m benchmarks.bench_shards --records 50000 --shards 1 2 4
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+
+def build_records(count: int, seed: int):
+    """大部分是浏览，其余为事件和时长；received_at 在最近一小时内递增"""
+    from benchmarks.dataset import USER_AGENTS
+
+    rng = random.Random(seed)
+    user_agents = [ua for ua, _ in USER_AGENTS]
+    start = time.time() - 3600
+    records = []
+    for i in range(count):
+        session = rng.randint(0, count // 8)
+        record = {"site_id": "default", "session_id": f"s{session}", "received_at": start + i * 3600 / count,
+                  "ip_address": f"10.{i % 200}.{rng.randint(0, 255)}.{rng.randint(1, 254)}",
+                  "user_agent": rng.choice(user_agents)}
+        kind = rng.random()
+        if kind < 0.7:
+            record.update(type="pageview", page_url=f"https://example.com/p/{rng.randint(0, 500)}",
+                          page_title="Example", referrer="https://www.google.com/", user_id=f"u{session % 20000}",
+                          screen_width=1920, screen_height=1080, language="zh-CN")
+        elif kind < 0.9:
+            record.update(type="event", event_type="click", event_name="signup_button",
+                          properties='{"plan": "pro"}', page_url="https://example.com/")
+        else:
+            record.update(type="duration", duration=round(rng.uniform(1, 600), 1))
+        records.append(record)
+    return records
+
+
+def child(records: int, seed: int):
+    from config.settings import settings
+    from backend.models import init_db, shards
+    from backend.services.tracking_service import tracking_service
+    from backend.services.identity_cache import identity_cache
+
+    init_db()
+    if shards.enabled:
+        from backend.services.sharding import ShardWriter
+
+        handler, batch_size = ShardWriter().ingest_batch, settings.SPOOL_BATCH_SIZE * len(shards)
+    else:
+        handler, batch_size = tracking_service.ingest_batch, settings.SPOOL_BATCH_SIZE
+    data = build_records(records, seed)
+    started = time.perf_counter()
+    for i in range(0, len(data), batch_size):
+        handler(data[i:i + batch_size])
+    identity_cache.flush()
+    elapsed = time.perf_counter() - started
+    print(json.dumps({"records": len(data), "seconds": elapsed}))
+
+
+def run(count: int, records: int, seed: int, directory: str) -> dict:
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{directory}/main.db", SPOOL_DIR=f"{directory}/spool",
+               SHARD_COUNT=str(count), SHARD_PATHS=json.dumps([f"{directory}/shard_{i:02d}.db" for i in range(count)])
+               if count > 1 else "[]")
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.bench_shards", "--child", "--records", str(records), "--seed", str(seed)],
+        env=env, cwd=Path(__file__).parent.parent, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="分片写入吞吐量基准测试")
+    parser.add_argument("--records", type=int, default=50000)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 4], help="要比较的分片数，1 表示单库")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        child(args.records, args.seed)
+        return
+
+    baseline = None
+    for count in args.shards:
+        directory = tempfile.mkdtemp(prefix="bench-shards-")
+        try:
+            result = run(count, args.records, args.seed, directory)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        rate = result["records"] / result["seconds"]
+        baseline = baseline or rate
+        label = "单库" if count == 1 else f"{count} 个分片"
+        print(f"{label:<10} {rate:10.0f} 条/秒  {result['seconds']:7.2f}s  {rate / baseline:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""
+合成数据集生成器
+
+按照真实的时间分布（日内曲线、工作日/周末差异、逐日增长）生成页面浏览、事件、会话和用户数据，
+用于基准测试。相同的 seed 总是生成相同的数据集。
+
+用法:
+    python -m benchmarks.dataset --url sqlite:///data/bench.db --page-views 1000000 --days 30
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from sqlalchemy import create_engine, event
+
+from backend.models.database import Base, PageView, Event, Session, User, bulk_insert
+from backend.models.migrations import run_migrations
+from backend.services.dimension_service import (
+    dimension_service, PAGE_VIEW_DIMENSIONS, EVENT_DIMENSIONS, SESSION_DIMENSIONS
+)
+from backend.services.traffic_filter import traffic_filter
+
+# 0-23 点的相对流量，白天和晚间是高峰
+HOURLY_WEIGHTS = [
+    2, 1, 1, 1, 1, 2, 4, 7, 10, 12, 13, 12,
+    11, 12, 13, 13, 12, 11, 12, 14, 15, 13, 9, 5
+]
+# 周一到周日
+WEEKDAY_WEIGHTS = [1.0, 1.05, 1.05, 1.0, 0.95, 0.7, 0.65]
+
+PAGES = [
+    ("/", "首页"),
+    ("/search", "搜索"),
+    ("/login", "登录"),
+    ("/register", "注册"),
+    ("/submit", "提交"),
+    ("/wifi-model", "WiFi模型"),
+    ("/about", "关于我们"),
+    ("/docs/getting-started", "快速开始"),
+    ("/docs/api/reference", "API 参考"),
+    ("/blog", "博客"),
+]
+DETAIL_PAGES = 2000
+
+REFERRERS = [
+    ("", 40),
+    ("https://www.google.com/", 20),
+    ("https://www.baidu.com/s?wd=raymond", 15),
+    ("https://www.bing.com/", 5),
+    ("https://weibo.com/", 4),
+    ("https://www.zhihu.com/question/1", 4),
+    ("https://www.bilibili.com/", 3),
+    ("https://github.com/", 3),
+    ("https://news.example.org/", 6),
+]
+
+USER_AGENTS = [
+    ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36", 35),
+    ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15", 15),
+    ("Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36", 10),
+    ("Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Mobile/15E148 Safari/604.1", 15),
+    ("Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Mobile Safari/537.36", 12),
+    ("Mozilla/5.0 (X11; Linux x86_64; rv:121.0) Gecko/20100101 Firefox/121.0", 5),
+    ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 Edg/120.0.0.0", 6),
+    ("Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)", 2),
+]
+
+EVENTS = [
+    ("click", "signup_button"),
+    ("click", "search_submit"),
+    ("click", "download"),
+    ("custom", "video_play"),
+    ("custom", "share"),
+]
+
+LANGUAGES = ["zh-CN", "zh-CN", "zh-CN", "en-US", "en-GB", "ja-JP"]
+SCREENS = [(1920, 1080), (1440, 900), (2560, 1440), (390, 844), (412, 915)]
+
+BATCH_SIZE = 10000
+
+
+def _weighted(items):
+    values = [v for v, _ in items]
+    weights = [w for _, w in items]
+    return values, weights
+
+
+class DatasetGenerator:
+    """生成确定性的合成访问数据并批量写入数据库"""
+
+    def __init__(self, engine, seed: int = 42, host: str = "https://www.example.com",
+                 pages_per_session: float = 3.0, event_rate: float = 0.3,
+                 returning_rate: float = 0.35):
+        self.engine = engine
+        self.rng = random.Random(seed)
+        self.host = host
+        self.pages_per_session = pages_per_session
+        self.event_rate = event_rate
+        self.returning_rate = returning_rate
+
+        self._referrers = _weighted(REFERRERS)
+        self._user_agents = _weighted(USER_AGENTS)
+        self._users = []
+        self._user_rows = {}
+        self._counts = {"page_views": 0, "events": 0, "sessions": 0, "users": 0}
+
+    def _random_url(self):
+        rng = self.rng
+        # 80% 的流量落在少数热门页面上，剩下的分散在详情页（Zipf 近似）
+        if rng.random() < 0.8:
+            path, title = PAGES[min(int(rng.paretovariate(1.2)) - 1, len(PAGES) - 1)]
+            return f"{self.host}{path}", title
+        model_id = min(int(rng.paretovariate(0.8)), DETAIL_PAGES)
+        return f"{self.host}/wifi-model/{model_id}", f"WiFi模型 {model_id}"
+
+    def _pick_user(self, ts: datetime):
+        rng = self.rng
+        if self._users and rng.random() < self.returning_rate:
+            # 老用户更偏向最近活跃的用户
+            index = len(self._users) - 1 - min(int(rng.expovariate(1 / 200)), len(self._users) - 1)
+            user_id = self._users[index]
+            row = self._user_rows[user_id]
+            row["last_visit"] = ts
+            row["visit_count"] += 1
+            return user_id, row
+        user_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        row = {
+            "user_id": user_id,
+            "first_visit": ts,
+            "last_visit": ts,
+            "visit_count": 1,
+            "ip_address": None,
+            "user_agent": None,
+        }
+        self._users.append(user_id)
+        self._user_rows[user_id] = row
+        return user_id, row
+
+    def _daily_targets(self, total: int, days: int, end: datetime):
+        start_day = (end - timedelta(days=days - 1)).date()
+        weights = []
+        for i in range(days):
+            day = start_day + timedelta(days=i)
+            growth = 1.0 + 0.5 * i / max(days - 1, 1)
+            weights.append(WEEKDAY_WEIGHTS[day.weekday()] * growth)
+        scale = total / sum(weights)
+        return [(start_day + timedelta(days=i), int(round(w * scale))) for i, w in enumerate(weights)]
+
+    def _session_rows(self, start: datetime):
+        rng = self.rng
+        user_id, user_row = self._pick_user(start)
+        session_id = str(uuid.UUID(int=rng.getrandbits(128)))
+        user_agent = rng.choices(*self._user_agents)[0]
+        referrer = rng.choices(*self._referrers)[0] or None
+        ip_address = f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+        width, height = rng.choice(SCREENS)
+        language = rng.choice(LANGUAGES)
+
+        if user_row["ip_address"] is None:
+            user_row["ip_address"] = ip_address
+            user_row["user_agent"] = user_agent
+
+        n_pages = max(1, int(rng.expovariate(1 / self.pages_per_session)) + 1)
+        ts = start
+        page_views = []
+        events = []
+        for i in range(n_pages):
+            url, title = self._random_url()
+            dwell = rng.lognormvariate(3.2, 1.0)
+            page_views.append({
+                "session_id": session_id,
+                "user_id": user_id,
+                "page_url": url,
+                "page_title": title,
+                "referrer": referrer if i == 0 else page_views[-1]["page_url"],
+                "ip_address": ip_address,
+                "user_agent": user_agent,
+                "screen_width": width,
+                "screen_height": height,
+                "language": language,
+                "duration": round(dwell, 2),
+                "traffic_class": traffic_filter.classify(url, ip_address, user_agent),
+                "timestamp": ts,
+            })
+            if rng.random() < self.event_rate:
+                event_type, event_name = rng.choice(EVENTS)
+                events.append({
+                    "session_id": session_id,
+                    "user_id": user_id,
+                    "event_type": event_type,
+                    "event_name": event_name,
+                    "properties": json.dumps({"position": rng.randint(1, 5)}),
+                    "page_url": url,
+                    "ip_address": ip_address,
+                    "user_agent": user_agent,
+                    "timestamp": ts + timedelta(seconds=dwell / 2),
+                })
+            ts += timedelta(seconds=dwell)
+
+        session = {
+            "session_id": session_id,
+            "user_id": user_id,
+            "ip_address": ip_address,
+            "user_agent": user_agent,
+            "start_time": start,
+            "end_time": ts,
+            "page_views": n_pages,
+            "duration": round((ts - start).total_seconds(), 2),
+            "referrer": referrer,
+        }
+        return session, page_views, events
+
+    def generate(self, page_views: int, days: int = 30, end: datetime = None, progress: bool = True):
+        """生成约 page_views 条页面浏览记录，分布在截止到 end 的 days 天内"""
+        end = end or datetime.now()
+        rng = self.rng
+        buffers = {"page_views": [], "events": [], "sessions": []}
+        started = time.perf_counter()
+
+        for day, target in self._daily_targets(page_views, days, end):
+            day_start = datetime.combine(day, datetime.min.time())
+            produced = 0
+            while produced < target:
+                hour = rng.choices(range(24), weights=HOURLY_WEIGHTS)[0]
+                start = day_start + timedelta(hours=hour, seconds=rng.random() * 3600)
+                if start > end:
+                    break
+                session, pvs, evs = self._session_rows(start)
+                buffers["sessions"].append(session)
+                buffers["page_views"].extend(pvs)
+                buffers["events"].extend(evs)
+                produced += len(pvs)
+
+                if len(buffers["page_views"]) >= BATCH_SIZE:
+                    self._flush(buffers)
+            if progress:
+                elapsed = time.perf_counter() - started
+                print(f"  {day}: {self._counts['page_views'] + len(buffers['page_views'])} page views ({elapsed:.1f}s)",
+                      file=sys.stderr)
+
+        self._flush(buffers)
+        self._write_users()
+        return dict(self._counts)
+
+    def _flush(self, buffers):
+        for table, columns in (("sessions", SESSION_DIMENSIONS), ("page_views", PAGE_VIEW_DIMENSIONS),
+                               ("events", EVENT_DIMENSIONS)):
+            dimension_service.replace(buffers[table], columns, engine=self.engine)
+        with self.engine.begin() as conn:
+            for table, model in (("sessions", Session), ("page_views", PageView), ("events", Event)):
+                rows = buffers[table]
+                if rows:
+                    bulk_insert(conn, model.__table__, rows)
+                    self._counts[table] += len(rows)
+                    buffers[table] = []
+
+    def _write_users(self):
+        rows = [self._user_rows[user_id] for user_id in self._users]
+        with self.engine.begin() as conn:
+            for i in range(0, len(rows), BATCH_SIZE):
+                bulk_insert(conn, User.__table__, rows[i:i + BATCH_SIZE])
+        self._counts["users"] = len(rows)
+
+
+def create_bench_engine(url: str):
+    """创建用于数据生成的引擎；SQLite 下关闭同步写以加快导入"""
+    engine = create_engine(url)
+    if engine.dialect.name == "sqlite":
+        @event.listens_for(engine, "connect")
+        def _fast_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=OFF")
+            cursor.close()
+    return engine
+
+
+def build_dataset(url: str, page_views: int, days: int = 30, seed: int = 42, reset: bool = True, progress: bool = True):
+    engine = create_bench_engine(url)
+    if reset:
+        Base.metadata.drop_all(bind=engine)
+        dimension_service.clear()
+    Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+    counts = DatasetGenerator(engine, seed=seed).generate(page_views, days=days, progress=progress)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("ANALYZE")
+    engine.dispose()
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="生成合成访问数据集")
+    parser.add_argument("--url", required=True, help="SQLAlchemy 数据库 URL")
+    parser.add_argument("--page-views", type=int, default=100000, help="页面浏览记录数")
+    parser.add_argument("--days", type=int, default=30, help="覆盖的天数")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--append", action="store_true", help="追加数据而不是重建表")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    counts = build_dataset(args.url, args.page_views, days=args.days, seed=args.seed, reset=not args.append)
+    elapsed = time.perf_counter() - started
+    print(json.dumps(counts, ensure_ascii=False))
+    print(f"完成，用时 {elapsed:.1f}s（{counts['page_views'] / max(elapsed, 1e-9):.0f} 条/秒）", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
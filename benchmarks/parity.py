@@ -0,0 +1,222 @@
+"""
+SQLite / PostgreSQL 结果一致性检查
+
+把基准数据集从 SQLite 原样复制到 PostgreSQL（COPY），在两个库上分别重建派生数据
+（事件属性、留存位图、每日汇总），然后逐个调用统计接口并比较结果，同时输出两边的耗时。
+没有指定 --pg-url 时用本机的 initdb/pg_ctl 在临时目录启动一个实例，结束后删除。
+
+用法:
+    python -m benchmarks.parity                                   # 临时实例，10000 条数据
+    python -m benchmarks.parity --scale 100000 --pg-url postgresql+psycopg2://user@localhost/bench
+    PG_BIN=/usr/lib/postgresql/16/bin python -m benchmarks.parity
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from sqlalchemy import create_engine, func, select, text
+
+from backend.models.database import Base, SessionLocal, ReadSessionLocal, bulk_insert
+from backend.models.migrations import run_migrations
+from backend.services.duration_service import duration_service
+from backend.services.event_property_service import event_property_service
+from backend.services.funnel_service import funnel_service
+from backend.services.geo_service import geo_service
+from backend.services.path_service import path_service
+from backend.services.retention_service import retention_service
+from backend.services.stats_service import stats_service
+from benchmarks.dataset import build_dataset, create_bench_engine
+from benchmarks.run_stats import CASES, DEFAULT_DATA_DIR, time_case
+
+COPY_BATCH = 10000
+# 与数据无关、每次调用都不同的字段
+VOLATILE_KEYS = {"generated_at", "end"}
+
+EXTRA_CASES = [
+    ("get_site_overview(30)", lambda: stats_service.get_site_overview(30)),
+    ("get_funnel(/ -> /search -> /login)", lambda: funnel_service.get_funnel(["page:/", "page:/search", "page:/login"], 30)),
+    ("get_retention(day)", lambda: retention_service.get_retention("day", 14)),
+    ("get_retention(week)", lambda: retention_service.get_retention("week", 4)),
+    ("get_breakdown(position)", lambda: event_property_service.get_breakdown("position", None, 30)),
+    ("get_geo_stats(30)", lambda: geo_service.get_geo_stats(30)),
+    ("get_durations(session, 30)", lambda: duration_service.get_durations("session", 30)),
+    ("get_paths(首页, 4)", lambda: path_service.get_paths(["首页"], 4, 30, 100)),
+]
+
+
+@contextmanager
+def temporary_postgres(pg_bin: str = None):
+    """在临时目录里 initdb 并启动一个只监听 Unix socket 的实例，退出时停止并删除"""
+    bin_dir = pg_bin or os.environ.get("PG_BIN")
+    initdb = os.path.join(bin_dir, "initdb") if bin_dir else shutil.which("initdb")
+    pg_ctl = os.path.join(bin_dir, "pg_ctl") if bin_dir else shutil.which("pg_ctl")
+    if not initdb or not os.path.exists(initdb):
+        raise SystemExit("找不到 initdb，请设置 PG_BIN 或使用 --pg-url")
+    if hasattr(os, "geteuid") and os.geteuid() == 0:
+        raise SystemExit("PostgreSQL 不能以 root 运行，请换用普通用户或使用 --pg-url")
+
+    workdir = tempfile.mkdtemp(prefix="raymond-pg-")
+    data_dir = os.path.join(workdir, "data")
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    subprocess.run([initdb, "-D", data_dir, "-U", "postgres", "-A", "trust", "-E", "UTF8"],
+                   check=True, stdout=subprocess.DEVNULL)
+    subprocess.run([pg_ctl, "-D", data_dir, "-l", os.path.join(workdir, "log"), "-w",
+                    "-o", f"-p {port} -k {workdir} -c listen_addresses=''", "start"],
+                   check=True, stdout=subprocess.DEVNULL)
+    try:
+        yield f"postgresql+psycopg2://postgres@/postgres?host={workdir}&port={port}"
+    finally:
+        subprocess.run([pg_ctl, "-D", data_dir, "-m", "fast", "-w", "stop"], stdout=subprocess.DEVNULL)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _bind(engine):
+    SessionLocal.configure(bind=engine)
+    ReadSessionLocal.configure(bind=engine)
+
+
+def copy_database(source, target):
+    """重建目标库的表结构并按表复制所有行，之后把自增序列推进到最大 ID"""
+    # 较早生成的数据集可能缺少后来加的表
+    _bind(source)
+    Base.metadata.create_all(bind=source)
+    run_migrations(source)
+    _bind(target)
+    Base.metadata.drop_all(bind=target)
+    Base.metadata.create_all(bind=target)
+    run_migrations(target)
+    copied = {}
+    with source.connect() as src, target.begin() as dst:
+        for table in Base.metadata.sorted_tables:
+            dst.execute(table.delete())
+            result = src.execution_options(yield_per=COPY_BATCH).execute(table.select())
+            copied[table.name] = 0
+            for rows in result.mappings().partitions():
+                bulk_insert(dst, table, [dict(row) for row in rows])
+                copied[table.name] += len(rows)
+            if target.dialect.name == "postgresql" and "id" in table.c:
+                max_id = dst.execute(select(func.max(table.c.id))).scalar()
+                if max_id:
+                    dst.execute(text("SELECT setval(pg_get_serial_sequence(:table, 'id'), :max_id)"),
+                                {"table": table.name, "max_id": max_id})
+    with target.begin() as conn:
+        conn.exec_driver_sql("ANALYZE")
+    return copied
+
+
+def prepare(engine):
+    """在当前库上重新计算派生数据，两个库各自用自己的 SQL 方言生成"""
+    _bind(engine)
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM event_properties"))
+        event_property_service.index_events(conn)
+    retention_service.rebuild()
+    duration_service.rebuild_sessions()
+    stats_service.rollup_site_stats(30)
+    geo_service.rollup(30)
+    path_service.rollup(30)
+
+
+def normalize(value):
+    """Decimal 转 float、浮点数保留 6 位小数、日期转字符串，便于跨数据库比较"""
+    if isinstance(value, dict):
+        return {str(k): normalize(v) for k, v in value.items() if k not in VOLATILE_KEYS}
+    if isinstance(value, (list, tuple)):
+        return [normalize(v) for v in value]
+    if isinstance(value, Decimal):
+        value = float(value)
+    if isinstance(value, float):
+        return round(value, 6)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _sorted(value):
+    """并列项的先后顺序不保证一致：列表按 JSON 文本排序后再比较"""
+    if isinstance(value, dict):
+        return {k: _sorted(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return sorted((_sorted(v) for v in value), key=lambda v: json.dumps(v, sort_keys=True, ensure_ascii=False))
+    return value
+
+
+def run_cases(engines, repeat: int):
+    """逐个用例依次在各个库上执行：数据集的时间窗口随当前时间移动，两次调用要尽量挨着"""
+    results = {name: [] for name, _ in CASES + EXTRA_CASES}
+    for name, fn in CASES + EXTRA_CASES:
+        for engine in engines:
+            _bind(engine)
+            results[name].append((normalize(fn()), time_case(fn, repeat)["median"]))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="比较 SQLite 与 PostgreSQL 上的统计结果")
+    parser.add_argument("--scale", type=int, default=10000, help="页面浏览记录数")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--data-dir", type=Path, default=DEFAULT_DATA_DIR)
+    parser.add_argument("--pg-url", help="已有的 PostgreSQL 库（表会被重建）；不指定时启动临时实例")
+    parser.add_argument("--pg-bin", help="initdb/pg_ctl 所在目录，默认读 PG_BIN 或 PATH")
+    args = parser.parse_args(argv)
+
+    args.data_dir.mkdir(parents=True, exist_ok=True)
+    db_path = args.data_dir / f"bench_{args.scale}.db"
+    if not db_path.exists():
+        print(f"生成 {args.scale} 条页面浏览数据 -> {db_path}", file=sys.stderr)
+        build_dataset(f"sqlite:///{db_path}", args.scale, days=args.days, progress=False)
+
+    with (temporary_postgres(args.pg_bin) if not args.pg_url else _given(args.pg_url)) as pg_url:
+        sqlite_engine = create_bench_engine(f"sqlite:///{db_path}")
+        pg_engine = create_engine(pg_url)
+        try:
+            started = time.perf_counter()
+            copied = copy_database(sqlite_engine, pg_engine)
+            print(f"已复制 {sum(copied.values())} 行到 PostgreSQL，用时 {time.perf_counter() - started:.1f}s",
+                  file=sys.stderr)
+            prepare(sqlite_engine)
+            prepare(pg_engine)
+            results = run_cases([sqlite_engine, pg_engine], args.repeat)
+        finally:
+            sqlite_engine.dispose()
+            pg_engine.dispose()
+
+    mismatches = 0
+    print(f"{'用例':<36} {'SQLite':>10} {'PostgreSQL':>12}  结果", file=sys.stderr)
+    for name, ((expected, sqlite_time), (actual, pg_time)) in results.items():
+        if actual == expected:
+            verdict = "一致"
+        elif _sorted(actual) == _sorted(expected):
+            verdict = "一致（并列项顺序不同）"
+        else:
+            verdict = "不一致"
+            mismatches += 1
+        print(f"{name:<36} {sqlite_time * 1000:8.2f}ms {pg_time * 1000:10.2f}ms  {verdict}", file=sys.stderr)
+        if verdict == "不一致":
+            print(f"    SQLite:     {json.dumps(expected, ensure_ascii=False)[:500]}", file=sys.stderr)
+            print(f"    PostgreSQL: {json.dumps(actual, ensure_ascii=False)[:500]}", file=sys.stderr)
+    return 1 if mismatches else 0
+
+
+@contextmanager
+def _given(url: str):
+    yield url
+
+
+if __name__ == "__main__":
+    sys.exit(main())
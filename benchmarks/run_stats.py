@@ -0,0 +1,199 @@
+"""
+StatsService 查询基准测试
+
+在不同数据规模下为每个 StatsService 方法和 get_page_flow 计时，记录 EXPLAIN QUERY PLAN，
+并与保存的基线比较，出现性能回退时以非零状态码退出。
+
+用法:
+    python -m benchmarks.run_stats                      # 使用默认规模并与基线比较
+    python -m benchmarks.run_stats --scales 10000 --update-baseline
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from sqlalchemy import event
+
+from config.settings import settings
+from backend.models.database import Base, SessionLocal, ReadSessionLocal
+from backend.models.migrations import run_migrations
+from backend.services.stats_service import stats_service
+from backend.services.flow_service import flow_service
+from backend.services.cache_service import site_key
+from benchmarks.dataset import build_dataset, create_bench_engine
+
+BENCH_DIR = Path(__file__).parent
+DEFAULT_BASELINE = BENCH_DIR / "baseline.json"
+DEFAULT_DATA_DIR = BENCH_DIR.parent / "data" / "bench"
+DEFAULT_SCALES = [10000, 100000]
+
+# (名称, 调用)；名称同时作为基线中的键
+CASES = [
+    ("get_realtime_stats", lambda: stats_service.get_realtime_stats()),
+    ("get_page_views_trend(1)", lambda: stats_service.get_page_views_trend(1)),
+    ("get_page_views_trend(7)", lambda: stats_service.get_page_views_trend(7)),
+    ("get_unique_visitors_trend(7)", lambda: stats_service.get_unique_visitors_trend(7)),
+    ("get_hourly_distribution(1)", lambda: stats_service.get_hourly_distribution(1)),
+    ("get_top_pages(10)", lambda: stats_service.get_top_pages(10)),
+    ("get_referrers(10)", lambda: stats_service.get_referrers(10)),
+    ("get_device_stats", lambda: stats_service.get_device_stats()),
+    ("get_browser_stats", lambda: stats_service.get_browser_stats()),
+    ("get_event_stats(7)", lambda: stats_service.get_event_stats(None, 7)),
+    ("get_user_type_stats", lambda: stats_service.get_user_type_stats()),
+    ("get_user_type_trend(7)", lambda: stats_service.get_user_type_trend(7)),
+    ("get_page_flow(7)", lambda: flow_service.get_page_flow(7)),
+    ("get_dashboard_snapshot(7)", lambda: _uncached_snapshot(7)),
+]
+
+
+def _uncached_snapshot(days: int):
+    # 只测查询本身，跳过快照缓存
+    stats_service._local_cache.delete(site_key(settings.DEFAULT_SITE_ID, f"stats:dashboard:{days}"))
+    return stats_service.get_dashboard_snapshot(days)
+
+
+class QueryCapture:
+    """在引擎上记录执行过的 SELECT 语句，用于之后生成查询计划"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+        self.active = False
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.active and statement.lstrip().upper().startswith("SELECT"):
+            self.statements.append((statement, parameters))
+
+    def explain(self):
+        """对捕获到的不同语句执行 EXPLAIN（SQLite 下为 EXPLAIN QUERY PLAN）"""
+        plans = []
+        seen = set()
+        prefix = "EXPLAIN QUERY PLAN " if self.engine.dialect.name == "sqlite" else "EXPLAIN "
+        with self.engine.connect() as conn:
+            for statement, parameters in self.statements:
+                if statement in seen:
+                    continue
+                seen.add(statement)
+                try:
+                    rows = conn.exec_driver_sql(prefix + statement, parameters).fetchall()
+                    plan = [" ".join(str(col) for col in row[-1:]) for row in rows]
+                except Exception as e:
+                    plan = [f"EXPLAIN failed: {e}"]
+                plans.append({"sql": " ".join(statement.split()), "plan": plan})
+        return plans
+
+
+def time_case(fn, repeat: int):
+    fn()  # 预热，避免首次编译/加载页缓存影响结果
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return {
+        "median": statistics.median(samples),
+        "min": min(samples),
+        "max": max(samples),
+    }
+
+
+def run_scale(scale: int, data_dir: Path, days: int, repeat: int, rebuild: bool, with_plans: bool):
+    data_dir.mkdir(parents=True, exist_ok=True)
+    db_path = data_dir / f"bench_{scale}.db"
+    url = f"sqlite:///{db_path}"
+    if rebuild or not db_path.exists():
+        print(f"生成 {scale} 条页面浏览数据 -> {db_path}", file=sys.stderr)
+        build_dataset(url, scale, days=days, progress=False)
+
+    engine = create_bench_engine(url)
+    SessionLocal.configure(bind=engine)
+    ReadSessionLocal.configure(bind=engine)
+    # 之前生成的数据集按当前结构升级
+    Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
+    capture = QueryCapture(engine)
+
+    results = {}
+    for name, fn in CASES:
+        capture.statements = []
+        capture.active = True
+        try:
+            timing = time_case(fn, repeat)
+        finally:
+            capture.active = False
+        if with_plans:
+            timing["queries"] = capture.explain()
+        results[name] = timing
+        print(f"  [{scale}] {name:<32} {timing['median'] * 1000:9.2f} ms", file=sys.stderr)
+
+    engine.dispose()
+    return results
+
+
+def compare(report: dict, baseline: dict, tolerance: float, min_delta: float):
+    """返回所有超过基线 (1 + tolerance) 倍且绝对差值大于 min_delta 秒的用例"""
+    regressions = []
+    for scale, cases in report.items():
+        for name, timing in cases.items():
+            base = baseline.get(scale, {}).get(name)
+            if base is None:
+                continue
+            current = timing["median"]
+            if current > base * (1 + tolerance) and current - base > min_delta:
+                regressions.append((scale, name, base, current))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="StatsService 查询基准测试")
+    parser.add_argument("--scales", type=int, nargs="+", default=DEFAULT_SCALES, help="页面浏览记录数")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--data-dir", type=Path, default=DEFAULT_DATA_DIR)
+    parser.add_argument("--rebuild", action="store_true", help="重新生成数据集")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--update-baseline", action="store_true", help="用本次结果覆盖基线")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="允许相对基线变慢的比例")
+    parser.add_argument("--min-delta", type=float, default=0.005, help="忽略小于该秒数的差异")
+    parser.add_argument("--output", type=Path, help="将完整报告（含查询计划）写入 JSON 文件")
+    parser.add_argument("--no-plans", action="store_true", help="不采集 EXPLAIN QUERY PLAN")
+    args = parser.parse_args(argv)
+
+    report = {}
+    for scale in args.scales:
+        report[str(scale)] = run_scale(scale, args.data_dir, args.days, args.repeat, args.rebuild, not args.no_plans)
+
+    if args.output:
+        args.output.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    medians = {
+        scale: {name: round(timing["median"], 6) for name, timing in cases.items()}
+        for scale, cases in report.items()
+    }
+
+    if args.update_baseline:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8")) if args.baseline.exists() else {}
+        baseline.update(medians)
+        args.baseline.write_text(json.dumps(baseline, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+        print(f"基线已更新: {args.baseline}", file=sys.stderr)
+        return 0
+
+    if not args.baseline.exists():
+        print("没有找到基线文件，使用 --update-baseline 生成", file=sys.stderr)
+        return 0
+
+    baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+    regressions = compare(report, baseline, args.tolerance, args.min_delta)
+    for scale, name, base, current in regressions:
+        print(f"性能回退 [{scale}] {name}: {base * 1000:.2f} ms -> {current * 1000:.2f} ms", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
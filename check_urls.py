@@ -1,19 +1,21 @@
-from backend.models.database import SessionLocal, PageView
+from backend.models.database import SessionLocal, PageView, UrlDimension
 import sys
 
 db = SessionLocal()
 try:
-    pageviews = db.query(PageView).all()
-    
+    # 只取 URL 一列并分批读取，不把整张表加载到内存；URL 保存在字典表中
+    total = 0
     unique_urls = set()
     url_counts = {}
     
-    for pv in pageviews:
-        url = pv.page_url
+    for (url,) in db.query(UrlDimension.value).select_from(PageView).outerjoin(
+        UrlDimension, UrlDimension.id == PageView.url_id
+    ).yield_per(5000):
+        total += 1
         unique_urls.add(url)
         url_counts[url] = url_counts.get(url, 0) + 1
     
-    print(f"总共 {len(pageviews)} 条pageview记录")
+    print(f"总共 {total} 条pageview记录")
     print(f"唯一URL数量: {len(unique_urls)}")
     print("\n所有URL及其出现次数:")
     for url, count in sorted(url_counts.items()):
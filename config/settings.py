@@ -1,13 +1,27 @@
 from pydantic_settings import BaseSettings
 from pathlib import Path
+from typing import List, Optional
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# site_id 只允许字母、数字和 _ . -，既用于 URL 参数也用于 Redis 键
+SITE_ID_PATTERN = r"^[A-Za-z0-9_.-]{1,64}$"
+
 class Settings(BaseSettings):
     PROJECT_NAME: str = "Raymond Analysis"
     VERSION: str = "1.0.0"
     
     DATABASE_URL: str = f"sqlite:///{BASE_DIR}/data/raymond_analysis.db"
+    # 只读查询使用的库（如 PostgreSQL 只读副本）；为空时 SQLite 以只读模式打开同一文件，其它数据库复用主库
+    DATABASE_READ_URL: str = ""
+    
+    # 非 SQLite 数据库（PostgreSQL）的连接池：常驻连接数、突发时额外允许的连接数、等待连接的超时（秒）、
+    # 连接最长使用时间（秒），以及 executemany 时每条多行 INSERT 包含的行数
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_RECYCLE: int = 1800
+    DB_INSERT_PAGE_SIZE: int = 1000
     
     REDIS_HOST: str = "localhost"
     REDIS_PORT: int = 6379
@@ -20,9 +34,140 @@ class Settings(BaseSettings):
     
     HOST: str = "0.0.0.0"
     PORT: int = 5500
+    DEBUG: bool = False
+    
+    # 追踪脚本与页面模板：启动时加载并预压缩，DEBUG 模式下文件变化时热加载
+    ASSET_VARIANT_CACHE_SIZE: int = 256
+    TRACKER_CACHE_MAX_AGE: int = 300
+    
+    # 仪表盘快照：并行查询的线程数和整体缓存时间（秒）
+    DASHBOARD_QUERY_WORKERS: int = 4
+    DASHBOARD_CACHE_SECONDS: int = 30
+    
+    # 统计接口的负载管理：light/heavy 两类接口各自的并发上限和语句超时（秒）、没有旧结果时等待空位的最长时间（秒）、
+    # 超载或超时时可以代替新结果返回的旧结果的最长保存时间（秒）和条数，以及 spool 积压超过多少条时 heavy 查询让路给写入
+    WORKLOAD_LIGHT_CONCURRENCY: int = 8
+    WORKLOAD_LIGHT_TIMEOUT_SECONDS: float = 5.0
+    WORKLOAD_HEAVY_CONCURRENCY: int = 2
+    WORKLOAD_HEAVY_TIMEOUT_SECONDS: float = 15.0
+    WORKLOAD_QUEUE_TIMEOUT_SECONDS: float = 2.0
+    WORKLOAD_STALE_MAX_AGE_SECONDS: int = 900
+    WORKLOAD_STALE_CACHE_SIZE: int = 512
+    WORKLOAD_INGEST_BACKLOG: int = 5000
+    
+    # 定时任务：查库的任务在这么多个线程中执行，每个任务的触发时间加上间隔乘以 SCHEDULER_JITTER_RATIO 以内的随机偏移，
+    # 错过计划时间超过 SCHEDULER_MISFIRE_GRACE_SECONDS 秒的执行直接跳过
+    SCHEDULER_WORKERS: int = 4
+    SCHEDULER_JITTER_RATIO: float = 0.1
+    SCHEDULER_MISFIRE_GRACE_SECONDS: int = 30
     
     DATA_RETENTION_DAYS: int = 30
     
+    # /api/export 每次从服务端游标取出并编码的行数
+    EXPORT_BATCH_ROWS: int = 5000
+    
+    # 多站点：未指定 site_id 的请求和老数据都归到默认站点；每日汇总会回补最近几天
+    DEFAULT_SITE_ID: str = "default"
+    SITE_ROLLUP_DAYS: int = 2
+    
+    # 追踪数据先落盘到 spool 再由后台线程批量写库；SPOOL_FSYNC 为 always、interval 或 never。
+    # 每个 worker 进程使用 SPOOL_DIR 下自己的子目录。SPOOL_JSON_ENDPOINTS 打开时 POST /api/track/* 也走 spool，
+    # 响应改为 "status": "queued"，不再带有 user_type/is_new_user 的真实值和记录 ID；默认只有像素请求走 spool
+    SPOOL_ENABLED: bool = True
+    SPOOL_JSON_ENDPOINTS: bool = False
+    SPOOL_DIR: str = str(BASE_DIR / "data" / "spool")
+    SPOOL_SEGMENT_BYTES: int = 16 * 1024 * 1024
+    SPOOL_FSYNC: str = "interval"
+    SPOOL_FSYNC_INTERVAL_MS: int = 1000
+    SPOOL_BATCH_SIZE: int = 500
+    SPOOL_POLL_INTERVAL_MS: int = 200
+    SPOOL_MAX_BACKOFF_SECONDS: float = 30.0
+    
+    # 历史数据导入（python -m backend.services.importer）：解析进程数、每个事务写入的记录数、
+    # 访问日志没有会话 ID 时按同一 IP+UA 的不活跃间隔切分会话，以及跳过的静态资源后缀
+    IMPORT_WORKERS: int = 2
+    IMPORT_BATCH_SIZE: int = 50000
+    IMPORT_SESSION_TIMEOUT_MINUTES: int = 30
+    IMPORT_SKIP_EXTENSIONS: List[str] = [
+        ".js", ".css", ".png", ".jpg", ".jpeg", ".gif", ".svg", ".ico", ".webp",
+        ".woff", ".woff2", ".ttf", ".map", ".txt", ".xml", ".json"
+    ]
+    IMPORT_SKIP_PATH_PREFIXES: List[str] = ["/api/", "/static/", "/tracker.js", "/ra.js"]
+    
+    # 本地 GeoIP 库（python -m backend.utils.geoip build 生成），文件不存在时不填地理信息；
+    # 查询结果按 IPv4 /24、IPv6 /48 前缀缓存的条数
+    GEOIP_DB_PATH: str = str(BASE_DIR / "data" / "geoip.radb")
+    GEOIP_CACHE_SIZE: int = 65536
+    
+    # 写入 event_properties 索引的事件属性键，为空时索引所有顶层标量键
+    EVENT_PROPERTY_KEYS: List[str] = []
+    
+    # URL、标题、UA、来源的字典表：写入时在进程内缓存 字符串 -> ID 的条数（每类各自计数）
+    DIMENSION_CACHE_SIZE: int = 100000
+    
+    # 最近 HOT_WINDOW_HOURS 小时浏览的内存列存（需要 numpy）：数组占用的内存上限，
+    # 以及查询时距上次同步超过多少秒就先补读数据库中其他进程写入的行
+    HOT_WINDOW_ENABLED: bool = True
+    HOT_WINDOW_HOURS: int = 48
+    HOT_WINDOW_MEMORY_MB: int = 64
+    HOT_WINDOW_SYNC_SECONDS: float = 1.0
+    
+    # 写入时的身份缓存：最近活跃用户/会话的 LRU 条数、已知用户布隆过滤器的初始容量和误判率、
+    # 判断为新用户前补读其他进程新建用户的最短间隔，以及 visit_count/page_views 等计数的批量写回间隔
+    IDENTITY_USER_CACHE_SIZE: int = 100000
+    IDENTITY_SESSION_CACHE_SIZE: int = 50000
+    IDENTITY_BLOOM_CAPACITY: int = 1000000
+    IDENTITY_BLOOM_ERROR_RATE: float = 0.001
+    IDENTITY_SYNC_SECONDS: float = 1.0
+    IDENTITY_FLUSH_INTERVAL_SECONDS: int = 5
+    
+    # 时长分布草图：分位数的相对误差、待合并的增量写回间隔，以及 /api/stats/durations 直方图的分界（秒）
+    DURATION_SKETCH_ACCURACY: float = 0.01
+    DURATION_FLUSH_INTERVAL_SECONDS: int = 60
+    DURATION_HISTOGRAM_EDGES: List[float] = [10, 30, 60, 180, 600, 1800]
+    
+    # 会话路径前缀树（/api/stats/paths）：每个会话保留的最多步数、每天的树中剪掉会话数少于 PATH_PRUNE_MIN_SESSIONS 的节点、
+    # 每个节点最多保留的子节点数，以及定时重算最近几天（SITE_ROLLUP_DAYS）的间隔（秒）
+    PATH_MAX_DEPTH: int = 12
+    PATH_PRUNE_MIN_SESSIONS: int = 2
+    PATH_MAX_CHILDREN: int = 50
+    PATH_ROLLUP_INTERVAL_SECONDS: int = 600
+    
+    # 分片存储（见 backend/models/shards.py）：SHARD_COUNT 大于 1 时追踪数据按 user_id 的哈希写入这么多个 SQLite 文件，
+    # 每个分片一个写线程，统计查询并行访问所有分片后合并。SHARD_PATHS 为空时使用 data/shards/shard_00.db 等；
+    # 并行查询分片的线程数，以及各分片计算前 N 项时多取的条数。修改分片数后用 python -m backend.services.sharding split 重新分布
+    SHARD_COUNT: int = 1
+    SHARD_PATHS: List[str] = []
+    SHARD_QUERY_WORKERS: int = 8
+    SHARD_TOPK_SLACK: int = 20
+    
+    # 留存位图：写入时先记在内存，每隔这么多秒并入 activity_bitmaps
+    RETENTION_FLUSH_INTERVAL_SECONDS: int = 60
+    
+    # /api/admin 的访问令牌（请求头 X-Admin-Token）；为空时管理接口一律返回 403
+    ADMIN_TOKEN: str = ""
+    
+    SQL_PROFILING_ENABLED: bool = False
+    SQL_SLOW_QUERY_MS: float = 100.0
+    SQL_PROFILE_TOP_N: int = 50
+    SQL_EXPLAIN_THRESHOLD_MS: Optional[float] = None
+    
+    # 写入时的流量分类规则；TRAFFIC_DROP_CLASSES 中的类别（internal/bot）直接丢弃，其余仅打标记
+    TRAFFIC_INTERNAL_HOSTS: List[str] = ["localhost:5500"]
+    TRAFFIC_INTERNAL_PATH_PREFIXES: List[str] = ["/dashboard"]
+    TRAFFIC_INTERNAL_IP_RANGES: List[str] = []
+    TRAFFIC_BOT_USER_AGENTS: List[str] = []
+    TRAFFIC_DROP_CLASSES: List[str] = []
+    
+    # 爬虫识别：UA 特征列表 + 按 IP/会话的请求频率；BOT_ACTION 为 count（只计数）、drop 或 store（照常入库并标记）
+    BOT_SIGNATURES_FILE: str = str(BASE_DIR / "config" / "bot_signatures.txt")
+    BOT_ACTION: str = "count"
+    BOT_EMPTY_UA_IS_BOT: bool = True
+    BOT_RATE_WINDOW_SECONDS: int = 10
+    # 每秒请求数上限，0 表示不按该维度判断；NAT、公司代理和 CDN 后面的真实用户共用一个 IP，按 IP 判断默认关闭
+    BOT_MAX_HITS_PER_SECOND_IP: float = 0
+    BOT_MAX_HITS_PER_SECOND_SESSION: float = 5.0
+    
     class Config:
         env_file = BASE_DIR / ".env"
 
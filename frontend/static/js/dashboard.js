@@ -2,9 +2,16 @@ class Dashboard {
     constructor() {
         this.charts = {};
         this.ws = null;
+        // 通过 /?site_id=xxx 查看指定站点，默认站点为 default
+        this.siteId = new URLSearchParams(window.location.search).get('site_id') || 'default';
         this.init();
     }
 
+    apiUrl(path) {
+        const separator = path.includes('?') ? '&' : '?';
+        return `${path}${separator}site_id=${encodeURIComponent(this.siteId)}`;
+    }
+
     async init() {
         await this.initCharts();
         await this.loadInitialData();
@@ -30,22 +37,42 @@ class Dashboard {
     }
 
     async loadInitialData() {
-        await Promise.all([
-            this.updateRealtimeStats(),
-            this.loadPageViewsTrend(7),
-            this.loadVisitorsTrend(7),
-            this.loadHourlyDistribution(1),
-            this.loadDeviceStats(),
-            this.loadBrowserStats(),
-            this.loadUserTypeStats(),
-            this.loadUserTypeTrend(7),
-            this.loadTopPages(),
-            this.loadReferrers(),
-            this.loadPageFlow()
-        ]);
+        await this.loadDashboard();
         this.initTimeRangeSelectors();
     }
 
+    // 一次请求取回所有面板；panels 为空时渲染全部面板
+    async loadDashboard(panels = null, days = 7) {
+        const renderers = {
+            realtime: data => this.renderRealtimeStats(data),
+            page_views_trend: data => this.renderPageViewsTrend(data, days),
+            visitors_trend: data => this.renderVisitorsTrend(data, days),
+            hourly: data => this.renderHourlyDistribution(data, 1),
+            devices: data => this.renderDeviceStats(data),
+            browsers: data => this.renderBrowserStats(data),
+            user_type: data => this.renderUserTypeStats(data),
+            user_type_trend: data => this.renderUserTypeTrend(data, days),
+            top_pages: data => this.renderTopPages(data),
+            referrers: data => this.renderReferrers(data),
+            page_flow: data => this.renderPageFlow(data)
+        };
+
+        try {
+            const response = await fetch(this.apiUrl(`/api/stats/dashboard?days=${days}`));
+            const data = await response.json();
+
+            (panels || Object.keys(renderers)).forEach(panel => {
+                try {
+                    renderers[panel](data[panel]);
+                } catch (error) {
+                    console.error(`Failed to render ${panel}:`, error);
+                }
+            });
+        } catch (error) {
+            console.error('Failed to load dashboard:', error);
+        }
+    }
+
     initTimeRangeSelectors() {
         document.getElementById('page-views-time-range').addEventListener('change', (e) => {
             this.loadPageViewsTrend(parseInt(e.target.value));
@@ -66,421 +93,441 @@ class Dashboard {
 
     async updateRealtimeStats() {
         try {
-            const response = await fetch('/api/stats/realtime');
-            const data = await response.json();
-
-            document.getElementById('online-users').textContent = data.online_users || 0;
-            document.getElementById('page-views-today').textContent = data.page_views_today || 0;
-            document.getElementById('unique-visitors-today').textContent = data.unique_visitors_today || 0;
-            document.getElementById('avg-duration').textContent = Math.round(data.avg_duration_today || 0) + 's';
+            const response = await fetch(this.apiUrl('/api/stats/realtime'));
+            this.renderRealtimeStats(await response.json());
         } catch (error) {
             console.error('Failed to load realtime stats:', error);
         }
     }
 
+    renderRealtimeStats(data) {
+        document.getElementById('online-users').textContent = data.online_users || 0;
+        document.getElementById('page-views-today').textContent = data.page_views_today || 0;
+        document.getElementById('unique-visitors-today').textContent = data.unique_visitors_today || 0;
+        document.getElementById('avg-duration').textContent = Math.round(data.avg_duration_today || 0) + 's';
+    }
+
     async loadPageViewsTrend(days = 7) {
         try {
-            const response = await fetch(`/api/stats/page-views/trend?days=${days}`);
-            const data = await response.json();
-
-            let titleText = '页面浏览量';
-            if (days === 1) titleText = '24小时页面浏览量';
-            else if (days === 2) titleText = '48小时页面浏览量';
-            else titleText = `近${days}天页面浏览量`;
-
-            const option = {
-                title: {
-                    text: titleText
-                },
-                tooltip: {
-                    trigger: 'axis'
-                },
-                xAxis: {
-                    type: 'category',
-                    data: data.map(d => d.date)
-                },
-                yAxis: {
-                    type: 'value'
-                },
-                series: [{
-                    name: '浏览量',
-                    type: 'line',
-                    data: data.map(d => d.views),
-                    smooth: true,
-                    areaStyle: {
-                        color: new echarts.graphic.LinearGradient(0, 0, 0, 1, [
-                            { offset: 0, color: 'rgba(102, 126, 234, 0.8)' },
-                            { offset: 1, color: 'rgba(102, 126, 234, 0.1)' }
-                        ])
-                    },
-                    itemStyle: {
-                        color: '#667eea'
-                    }
-                }]
-            };
-
-            this.charts.pageViews.setOption(option);
+            const response = await fetch(this.apiUrl(`/api/stats/page-views/trend?days=${days}`));
+            this.renderPageViewsTrend(await response.json(), days);
         } catch (error) {
             console.error('Failed to load page views trend:', error);
         }
     }
 
-    async loadVisitorsTrend(days = 7) {
-        try {
-            const response = await fetch(`/api/stats/visitors/trend?days=${days}`);
-            const data = await response.json();
-
-            let titleText = '访客数量';
-            if (days === 1) titleText = '24小时访客数量';
-            else if (days === 2) titleText = '48小时访客数量';
-            else titleText = `近${days}天访客数量`;
-
-            const option = {
-                title: {
-                    text: titleText
-                },
-                tooltip: {
-                    trigger: 'axis'
-                },
-                xAxis: {
-                    type: 'category',
-                    data: data.map(d => d.date)
-                },
-                yAxis: {
-                    type: 'value'
+    renderPageViewsTrend(data, days = 7) {
+        let titleText = '页面浏览量';
+        if (days === 1) titleText = '24小时页面浏览量';
+        else if (days === 2) titleText = '48小时页面浏览量';
+        else titleText = `近${days}天页面浏览量`;
+
+        const option = {
+            title: {
+                text: titleText
+            },
+            tooltip: {
+                trigger: 'axis'
+            },
+            xAxis: {
+                type: 'category',
+                data: data.map(d => d.date)
+            },
+            yAxis: {
+                type: 'value'
+            },
+            series: [{
+                name: '浏览量',
+                type: 'line',
+                data: data.map(d => d.views),
+                smooth: true,
+                areaStyle: {
+                    color: new echarts.graphic.LinearGradient(0, 0, 0, 1, [
+                        { offset: 0, color: 'rgba(102, 126, 234, 0.8)' },
+                        { offset: 1, color: 'rgba(102, 126, 234, 0.1)' }
+                    ])
                 },
-                series: [{
-                    name: '访客数',
-                    type: 'bar',
-                    data: data.map(d => d.visitors),
-                    itemStyle: {
-                        color: '#764ba2'
-                    }
-                }]
-            };
+                itemStyle: {
+                    color: '#667eea'
+                }
+            }]
+        };
 
-            this.charts.visitors.setOption(option);
+        this.charts.pageViews.setOption(option);
+    }
+
+    async loadVisitorsTrend(days = 7) {
+        try {
+            const response = await fetch(this.apiUrl(`/api/stats/visitors/trend?days=${days}`));
+            this.renderVisitorsTrend(await response.json(), days);
         } catch (error) {
             console.error('Failed to load visitors trend:', error);
         }
     }
 
-    async loadHourlyDistribution(days = 1) {
-        try {
-            const response = await fetch(`/api/stats/hourly?days=${days}`);
-            const data = await response.json();
-
-            let titleText = '访问分布';
-            if (days === 1) titleText = '24小时访问分布';
-            else if (days === 2) titleText = '48小时访问分布';
-            else titleText = `近${days}天访问分布`;
+    renderVisitorsTrend(data, days = 7) {
+        let titleText = '访客数量';
+        if (days === 1) titleText = '24小时访客数量';
+        else if (days === 2) titleText = '48小时访客数量';
+        else titleText = `近${days}天访客数量`;
+
+        const option = {
+            title: {
+                text: titleText
+            },
+            tooltip: {
+                trigger: 'axis'
+            },
+            xAxis: {
+                type: 'category',
+                data: data.map(d => d.date)
+            },
+            yAxis: {
+                type: 'value'
+            },
+            series: [{
+                name: '访客数',
+                type: 'bar',
+                data: data.map(d => d.visitors),
+                itemStyle: {
+                    color: '#764ba2'
+                }
+            }]
+        };
 
-            const option = {
-                title: {
-                    text: titleText
-                },
-                tooltip: {
-                    trigger: 'axis'
-                },
-                xAxis: {
-                    type: 'category',
-                    data: data.map(d => d.hour + ':00')
-                },
-                yAxis: {
-                    type: 'value'
-                },
-                series: [{
-                    name: '访问量',
-                    type: 'line',
-                    data: data.map(d => d.views),
-                    smooth: true,
-                    itemStyle: {
-                        color: '#10b981'
-                    },
-                    areaStyle: {
-                        color: new echarts.graphic.LinearGradient(0, 0, 0, 1, [
-                            { offset: 0, color: 'rgba(16, 185, 129, 0.8)' },
-                            { offset: 1, color: 'rgba(16, 185, 129, 0.1)' }
-                        ])
-                    }
-                }]
-            };
+        this.charts.visitors.setOption(option);
+    }
 
-            this.charts.hourly.setOption(option);
+    async loadHourlyDistribution(days = 1) {
+        try {
+            const response = await fetch(this.apiUrl(`/api/stats/hourly?days=${days}`));
+            this.renderHourlyDistribution(await response.json(), days);
         } catch (error) {
             console.error('Failed to load hourly distribution:', error);
         }
     }
 
-    async loadDeviceStats() {
-        try {
-            const response = await fetch('/api/stats/devices');
-            const data = await response.json();
+    renderHourlyDistribution(data, days = 1) {
+        let titleText = '访问分布';
+        if (days === 1) titleText = '24小时访问分布';
+        else if (days === 2) titleText = '48小时访问分布';
+        else titleText = `近${days}天访问分布`;
+
+        const option = {
+            title: {
+                text: titleText
+            },
+            tooltip: {
+                trigger: 'axis'
+            },
+            xAxis: {
+                type: 'category',
+                data: data.map(d => d.hour + ':00')
+            },
+            yAxis: {
+                type: 'value'
+            },
+            series: [{
+                name: '访问量',
+                type: 'line',
+                data: data.map(d => d.views),
+                smooth: true,
+                itemStyle: {
+                    color: '#10b981'
+                },
+                areaStyle: {
+                    color: new echarts.graphic.LinearGradient(0, 0, 0, 1, [
+                        { offset: 0, color: 'rgba(16, 185, 129, 0.8)' },
+                        { offset: 1, color: 'rgba(16, 185, 129, 0.1)' }
+                    ])
+                }
+            }]
+        };
 
-            const osData = Object.entries(data).map(([name, stats]) => ({
-                value: stats.count,
-                name: name
-            }));
+        this.charts.hourly.setOption(option);
+    }
 
-            const option = {
-                title: {
-                    text: '操作系统分布',
-                    left: 'center'
-                },
-                tooltip: {
-                    trigger: 'item',
-                    formatter: '{a} <br/>{b}: {c} ({d}%)'
-                },
-                series: [{
-                    name: '操作系统',
-                    type: 'pie',
-                    radius: ['40%', '70%'],
-                    avoidLabelOverlap: false,
-                    itemStyle: {
-                        borderRadius: 10,
-                        borderColor: '#fff',
-                        borderWidth: 2
-                    },
-                    label: {
-                        show: true,
-                        formatter: '{b}: {d}%'
-                    },
-                    data: osData
-                }]
-            };
-
-            this.charts.devices.setOption(option);
+    async loadDeviceStats() {
+        try {
+            const response = await fetch(this.apiUrl('/api/stats/devices'));
+            this.renderDeviceStats(await response.json());
         } catch (error) {
             console.error('Failed to load device stats:', error);
         }
     }
 
-    async loadBrowserStats() {
-        try {
-            const response = await fetch('/api/stats/browsers');
-            const data = await response.json();
-
-            const browserData = Object.entries(data).map(([name, stats]) => ({
-                value: stats.count,
-                name: name
-            }));
-
-            const option = {
-                title: {
-                    text: '浏览器分布',
-                    left: 'center'
+    renderDeviceStats(data) {
+        const osData = Object.entries(data).map(([name, stats]) => ({
+            value: stats.count,
+            name: name
+        }));
+
+        const option = {
+            title: {
+                text: '操作系统分布',
+                left: 'center'
+            },
+            tooltip: {
+                trigger: 'item',
+                formatter: '{a} <br/>{b}: {c} ({d}%)'
+            },
+            series: [{
+                name: '操作系统',
+                type: 'pie',
+                radius: ['40%', '70%'],
+                avoidLabelOverlap: false,
+                itemStyle: {
+                    borderRadius: 10,
+                    borderColor: '#fff',
+                    borderWidth: 2
                 },
-                tooltip: {
-                    trigger: 'item',
-                    formatter: '{a} <br/>{b}: {c} ({d}%)'
+                label: {
+                    show: true,
+                    formatter: '{b}: {d}%'
                 },
-                series: [{
-                    name: '浏览器',
-                    type: 'pie',
-                    radius: ['40%', '70%'],
-                    avoidLabelOverlap: false,
-                    itemStyle: {
-                        borderRadius: 10,
-                        borderColor: '#fff',
-                        borderWidth: 2
-                    },
-                    label: {
-                        show: true,
-                        formatter: '{b}: {d}%'
-                    },
-                    data: browserData
-                }]
-            };
-
-            this.charts.browsers.setOption(option);
+                data: osData
+            }]
+        };
+
+        this.charts.devices.setOption(option);
+    }
+
+    async loadBrowserStats() {
+        try {
+            const response = await fetch(this.apiUrl('/api/stats/browsers'));
+            this.renderBrowserStats(await response.json());
         } catch (error) {
             console.error('Failed to load browser stats:', error);
         }
     }
 
-    async loadUserTypeStats() {
-        try {
-            const response = await fetch('/api/stats/user-type');
-            const data = await response.json();
-
-            const userTypeData = [
-                {
-                    value: data.new_users,
-                    name: '新用户'
-                },
-                {
-                    value: data.returning_users,
-                    name: '老用户'
-                }
-            ];
-
-            const option = {
-                title: {
-                    text: '新老用户分布',
-                    left: 'center'
+    renderBrowserStats(data) {
+        const browserData = Object.entries(data).map(([name, stats]) => ({
+            value: stats.count,
+            name: name
+        }));
+
+        const option = {
+            title: {
+                text: '浏览器分布',
+                left: 'center'
+            },
+            tooltip: {
+                trigger: 'item',
+                formatter: '{a} <br/>{b}: {c} ({d}%)'
+            },
+            series: [{
+                name: '浏览器',
+                type: 'pie',
+                radius: ['40%', '70%'],
+                avoidLabelOverlap: false,
+                itemStyle: {
+                    borderRadius: 10,
+                    borderColor: '#fff',
+                    borderWidth: 2
                 },
-                tooltip: {
-                    trigger: 'item',
-                    formatter: '{a} <br/>{b}: {c} ({d}%)'
+                label: {
+                    show: true,
+                    formatter: '{b}: {d}%'
                 },
-                series: [{
-                    name: '用户类型',
-                    type: 'pie',
-                    radius: ['40%', '70%'],
-                    avoidLabelOverlap: false,
-                    itemStyle: {
-                        borderRadius: 10,
-                        borderColor: '#fff',
-                        borderWidth: 2
-                    },
-                    label: {
-                        show: true,
-                        formatter: '{b}: {d}%'
-                    },
-                    data: userTypeData,
-                    color: ['#667eea', '#764ba2']
-                }]
-            };
-
-            this.charts.userType.setOption(option);
+                data: browserData
+            }]
+        };
+
+        this.charts.browsers.setOption(option);
+    }
+
+    async loadUserTypeStats() {
+        try {
+            const response = await fetch(this.apiUrl('/api/stats/user-type'));
+            this.renderUserTypeStats(await response.json());
         } catch (error) {
             console.error('Failed to load user type stats:', error);
         }
     }
 
-    async loadUserTypeTrend(days = 7) {
-        try {
-            const response = await fetch(`/api/stats/user-type/trend?days=${days}`);
-            const data = await response.json();
-
-            let titleText = '新老用户趋势';
-            if (days === 1) titleText = '24小时新老用户趋势';
-            else if (days === 2) titleText = '48小时新老用户趋势';
-            else titleText = `近${days}天新老用户趋势`;
-
-            const option = {
-                title: {
-                    text: titleText
-                },
-                tooltip: {
-                    trigger: 'axis'
-                },
-                legend: {
-                    data: ['新用户', '老用户']
-                },
-                xAxis: {
-                    type: 'category',
-                    data: data.map(d => d.date)
+    renderUserTypeStats(data) {
+        const userTypeData = [
+            {
+                value: data.new_users,
+                name: '新用户'
+            },
+            {
+                value: data.returning_users,
+                name: '老用户'
+            }
+        ];
+
+        const option = {
+            title: {
+                text: '新老用户分布',
+                left: 'center'
+            },
+            tooltip: {
+                trigger: 'item',
+                formatter: '{a} <br/>{b}: {c} ({d}%)'
+            },
+            series: [{
+                name: '用户类型',
+                type: 'pie',
+                radius: ['40%', '70%'],
+                avoidLabelOverlap: false,
+                itemStyle: {
+                    borderRadius: 10,
+                    borderColor: '#fff',
+                    borderWidth: 2
                 },
-                yAxis: {
-                    type: 'value'
+                label: {
+                    show: true,
+                    formatter: '{b}: {d}%'
                 },
-                series: [
-                    {
-                        name: '新用户',
-                        type: 'bar',
-                        data: data.map(d => d.new_users),
-                        itemStyle: {
-                            color: '#667eea'
-                        }
-                    },
-                    {
-                        name: '老用户',
-                        type: 'bar',
-                        data: data.map(d => d.returning_users),
-                        itemStyle: {
-                            color: '#764ba2'
-                        }
-                    }
-                ]
-            };
+                data: userTypeData,
+                color: ['#667eea', '#764ba2']
+            }]
+        };
+
+        this.charts.userType.setOption(option);
+    }
 
-            this.charts.userTypeTrend.setOption(option);
+    async loadUserTypeTrend(days = 7) {
+        try {
+            const response = await fetch(this.apiUrl(`/api/stats/user-type/trend?days=${days}`));
+            this.renderUserTypeTrend(await response.json(), days);
         } catch (error) {
             console.error('Failed to load user type trend:', error);
         }
     }
 
-    async loadTopPages() {
-        try {
-            const response = await fetch('/api/stats/top-pages?limit=10');
-            const data = await response.json();
-
-            const option = {
-                title: {
-                    text: '热门页面 TOP 10'
-                },
-                tooltip: {
-                    trigger: 'axis',
-                    axisPointer: {
-                        type: 'shadow'
+    renderUserTypeTrend(data, days = 7) {
+        let titleText = '新老用户趋势';
+        if (days === 1) titleText = '24小时新老用户趋势';
+        else if (days === 2) titleText = '48小时新老用户趋势';
+        else titleText = `近${days}天新老用户趋势`;
+
+        const option = {
+            title: {
+                text: titleText
+            },
+            tooltip: {
+                trigger: 'axis'
+            },
+            legend: {
+                data: ['新用户', '老用户']
+            },
+            xAxis: {
+                type: 'category',
+                data: data.map(d => d.date)
+            },
+            yAxis: {
+                type: 'value'
+            },
+            series: [
+                {
+                    name: '新用户',
+                    type: 'bar',
+                    data: data.map(d => d.new_users),
+                    itemStyle: {
+                        color: '#667eea'
                     }
                 },
-                grid: {
-                    left: '3%',
-                    right: '4%',
-                    bottom: '3%',
-                    containLabel: true
-                },
-                xAxis: {
-                    type: 'value'
-                },
-                yAxis: {
-                    type: 'category',
-                    data: data.map(d => d.url).reverse()
-                },
-                series: [{
-                    name: '浏览量',
+                {
+                    name: '老用户',
                     type: 'bar',
-                    data: data.map(d => d.views).reverse(),
+                    data: data.map(d => d.returning_users),
                     itemStyle: {
-                        color: new echarts.graphic.LinearGradient(0, 0, 1, 0, [
-                            { offset: 0, color: '#667eea' },
-                            { offset: 1, color: '#764ba2' }
-                        ])
+                        color: '#764ba2'
                     }
-                }]
-            };
+                }
+            ]
+        };
 
-            this.charts.topPages.setOption(option);
+        this.charts.userTypeTrend.setOption(option);
+    }
+
+    async loadTopPages() {
+        try {
+            const response = await fetch(this.apiUrl('/api/stats/top-pages?limit=10'));
+            this.renderTopPages(await response.json());
         } catch (error) {
             console.error('Failed to load top pages:', error);
         }
     }
 
+    renderTopPages(data) {
+        const option = {
+            title: {
+                text: '热门页面 TOP 10'
+            },
+            tooltip: {
+                trigger: 'axis',
+                axisPointer: {
+                    type: 'shadow'
+                }
+            },
+            grid: {
+                left: '3%',
+                right: '4%',
+                bottom: '3%',
+                containLabel: true
+            },
+            xAxis: {
+                type: 'value'
+            },
+            yAxis: {
+                type: 'category',
+                data: data.map(d => d.url).reverse()
+            },
+            series: [{
+                name: '浏览量',
+                type: 'bar',
+                data: data.map(d => d.views).reverse(),
+                itemStyle: {
+                    color: new echarts.graphic.LinearGradient(0, 0, 1, 0, [
+                        { offset: 0, color: '#667eea' },
+                        { offset: 1, color: '#764ba2' }
+                    ])
+                }
+            }]
+        };
+
+        this.charts.topPages.setOption(option);
+    }
+
     async loadReferrers() {
         try {
-            const response = await fetch('/api/stats/referrers?limit=10');
-            const data = await response.json();
-
-            const option = {
-                title: {
-                    text: '流量来源'
-                },
-                tooltip: {
-                    trigger: 'item',
-                    formatter: '{a} <br/>{b}: {c} ({d}%)'
-                },
-                series: [{
-                    name: '来源',
-                    type: 'pie',
-                    radius: '70%',
-                    data: data.map(d => ({
-                        value: d.views,
-                        name: d.referrer
-                    }))
-                }]
-            };
-
-            this.charts.referrers.setOption(option);
+            const response = await fetch(this.apiUrl('/api/stats/referrers?limit=10'));
+            this.renderReferrers(await response.json());
         } catch (error) {
             console.error('Failed to load referrers:', error);
         }
     }
 
+    renderReferrers(data) {
+        const option = {
+            title: {
+                text: '流量来源'
+            },
+            tooltip: {
+                trigger: 'item',
+                formatter: '{a} <br/>{b}: {c} ({d}%)'
+            },
+            series: [{
+                name: '来源',
+                type: 'pie',
+                radius: '70%',
+                data: data.map(d => ({
+                    value: d.views,
+                    name: d.referrer
+                }))
+            }]
+        };
+
+        this.charts.referrers.setOption(option);
+    }
+
     connectWebSocket() {
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const wsUrl = `${protocol}//${window.location.host}/api/ws/realtime`;
+        const wsUrl = `${protocol}//${window.location.host}${this.apiUrl('/api/ws/realtime')}`;
 
         this.ws = new WebSocket(wsUrl);
 
@@ -529,26 +576,24 @@ class Dashboard {
         }, 30000);
 
         setInterval(() => {
-            this.loadTopPages();
-            this.loadDeviceStats();
-            this.loadBrowserStats();
-            this.loadUserTypeStats();
-            this.loadPageFlow();
+            this.loadDashboard(['top_pages', 'devices', 'browsers', 'user_type', 'page_flow']);
         }, 60000);
     }
 
     async loadPageFlow() {
         try {
-            const response = await fetch('/api/stats/page-flow?days=7');
-            const data = await response.json();
-
-            if (data.nodes && data.links) {
-                this.charts.sankey.setData(data);
-            }
+            const response = await fetch(this.apiUrl('/api/stats/page-flow?days=7'));
+            this.renderPageFlow(await response.json());
         } catch (error) {
             console.error('Failed to load page flow:', error);
         }
     }
+
+    renderPageFlow(data) {
+        if (data.nodes && data.links) {
+            this.charts.sankey.setData(data);
+        }
+    }
 }
 
 document.addEventListener('DOMContentLoaded', () => {
@@ -1,8 +1,11 @@
+from fastapi import Response
+from config.settings import settings
 from backend.api.sankey import get_page_flow
 import asyncio
 
 async def test():
-    result = await get_page_flow(days=7)
+    # 直接调用路由函数时 FastAPI 不会注入参数，Response 和 site_id 都要显式传入
+    result = await get_page_flow(Response(), days=7, site_id=settings.DEFAULT_SITE_ID)
     print("返回的数据:")
     print(f"  entry_pages: {result['entry_pages']}")
     print(f"\n  节点数量: {len(result['nodes'])}")
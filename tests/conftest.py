@@ -0,0 +1,21 @@
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# 配置在导入时读取环境变量，必须在导入 backend 之前指向临时目录，测试不碰 data/ 下的库
+TMP_DIR = Path(tempfile.mkdtemp(prefix="raymond-tests-"))
+os.environ["DATABASE_URL"] = f"sqlite:///{TMP_DIR / 'test.db'}"
+os.environ["SPOOL_DIR"] = str(TMP_DIR / "spool")
+os.environ["SHARD_COUNT"] = "1"
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    from backend.models import init_db
+    init_db()
+    yield
+    shutil.rmtree(TMP_DIR, ignore_errors=True)
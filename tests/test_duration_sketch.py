@@ -0,0 +1,46 @@
+import math
+import random
+from datetime import datetime
+
+import pytest
+
+from backend.services.duration_service import DDSketch, DurationService, KIND_SESSION
+
+ACCURACY = 0.01
+
+@pytest.mark.parametrize("q", [0.0, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99, 1.0])
+def test_quantile_relative_error(q):
+    rng = random.Random(7)
+    values = [rng.lognormvariate(3, 1.5) for _ in range(20000)]
+    sketch = DDSketch(ACCURACY)
+    for value in values:
+        sketch.add(value)
+
+    exact = sorted(values)[math.floor(q * (len(values) - 1))]
+    assert abs(sketch.quantile(q) - exact) <= ACCURACY * exact
+
+def test_serialize_round_trip():
+    sketch = DDSketch(ACCURACY)
+    for value in (0.5, 3, 3, 120, 7200):
+        sketch.add(value)
+    sketch.add(3, -1)
+    restored = DDSketch.deserialize(sketch.serialize(), ACCURACY)
+    assert restored.counts == sketch.counts
+
+def test_rereported_session_is_replaced_exactly():
+    """时长像素对同一会话多次上报：旧值精确减去，结果与只记录最终时长的草图一致"""
+    service = DurationService(ACCURACY)
+    start = datetime(2024, 3, 1, 8, 30)
+    reports = {"a": [5.0, 42.0, 61.5], "b": [12.0], "c": [0.8, 900.0]}
+    for durations in reports.values():
+        old = None
+        for duration in durations:
+            service.record_session("site", start, old, duration)
+            old = duration
+
+    (delta,) = [sketch for (_, kind, _, _), sketch in service._pending.items() if kind == KIND_SESSION]
+    expected = DDSketch(ACCURACY)
+    for durations in reports.values():
+        expected.add(durations[-1])
+    assert delta.compact().counts == expected.counts
+    assert delta.count == len(reports)
@@ -0,0 +1,113 @@
+import sys
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from backend.models import SessionLocal, Session as SessionModel, User
+from backend.services.identity_cache import IdentityCache
+from backend.services.tracking_service import tracking_service
+
+# backend.services 导出的同名单例会遮住模块，替换模块里的全局变量要从 sys.modules 取模块
+tracking = sys.modules["backend.services.tracking_service"]
+identity = sys.modules["backend.services.identity_cache"]
+
+UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+START = datetime(2024, 3, 1, 9, 0).timestamp()
+
+# (类型, 用户, 会话)：同一用户多个会话、跨批次的回访、匿名会话、只有事件的新用户、会话时长
+HITS = [
+    ("pageview", "u1", "s1"), ("pageview", "u2", "s2"), ("pageview", "u1", "s1"),
+    ("event", "u1", "s1"), ("duration", "u1", "s1"), ("pageview", None, "s5"),
+    ("pageview", "u1", "s3"), ("event", "u4", "s6"), ("pageview", "u2", "s2"),
+    ("pageview", "u3", "s4"), ("pageview", None, "s5"), ("duration", "u2", "s2"),
+    ("pageview", "u4", "s6"), ("pageview", "u1", "s3"), ("pageview", "u3", "s4"),
+]
+
+def _records(site_id: str):
+    records = []
+    for i, (hit_type, user_id, session_id) in enumerate(HITS):
+        record = {
+            "type": hit_type, "site_id": site_id, "user_id": user_id, "session_id": session_id,
+            "page_url": f"https://example.com/{i % 4}", "user_agent": UA, "ip_address": "10.0.0.1",
+            "received_at": START + i * 60,
+        }
+        if hit_type == "event":
+            record.update(event_type="click", event_name="buy")
+        elif hit_type == "duration":
+            record["duration"] = 30.0 + i
+        records.append(record)
+    return records
+
+def _rows(site_id: str):
+    db = SessionLocal()
+    try:
+        users = db.query(User.user_id, User.first_visit, User.last_visit, User.visit_count, User.ip_address,
+                         User.user_agent).filter(User.site_id == site_id).order_by(User.user_id).all()
+        sessions = db.query(SessionModel.session_id, SessionModel.user_id, SessionModel.start_time,
+                            SessionModel.end_time, SessionModel.page_views, SessionModel.duration,
+                            SessionModel.ua_id, SessionModel.referrer_id).filter(
+            SessionModel.site_id == site_id).order_by(SessionModel.session_id).all()
+        return [tuple(row) for row in users], [tuple(row) for row in sessions]
+    finally:
+        db.close()
+
+def _write_direct(record: dict):
+    """逐条写入并立即写回计数，相当于每次命中都 SELECT + UPDATE 的旧写法"""
+    if record["type"] == "pageview":
+        tracking_service.track_page_view(record)
+    elif record["type"] == "event":
+        tracking_service.track_event(record)
+    else:
+        tracking_service.ingest_batch([record])
+
+def test_write_back_matches_direct_writes(monkeypatch):
+    direct = IdentityCache(user_cache_size=0, session_cache_size=0)
+    monkeypatch.setattr(tracking, "identity_cache", direct)
+    for record in _records("identity-direct"):
+        _write_direct(record)
+        direct.flush()
+
+    cached = IdentityCache()
+    cached.warm()
+    monkeypatch.setattr(tracking, "identity_cache", cached)
+    records = _records("identity-cached")
+    # 分批写入，中途写回一次：写回后的命中要在已写回的计数上继续累加
+    for i in range(0, len(records), 4):
+        tracking_service.ingest_batch(records[i:i + 4])
+        if i == 4:
+            assert cached.flush() > 0
+    cached.flush()
+
+    expected_users, expected_sessions = _rows("identity-direct")
+    users, sessions = _rows("identity-cached")
+    assert users == expected_users
+    assert sessions == expected_sessions
+
+    visits = {row[0]: row[3] for row in users}
+    assert visits == {None: 2, "u1": 4, "u2": 2, "u3": 2, "u4": 2}
+    views = {row[0]: row[4] for row in sessions}
+    assert views == {"s1": 2, "s2": 2, "s3": 2, "s4": 2, "s5": 2, "s6": 1}
+
+@pytest.mark.parametrize("size", [0, 2])
+def test_write_back_survives_flush_failure(monkeypatch, tmp_path, size):
+    """写回失败时计数放回待写，下一次写回不丢不重"""
+    cache = IdentityCache(user_cache_size=size, session_cache_size=size)
+    monkeypatch.setattr(tracking, "identity_cache", cache)
+    site_id = f"identity-retry-{size}"
+    for record in _records(site_id)[:4]:
+        tracking_service.ingest_batch([record])
+
+    # 写回时数据库打不开
+    unavailable = sessionmaker(bind=create_engine(f"sqlite:///{tmp_path / 'missing' / 'db.sqlite'}"))
+    with monkeypatch.context() as patch:
+        patch.setattr(identity, "get_db", lambda: iter([unavailable()]))
+        with pytest.raises(OperationalError):
+            cache.flush()
+    cache.flush()
+
+    users, sessions = _rows(site_id)
+    assert {row[0]: row[3] for row in users} == {"u1": 2, "u2": 1}
+    assert {row[0]: row[4] for row in sessions} == {"s1": 2, "s2": 1}
@@ -0,0 +1,32 @@
+from datetime import datetime, timedelta
+
+from backend.services.retention_service import RetentionService
+
+def _matrix(result):
+    return [(cohort["size"], [cell["users"] for cell in cohort["retention"]]) for cohort in result["cohorts"]]
+
+def test_daily_retention_matrix():
+    today = datetime.now().date()
+    d0, d1 = today - timedelta(days=2), today - timedelta(days=1)
+    service = RetentionService()
+    site = "retention-test"
+
+    # 前天新来 1、2、3，昨天还有 1、2，今天只剩 1；昨天新来 4、5，今天还有 5
+    for user, active in {1: (d0, d1, today), 2: (d0, d1), 3: (d0,)}.items():
+        for day in active:
+            service.record(site, user, d0, day)
+    for user, active in {4: (d1,), 5: (d1, today)}.items():
+        for day in active:
+            service.record(site, user, d1, day)
+    # 其他站点的用户不计入
+    service.record("other-site", 1, d0, today)
+
+    expected = [(3, [3, 2, 1]), (2, [2, 1]), (0, [0])]
+    # 未写回时从待合并集合计算，写回后从已存的位图计算，结果相同
+    assert _matrix(service.get_retention("day", 3, site_id=site)) == expected
+    assert service.flush() > 0
+    assert _matrix(service.get_retention("day", 3, site_id=site)) == expected
+
+    result = service.get_retention("day", 3, site_id=site)
+    assert result["cohorts"][0]["cohort"] == d0.isoformat()
+    assert [cell["rate"] for cell in result["cohorts"][0]["retention"]] == [100.0, 66.67, 33.33]
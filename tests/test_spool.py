@@ -0,0 +1,68 @@
+from backend.services.spool import Spool, SpoolConsumer, encode_record, segment_name
+
+def _hits(start: int, count: int):
+    return [{"type": "pageview", "seq": i} for i in range(start, start + count)]
+
+def _consumer(spool: Spool, seen: list) -> SpoolConsumer:
+    def handler(records):
+        seen.extend(record["seq"] for record in records)
+        return {"written": len(records)}
+    return SpoolConsumer(spool, handler, batch_size=100)
+
+def test_truncated_tail_is_cut_on_open(tmp_path):
+    spool = Spool(tmp_path, fsync="never")
+    spool.open()
+    for record in _hits(0, 5):
+        spool.append(record)
+    spool.close()
+
+    # 崩溃时最后一条记录只写了一半
+    path = tmp_path / segment_name(1)
+    intact = path.stat().st_size
+    path.write_bytes(path.read_bytes() + encode_record({"type": "pageview", "seq": 5})[:7])
+
+    spool = Spool(tmp_path, fsync="never")
+    spool.open()
+    assert path.stat().st_size == intact
+    assert spool.pending == 5
+
+    # 之后追加的记录接在截断处，整个分段可以完整读出
+    for record in _hits(5, 2):
+        spool.append(record)
+    seen = []
+    assert _consumer(spool, seen).drain() == 7
+    spool.close()
+    assert seen == list(range(7))
+
+def test_bad_crc_skips_rest_of_segment(tmp_path):
+    spool = Spool(tmp_path, fsync="never")
+    spool.open()
+    for record in _hits(0, 4):
+        spool.append(record)
+    spool.close()
+
+    # 改坏第 3 条记录的一个字节，长度不变但校验和对不上
+    path = tmp_path / segment_name(1)
+    data = bytearray(path.read_bytes())
+    offset = sum(len(encode_record(record)) for record in _hits(0, 2))
+    data[offset + 12] ^= 0xFF
+    path.write_bytes(bytes(data))
+
+    spool = Spool(tmp_path, fsync="never")
+    spool.open()
+    assert spool.pending == 2
+
+    seen = []
+    consumer = _consumer(spool, seen)
+    # 先交出损坏之前的记录，下一次跳过该分段
+    assert consumer.run_once() == 2
+    assert consumer.run_once() == 0
+    assert spool.read_checkpoint().segment == 2
+
+    # 损坏的分段不再追加，新记录写入下一个分段并照常消费
+    for record in _hits(10, 3):
+        spool.append(record)
+    assert consumer.drain() == 3
+    spool.close()
+    assert seen == [0, 1, 10, 11, 12]
+    assert not path.exists()
@@ -6,6 +6,8 @@
     const COOKIE_NAME = 'ra_user_id';
     const SESSION_COOKIE = 'ra_session_id';
     const COOKIE_EXPIRY = 365 * 24 * 60 * 60 * 1000; // 1 year
+    // 通过 /tracker.js?site_id=xxx 加载时服务端会替换为对应站点
+    const SITE_ID = window.RA_TRACKER_ID || 'default';
 
     function generateUUID() {
         return 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'.replace(/[xy]/g, function(c) {
@@ -50,7 +52,7 @@
     function sendData(endpoint, data) {
         try {
             const img = new Image(1, 1);
-            const params = new URLSearchParams(data).toString();
+            const params = new URLSearchParams({ site_id: SITE_ID, ...data }).toString();
             img.src = `http://localhost:5500/api/pixel?${params}`;
             img.onload = function() {
                 console.log('[RA] Tracking data sent successfully');
@@ -122,6 +124,8 @@
         updateSessionDuration: function(duration) {
             const data = {
                 type: 'duration',
+                page_url: window.location.href,
+                user_id: this.userID,
                 session_id: this.sessionID,
                 duration: duration
             };